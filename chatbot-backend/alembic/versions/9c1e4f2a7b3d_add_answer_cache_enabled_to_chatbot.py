@@ -0,0 +1,26 @@
+"""add answer_cache_enabled field to chatbot
+
+Revision ID: 9c1e4f2a7b3d
+Revises: 64314f8aacab
+Create Date: 2026-10-17 09:12:41.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c1e4f2a7b3d'
+down_revision: Union[str, None] = '64314f8aacab'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chatbot', sa.Column('answer_cache_enabled', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade() -> None:
+    op.drop_column('chatbot', 'answer_cache_enabled')
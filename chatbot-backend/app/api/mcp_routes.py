@@ -2,6 +2,8 @@
 from flask import Blueprint, request, jsonify, current_app, g
 from functools import wraps
 from app.models import Chatbot
+from app.services.api_key_cache import verify_chatbot_api_key
+from app.services.chatbot_config_cache import get_chatbot_config
 from app.services.rag_service import RagService # For type hinting and instantiation
 from app.mcp.mcp_service import MCPService
 from app import limiter # Assuming limiter is initialized in app/__init__.py
@@ -44,14 +46,12 @@ def require_mcp_api_key(f):
         except ValueError:
             return jsonify({"error": {"code": "INVALID_CHATBOT_ID", "message": "Invalid chatbot_id format."}}), 400
 
-        chatbot = Chatbot.query.filter_by(id=chatbot_id).first()
+        chatbot = get_chatbot_config(chatbot_id)
         if not chatbot:
             return jsonify({"error": {"code": "CHATBOT_NOT_FOUND", "message": "Chatbot not found."}}), 404
 
-        # Assuming api_key in Chatbot model is hashed.
-        # The original require_api_key uses check_password_hash. We need to import it.
-        from werkzeug.security import check_password_hash
-        if not chatbot.api_key or not check_password_hash(chatbot.api_key, api_key):
+        # Same cached verification as require_api_key (see api_key_cache.py)
+        if not chatbot.api_key or not verify_chatbot_api_key(chatbot, api_key):
             current_app.logger.warning(f"MCP: Invalid API key for chatbot {chatbot_id}.")
             return jsonify({"error": {"code": "AUTH_INVALID_KEY", "message": "Invalid or unauthorized API key."}}), 403
         
@@ -33,9 +33,11 @@ from celery.result import AsyncResult
 from app import limiter # Import the limiter instance from __init__
 from config import Config # Import Config to access constants
 import redis # Import redis for pubsub
-from functools import wraps # For API key decorator
-from werkzeug.security import generate_password_hash, check_password_hash # For API key hashing
+from functools import partial, wraps # wraps for the API key decorator
 from app.services.summarization_service import SummarizationService # Import the new service
+from app.services.api_key_cache import hash_api_key, verify_chatbot_api_key, invalidate_api_key_cache
+from app.services.chat_history import load_session_history, session_history_fingerprint, trim_client_history
+from app.services.chatbot_config_cache import get_chatbot_config
 
 
 # Language detection/translation functions removed from language_service
@@ -44,13 +46,13 @@ from app.services.summarization_service import SummarizationService # Import the
 # *** Assuming sse_utils.py exists in the app folder ***
 # We still import push_status_update, but sse_message_queue is no longer used here.
 try:
-    from app.sse_utils import push_status_update, SSE_CHANNEL, redis_client as sse_redis_client # Import channel and client
+    from app.sse_utils import push_status_update, SSE_CHANNEL, get_redis_client as get_sse_redis_client # Import channel and client accessor
 except ImportError:
      print("ERROR: Cannot import from app.sse_utils. SSE will not work.")
      # Define dummies to prevent further crashes
      def push_status_update(chatbot_id, status, client_id): pass
      SSE_CHANNEL = "chatbot-status-updates" # Define fallback channel name
-     sse_redis_client = None # Define fallback client
+     def get_sse_redis_client(): return None # Define fallback client accessor
 # -----------------------------------
 
 # --- API Key Authentication Decorator ---
@@ -83,23 +85,21 @@ def require_api_key(f):
             current_app.logger.warning(f"API access attempt missing API key for chatbot {chatbot_id}.")
             return jsonify({"error": "Missing API key"}), 401
 
-        # Find chatbot by ID first
-        chatbot = Chatbot.query.filter_by(id=chatbot_id).first()
+        # Find chatbot by ID first (cached read-only snapshot; see chatbot_config_cache.py)
+        chatbot = get_chatbot_config(chatbot_id)
         if not chatbot:
             # Log that the chatbot ID itself wasn't found
             current_app.logger.warning(f"API access attempt for non-existent chatbot ID: {chatbot_id}.")
             # Return 404 Not Found if the chatbot ID doesn't exist
             return jsonify({"error": "Chatbot not found"}), 404
 
-        # Now verify the provided API key against the stored hash
-        stored_hash = chatbot.api_key
-        # Use check_password_hash to compare the received plaintext key against the stored hash
-        if not stored_hash or not check_password_hash(stored_hash, api_key):
+        # Now verify the provided API key against the stored hash (cached; see api_key_cache.py)
+        if not chatbot.api_key or not verify_chatbot_api_key(chatbot, api_key):
             current_app.logger.warning(f"API access attempt with invalid key for chatbot {chatbot_id}.")
             return jsonify({"error": "Invalid or unauthorized API key"}), 403 # Forbidden
 
         # Inject chatbot object into request context if needed by the route
-        g.chatbot = chatbot # Store the validated chatbot object in Flask's 'g' context
+        g.chatbot = chatbot # Store the validated chatbot snapshot in Flask's 'g' context (read-only)
 
         return f(*args, **kwargs)
     return decorated_function
@@ -393,7 +393,7 @@ def create_chatbot():
         # Generate plaintext API key
         plaintext_api_key = secrets.token_urlsafe(32)
         # Hash the API key for storage
-        hashed_api_key = generate_password_hash(plaintext_api_key)
+        hashed_api_key = hash_api_key(plaintext_api_key)
 
         new_chatbot = Chatbot( # Replace Chatbot with your actual model
             name=name,
@@ -480,6 +480,7 @@ def chatbot_status_stream():
     current_app.logger.info(f"SSE Client connected: {request.remote_addr}, ClientID: {request_client_id}")
 
     def event_stream():
+        sse_redis_client = get_sse_redis_client()
         if not sse_redis_client:
             current_app.logger.error(f"SSE Stream: Cannot connect for {request_client_id}, Redis client unavailable.")
             # Optionally yield an error message to the client?
@@ -724,10 +725,32 @@ def get_chatbot_details(chatbot_id):
         "voice_activity_detection_enabled": bool(chatbot.vad_enabled), # Convert DB int (0/1) to boolean
         'summarization_enabled': chatbot.summarization_enabled, # Added
         'allowed_scraping_domains': chatbot.allowed_scraping_domains, # Added
-        'advanced_rag_enabled': chatbot.advanced_rag_enabled # Add the new flag
+        'advanced_rag_enabled': chatbot.advanced_rag_enabled, # Add the new flag
+        'answer_cache_enabled': chatbot.answer_cache_enabled
     }
     return jsonify(chatbot_data), 200
 
+# --- Readiness Endpoint ---
+@bp.route('/health/ready', methods=['GET'])
+@limiter.exempt
+def readiness_check():
+    """Reports whether this process has its RAG services loaded (used by load balancer probes)."""
+    from app.services.advanced_rag_service import is_advanced_rag_ready # Local import
+    rag_instance = current_app.extensions.get('rag_service') if hasattr(current_app, 'extensions') else None
+    from app.services.chunk_cache import get_chunk_cache # Local import
+    from app.services.usage_logger import get_usage_log_writer # Local import
+    from app.services.image_analysis_cache import get_image_analysis_cache # Local import
+    chunk_cache = get_chunk_cache()
+    image_cache = get_image_analysis_cache()
+    status = {
+        "rag_service_ready": bool(rag_instance and rag_instance.clients_initialized),
+        "advanced_rag_ready": is_advanced_rag_ready(),
+        "chunk_cache": chunk_cache.get_stats() if chunk_cache else None,
+        "image_analysis_cache": image_cache.get_stats() if image_cache else None,
+        "usage_log": get_usage_log_writer().get_stats(),
+    }
+    return jsonify(status), 200 if status["rag_service_ready"] else 503
+
 # --- Get Widget Config Endpoint ---
 @bp.route('/chatbots/<int:chatbot_id>/widget-config', methods=['GET'])
 @limiter.limit("300 per minute") # Allow more frequent config fetches for widgets
@@ -1348,6 +1371,8 @@ def update_chatbot(chatbot_id): # noqa: C901 - Ignore complexity for now
         # --- Advanced RAG Toggle ---
         chatbot.advanced_rag_enabled = form_checkbox_to_bool('advanced_rag_enabled') # Add handling for the new flag
         current_app.logger.debug(f"UPDATE Chatbot {chatbot_id}: Setting advanced_rag_enabled to: {chatbot.advanced_rag_enabled}")
+        # --- Semantic Answer Cache Toggle ---
+        chatbot.answer_cache_enabled = form_checkbox_to_bool('answer_cache_enabled')
  
         # Set status if sources changed (only possible if source_update_requested was true)
         if files_changed or urls_changed:
@@ -1980,12 +2005,13 @@ def regenerate_api_key(chatbot_id):
         # 1. Generate a new secure plaintext API key
         new_plaintext_key = secrets.token_urlsafe(32)
         # 2. Hash the new plaintext key
-        new_hashed_key = generate_password_hash(new_plaintext_key)
+        new_hashed_key = hash_api_key(new_plaintext_key)
 
         # 3. Update the api_key field of the Chatbot instance with the new hashed key
         chatbot.api_key = new_hashed_key
         # 4. Commit the change to the database
         db.session.commit()
+        invalidate_api_key_cache(chatbot_id) # The old key stops working immediately in this worker
 
         current_app.logger.info(f"Successfully regenerated and stored new hashed API key for chatbot {chatbot_id}")
 
@@ -1998,6 +2024,61 @@ def regenerate_api_key(chatbot_id):
         return jsonify({"error": "Internal server error during key regeneration"}), 500
 
 
+# --- Chat History Helpers (shared by the query endpoints) ---
+def _load_chat_history(chatbot, session_id, limit=10):
+    """
+    Returns the session's history as [{'role', 'content'}] (empty if history is disabled): recent turns
+    verbatim plus a cached summary of older ones (see chat_history), or the last `limit` messages.
+    """
+    history_start_time = time.time()
+    chat_history = []
+    if chatbot.save_history_enabled and session_id:
+        try:
+            chat_history = load_session_history(chatbot.id, session_id, fallback_limit=limit)
+            current_app.logger.debug(f"Retrieved {len(chat_history)} messages for session {session_id}")
+
+        except Exception as history_err:
+            current_app.logger.error(f"Error retrieving chat history for session {session_id}: {history_err}", exc_info=True)
+            # Proceed without history, but log the error
+    current_app.logger.info(f"PERF: Chat History Retrieval for chatbot {chatbot.id} took {time.time() - history_start_time:.4f} seconds.")
+    return chat_history
+
+def _chat_history_fingerprint(chatbot, session_id):
+    """Identity of the history _load_chat_history would return, without loading it ('' when there is none)."""
+    if not (chatbot.save_history_enabled and session_id):
+        return ""
+    return session_history_fingerprint(chatbot.id, session_id)
+
+def _save_chat_exchange(chatbot, session_id, user_query, assistant_text):
+    """Persists the user/assistant message pair if history is enabled. Returns the assistant message id or None."""
+    if not (chatbot.save_history_enabled and session_id):
+        return None
+    try:
+        # Save user message regardless of RAG success/failure
+        user_message = ChatMessage(
+            chatbot_id=chatbot.id,
+            session_id=session_id,
+            role='user',
+            content=user_query # Save original user query
+        )
+        db.session.add(user_message)
+
+        # Save assistant response (which might be an error message)
+        assistant_message = ChatMessage(
+            chatbot_id=chatbot.id,
+            session_id=session_id,
+            role='assistant',
+            content=assistant_text # Save the final text sent to user
+        )
+        db.session.add(assistant_message)
+        db.session.commit()
+        current_app.logger.debug(f"Saved user and assistant messages for session {session_id}")
+        return assistant_message.id # Get ID after successful commit
+    except Exception as save_hist_err:
+         db.session.rollback()
+         current_app.logger.error(f"Error saving chat history for session {session_id}: {save_hist_err}", exc_info=True)
+         return None
+
 # --- Query Chatbot Endpoint ---
 @bp.route('/chatbots/<int:chatbot_id>/query', methods=['POST'])
 @limiter.limit("100 per minute") # Limit query rate per chatbot
@@ -2043,30 +2124,19 @@ def query_chatbot(chatbot_id):
     else:
         current_rag_mode_is_advanced = chatbot.advanced_rag_enabled
         current_app.logger.info(f"RAG mode for query using chatbot setting: {'Advanced' if current_rag_mode_is_advanced else 'Standard'}")
+    # Only an explicit override is forced; otherwise the pipeline applies the chatbot setting (and adaptive routing)
+    force_advanced_rag = use_advanced_rag_override if isinstance(use_advanced_rag_override, bool) else None
 
     # --- Language Detection Disabled ---
     # Language detection and translation logic removed as requested.
     # Passing original user_query directly to RAG.
     # ---------------------------------
 
-    # --- Retrieve Chat History (if enabled and session_id provided) ---
-    history_start_time = time.time()
-    chat_history = []
-    if chatbot.save_history_enabled and session_id:
-        try:
-            # Fetch recent messages for this session, ordered by timestamp
-            recent_messages = ChatMessage.query.filter_by(
-                chatbot_id=chatbot_id,
-                session_id=session_id
-            ).order_by(ChatMessage.timestamp.asc()).limit(10).all() # Limit history length
-
-            chat_history = [{"role": msg.role, "content": msg.content} for msg in recent_messages]
-            current_app.logger.debug(f"Retrieved {len(chat_history)} messages for session {session_id}")
-
-        except Exception as history_err:
-            current_app.logger.error(f"Error retrieving chat history for session {session_id}: {history_err}", exc_info=True)
-            # Proceed without history, but log the error
-    current_app.logger.info(f"PERF: Chat History Retrieval for chatbot {chatbot_id} took {time.time() - history_start_time:.4f} seconds.")
+    # --- Chat History (if enabled and session_id provided) ---
+    # Loaded by the pipeline alongside embedding/retrieval; a session started by this request has none.
+    # The fingerprint lets identical concurrent requests coalesce without loading the history first.
+    history_loader = partial(_load_chat_history, chatbot, session_id) if data.get('session_id') else None
+    history_fingerprint = partial(_chat_history_fingerprint, chatbot, session_id) if history_loader else None
 
     # --- Execute RAG Pipeline ---
     try:
@@ -2080,9 +2150,11 @@ def query_chatbot(chatbot_id):
         response_data = rag_service.execute_pipeline(
             chatbot_id=str(chatbot_id), 
             query=user_query, 
-            chat_history=chat_history, 
+            chat_history=None if history_loader else [],
+            history_loader=history_loader,
+            history_fingerprint=history_fingerprint,
             client_id=chatbot.client_id, 
-            force_advanced_rag=current_rag_mode_is_advanced
+            force_advanced_rag=force_advanced_rag
         )
         current_app.logger.info(f"PERF: RAG Pipeline execution for chatbot {chatbot_id} took {time.time() - rag_call_start_time:.4f} seconds.")
         # Log a summary of response_data instead of the full content
@@ -2134,33 +2206,7 @@ def query_chatbot(chatbot_id):
             http_status_code = 500
 
         # --- Save Interaction to History (if enabled) ---
-        assistant_message_id = None # Initialize before try block
-        if chatbot.save_history_enabled and session_id:
-            try:
-                # Save user message regardless of RAG success/failure
-                user_message = ChatMessage(
-                    chatbot_id=chatbot_id,
-                    session_id=session_id,
-                    role='user',
-                    content=user_query # Save original user query
-                )
-                db.session.add(user_message)
-
-                # Save assistant response (which might be an error message)
-                assistant_message = ChatMessage(
-                    chatbot_id=chatbot_id,
-                    session_id=session_id,
-                    role='assistant',
-                    content=final_response_text # Save the final text sent to user
-                )
-                db.session.add(assistant_message)
-                db.session.commit()
-                assistant_message_id = assistant_message.id # Get ID after successful commit
-                current_app.logger.debug(f"Saved user and assistant messages for session {session_id}")
-            except Exception as save_hist_err:
-                 db.session.rollback()
-                 current_app.logger.error(f"Error saving chat history for session {session_id}: {save_hist_err}", exc_info=True)
-                 # assistant_message_id remains None
+        assistant_message_id = _save_chat_exchange(chatbot, session_id, user_query, final_response_text)
 
         # --- Return Response ---
         # Explicitly construct the final response dictionary to ensure all keys are present.
@@ -2190,6 +2236,105 @@ def query_chatbot(chatbot_id):
         return jsonify({"error": "An unexpected error occurred processing your request.", "detail": error_detail, "session_id": session_id, "sources": []}), 500
 
 
+# --- Streaming Query Endpoint (SSE) ---
+@bp.route('/chatbots/<int:chatbot_id>/query/stream', methods=['POST'])
+@limiter.limit("100 per minute") # Same budget as the non-streaming query endpoint
+@require_api_key
+def query_chatbot_stream(chatbot_id):
+    """
+    Streaming variant of query_chatbot. Responds with Server-Sent Events:
+      event: retrieval  -> {"sources": [...], "session_id": ...} once context is ready
+      event: delta      -> {"text": "..."} for each generated fragment
+      event: done       -> {"message_id", "session_id", "finish_reason", "token_counts", "metadata", "error", "warnings"}
+    Chat messages are persisted after generation finishes; usage is logged by the pipeline.
+    """
+    chatbot = g.chatbot
+    data = request.get_json(silent=True)
+    if not data or 'query' not in data:
+        return jsonify({"error": "Missing 'query' in request body"}), 400
+
+    user_query = data['query']
+    session_id = data.get('session_id') or str(uuid.uuid4())
+    use_advanced_rag_override = data.get('use_advanced_rag')
+    force_advanced_rag = use_advanced_rag_override if isinstance(use_advanced_rag_override, bool) else None
+
+    try:
+        rag_service = get_rag_service()
+    except Exception as e:
+        current_app.logger.error(f"QueryChatbotStream: RAG service unavailable for chatbot {chatbot_id}: {e}", exc_info=True)
+        return jsonify({"error": "Assistant is temporarily unavailable.", "session_id": session_id}), 503
+
+    # Loaded by the pipeline alongside embedding/retrieval; a session started by this request has none
+    history_loader = partial(_load_chat_history, chatbot, session_id) if data.get('session_id') else None
+
+    def sse_event(event_name, payload):
+        return f"event: {event_name}\ndata: {json.dumps(payload)}\n\n"
+
+    def event_stream():
+        stream_start_time = time.time()
+        first_delta_sent = False
+        response_data = None
+        streamed_parts = []
+        pipeline_events = rag_service.stream_pipeline(
+            query=user_query,
+            chatbot_id=str(chatbot_id),
+            client_id=chatbot.client_id,
+            chat_history=None if history_loader else [],
+            history_loader=history_loader,
+            force_advanced_rag=force_advanced_rag
+        )
+        try:
+            for event_type, payload in pipeline_events:
+                if event_type == 'retrieval':
+                    current_app.logger.info(f"PERF: QueryChatbotStream retrieval ready for chatbot {chatbot_id} after {time.time() - stream_start_time:.4f} seconds.")
+                    yield sse_event('retrieval', {"sources": payload.get("sources", []), "session_id": session_id})
+                elif event_type == 'delta':
+                    if not first_delta_sent:
+                        current_app.logger.info(f"PERF: QueryChatbotStream first token for chatbot {chatbot_id} after {time.time() - stream_start_time:.4f} seconds.")
+                        first_delta_sent = True
+                    streamed_parts.append(payload)
+                    yield sse_event('delta', {"text": payload})
+                elif event_type == 'result':
+                    response_data = payload
+        except GeneratorExit:
+            current_app.logger.info(f"QueryChatbotStream: Client disconnected during stream for chatbot {chatbot_id}, session {session_id}.")
+            if streamed_parts:
+                # Keep the part of the answer the user already saw, so the session history matches the conversation
+                _save_chat_exchange(chatbot, session_id, user_query, "".join(streamed_parts))
+            pipeline_events.close() # Stops generation and logs the request's usage
+            raise
+        except Exception as e:
+            current_app.logger.error(f"QueryChatbotStream: Unexpected error for chatbot {chatbot_id}: {e}", exc_info=True)
+            response_data = {"error": "An unexpected error occurred processing your request."}
+
+        response_data = response_data if isinstance(response_data, dict) else {"error": "Received invalid response structure from assistant."}
+        error_message = response_data.get("error")
+        if error_message:
+            final_response_text = f"Error: {error_message}"
+        else:
+            final_response_text = response_data.get("answer") or "".join(streamed_parts)
+        assistant_message_id = _save_chat_exchange(chatbot, session_id, user_query, final_response_text)
+
+        metadata = response_data.get("metadata") or {}
+        yield sse_event('done', {
+            "message_id": assistant_message_id,
+            "session_id": session_id,
+            "answer": final_response_text,
+            "finish_reason": metadata.get("finish_reason"),
+            "token_counts": metadata.get("token_counts", {}),
+            "metadata": metadata,
+            "error": error_message,
+            "warnings": response_data.get("warnings")
+        })
+        current_app.logger.info(f"PERF: QueryChatbotStream for chatbot {chatbot_id} overall took {time.time() - stream_start_time:.4f} seconds.")
+
+    headers = {
+        'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no', # Disable proxy buffering so deltas reach the widget immediately
+    }
+    return Response(stream_with_context(event_stream()), headers=headers)
+
+
 # --- Delete Chat Session History Endpoint ---
 @bp.route('/chat-sessions/<string:session_id>/history', methods=['DELETE'])
 @limiter.limit("20 per hour")
@@ -2332,6 +2477,7 @@ def query_chatbot_with_image(chatbot_id):
     except (json.JSONDecodeError, ValueError) as e:
         current_app.logger.warning(f"Invalid chat history format received for chatbot {chatbot_id}: {e}. History: '{history_str[:100]}...'")
         chat_history = [] # Default to empty history on error
+    chat_history = trim_client_history(chat_history)
 
     # --- 5. Prepare for RAG Service ---
     # Ensure session_id exists if needed for message saving
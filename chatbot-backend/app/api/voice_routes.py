@@ -1,11 +1,11 @@
 # chatbot-backend/app/api/voice_routes.py
 import base64
 from flask import Blueprint, request, jsonify, make_response, current_app, g
-from app.services.voice_service import synthesize_speech_google, transcribe_audio_google
 from app.utils import remove_markdown
 # Language detection removed from language_service
 from app.models import Chatbot, ChatMessage # Import Chatbot and ChatMessage
 from app.api.routes import require_api_key, get_rag_service # Import necessary items from main routes
+from app.services.chat_history import load_session_history
 from app import db # Import db for saving messages
 import uuid # For generating unique IDs for audio files
 import os   # For potential path operations
@@ -52,6 +52,7 @@ def text_to_speech():
     if not text:
         return jsonify({"error": "Missing 'text' field in request body"}), 400
     try:
+        from app.services.voice_service import synthesize_speech_google # Loads the Cloud TTS client on first use
         # Language detection removed. Use provided language or default.
         current_app.logger.info(f"Using language '{language}' for TTS input text.")
 
@@ -101,6 +102,7 @@ def voice_interaction(chatbot_id):
          return jsonify({"error": f"Unsupported language: {language}. Supported: {', '.join(supported_langs)}"}), 400
 
     try:
+        from app.services.voice_service import synthesize_speech_google, transcribe_audio_google # Loads the Cloud STT/TTS clients on first use
         audio_content = audio_file.read()
 
         # 1. Perform STT (using the language specified in the request)
@@ -126,15 +128,7 @@ def voice_interaction(chatbot_id):
         history_for_rag = [] 
         if chatbot.save_history_enabled:
             try:
-                recent_messages_objects = ChatMessage.query.filter_by(
-                    chatbot_id=chatbot_id, session_id=session_id
-                ).order_by(ChatMessage.timestamp.desc()).limit(10).all()
-                recent_messages_objects.reverse() 
-
-                history_for_rag = [
-                    {'role': msg.role, 'content': msg.content}
-                    for msg in recent_messages_objects
-                ]
+                history_for_rag = load_session_history(chatbot_id, session_id, fallback_limit=10)
                 current_app.logger.debug(f"Retrieved and formatted {len(history_for_rag)} messages for history (chatbot {chatbot_id}, session {session_id})")
             except Exception as hist_e:
                  current_app.logger.error(f"Error retrieving/formatting chat history for chatbot {chatbot_id}, session {session_id}: {hist_e}")
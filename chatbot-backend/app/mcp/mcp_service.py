@@ -6,6 +6,7 @@ from flask import current_app, g
 from app.services.rag_service import RagService # Assuming RagService can be imported
 from app.mcp.schema_formatter import SchemaFormatter
 from app.models import Chatbot # To fetch client_id
+from app.services.chat_history import trim_client_history
 
 class MCPService:
     """
@@ -79,7 +80,7 @@ class MCPService:
             history = []
             if context and 'history' in context:
                 max_history = self.mcp_config.get('MAX_HISTORY_LENGTH', 10)
-                history = context['history'][-max_history:]
+                history = trim_client_history(context['history'][-max_history:])
             
             rag_response_data = self.rag_service.execute_pipeline(
                 query=query,
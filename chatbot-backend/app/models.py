@@ -159,6 +159,8 @@ class Chatbot(db.Model):
 
     # New field for Advanced RAG
     advanced_rag_enabled = db.Column(db.Boolean, default=False, nullable=False)
+    # Opt-in semantic answer cache (reuses answers to near-duplicate questions)
+    answer_cache_enabled = db.Column(db.Boolean, default=False, nullable=False)
  
     def __repr__(self):
         return f'<Chatbot {self.name} id={self.id} client_id={self.client_id}>'
@@ -186,6 +188,10 @@ class Chatbot(db.Model):
 
         db.session.commit()
 
+    def bump_index_version(self):
+        """Marks the indexed content as changed (invalidates cached answers). Caller commits."""
+        self.index_version = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+
     def start_index_operation(self, operation_id):
         """Start tracking a new index operation."""
         self.index_operation_id = operation_id
@@ -201,6 +207,7 @@ class Chatbot(db.Model):
         if success:
             self.status = 'Ready'
             self.last_index_update = datetime.utcnow()
+            self.bump_index_version()
             if total_chunks is not None:
                 self.total_chunks_indexed = total_chunks
         else:
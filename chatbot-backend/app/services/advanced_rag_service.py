@@ -3,6 +3,9 @@ import logging
 import re
 import time # Ensure time is imported
 import json
+import random
+import threading
+import numpy as np
 from typing import List, Tuple, Any, Dict, TYPE_CHECKING
 from flask import current_app
 from collections import defaultdict # Add this import
@@ -13,37 +16,52 @@ from cachetools import LFUCache, TTLCache # Added for BM25 caching
 # --- Service Dependencies ---
 if TYPE_CHECKING:
     from .rag_service import RAGService
+    from vertexai.generative_models import GenerativeModel, GenerationConfig
 # Updated import to include VectorIdMapping
 from app.models import Chatbot, db, VectorIdMapping # Ensure db is imported
+from app.services.chatbot_config_cache import get_chatbot_config
+from app.services.chat_history import format_history
+from app.services.concurrency import run_cpu_bound
+from app.services.hybrid_retrieval import SparseBM25, fuse_hybrid_ranks
+from app.services.reranker import load_cross_encoder_scorer, MicroBatchReranker
+from app.services.stage_scheduler import StageScheduler
 from sqlalchemy.orm import Session # Added Session for type hinting if needed
-from rank_bm25 import BM25Okapi # Added for Hybrid Search
-from sentence_transformers import CrossEncoder # Added for re-ranking
+# rank_bm25 and sentence_transformers (torch) are imported on first use: loading them
+# costs seconds and hundreds of MB, and most processes never run an advanced query
 
 # --- LLM Interaction ---
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig, Part
-from google.cloud.aiplatform_v1.types import HarmCategory, SafetySetting
+# vertexai and the aiplatform types are imported on first use as well (see rag_service)
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 # --- Default Safety Settings (used if not found in config) ---
-DEFAULT_QUERY_REPHRASING_SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-}
-
-DEFAULT_RELAXED_JSON_SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-}
+def _default_query_rephrasing_safety_settings() -> dict:
+    from google.cloud.aiplatform_v1.types import HarmCategory, SafetySetting
+    return {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    }
+
+def _default_relaxed_json_safety_settings() -> dict:
+    from google.cloud.aiplatform_v1.types import HarmCategory, SafetySetting
+    return {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    }
 
 bm25_cache = TTLCache(maxsize=100, ttl=3600)
 
+# --- Per-process processor registry ---
+# Loading the CrossEncoder weights is expensive, so processors are built once per
+# process (keyed by the configured model names) and shared by all requests.
+_processor_registry: Dict[tuple, 'AdvancedRagProcessor'] = {}
+_processor_registry_lock = threading.Lock()
+
 class AdvancedRagProcessor:
     def __init__(self):
         logger.info("Initializing AdvancedRagProcessor and loading models...")
@@ -52,8 +70,13 @@ class AdvancedRagProcessor:
         self.final_llm = None
         self.cross_encoder = None
         self.cross_encoder_model_name = None
+        self.reranker = None # MicroBatchReranker sharing inference across concurrent requests (RERANKER_BATCHING_ENABLED)
+        self.ready = False # Set once warm_up() has completed a CrossEncoder inference
+        # CrossEncoder (tokenizer + torch module) is not safe for concurrent predict calls; used when batching is off
+        self._cross_encoder_lock = threading.Lock()
 
         try:
+            from vertexai.generative_models import GenerativeModel
             rephrasing_model_name = current_app.config.get('QUERY_REPHRASING_MODEL_NAME', "gemini-2.5-flash")
             final_response_model_name = current_app.config.get('FINAL_RESPONSE_MODEL_NAME', "gemini-2.5-flash")
 
@@ -62,10 +85,27 @@ class AdvancedRagProcessor:
             logger.info(f"Using Rephrasing LLM: {rephrasing_model_name}")
             logger.info(f"Using Final Response LLM: {final_response_model_name}")
 
-            self.cross_encoder_model_name = current_app.config.get('CROSS_ENCODER_MODEL_NAME', 'cross-encoder/ms-marco-MiniLM-L6-v2')
-            cross_encoder_max_length = current_app.config.get('CROSS_ENCODER_MAX_LENGTH', 1000)
-            self.cross_encoder = CrossEncoder(self.cross_encoder_model_name, max_length=cross_encoder_max_length)
-            logger.info(f"Successfully loaded CrossEncoder model: {self.cross_encoder_model_name} with max_length={cross_encoder_max_length}")
+            app_config = current_app.config
+            self.cross_encoder_model_name = app_config.get('CROSS_ENCODER_MODEL_NAME', 'cross-encoder/ms-marco-MiniLM-L6-v2')
+            cross_encoder_max_length = app_config.get('CROSS_ENCODER_MAX_LENGTH', 1000)
+            # Scorer exposing predict(pairs) -> scores; see reranker.py for the torch/ONNX backends
+            self.cross_encoder = load_cross_encoder_scorer(
+                self.cross_encoder_model_name,
+                cross_encoder_max_length,
+                backend=app_config.get('RERANKER_BACKEND', 'torch'),
+                quantize=app_config.get('RERANKER_QUANTIZE', False),
+                threads=app_config.get('RERANKER_THREADS', 0),
+                cache_dir=app_config.get('RERANKER_ONNX_CACHE_DIR'),
+                batch_size=app_config.get('RERANKER_INFERENCE_BATCH_SIZE', 32),
+            )
+            logger.info(f"Successfully loaded CrossEncoder model: {self.cross_encoder_model_name} with max_length={cross_encoder_max_length} (Backend: {self.cross_encoder.backend}, Quantized: {self.cross_encoder.quantized})")
+            if app_config.get('RERANKER_BATCHING_ENABLED', True):
+                self.reranker = MicroBatchReranker(
+                    self.cross_encoder,
+                    max_batch_pairs=app_config.get('RERANKER_MAX_BATCH_PAIRS', 128),
+                    max_wait_ms=app_config.get('RERANKER_MAX_WAIT_MS', 5.0),
+                    logger_instance=logger,
+                )
 
             logger.info(f"All models initialized in {time.time() - start_time:.2f}s.")
 
@@ -76,6 +116,23 @@ class AdvancedRagProcessor:
             if not self.cross_encoder: logger.error(f"CrossEncoder model '{self.cross_encoder_model_name or 'N/A'}' failed to initialize.")
             raise RuntimeError("Failed to initialize one or more core models for Advanced RAG.") from e
 
+    def warm_up(self) -> bool:
+        """Runs a throwaway CrossEncoder inference so the first real query doesn't pay for lazy init."""
+        if self.ready:
+            return True
+        if self.cross_encoder is None:
+            logger.warning("Cannot warm up AdvancedRagProcessor: CrossEncoder not loaded.")
+            return False
+        start_time = time.time()
+        try:
+            with self._cross_encoder_lock:
+                self.cross_encoder.predict([("warm up query", "warm up passage")])
+            self.ready = True
+            logger.info(f"AdvancedRagProcessor warm-up finished in {time.time() - start_time:.2f}s.")
+        except Exception as e:
+            logger.error(f"AdvancedRagProcessor warm-up inference failed: {e}", exc_info=True)
+        return self.ready
+
     def _estimate_token_count(self, text: str) -> int:
         if not self.rephrasing_llm:
             logger.warning("Rephrasing LLM not available for token counting. Falling back to approximation.")
@@ -124,7 +181,8 @@ Output *only* the summarized context.
             compression_temp = current_app.config.get('CONTEXT_COMPRESSION_TEMPERATURE', 0.3)
             compression_token_buffer = current_app.config.get('CONTEXT_COMPRESSION_TOKEN_BUFFER', 500)
             compression_max_tokens = config_target_token_limit + compression_token_buffer
-            compression_safety_settings = current_app.config.get('FINAL_RESPONSE_SAFETY_SETTINGS', DEFAULT_QUERY_REPHRASING_SAFETY_SETTINGS)
+            compression_safety_settings = current_app.config.get('FINAL_RESPONSE_SAFETY_SETTINGS') or _default_query_rephrasing_safety_settings()
+            from vertexai.generative_models import GenerationConfig
             generation_config = GenerationConfig(temperature=compression_temp, max_output_tokens=compression_max_tokens)
             response = self.final_llm.generate_content(contents=[prompt], generation_config=generation_config, safety_settings=compression_safety_settings, stream=False)
 
@@ -163,7 +221,7 @@ Output *only* the summarized context.
         if not self.rephrasing_llm:
             logger.error("Rephrasing LLM not initialized. Falling back to original query.")
             return [original_query]
-        formatted_history = "\n".join([f"{turn['role']}: {turn['content']}" for turn in chat_history])
+        formatted_history = format_history(chat_history, assistant_label="Assistant")
         prompt = f"""Given the following chat history and the latest user query, generate 3-5 diverse rephrasings or expansions of the original query. Focus on capturing different facets or underlying intents of the query, considering the conversation context. Output *only* the rephrased queries, each on a new line, without any preamble or numbering.
 Include the original query itself in the output list.
 
@@ -178,7 +236,8 @@ Rephrased Queries (including original):"""
         try:
             rephrasing_temp = current_app.config.get('QUERY_REPHRASING_TEMPERATURE', 0.7)
             rephrasing_max_tokens = current_app.config.get('QUERY_REPHRASING_MAX_TOKENS', 150)
-            rephrasing_safety_settings = current_app.config.get('QUERY_REPHRASING_SAFETY_SETTINGS', DEFAULT_QUERY_REPHRASING_SAFETY_SETTINGS)
+            rephrasing_safety_settings = current_app.config.get('QUERY_REPHRASING_SAFETY_SETTINGS') or _default_query_rephrasing_safety_settings()
+            from vertexai.generative_models import GenerationConfig
             generation_config = GenerationConfig(temperature=rephrasing_temp, max_output_tokens=rephrasing_max_tokens)
             response = self.rephrasing_llm.generate_content(contents=[prompt], generation_config=generation_config, safety_settings=rephrasing_safety_settings, stream=False)
             if response and response.candidates and response.candidates[0].content.parts:
@@ -197,6 +256,16 @@ Rephrased Queries (including original):"""
             logger.error(f"Unexpected error generating query variations: {e}", exc_info=True)
             return [original_query]
 
+    def _generate_variations_for_all(self, questions: list, chat_history: list, max_concurrency: int) -> list[str]:
+        """Generates variations for every question concurrently (at most max_concurrency LLM calls at once); returns them in question order."""
+        if len(questions) <= 1 or max_concurrency <= 1:
+            return [variation for q_text in questions for variation in self._generate_query_variations(q_text, chat_history)]
+        scheduler = StageScheduler(max_workers=max_concurrency, logger_instance=logger, log_prefix="ADV_RAG Variations: ")
+        for q_idx, q_text in enumerate(questions):
+            scheduler.add(f"variations_{q_idx}", lambda _deps, q_text=q_text: self._generate_query_variations(q_text, chat_history))
+        scheduler.run()
+        return [variation for q_idx, q_text in enumerate(questions) for variation in scheduler.get(f"variations_{q_idx}") or [q_text]]
+
     def _rerank_chunks(self, original_query: str, chunks: List[Dict]) -> List[Dict]:
         logger.info(f"Starting re-ranking for {len(chunks)} chunks...")
         start_time = time.time()
@@ -209,7 +278,11 @@ Rephrased Queries (including original):"""
             return chunks
         try:
             model_input = [(original_query, chunk.get('text', '')) for chunk in chunks]
-            scores = self.cross_encoder.predict(model_input, show_progress_bar=False)
+            if self.reranker is not None:
+                scores = self.reranker.score(model_input)
+            else:
+                with self._cross_encoder_lock:
+                    scores = run_cpu_bound(self.cross_encoder.predict, model_input)
             chunks_with_scores = list(zip(scores, chunks))
             sorted_chunks_with_scores = sorted(chunks_with_scores, key=lambda x: x[0], reverse=True)
             reranked_chunks = [chunk for score, chunk in sorted_chunks_with_scores]
@@ -226,7 +299,16 @@ Rephrased Queries (including original):"""
         cleaned = match.group(1) if match else raw_string
         return cleaned.strip()
 
-    def _call_llm_with_retry_and_parse_json(self, model: GenerativeModel, prompt: str, generation_config: GenerationConfig, safety_settings: dict, expected_keys: list = None, expected_types: dict = None, max_retries: int = None, retry_delay: int = None, fallback_value: Any = None) -> Any:
+    @staticmethod
+    def _retry_backoff(attempt: int, base_delay: float, max_delay: float = 8.0) -> float:
+        """
+        Exponential backoff with jitter, so parallel calls that fail together (e.g. on quota) don't retry in lockstep.
+        The sleep only suspends the calling greenlet/thread; the request's other LLM calls keep running.
+        """
+        delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _call_llm_with_retry_and_parse_json(self, model: 'GenerativeModel', prompt: str, generation_config: 'GenerationConfig', safety_settings: dict, expected_keys: list = None, expected_types: dict = None, max_retries: int = None, retry_delay: int = None, fallback_value: Any = None) -> Any:
         config_max_retries = current_app.config.get('LLM_JSON_MAX_RETRIES', 2) if max_retries is None else max_retries
         config_retry_delay = current_app.config.get('LLM_JSON_RETRY_DELAY', 1) if retry_delay is None else retry_delay
         if not model:
@@ -242,14 +324,14 @@ Rephrased Queries (including original):"""
                 if not (response and response.candidates and response.candidates[0].content.parts):
                     logger.warning(f"LLM response was empty or invalid structure on attempt {attempts}. Response: {response}")
                     last_exception = ValueError("LLM response empty or invalid structure")
-                    if attempts <= config_max_retries: time.sleep(config_retry_delay)
+                    if attempts <= config_max_retries: time.sleep(self._retry_backoff(attempts, config_retry_delay))
                     continue
                 raw_text = response.candidates[0].content.parts[0].text
                 cleaned_text = self._clean_json_string(raw_text)
                 if not cleaned_text:
                      logger.warning(f"LLM response was empty after cleaning on attempt {attempts}. Raw: '{raw_text}'")
                      last_exception = ValueError("LLM response empty after cleaning")
-                     if attempts <= config_max_retries: time.sleep(config_retry_delay)
+                     if attempts <= config_max_retries: time.sleep(self._retry_backoff(attempts, config_retry_delay))
                      continue
                 try:
                     parsed_json = json.loads(cleaned_text)
@@ -257,27 +339,28 @@ Rephrased Queries (including original):"""
                         missing_keys = [k for k in expected_keys if k not in parsed_json]
                         logger.warning(f"Parsed JSON missing expected keys: {missing_keys} on attempt {attempts}. JSON: {parsed_json}")
                         last_exception = ValueError(f"Parsed JSON missing expected keys: {missing_keys}")
-                        if attempts <= config_max_retries: time.sleep(config_retry_delay)
+                        if attempts <= config_max_retries: time.sleep(self._retry_backoff(attempts, config_retry_delay))
                         continue
                     if expected_types:
                         type_errors = [f"Key '{key}' expected type {expected_type}, got {type(parsed_json[key])}" for key, expected_type in expected_types.items() if key in parsed_json and not isinstance(parsed_json[key], expected_type)]
                         if type_errors:
                              logger.warning(f"Parsed JSON type validation failed: {type_errors} on attempt {attempts}. JSON: {parsed_json}")
                              last_exception = TypeError(f"Parsed JSON type validation failed: {'; '.join(type_errors)}")
-                             if attempts <= config_max_retries: time.sleep(config_retry_delay)
+                             if attempts <= config_max_retries: time.sleep(self._retry_backoff(attempts, config_retry_delay))
                              continue
                     logger.debug(f"LLM JSON call successful on attempt {attempts}.")
                     return parsed_json
                 except json.JSONDecodeError as e:
                     logger.warning(f"JSONDecodeError on attempt {attempts}: {e}. Cleaned text: '{cleaned_text}'")
                     last_exception = e
-                    if attempts <= config_max_retries: time.sleep(config_retry_delay)
+                    if attempts <= config_max_retries: time.sleep(self._retry_backoff(attempts, config_retry_delay))
             except (GoogleAPICallError, RetryError, DeadlineExceeded) as e:
                 logger.warning(f"API Error on LLM JSON call attempt {attempts}: {type(e).__name__} - {e}")
                 last_exception = e
                 if attempts <= config_max_retries:
-                    logger.info(f"Retrying in {config_retry_delay}s...")
-                    time.sleep(config_retry_delay)
+                    backoff = self._retry_backoff(attempts, config_retry_delay)
+                    logger.info(f"Retrying in {backoff:.2f}s...")
+                    time.sleep(backoff)
             except Exception as e:
                 logger.error(f"Unexpected error during LLM JSON call attempt {attempts}: {e}", exc_info=True)
                 last_exception = e
@@ -291,7 +374,7 @@ Rephrased Queries (including original):"""
         if not self.rephrasing_llm:
             logger.error("Decomposition LLM (rephrasing_llm) not initialized. Falling back to original query.")
             return [original_query]
-        formatted_history = "\n".join([f"{turn['role']}: {turn['content']}" for turn in chat_history])
+        formatted_history = format_history(chat_history, assistant_label="Assistant")
         prompt = f"""Analyze the 'Original Query' in the context of the 'Chat History'.
 Break it down into one or more simpler, self-contained sub-questions that can be answered independently to fully address the original query.
 If the original query is already simple and self-contained, just return the original query as a single item in the list.
@@ -308,7 +391,8 @@ Original Query: "{original_query}"
 JSON Output:"""
         decomp_temp = current_app.config.get('QUERY_DECOMPOSITION_TEMPERATURE', 0.7)
         decomp_max_tokens = current_app.config.get('QUERY_DECOMPOSITION_MAX_TOKENS', 150)
-        decomp_safety_settings = current_app.config.get('RELAXED_JSON_SAFETY_SETTINGS', DEFAULT_RELAXED_JSON_SAFETY_SETTINGS)
+        decomp_safety_settings = current_app.config.get('RELAXED_JSON_SAFETY_SETTINGS') or _default_relaxed_json_safety_settings()
+        from vertexai.generative_models import GenerationConfig
         generation_config = GenerationConfig(temperature=decomp_temp, max_output_tokens=decomp_max_tokens, response_mime_type="application/json")
         parsed_result = self._call_llm_with_retry_and_parse_json(model=self.rephrasing_llm, prompt=prompt, generation_config=generation_config, safety_settings=decomp_safety_settings, fallback_value=None)
         if isinstance(parsed_result, list) and all(isinstance(q, str) for q in parsed_result) and parsed_result:
@@ -324,7 +408,7 @@ JSON Output:"""
         if not self.rephrasing_llm:
             logger.error("Intent/Slot LLM (rephrasing_llm) not initialized. Returning empty dict.")
             return {"intent": "error", "slots": {}}
-        formatted_history = "\n".join([f"{turn['role']}: {turn['content']}" for turn in chat_history])
+        formatted_history = format_history(chat_history, assistant_label="Assistant")
         prompt = f"""Analyze the 'Original Query' in the context of the 'Chat History'.
 Identify the primary user intent (e.g., 'information_seeking', 'comparison', 'greeting', 'request_action', 'clarification', 'other').
 Extract key named entities or slots relevant to the query (e.g., product names, features, locations, dates).
@@ -343,7 +427,8 @@ Original Query: "{query}"
 JSON Output:"""
         intent_temp = current_app.config.get('INTENT_SLOT_TEMPERATURE', 0.2)
         intent_max_tokens = current_app.config.get('INTENT_SLOT_MAX_TOKENS', 200)
-        intent_safety_settings = current_app.config.get('RELAXED_JSON_SAFETY_SETTINGS', DEFAULT_RELAXED_JSON_SAFETY_SETTINGS)
+        intent_safety_settings = current_app.config.get('RELAXED_JSON_SAFETY_SETTINGS') or _default_relaxed_json_safety_settings()
+        from vertexai.generative_models import GenerationConfig
         generation_config = GenerationConfig(temperature=intent_temp, max_output_tokens=intent_max_tokens, response_mime_type="application/json")
         expected_keys = ["intent", "slots"]
         expected_types = {"intent": str, "slots": dict}
@@ -382,7 +467,8 @@ Example: {{"sufficient": true, "follow_ups": ["What are the side effects?", "How
 """
         followup_temp = current_app.config.get('FOLLOWUP_TEMPERATURE', 0.6)
         followup_max_tokens = current_app.config.get('FOLLOWUP_MAX_TOKENS', 300)
-        followup_safety_settings = current_app.config.get('RELAXED_JSON_SAFETY_SETTINGS', DEFAULT_RELAXED_JSON_SAFETY_SETTINGS)
+        followup_safety_settings = current_app.config.get('RELAXED_JSON_SAFETY_SETTINGS') or _default_relaxed_json_safety_settings()
+        from vertexai.generative_models import GenerationConfig
         generation_config = GenerationConfig(temperature=followup_temp, max_output_tokens=followup_max_tokens, response_mime_type="application/json")
         expected_keys = ["sufficient", "follow_ups"]
         expected_types = {"sufficient": bool, "follow_ups": list}
@@ -394,6 +480,153 @@ Example: {{"sufficient": true, "follow_ups": ["What are the side effects?", "How
         logger.info(f"Retrieval analysis/follow-up generation finished in {time.time() - start_time:.2f}s. Result: {parsed_result}")
         return parsed_result
 
+def _processor_registry_key() -> tuple:
+    return (
+        current_app.config.get('QUERY_REPHRASING_MODEL_NAME', "gemini-2.5-flash"),
+        current_app.config.get('FINAL_RESPONSE_MODEL_NAME', "gemini-2.5-flash"),
+        current_app.config.get('CROSS_ENCODER_MODEL_NAME', 'cross-encoder/ms-marco-MiniLM-L6-v2'),
+        current_app.config.get('CROSS_ENCODER_MAX_LENGTH', 1000),
+        current_app.config.get('RERANKER_BACKEND', 'torch'),
+        current_app.config.get('RERANKER_QUANTIZE', False),
+    )
+
+def get_advanced_rag_processor() -> AdvancedRagProcessor:
+    """
+    Returns the process-wide AdvancedRagProcessor for the current model configuration,
+    building it on first use. Must be called inside an app context.
+    Raises RuntimeError if the models fail to load (nothing is cached in that case).
+    """
+    key = _processor_registry_key()
+    processor = _processor_registry.get(key)
+    if processor is not None:
+        return processor
+    with _processor_registry_lock:
+        processor = _processor_registry.get(key)
+        if processor is None:
+            processor = AdvancedRagProcessor()
+            _processor_registry[key] = processor
+    return processor
+
+def warm_up_advanced_rag() -> bool:
+    """Loads the processor and runs a warm-up inference. Intended for worker start-up."""
+    try:
+        return get_advanced_rag_processor().warm_up()
+    except Exception as e:
+        logger.error(f"Advanced RAG warm-up failed: {e}", exc_info=True)
+        return False
+
+def is_advanced_rag_ready() -> bool:
+    """True once the processor for the current config is loaded and warmed up."""
+    processor = _processor_registry.get(_processor_registry_key())
+    return bool(processor and processor.ready)
+
+def _load_bm25_index(chatbot_id: int, rag_service_instance: 'RAGService', current_logger) -> tuple:
+    """
+    Returns (BM25 index, vector IDs in corpus order, SparseBM25 or None) for the chatbot, building and caching them
+    if needed; (None, [], None) if unavailable. The sparse index is None without scipy (scores then come from get_scores).
+    """
+    bm25 = None
+    corpus_chunk_ids_for_bm25 = [] # Renamed to clarify its purpose
+    sparse_bm25 = None
+    cache_key = f"bm25_index_{chatbot_id}"
+
+    if cache_key in bm25_cache:
+        try:
+            bm25, corpus_chunk_ids_for_bm25, sparse_bm25 = bm25_cache[cache_key]
+            current_logger.info(f"ADV_RAG: BM25 index found in cache for chatbot {chatbot_id}. Using cached index with {len(corpus_chunk_ids_for_bm25)} documents.")
+            # We don't need to pre-fetch texts for cached BM25 here if BM25Okapi doesn't require them for scoring.
+            # Texts will be fetched on-demand for selected RRF chunks.
+        except Exception as e:
+            current_logger.error(f"ADV_RAG: Error retrieving BM25 from cache: {e}. Will attempt rebuild.", exc_info=True)
+            bm25 = None; corpus_chunk_ids_for_bm25 = []; sparse_bm25 = None
+            if cache_key in bm25_cache: del bm25_cache[cache_key]
+    
+    if bm25 is None:
+        current_logger.info(f"ADV_RAG: BM25 index not in cache for chatbot {chatbot_id}. Attempting to build...")
+        try:
+            # Fetch ALL vector IDs associated with the chatbot to build a comprehensive BM25 index
+            all_chatbot_vector_ids = [m.vector_id for m in db.session.query(VectorIdMapping.vector_id).filter_by(chatbot_id=chatbot_id).all() if m.vector_id]
+            
+            if all_chatbot_vector_ids:
+                current_logger.info(f"ADV_RAG: Found {len(all_chatbot_vector_ids)} vector IDs for chatbot {chatbot_id} for BM25 index build.")
+                
+                # Fetch texts for these IDs to build the BM25 index
+                # This fetch is for BM25 corpus creation, not for RRF results later.
+                bm25_corpus_texts_by_id, fetch_err = rag_service_instance.fetch_chunk_texts_by_id(all_chatbot_vector_ids, chatbot_id)
+                
+                if fetch_err:
+                    current_logger.warning(f"ADV_RAG: Error fetching some texts for BM25 build: {fetch_err}")
+                
+                # Keyed by vector ID, so chunks that failed to fetch are simply left out of the corpus
+                valid_ids_for_bm25_corpus = list(bm25_corpus_texts_by_id.keys())
+                valid_texts_for_bm25 = list(bm25_corpus_texts_by_id.values())
+
+                if valid_texts_for_bm25:
+                    current_logger.info(f"ADV_RAG: Building BM25 index with {len(valid_texts_for_bm25)} documents.")
+                    tokenized_corpus = [doc.split(" ") for doc in valid_texts_for_bm25]
+                    from rank_bm25 import BM25Okapi
+                    bm25 = run_cpu_bound(BM25Okapi, tokenized_corpus)
+                    corpus_chunk_ids_for_bm25 = valid_ids_for_bm25_corpus # Store the IDs corresponding to the BM25 corpus order
+                    try:
+                        sparse_bm25 = run_cpu_bound(SparseBM25.from_bm25, bm25, corpus_chunk_ids_for_bm25)
+                    except Exception as e: # ImportError without scipy
+                        current_logger.warning(f"ADV_RAG: Could not build sparse BM25 matrix ({e}); scoring variations one by one.")
+                    current_logger.info(f"ADV_RAG: BM25 index built successfully. Caching...")
+                    bm25_cache[cache_key] = (bm25, corpus_chunk_ids_for_bm25, sparse_bm25)
+                else:
+                    current_logger.warning("ADV_RAG: No valid text found after fetching texts for BM25 index build.")
+            else:
+                current_logger.warning(f"ADV_RAG: No VectorIdMappings found for chatbot {chatbot_id}. Skipping BM25 build.")
+        except Exception as e:
+            current_logger.error(f"ADV_RAG: Error preparing BM25 index: {e}", exc_info=True)
+    return bm25, corpus_chunk_ids_for_bm25, sparse_bm25
+
+def _retrieve_hybrid_for_variations(variations: list, chatbot_id: int, rag_service_instance: 'RAGService', bm25_index: tuple, current_logger) -> list:
+    """
+    Hybrid (vector + BM25, fused with RRF) retrieval for a round of variations: one batched embedding call,
+    one multi-query vector search and one BM25 scoring pass for all of them.
+    Returns the top NUM_HYBRID_CHUNKS_PER_VARIATION chunk IDs per variation, aligned with variations.
+    """
+    app_config = current_app.config
+    rrf_k_val = app_config.get('RRF_K', 60)
+    num_hybrid_chunks = app_config.get('NUM_HYBRID_CHUNKS_PER_VARIATION', 5)
+    bm25, corpus_chunk_ids_for_bm25, sparse_bm25 = bm25_index
+
+    hybrid_ids = [[] for _ in variations]
+    query_embeddings, emb_error = rag_service_instance.generate_multiple_embeddings(variations)
+    if emb_error:
+        current_logger.error(f"ADV_RAG: Failed to generate embeddings for variations: {emb_error}")
+    # As before, a variation whose embedding failed is skipped entirely (no BM25-only results)
+    embedded_indices = [i for i, e in enumerate(query_embeddings or []) if e is not None]
+    if not embedded_indices:
+        return hybrid_ids
+
+    per_query_neighbors, failed_requests = rag_service_instance.find_neighbors_per_query(
+        [query_embeddings[i] for i in embedded_indices], chatbot_id, app_config.get('RAG_TOP_K', 5))
+    if failed_requests:
+        current_logger.warning(f"ADV_RAG: Vector search failed for {failed_requests} request(s) across {len(embedded_indices)} variations.")
+    fusion_strategy = app_config.get('RETRIEVAL_FUSION_STRATEGY', 'min_distance')
+    m_fused_chunks = app_config.get('M_FUSED_CHUNKS', 10)
+    # Same ranking retrieve_chunks_multi_query gives a single variation
+    vector_id_lists = [rag_service_instance.fuse_neighbor_lists([neighbors], fusion_strategy, rrf_k_val)[:m_fused_chunks] if neighbors else []
+                       for neighbors in per_query_neighbors]
+
+    bm25_scores = None
+    if bm25 is not None and corpus_chunk_ids_for_bm25:
+        tokenized_variations = [variations[i].split(" ") for i in embedded_indices]
+        try:
+            if sparse_bm25 is not None:
+                bm25_scores = run_cpu_bound(sparse_bm25.score_batch, tokenized_variations)
+            else:
+                bm25_scores = np.vstack([run_cpu_bound(bm25.get_scores, tokens) for tokens in tokenized_variations])
+        except Exception as e:
+            current_logger.error(f"ADV_RAG: BM25 scoring failed for {len(tokenized_variations)} variations: {e}", exc_info=True)
+
+    fused = run_cpu_bound(fuse_hybrid_ranks, vector_id_lists, bm25_scores, corpus_chunk_ids_for_bm25, num_hybrid_chunks, rrf_k_val)
+    for i, ids in zip(embedded_indices, fused):
+        hybrid_ids[i] = ids
+    return hybrid_ids
+
 def process_advanced_query(query: str, chat_history: list, chatbot_id: int, session_id: str, rag_service_instance: 'RAGService', image_data: bytes = None, image_mime_type: str = None):
     start_pipeline_time = time.time()
     current_logger = current_app.logger if current_app else logger
@@ -401,87 +634,36 @@ def process_advanced_query(query: str, chat_history: list, chatbot_id: int, sess
 
     try:
         try:
-            processor = AdvancedRagProcessor()
+            processor = get_advanced_rag_processor()
         except Exception as e:
-            current_logger.error(f"ADV_RAG: Failed to instantiate AdvancedRagProcessor: {e}", exc_info=True)
+            current_logger.error(f"ADV_RAG: Failed to get AdvancedRagProcessor: {e}", exc_info=True)
             return ("Sorry, I encountered an internal error (Processor Init).", [], None, "Failed to initialize RAG processor.", 500, {})
 
         if not processor.rephrasing_llm or not processor.final_llm:
             current_logger.error("ADV_RAG: LLM models were not initialized correctly within AdvancedRagProcessor.")
             return ("Sorry, I encountered an internal error (LLM Init).", [], None, "Failed to initialize necessary LLM models.", 500, {})
 
-        chatbot = db.session.get(Chatbot, chatbot_id)
+        chatbot = get_chatbot_config(chatbot_id) # Cached snapshot; usually already loaded by the pipeline
         if not chatbot:
             current_logger.error(f"ADV_RAG: Chatbot with ID {chatbot_id} not found.")
             return ("Error: Chatbot configuration not found.", [], None, "Chatbot not found.", 404, {})
 
+        # Intent/slot recognition and decomposition are independent LLM calls, and the BM25 index
+        # (DB + GCS on a cache miss) needs neither, so all three run concurrently
+        llm_concurrency = max(1, current_app.config.get('ADVANCED_RAG_LLM_CONCURRENCY', 4))
         current_logger.info("--- ADV_RAG Step 1: Query Understanding ---")
-        intent_slots = processor._recognize_intent_and_slots(query, chat_history)
+        understanding = StageScheduler(max_workers=llm_concurrency, logger_instance=current_logger, log_prefix="ADV_RAG Query Understanding: ")
+        understanding.add('intent_slots', lambda _deps: processor._recognize_intent_and_slots(query, chat_history))
+        understanding.add('decompose', lambda _deps: processor._decompose_query(query, chat_history))
+        understanding.add('bm25_index', lambda _deps: _load_bm25_index(chatbot_id, rag_service_instance, current_logger))
+        understanding.run()
+        intent_slots = understanding.get('intent_slots') or {"intent": "unknown", "slots": {}}
         current_logger.info(f"ADV_RAG Recognized Intent: {intent_slots.get('intent', 'N/A')}, Slots: {intent_slots.get('slots', {})}")
-        sub_questions = processor._decompose_query(query, chat_history)
+        sub_questions = understanding.get('decompose') or [query]
         current_logger.info(f"ADV_RAG Decomposed into Sub-questions: {sub_questions}")
+        bm25_index = understanding.get('bm25_index') or (None, [], None)
 
         current_logger.info("--- ADV_RAG Step 2: Multi-Step Retrieval ---")
-        # removed fetched_texts_dict initialization here as it was tied to BM25 only
-        bm25 = None
-        corpus_chunk_ids_for_bm25 = [] # Renamed to clarify its purpose
-        cache_key = f"bm25_index_{chatbot_id}"
-
-        if cache_key in bm25_cache:
-            try:
-                bm25, corpus_chunk_ids_for_bm25 = bm25_cache[cache_key]
-                current_logger.info(f"ADV_RAG: BM25 index found in cache for chatbot {chatbot_id}. Using cached index with {len(corpus_chunk_ids_for_bm25)} documents.")
-                # We don't need to pre-fetch texts for cached BM25 here if BM25Okapi doesn't require them for scoring.
-                # Texts will be fetched on-demand for selected RRF chunks.
-            except Exception as e:
-                current_logger.error(f"ADV_RAG: Error retrieving BM25 from cache: {e}. Will attempt rebuild.", exc_info=True)
-                bm25 = None; corpus_chunk_ids_for_bm25 = []
-                if cache_key in bm25_cache: del bm25_cache[cache_key]
-        
-        if bm25 is None:
-            current_logger.info(f"ADV_RAG: BM25 index not in cache for chatbot {chatbot_id}. Attempting to build...")
-            try:
-                # Fetch ALL vector IDs associated with the chatbot to build a comprehensive BM25 index
-                all_chatbot_vector_ids = [m.vector_id for m in db.session.query(VectorIdMapping.vector_id).filter_by(chatbot_id=chatbot_id).all() if m.vector_id]
-                
-                if all_chatbot_vector_ids:
-                    current_logger.info(f"ADV_RAG: Found {len(all_chatbot_vector_ids)} vector IDs for chatbot {chatbot_id} for BM25 index build.")
-                    
-                    # Fetch texts for these IDs to build the BM25 index
-                    # This fetch_chunk_texts is for BM25 corpus creation, not for RRF results later.
-                    bm25_corpus_texts_list, fetch_err = rag_service_instance.fetch_chunk_texts(all_chatbot_vector_ids, chatbot_id)
-                    
-                    if fetch_err:
-                        current_logger.warning(f"ADV_RAG: Error fetching some texts for BM25 build: {fetch_err}")
-                    
-                    valid_texts_for_bm25 = []
-                    valid_ids_for_bm25_corpus = []
-
-                    if isinstance(bm25_corpus_texts_list, list) and len(bm25_corpus_texts_list) == len(all_chatbot_vector_ids):
-                        for i, text_content in enumerate(bm25_corpus_texts_list):
-                            if text_content: # Ensure text is not None or empty
-                                valid_texts_for_bm25.append(text_content)
-                                valid_ids_for_bm25_corpus.append(all_chatbot_vector_ids[i])
-                            else:
-                                current_logger.debug(f"ADV_RAG: Skipping vector ID {all_chatbot_vector_ids[i]} for BM25 due to empty text.")
-                        
-                        if valid_texts_for_bm25:
-                            current_logger.info(f"ADV_RAG: Building BM25 index with {len(valid_texts_for_bm25)} documents.")
-                            tokenized_corpus = [doc.split(" ") for doc in valid_texts_for_bm25]
-                            bm25 = BM25Okapi(tokenized_corpus)
-                            corpus_chunk_ids_for_bm25 = valid_ids_for_bm25_corpus # Store the IDs corresponding to the BM25 corpus order
-                            current_logger.info(f"ADV_RAG: BM25 index built successfully. Caching...")
-                            bm25_cache[cache_key] = (bm25, corpus_chunk_ids_for_bm25)
-                        else:
-                            current_logger.warning("ADV_RAG: No valid text found after filtering fetched texts for BM25 index build.")
-                    else:
-                        current_logger.warning(f"ADV_RAG: Mismatch or error fetching texts for BM25 build. Fetched count/type issue. Skipping BM25.")
-                else:
-                    current_logger.warning(f"ADV_RAG: No VectorIdMappings found for chatbot {chatbot_id}. Skipping BM25 build.")
-            except Exception as e:
-                current_logger.error(f"ADV_RAG: Error preparing BM25 index: {e}", exc_info=True)
-
-
         all_retrieved_chunk_ids_set = set() # Changed name for clarity
         all_retrieved_chunks_list = [] # Changed name for clarity
         analysis_result = {"sufficient": False, "follow_ups": []}
@@ -498,61 +680,27 @@ def process_advanced_query(query: str, chat_history: list, chatbot_id: int, sess
             current_logger.info(f"ADV_RAG Step {current_step + 1}: Using {'initial sub-questions' if current_step == 0 else 'follow-up questions'}: {queries_for_step}")
             
             current_step_variations = []
-            for q_idx, q_text in enumerate(queries_for_step):
-                 if processed_count >= variation_processing_limit: break
-                 current_step_variations.extend(processor._generate_query_variations(q_text, chat_history))
+            if processed_count < variation_processing_limit:
+                current_step_variations = processor._generate_variations_for_all(queries_for_step, chat_history, llm_concurrency)
             current_step_variations = list(dict.fromkeys(current_step_variations)) # Deduplicate
             current_logger.info(f"ADV_RAG Step {current_step + 1}: Generated {len(current_step_variations)} unique variations.")
 
             current_step_candidate_chunk_ids = set() # IDs found in this step
-            for i, current_variation in enumerate(current_step_variations):
-                if processed_count >= variation_processing_limit:
-                    current_logger.warning(f"ADV_RAG: Reached processing limit ({processed_count}). Skipping remaining variations for step {current_step + 1}.")
-                    break
-                current_logger.debug(f"ADV_RAG Step {current_step + 1}, Variation {i+1}/{len(current_step_variations)}: Processing '{current_variation[:100]}...'")
-                
-                vector_ranks = {}; bm25_ranks = {}
+            variations_to_process = current_step_variations[:max(0, variation_processing_limit - processed_count)]
+            if len(variations_to_process) < len(current_step_variations):
+                current_logger.warning(f"ADV_RAG: Reached processing limit ({variation_processing_limit}). Skipping {len(current_step_variations) - len(variations_to_process)} remaining variations for step {current_step + 1}.")
+            if variations_to_process:
+                # All of the step's variations are embedded, searched and BM25-scored together
+                hybrid_start_time = time.time()
                 try:
-                    query_embeddings, emb_error = rag_service_instance.generate_multiple_embeddings([current_variation])
-                    if emb_error or not query_embeddings:
-                        current_logger.error(f"ADV_RAG: Failed to generate embedding for variation '{current_variation[:50]}...': {emb_error}")
-                        processed_count += 1; continue
-                    
-                    neighbors_list, retrieval_error = rag_service_instance.retrieve_chunks_multi_query(query_embeddings=query_embeddings, chatbot_id=chatbot_id, client_id=session_id)
-                    vector_results_raw = [] if retrieval_error else [{'id': neighbor_id} for neighbor_id in neighbors_list] # Assuming retrieve_chunks_multi_query returns list of IDs
-                    if retrieval_error: current_logger.warning(f"ADV_RAG: Vector search failed for variation '{current_variation[:50]}...': {retrieval_error}")
-                    
-                    # Assuming retrieve_chunks_multi_query returns IDs already somewhat ranked or distances
-                    # If it returns distances, sort by distance. If just IDs, rank by order.
-                    # For simplicity, let's assume it's already implicitly ranked.
-                    vector_ranks = {res['id']: r + 1 for r, res in enumerate(vector_results_raw) if 'id' in res}
-
-                    if bm25 is not None and corpus_chunk_ids_for_bm25:
-                        tokenized_variation = current_variation.split(" ")
-                        if tokenized_variation:
-                            doc_scores_all = bm25.get_scores(tokenized_variation)
-                            # Map scores back to original vector_ids used to build BM25
-                            scored_chunk_ids = [(corpus_chunk_ids_for_bm25[idx], doc_scores_all[idx]) for idx in range(len(doc_scores_all)) if doc_scores_all[idx] > 0 and idx < len(corpus_chunk_ids_for_bm25)]
-                            bm25_results_ranked = sorted(scored_chunk_ids, key=lambda item: item[1], reverse=True)
-                            bm25_ranks = {item[0]: r + 1 for r, item in enumerate(bm25_results_ranked)}
-                    
-                    rrf_scores = defaultdict(float)
-                    all_ids_this_variation = set(vector_ranks.keys()) | set(bm25_ranks.keys())
-                    rrf_k_val = current_app.config.get('RRF_K', 60)
-                    for chunk_id_rrf in all_ids_this_variation: # Renamed chunk_id to chunk_id_rrf
-                        score = 0.0
-                        if chunk_id_rrf in vector_ranks: score += 1.0 / (rrf_k_val + vector_ranks[chunk_id_rrf])
-                        if chunk_id_rrf in bm25_ranks: score += 1.0 / (rrf_k_val + bm25_ranks[chunk_id_rrf])
-                        rrf_scores[chunk_id_rrf] = score
-                    
-                    rrf_sorted_chunk_ids_variation = sorted(all_ids_this_variation, key=lambda cid: rrf_scores[cid], reverse=True)
-                    num_hybrid_chunks = current_app.config.get('NUM_HYBRID_CHUNKS_PER_VARIATION', 5)
-                    top_rrf_chunk_ids_this_variation = rrf_sorted_chunk_ids_variation[:num_hybrid_chunks] # Renamed
-                    current_step_candidate_chunk_ids.update(set(top_rrf_chunk_ids_this_variation))
-                    processed_count += 1
+                    hybrid_ids_per_variation = _retrieve_hybrid_for_variations(variations_to_process, chatbot_id, rag_service_instance, bm25_index, current_logger)
+                    for top_rrf_chunk_ids_this_variation in hybrid_ids_per_variation:
+                        current_step_candidate_chunk_ids.update(top_rrf_chunk_ids_this_variation)
                 except Exception as e:
-                    current_logger.error(f"ADV_RAG: Error during retrieval or RRF for variation '{current_variation[:50]}...': {e}", exc_info=True)
-            
+                    current_logger.error(f"ADV_RAG: Error during retrieval or RRF for step {current_step + 1}: {e}", exc_info=True)
+                processed_count += len(variations_to_process)
+                current_logger.info(f"PERF: ADV_RAG Step {current_step + 1}: Hybrid retrieval for {len(variations_to_process)} variations took {time.time() - hybrid_start_time:.3f}s.")
+
             if processed_count >= variation_processing_limit and current_step < max_retrieval_steps -1 :
                  current_logger.warning(f"ADV_RAG: Reached processing limit ({processed_count}) during step {current_step + 1}. Breaking retrieval loop.")
                  break
@@ -564,35 +712,31 @@ def process_advanced_query(query: str, chat_history: list, chatbot_id: int, sess
             if new_chunk_ids_to_fetch_texts_for:
                 newly_fetched_chunks_this_step = [] # Renamed
                 # Fetch texts for these specific IDs
-                actual_fetched_texts_list, fetch_error = rag_service_instance.fetch_chunk_texts(new_chunk_ids_to_fetch_texts_for, chatbot_id)
+                fetched_texts_by_id, fetch_error = rag_service_instance.fetch_chunk_texts_by_id(new_chunk_ids_to_fetch_texts_for, chatbot_id)
                 
                 if fetch_error:
                     current_logger.error(f"ADV_RAG: Error fetching texts for new chunks in step {current_step + 1}: {fetch_error}")
-                elif actual_fetched_texts_list and isinstance(actual_fetched_texts_list, list) and len(actual_fetched_texts_list) == len(new_chunk_ids_to_fetch_texts_for):
-                    mappings = db.session.query(VectorIdMapping).filter(VectorIdMapping.vector_id.in_(new_chunk_ids_to_fetch_texts_for), VectorIdMapping.chatbot_id == chatbot_id).all()
+                if fetched_texts_by_id:
+                    mappings = db.session.query(VectorIdMapping).filter(VectorIdMapping.vector_id.in_(list(fetched_texts_by_id.keys())), VectorIdMapping.chatbot_id == chatbot_id).all()
                     mapping_dict = {m.vector_id: m for m in mappings}
                     
-                    for i, chunk_id_fetch in enumerate(new_chunk_ids_to_fetch_texts_for): # Renamed chunk_id
+                    for chunk_id_fetch, chunk_text_content in fetched_texts_by_id.items(): # Renamed chunk_id
                         mapping = mapping_dict.get(chunk_id_fetch)
-                        chunk_text_content = actual_fetched_texts_list[i] # Assumes fetch_chunk_texts returns in order
-
-                        if mapping and chunk_text_content: # Check if text_content is not None or empty
+                        if mapping:
                             newly_fetched_chunks_this_step.append({
                                 "id": chunk_id_fetch,
                                 "text": chunk_text_content,
                                 "metadata": {"source": mapping.source_identifier or 'Unknown source'}
                             })
                             all_retrieved_chunk_ids_set.add(chunk_id_fetch) # Add to master set *after* successful fetch
-                        elif not chunk_text_content:
-                            current_logger.warning(f"ADV_RAG: Fetched empty text for new chunk_id: {chunk_id_fetch}")
-                        elif not mapping:
+                        else:
                             current_logger.warning(f"ADV_RAG: Could not find mapping for successfully fetched new chunk_id: {chunk_id_fetch} (text was '{str(chunk_text_content)[:50]}...')")
                 
                     if newly_fetched_chunks_this_step:
                         all_retrieved_chunks_list.extend(newly_fetched_chunks_this_step)
                         current_logger.info(f"ADV_RAG Step {current_step + 1}: Accumulated {len(newly_fetched_chunks_this_step)} new chunks with text. Total unique with text: {len(all_retrieved_chunks_list)}")
                 else:
-                    current_logger.warning(f"ADV_RAG: Text fetch for new chunks returned unexpected result or count mismatch. Expected {len(new_chunk_ids_to_fetch_texts_for)}, got {len(actual_fetched_texts_list) if actual_fetched_texts_list else 'None'}")
+                    current_logger.warning(f"ADV_RAG: Text fetch for {len(new_chunk_ids_to_fetch_texts_for)} new chunks returned no texts.")
             # --- END OF MODIFIED TEXT FETCHING LOGIC ---
             
             if not all_retrieved_chunks_list:
@@ -630,7 +774,7 @@ def process_advanced_query(query: str, chat_history: list, chatbot_id: int, sess
         current_logger.info("--- ADV_RAG Step 5: Final Answer Synthesis ---")
         # ... (rest of the final answer synthesis code remains the same) ...
         final_answer = "Sorry, I couldn't generate a response based on the available information." # Default
-        formatted_history = "\n".join([f"{turn['role']}: {turn['content']}" for turn in chat_history])
+        formatted_history = format_history(chat_history, assistant_label="Assistant")
         base_prompt = chatbot.base_prompt or "You are a helpful assistant."
         final_prompt = f"""{base_prompt}
 
@@ -673,7 +817,8 @@ Answer:"""
         try:
             final_temp = current_app.config.get('FINAL_RESPONSE_TEMPERATURE', 0.5)
             final_max_tokens = current_app.config.get('FINAL_RESPONSE_MAX_TOKENS', 1500)
-            final_safety_settings = current_app.config.get('FINAL_RESPONSE_SAFETY_SETTINGS', DEFAULT_QUERY_REPHRASING_SAFETY_SETTINGS)
+            final_safety_settings = current_app.config.get('FINAL_RESPONSE_SAFETY_SETTINGS') or _default_query_rephrasing_safety_settings()
+            from vertexai.generative_models import GenerationConfig
             generation_config = GenerationConfig(temperature=final_temp, max_output_tokens=final_max_tokens)
             llm_response = processor.final_llm.generate_content(contents=[final_prompt], generation_config=generation_config, safety_settings=final_safety_settings, stream=False)
             if llm_response and llm_response.candidates and llm_response.candidates[0].content.parts:
@@ -706,6 +851,7 @@ Answer:"""
         # Prepare metadata for return
         final_metadata = {
             "follow_ups": analysis_result.get("follow_ups", []),
+            "stage_timings": {"query_understanding": understanding.timings},
             "retrieved_raw_texts": [chunk.get('text', '') for chunk in all_retrieved_chunks_list]
         }
         
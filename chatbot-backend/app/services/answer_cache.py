@@ -0,0 +1,167 @@
+# app/services/answer_cache.py
+"""
+Semantic answer cache for chatbots that opt in (Chatbot.answer_cache_enabled).
+
+Previous answers are stored in Redis per chatbot, together with the query
+embedding, and served again when a new query is similar enough (cosine
+similarity >= ANSWER_CACHE_SIMILARITY_THRESHOLD). The Redis namespace includes
+a fingerprint of everything that changes the answer (index version, last index
+update, base prompt, knowledge adherence level, RAG mode, answer language), so
+re-ingestion or a prompt change starts a fresh, empty namespace; stale ones age
+out via TTL.
+
+Only standalone questions are cached: with chat history the same text can mean
+something else ("what about the second one?"), so those queries neither read
+nor write the cache.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+import redis
+from flask import current_app
+
+from app.services.embedding_cache import encode_vector, decode_vector, normalize_query_text
+
+logger = logging.getLogger(__name__)
+
+
+def chatbot_answer_fingerprint(chatbot, advanced_mode: bool, query_language: str = None) -> str:
+    """Hash of the chatbot settings (and requested answer language) that invalidate cached answers when changed."""
+    parts = [
+        str(chatbot.index_version or ''),
+        chatbot.last_index_update.isoformat() if chatbot.last_index_update else '',
+        chatbot.base_prompt or '',
+        chatbot.knowledge_adherence_level or '',
+        'advanced' if advanced_mode else 'standard',
+        (query_language or '').lower(),
+    ]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def answer_cache_applies(query: str, chat_history: list = None, image_data: bytes = None) -> bool:
+    """True for text-only queries without conversation context, the only ones whose answers can be shared."""
+    return bool(query) and not image_data and not chat_history
+
+
+class AnswerCache:
+    def __init__(self, redis_url: str, similarity_threshold: float = 0.95, ttl_seconds: int = 24 * 3600,
+                 max_entries: int = 200, key_prefix: str = 'answercache:v1', logger_instance=None):
+        self.logger = logger_instance or logger
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.key_prefix = key_prefix
+        self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+
+    def _keys(self, chatbot_id, fingerprint: str):
+        base = f"{self.key_prefix}:{chatbot_id}:{fingerprint}"
+        return f"{base}:vec", f"{base}:data"
+
+    def lookup(self, chatbot_id, fingerprint: str, query: str, query_embedding) -> dict | None:
+        """Returns the best cached entry (with a 'similarity' field) above the threshold, or None."""
+        vec_key, data_key = self._keys(chatbot_id, fingerprint)
+        try:
+            raw_vectors = self._redis.hgetall(vec_key)
+        except Exception as e:
+            self.logger.warning(f"AnswerCache: Redis lookup failed for chatbot {chatbot_id}: {e}")
+            return None
+        if not raw_vectors:
+            return None
+
+        entry_ids = []
+        vectors = []
+        for entry_id, payload in raw_vectors.items():
+            values = decode_vector(payload)
+            if values and len(values) == len(query_embedding):
+                entry_ids.append(entry_id)
+                vectors.append(values)
+        if not vectors:
+            return None
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        query_vec = np.asarray(query_embedding, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query_vec) or 1.0)
+        similarities = matrix @ query_vec / np.where(norms == 0, 1.0, norms)
+        best = int(np.argmax(similarities))
+        best_similarity = float(similarities[best])
+        if best_similarity < self.similarity_threshold:
+            self.logger.debug(f"AnswerCache: Best similarity {best_similarity:.4f} below threshold {self.similarity_threshold} for chatbot {chatbot_id}.")
+            return None
+
+        try:
+            raw_entry = self._redis.hget(data_key, entry_ids[best])
+        except Exception as e:
+            self.logger.warning(f"AnswerCache: Redis entry fetch failed for chatbot {chatbot_id}: {e}")
+            return None
+        if not raw_entry:
+            return None
+        entry = json.loads(raw_entry)
+        entry['similarity'] = round(best_similarity, 4)
+        return entry
+
+    def store(self, chatbot_id, fingerprint: str, query: str, query_embedding, answer: str, sources: list, metadata: dict = None):
+        """Stores an answer for later reuse. Failures are logged and ignored."""
+        vec_key, data_key = self._keys(chatbot_id, fingerprint)
+        entry_id = uuid.uuid4().hex
+        entry = {
+            'query': query,
+            'normalized_query': normalize_query_text(query),
+            'answer': answer,
+            'sources': sources,
+            'metadata': metadata or {},
+            'created_at': time.time(),
+        }
+        try:
+            self._evict_if_full(vec_key, data_key)
+            pipe = self._redis.pipeline(transaction=True)
+            pipe.hset(vec_key, entry_id, encode_vector(query_embedding, 'float16'))
+            pipe.hset(data_key, entry_id, json.dumps(entry))
+            pipe.expire(vec_key, self.ttl_seconds)
+            pipe.expire(data_key, self.ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            self.logger.warning(f"AnswerCache: Failed to store answer for chatbot {chatbot_id}: {e}")
+
+    def _evict_if_full(self, vec_key: str, data_key: str):
+        if self._redis.hlen(data_key) < self.max_entries:
+            return
+        entries = self._redis.hgetall(data_key)
+        oldest_first = sorted(entries.items(), key=lambda item: json.loads(item[1]).get('created_at', 0))
+        to_remove = [entry_id for entry_id, _ in oldest_first[:max(1, len(entries) - self.max_entries + 1)]]
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hdel(vec_key, *to_remove)
+        pipe.hdel(data_key, *to_remove)
+        pipe.execute()
+
+
+# --- Per-process instance ---
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """Returns the process-wide AnswerCache, or None when disabled or Redis is unavailable."""
+    global _answer_cache
+    app_config = current_app.config
+    if not app_config.get('ANSWER_CACHE_ENABLED', True):
+        return None
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                try:
+                    _answer_cache = AnswerCache(
+                        redis_url=app_config.get('ANSWER_CACHE_REDIS_URL') or app_config.get('CELERY_BROKER_URL'),
+                        similarity_threshold=app_config.get('ANSWER_CACHE_SIMILARITY_THRESHOLD', 0.95),
+                        ttl_seconds=app_config.get('ANSWER_CACHE_TTL_SECONDS', 24 * 3600),
+                        max_entries=app_config.get('ANSWER_CACHE_MAX_ENTRIES', 200),
+                        logger_instance=current_app.logger,
+                    )
+                except Exception as e:
+                    current_app.logger.error(f"AnswerCache: Failed to initialize: {e}", exc_info=True)
+                    return None
+    return _answer_cache
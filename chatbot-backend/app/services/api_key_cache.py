@@ -0,0 +1,149 @@
+# app/services/api_key_cache.py
+"""
+Widget API key hashing and cached verification.
+
+Keys have historically been stored as werkzeug PBKDF2 hashes, which are slow by
+design and were checked on every widget request. Verification results are now
+cached in-process, keyed by (chatbot_id, sha256(presented key), sha256(stored hash)):
+
+- Including the stored hash means a regenerated key never matches an entry
+  cached for the old one, even in workers that missed the explicit invalidation.
+- Failed checks are cached too (with a shorter TTL), so repeated bad keys don't
+  each cost a PBKDF2 run.
+
+New keys can optionally be stored in a fast keyed-HMAC format
+("hmac-sha256$<hex>", API_KEY_HASH_SCHEME='hmac' plus API_KEY_HMAC_SECRET).
+Existing PBKDF2 hashes keep working and are upgraded to the HMAC format the next
+time the key is presented successfully (see needs_rehash).
+"""
+import hashlib
+import hmac
+import logging
+import threading
+
+from cachetools import TTLCache
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app import db
+from app.models import Chatbot
+
+logger = logging.getLogger(__name__)
+
+HMAC_PREFIX = "hmac-sha256$"
+
+
+def _sha256(value: str) -> str:
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def _hmac_secret() -> bytes | None:
+    secret = current_app.config.get('API_KEY_HMAC_SECRET')
+    return secret.encode('utf-8') if secret else None
+
+
+def _hmac_hash(secret: bytes, api_key: str) -> str:
+    return HMAC_PREFIX + hmac.new(secret, api_key.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def hash_api_key(api_key: str) -> str:
+    """Hashes a new plaintext key with the configured scheme (falls back to PBKDF2 without an HMAC secret)."""
+    secret = _hmac_secret()
+    if current_app.config.get('API_KEY_HASH_SCHEME', 'pbkdf2') == 'hmac' and secret:
+        return _hmac_hash(secret, api_key)
+    return generate_password_hash(api_key)
+
+
+def needs_rehash(stored_hash: str) -> bool:
+    """True when the stored hash is a legacy format and new keys should be stored as HMAC."""
+    return (
+        current_app.config.get('API_KEY_HASH_SCHEME', 'pbkdf2') == 'hmac'
+        and _hmac_secret() is not None
+        and not stored_hash.startswith(HMAC_PREFIX)
+    )
+
+
+def _check_api_key(stored_hash: str, api_key: str) -> bool:
+    if stored_hash.startswith(HMAC_PREFIX):
+        secret = _hmac_secret()
+        if not secret:
+            logger.error("API key is stored as HMAC but API_KEY_HMAC_SECRET is not configured.")
+            return False
+        return hmac.compare_digest(stored_hash, _hmac_hash(secret, api_key))
+    return check_password_hash(stored_hash, api_key)
+
+
+class ApiKeyCache:
+    def __init__(self, max_entries: int = 10000, ttl_seconds: int = 300, negative_ttl_seconds: int = 30):
+        self._valid = TTLCache(maxsize=max_entries, ttl=ttl_seconds) if ttl_seconds > 0 else None
+        self._invalid = TTLCache(maxsize=max_entries, ttl=negative_ttl_seconds) if negative_ttl_seconds > 0 else None
+        self._lock = threading.Lock() # cachetools caches are not thread-safe
+
+    def verify(self, chatbot_id, stored_hash: str, api_key: str) -> bool:
+        if not stored_hash or not api_key:
+            return False
+        key = (chatbot_id, _sha256(api_key), _sha256(stored_hash))
+        with self._lock:
+            if self._valid is not None and key in self._valid:
+                return True
+            if self._invalid is not None and key in self._invalid:
+                return False
+        is_valid = _check_api_key(stored_hash, api_key)
+        target = self._valid if is_valid else self._invalid
+        if target is not None:
+            with self._lock:
+                target[key] = True
+        return is_valid
+
+    def invalidate(self, chatbot_id):
+        """Drops every cached result (valid and invalid) for a chatbot."""
+        with self._lock:
+            for cache in (self._valid, self._invalid):
+                if cache is None:
+                    continue
+                for key in [k for k in cache.keys() if k[0] == chatbot_id]:
+                    cache.pop(key, None)
+
+
+_api_key_cache = None
+_api_key_cache_lock = threading.Lock()
+
+
+def get_api_key_cache() -> ApiKeyCache:
+    """Returns the process-wide ApiKeyCache."""
+    global _api_key_cache
+    if _api_key_cache is None:
+        with _api_key_cache_lock:
+            if _api_key_cache is None:
+                app_config = current_app.config
+                _api_key_cache = ApiKeyCache(
+                    max_entries=app_config.get('API_KEY_CACHE_MAX_ENTRIES', 10000),
+                    ttl_seconds=app_config.get('API_KEY_CACHE_TTL_SECONDS', 300),
+                    negative_ttl_seconds=app_config.get('API_KEY_NEGATIVE_CACHE_TTL_SECONDS', 30),
+                )
+    return _api_key_cache
+
+
+def verify_chatbot_api_key(chatbot, api_key: str) -> bool:
+    """
+    Checks a presented key against the chatbot's stored hash, using the cache. `chatbot` may be a
+    Chatbot or a ChatbotSnapshot. On success, a legacy PBKDF2 hash is upgraded to HMAC when that
+    scheme is configured.
+    """
+    stored_hash = chatbot.api_key
+    if not get_api_key_cache().verify(chatbot.id, stored_hash, api_key):
+        return False
+    if needs_rehash(stored_hash):
+        try:
+            db.session.get(Chatbot, chatbot.id).api_key = hash_api_key(api_key)
+            db.session.commit()
+            current_app.logger.info(f"Upgraded API key hash for chatbot {chatbot.id} to HMAC.")
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.warning(f"Failed to upgrade API key hash for chatbot {chatbot.id}: {e}")
+    return True
+
+
+def invalidate_api_key_cache(chatbot_id):
+    """Drops cached verification results for a chatbot in this process."""
+    get_api_key_cache().invalidate(chatbot_id)
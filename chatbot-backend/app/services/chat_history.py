@@ -0,0 +1,251 @@
+# app/services/chat_history.py
+"""
+Rolling chat-history compaction.
+
+Query endpoints used to pass the session's raw ChatMessage rows into every prompt
+(advanced RAG formats them into four LLM prompts per request), so prompt size grew
+with conversation length. ChatHistoryManager.load() instead returns:
+
+- The most recent CHAT_HISTORY_RECENT_MAX_MESSAGES messages, verbatim, trimmed from
+  the oldest end to CHAT_HISTORY_RECENT_TOKEN_BUDGET tokens.
+- Preceded by one {"role": "summary"} entry holding a running summary of everything
+  older, cached in Redis per (chatbot_id, session_id).
+
+The summary is never computed on the request path. When the verbatim window has
+moved past what the cached summary covers, a background thread folds only the newly
+aged-out messages into the previous summary (one LLM call), and the request uses the
+cached summary as it stands. A Redis lock keeps workers from summarizing the same
+session concurrently.
+"""
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+
+import redis
+from flask import current_app
+
+from app import db
+from app.models import ChatMessage
+from app.services.prompt_budget import get_token_counter
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ROLE = "summary"
+
+_ROLE_LABELS = {"user": "User", SUMMARY_ROLE: "Summary of earlier conversation"}
+
+
+def format_history(chat_history: list, assistant_label: str = "Chatbot") -> str:
+    """Formats history entries (including a leading summary entry) as 'Label: content' lines."""
+    return "\n".join(
+        f"{_ROLE_LABELS.get(turn.get('role'), assistant_label)}: {turn.get('content', '')}"
+        for turn in chat_history or []
+    )
+
+
+def trim_history(messages: list, max_messages: int, max_tokens: int, count_tokens) -> list:
+    """Keeps the newest messages that fit within both limits (always at least the newest one)."""
+    kept = []
+    tokens_used = 0
+    for message in reversed(messages[-max_messages:] if max_messages > 0 else []):
+        message_tokens = count_tokens(message.get('content', '')) + 4 # Role label and separators
+        if kept and tokens_used + message_tokens > max_tokens:
+            break
+        kept.append(message)
+        tokens_used += message_tokens
+    kept.reverse()
+    return kept
+
+
+class ChatHistoryManager:
+    def __init__(self, app, redis_url: str, recent_max_messages: int = 6, recent_token_budget: int = 600,
+                 summary_model_name: str = "gemini-2.5-flash", summary_max_words: int = 150,
+                 summary_batch_messages: int = 40, summary_ttl_seconds: int = 7 * 24 * 3600,
+                 tokenizer_encoding: str = "cl100k_base", key_prefix: str = "chathistory:v1", logger_instance=None):
+        self.app = app
+        self.logger = logger_instance or logger
+        self.recent_max_messages = recent_max_messages
+        self.recent_token_budget = recent_token_budget
+        self.summary_model_name = summary_model_name
+        self.summary_max_words = summary_max_words
+        self.summary_batch_messages = summary_batch_messages
+        self.summary_ttl_seconds = summary_ttl_seconds
+        self.key_prefix = key_prefix
+        self.count_tokens = get_token_counter(tokenizer_encoding)
+        self._redis = None
+        if redis_url:
+            try:
+                self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+            except Exception as e:
+                self.logger.warning(f"ChatHistoryManager: Redis unavailable ({e}); older turns won't be summarized.")
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def _key(self, chatbot_id, session_id) -> str:
+        return f"{self.key_prefix}:{chatbot_id}:{session_id}"
+
+    # --- Request path ---
+    def load(self, chatbot_id, session_id) -> list:
+        """Returns [summary entry?] + recent verbatim messages as [{'role', 'content'}] for the session."""
+        # Newest first, one extra row to learn whether anything older exists
+        rows = ChatMessage.query.filter_by(chatbot_id=chatbot_id, session_id=session_id) \
+            .order_by(ChatMessage.id.desc()).limit(self.recent_max_messages + 1).all()
+        rows.reverse()
+        messages = [{"role": row.role, "content": row.content, "id": row.id} for row in rows]
+        recent = trim_history(messages, self.recent_max_messages, self.recent_token_budget, self.count_tokens)
+        history = [{"role": m["role"], "content": m["content"]} for m in recent]
+        if len(recent) == len(messages) or self._redis is None:
+            return history # Nothing older than the verbatim window
+
+        boundary_id = recent[0]["id"] # Everything older than the window belongs in the summary
+        state = self._get_state(chatbot_id, session_id)
+        if state is None or state.get("boundary_id", 0) < boundary_id:
+            self._executor.submit(self._refresh_summary, chatbot_id, session_id, boundary_id)
+        if state and state.get("summary"):
+            history.insert(0, {"role": SUMMARY_ROLE, "content": state["summary"]})
+        return history
+
+    def _get_state(self, chatbot_id, session_id) -> dict | None:
+        try:
+            raw = self._redis.get(self._key(chatbot_id, session_id))
+            return json.loads(raw) if raw else None
+        except Exception as e:
+            self.logger.warning(f"ChatHistoryManager: Failed to read summary for session {session_id}: {e}")
+            return None
+
+    # --- Background summarization ---
+    def _get_model(self):
+        with self._model_lock:
+            if self._model is None:
+                from vertexai.generative_models import GenerativeModel # Heavy SDK; only background summaries need it
+                self._model = GenerativeModel(self.summary_model_name)
+            return self._model
+
+    def _refresh_summary(self, chatbot_id, session_id, boundary_id: int):
+        """Folds messages that aged out of the verbatim window (id < boundary_id) into the cached summary."""
+        key = self._key(chatbot_id, session_id)
+        lock_key = f"{key}:lock"
+        try:
+            if not self._redis.set(lock_key, "1", nx=True, ex=120):
+                return # Another worker is already summarizing this session
+        except Exception as e:
+            self.logger.warning(f"ChatHistoryManager: Could not acquire summary lock for session {session_id}: {e}")
+            return
+        start_time = time.time()
+        try:
+            with self.app.app_context():
+                state = self._get_state(chatbot_id, session_id) or {"summary": "", "boundary_id": 0}
+                while state["boundary_id"] < boundary_id:
+                    # Oldest unsummarized messages first, a bounded batch per LLM call
+                    rows = ChatMessage.query.filter(
+                        ChatMessage.chatbot_id == chatbot_id,
+                        ChatMessage.session_id == session_id,
+                        ChatMessage.id >= state["boundary_id"],
+                        ChatMessage.id < boundary_id,
+                    ).order_by(ChatMessage.id.asc()).limit(self.summary_batch_messages).all()
+                    if not rows:
+                        state["boundary_id"] = boundary_id
+                        break
+                    summary = self._summarize(state["summary"], [{"role": row.role, "content": row.content} for row in rows])
+                    if summary is None:
+                        return # Keep the previous summary; the next request retries
+                    state = {"summary": summary, "boundary_id": rows[-1].id + 1}
+                self._redis.set(key, json.dumps(state), ex=self.summary_ttl_seconds)
+            self.logger.info(f"PERF: Chat history summary for session {session_id} refreshed in {time.time() - start_time:.4f} seconds.")
+        except Exception as e:
+            self.logger.error(f"ChatHistoryManager: Summary refresh failed for session {session_id}: {e}", exc_info=True)
+        finally:
+            try:
+                self._redis.delete(lock_key)
+            except Exception:
+                pass
+
+    def _summarize(self, previous_summary: str, new_messages: list) -> str | None:
+        prompt = f"""You maintain a running summary of a conversation between a user and a chatbot.
+Update the summary with the new messages below. Keep facts, names, numbers, user preferences and open questions that later turns may refer to. Write in the language of the conversation, at most {self.summary_max_words} words. Output only the updated summary.
+
+Current summary:
+\"\"\"
+{previous_summary or "(none yet)"}
+\"\"\"
+
+New messages:
+\"\"\"
+{format_history(new_messages)}
+\"\"\""""
+        from vertexai.generative_models import GenerationConfig
+        try:
+            response = self._get_model().generate_content(
+                contents=[prompt],
+                generation_config=GenerationConfig(temperature=0.2, max_output_tokens=self.summary_max_words * 3),
+                stream=False,
+            )
+            summary = (response.text or "").strip()
+            return summary or None
+        except Exception as e:
+            self.logger.warning(f"ChatHistoryManager: Summary generation failed: {e}")
+            return None
+
+
+_chat_history_manager = None
+_chat_history_manager_lock = threading.Lock()
+
+
+def get_chat_history_manager() -> ChatHistoryManager:
+    """Returns the process-wide ChatHistoryManager."""
+    global _chat_history_manager
+    if _chat_history_manager is None:
+        with _chat_history_manager_lock:
+            if _chat_history_manager is None:
+                app_config = current_app.config
+                _chat_history_manager = ChatHistoryManager(
+                    current_app._get_current_object(),
+                    redis_url=app_config.get('CHAT_HISTORY_SUMMARY_REDIS_URL') or app_config.get('CELERY_BROKER_URL'),
+                    recent_max_messages=app_config.get('CHAT_HISTORY_RECENT_MAX_MESSAGES', 6),
+                    recent_token_budget=app_config.get('CHAT_HISTORY_RECENT_TOKEN_BUDGET', 600),
+                    summary_model_name=app_config.get('CHAT_HISTORY_SUMMARY_MODEL_NAME', "gemini-2.5-flash"),
+                    summary_max_words=app_config.get('CHAT_HISTORY_SUMMARY_MAX_WORDS', 150),
+                    summary_batch_messages=app_config.get('CHAT_HISTORY_SUMMARY_BATCH_MESSAGES', 40),
+                    summary_ttl_seconds=app_config.get('CHAT_HISTORY_SUMMARY_TTL_SECONDS', 7 * 24 * 3600),
+                    tokenizer_encoding=app_config.get('PROMPT_TOKENIZER_ENCODING', 'cl100k_base'),
+                    logger_instance=current_app.logger,
+                )
+    return _chat_history_manager
+
+
+def load_session_history(chatbot_id, session_id, fallback_limit: int = 10) -> list:
+    """
+    Returns the history to send with a query: compacted when CHAT_HISTORY_COMPACTION_ENABLED,
+    otherwise the last fallback_limit messages verbatim.
+    """
+    if current_app.config.get('CHAT_HISTORY_COMPACTION_ENABLED', True):
+        return get_chat_history_manager().load(chatbot_id, session_id)
+    rows = ChatMessage.query.filter_by(chatbot_id=chatbot_id, session_id=session_id) \
+        .order_by(ChatMessage.id.desc()).limit(fallback_limit).all()
+    return [{"role": row.role, "content": row.content} for row in reversed(rows)]
+
+
+def session_history_fingerprint(chatbot_id, session_id) -> str:
+    """
+    Cheap identity of a session's stored history (one aggregate query, no summary lookup): changes whenever
+    a message is added or deleted. '' when the session has no messages.
+    """
+    newest_id, message_count = db.session.query(db.func.max(ChatMessage.id), db.func.count(ChatMessage.id)) \
+        .filter(ChatMessage.chatbot_id == chatbot_id, ChatMessage.session_id == session_id).one()
+    return f"{session_id}:{newest_id}:{message_count}" if message_count else ""
+
+
+def trim_client_history(chat_history: list) -> list:
+    """Applies the verbatim-window limits to history supplied by the client (no session to summarize)."""
+    if not chat_history or not current_app.config.get('CHAT_HISTORY_COMPACTION_ENABLED', True):
+        return chat_history
+    app_config = current_app.config
+    return trim_history(
+        chat_history,
+        app_config.get('CHAT_HISTORY_RECENT_MAX_MESSAGES', 6),
+        app_config.get('CHAT_HISTORY_RECENT_TOKEN_BUDGET', 600),
+        get_token_counter(app_config.get('PROMPT_TOKENIZER_ENCODING', 'cl100k_base')),
+    )
@@ -0,0 +1,206 @@
+# app/services/chatbot_config_cache.py
+"""
+Read-through cache of immutable chatbot configuration snapshots.
+
+A widget query used to load the Chatbot row in require_api_key, again in the
+pipeline's config step and again in process_advanced_query, and _log_usage looked
+up the owner by client_id. get_chatbot_config() returns a ChatbotSnapshot (every
+Chatbot column, read-only) from a per-process cache instead.
+
+Invalidation:
+- Any committed insert/update/delete of a Chatbot row (update_chatbot, deletion,
+  ingestion status changes, key regeneration, ...) publishes the chatbot ID on the
+  CHATBOT_CONFIG_CHANNEL Redis channel. Every process listens on it and drops the
+  entry, so no call site has to remember to invalidate.
+- Entries also expire after CHATBOT_CONFIG_CACHE_TTL_SECONDS, which bounds
+  staleness if Redis is unavailable or a change bypasses the ORM (bulk updates).
+"""
+import logging
+import threading
+
+import redis
+from cachetools import TTLCache
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Chatbot
+
+logger = logging.getLogger(__name__)
+
+CHATBOT_CONFIG_CHANNEL = "chatbot-config-invalidate"
+
+
+class ChatbotSnapshot:
+    """Read-only copy of a Chatbot row's column values (safe to share across requests and threads)."""
+
+    __slots__ = ('_values',)
+
+    def __init__(self, values: dict):
+        object.__setattr__(self, '_values', dict(values))
+
+    @classmethod
+    def from_model(cls, chatbot) -> 'ChatbotSnapshot':
+        return cls({column.key: getattr(chatbot, column.key) for column in Chatbot.__table__.columns})
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(f"ChatbotSnapshot has no attribute '{name}'") from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ChatbotSnapshot is read-only; load the Chatbot model to modify it.")
+
+    @property
+    def version(self) -> str:
+        """Identifies this configuration; changes whenever the row is updated."""
+        updated_at = self._values.get('updated_at')
+        return f"{self._values.get('id')}:{updated_at.isoformat() if updated_at else ''}"
+
+    def __repr__(self):
+        return f"<ChatbotSnapshot {self.version}>"
+
+
+class ChatbotConfigCache:
+    def __init__(self, max_entries: int = 5000, ttl_seconds: int = 300, redis_url: str = None, logger_instance=None):
+        self.logger = logger_instance or logger
+        self._cache = TTLCache(maxsize=max_entries, ttl=ttl_seconds) if ttl_seconds > 0 else None
+        self._lock = threading.Lock()
+        self._generations = {} # chatbot_id -> invalidation count, so a load racing an invalidation isn't cached
+        self._redis = None
+        self._listener = None
+        if redis_url:
+            try:
+                self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+            except Exception as e:
+                self.logger.warning(f"ChatbotConfigCache: Redis unavailable ({e}); relying on TTL expiry only.")
+
+    @staticmethod
+    def _key(chatbot_id):
+        # Callers pass route strings as well as ints; invalidations arrive as ints, so entries must be keyed the same way
+        try:
+            return int(chatbot_id)
+        except (TypeError, ValueError):
+            return chatbot_id
+
+    def get(self, chatbot_id) -> ChatbotSnapshot | None:
+        """Returns the chatbot's snapshot, loading it from the database on a miss. None if the chatbot doesn't exist."""
+        chatbot_id = self._key(chatbot_id)
+        if self._cache is None:
+            chatbot = db.session.get(Chatbot, chatbot_id)
+            return ChatbotSnapshot.from_model(chatbot) if chatbot else None
+        with self._lock:
+            snapshot = self._cache.get(chatbot_id)
+            generation = self._generations.get(chatbot_id, 0)
+        if snapshot is not None:
+            return snapshot
+        chatbot = db.session.get(Chatbot, chatbot_id)
+        if chatbot is None:
+            return None
+        snapshot = ChatbotSnapshot.from_model(chatbot)
+        with self._lock:
+            if self._generations.get(chatbot_id, 0) == generation:
+                self._cache[chatbot_id] = snapshot
+        return snapshot
+
+    def drop(self, chatbot_id):
+        """Removes a chatbot's snapshot from this process only."""
+        chatbot_id = self._key(chatbot_id)
+        with self._lock:
+            self._generations[chatbot_id] = self._generations.get(chatbot_id, 0) + 1
+            if self._cache is not None:
+                self._cache.pop(chatbot_id, None)
+
+    def invalidate(self, chatbot_ids):
+        """Drops the snapshots here and tells every other process to drop them too."""
+        for chatbot_id in chatbot_ids:
+            self.drop(chatbot_id)
+        if self._redis is None:
+            return
+        for chatbot_id in chatbot_ids:
+            try:
+                self._redis.publish(CHATBOT_CONFIG_CHANNEL, str(chatbot_id))
+            except Exception as e:
+                self.logger.warning(f"ChatbotConfigCache: Failed to publish invalidation for chatbot {chatbot_id}: {e}")
+
+    def start_listener(self):
+        """Starts the background subscriber that applies invalidations published by other processes."""
+        if self._redis is None or self._listener is not None:
+            return
+
+        def _listen():
+            while True:
+                try:
+                    pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(CHATBOT_CONFIG_CHANNEL)
+                    for message in pubsub.listen():
+                        data = message.get('data')
+                        if isinstance(data, bytes):
+                            data = data.decode('utf-8')
+                        if data and str(data).isdigit():
+                            self.drop(int(data))
+                except Exception as e:
+                    self.logger.warning(f"ChatbotConfigCache: Invalidation listener error ({e}); clearing cache and resubscribing.")
+                    with self._lock:
+                        if self._cache is not None:
+                            self._cache.clear() # Invalidations may have been missed while disconnected
+                    threading.Event().wait(5)
+
+        self._listener = threading.Thread(target=_listen, name="chatbot-config-invalidation", daemon=True)
+        self._listener.start()
+
+
+_chatbot_config_cache = None
+_chatbot_config_cache_lock = threading.Lock()
+
+
+def get_chatbot_config_cache() -> ChatbotConfigCache:
+    """Returns the process-wide ChatbotConfigCache (starting its invalidation listener on first use)."""
+    global _chatbot_config_cache
+    if _chatbot_config_cache is None:
+        with _chatbot_config_cache_lock:
+            if _chatbot_config_cache is None:
+                app_config = current_app.config
+                cache = ChatbotConfigCache(
+                    max_entries=app_config.get('CHATBOT_CONFIG_CACHE_MAX_ENTRIES', 5000),
+                    ttl_seconds=app_config.get('CHATBOT_CONFIG_CACHE_TTL_SECONDS', 300) if app_config.get('CHATBOT_CONFIG_CACHE_ENABLED', True) else 0,
+                    redis_url=app_config.get('CHATBOT_CONFIG_CACHE_REDIS_URL') or app_config.get('CELERY_BROKER_URL'),
+                    logger_instance=current_app.logger,
+                )
+                cache.start_listener()
+                _chatbot_config_cache = cache
+    return _chatbot_config_cache
+
+
+def get_chatbot_config(chatbot_id) -> ChatbotSnapshot | None:
+    """Returns an immutable snapshot of the chatbot's configuration, or None if it doesn't exist."""
+    return get_chatbot_config_cache().get(ChatbotConfigCache._key(chatbot_id))
+
+
+# --- Automatic invalidation on committed Chatbot changes ---
+_PENDING_KEY = 'chatbot_config_invalidations'
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_chatbot_changes(session, flush_context):
+    changed = {obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted) if isinstance(obj, Chatbot) and obj.id is not None}
+    if changed:
+        session.info.setdefault(_PENDING_KEY, set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_chatbot_changes(session):
+    changed = session.info.pop(_PENDING_KEY, None)
+    if not changed:
+        return
+    try:
+        get_chatbot_config_cache().invalidate(sorted(changed))
+    except Exception as e: # Never fail a commit over cache invalidation (e.g. outside an app context)
+        logger.warning(f"ChatbotConfigCache: Could not invalidate chatbots {sorted(changed)}: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_chatbot_changes(session):
+    session.info.pop(_PENDING_KEY, None)
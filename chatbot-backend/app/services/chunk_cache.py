@@ -0,0 +1,303 @@
+# app/services/chunk_cache.py
+"""
+Cache for chunk texts stored in GCS (chatbot_{id}/source_{hash}/{index}.txt).
+
+Tier 1 is an in-process TTL cache bounded by the memory size of the cached
+texts, tier 2 is an optional shared tier (Redis, or a local directory shared by
+the processes on one host) so a chunk downloaded by one worker is a hit for the
+others. Entries are keyed by blob name, so a chatbot or a single source can be
+invalidated by prefix when it is re-ingested or deleted.
+
+Invalidation removes matching entries from the shared tier and this process's
+local tier, and bumps a per-chatbot epoch in the shared tier. Other processes
+re-read the epoch at most every CHUNK_CACHE_EPOCH_REFRESH_SECONDS and drop local
+entries cached before it.
+"""
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+import redis
+from cachetools import TTLCache
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_cache_prefix(chatbot_id, source_hash: str = None) -> str:
+    """Blob-name prefix covering a chatbot, or one of its sources (hash as used in the GCS path)."""
+    if source_hash:
+        return f"chatbot_{chatbot_id}/source_{source_hash}/"
+    return f"chatbot_{chatbot_id}/"
+
+
+def _scope_of(key: str) -> str:
+    """Epoch scope of a blob name or prefix: its chatbot_{id} path segment."""
+    return key.split('/', 1)[0]
+
+
+class _RedisChunkTier:
+    def __init__(self, redis_url: str, ttl_seconds: int, key_prefix: str):
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+
+    def _key(self, blob_name: str) -> str:
+        return f"{self.key_prefix}:text:{blob_name}"
+
+    def get_many(self, blob_names: list) -> list:
+        payloads = self._redis.mget([self._key(b) for b in blob_names])
+        return [p.decode('utf-8') if p is not None else None for p in payloads]
+
+    def set_many(self, items: dict):
+        pipe = self._redis.pipeline(transaction=False)
+        for blob_name, text in items.items():
+            pipe.set(self._key(blob_name), text.encode('utf-8'), ex=self.ttl_seconds)
+        pipe.execute()
+
+    def delete_prefix(self, prefix: str) -> int:
+        deleted = 0
+        batch = []
+        for key in self._redis.scan_iter(match=f"{self._key(prefix)}*", count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                deleted += self._redis.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += self._redis.unlink(*batch)
+        return deleted
+
+    def get_epochs(self, scopes: list) -> dict:
+        values = self._redis.mget([f"{self.key_prefix}:epoch:{s}" for s in scopes])
+        return {s: float(v) if v is not None else 0.0 for s, v in zip(scopes, values)}
+
+    def bump_epoch(self, scope: str, epoch: float):
+        self._redis.set(f"{self.key_prefix}:epoch:{scope}", repr(epoch))
+
+
+class _DiskChunkTier:
+    def __init__(self, root: str, ttl_seconds: int):
+        self.root = os.path.abspath(root)
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.join(self.root, '.epochs'), exist_ok=True)
+
+    def _path(self, blob_name: str) -> str | None:
+        path = os.path.abspath(os.path.join(self.root, blob_name))
+        # Blob names are generated by ingestion, but never let one escape the cache root
+        return path if path.startswith(self.root + os.sep) else None
+
+    def get_many(self, blob_names: list) -> list:
+        results = []
+        now = time.time()
+        for blob_name in blob_names:
+            path = self._path(blob_name)
+            try:
+                if path is None or now - os.path.getmtime(path) > self.ttl_seconds:
+                    results.append(None)
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    results.append(f.read())
+            except OSError:
+                results.append(None)
+        return results
+
+    def set_many(self, items: dict):
+        for blob_name, text in items.items():
+            path = self._path(blob_name)
+            if path is None:
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path) # Atomic, so readers never see partial files
+
+    def delete_prefix(self, prefix: str) -> int:
+        path = self._path(prefix.rstrip('/'))
+        if path is None or not os.path.isdir(path):
+            return 0
+        deleted = sum(len(files) for _, _, files in os.walk(path))
+        shutil.rmtree(path, ignore_errors=True)
+        return deleted
+
+    def get_epochs(self, scopes: list) -> dict:
+        epochs = {}
+        for scope in scopes:
+            try:
+                with open(os.path.join(self.root, '.epochs', scope), 'r') as f:
+                    epochs[scope] = float(f.read().strip() or 0)
+            except (OSError, ValueError):
+                epochs[scope] = 0.0
+        return epochs
+
+    def bump_epoch(self, scope: str, epoch: float):
+        with open(os.path.join(self.root, '.epochs', scope), 'w') as f:
+            f.write(repr(epoch))
+
+
+class ChunkTextCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: int = 3600, shared_backend: str = None,
+                 redis_url: str = None, disk_path: str = None, shared_ttl_seconds: int = 7 * 24 * 3600,
+                 epoch_refresh_seconds: float = 5.0, key_prefix: str = 'chunkcache:v1', logger_instance=None):
+        self.logger = logger_instance or logger
+        self.epoch_refresh_seconds = epoch_refresh_seconds
+        # Values are (text, cached_at); size is the memory footprint of the text object
+        self._local = TTLCache(maxsize=max_bytes, ttl=ttl_seconds, getsizeof=lambda entry: sys.getsizeof(entry[0]))
+        self._local_lock = threading.Lock() # cachetools caches are not thread-safe
+        self._epochs = {} # scope -> (epoch, checked_at)
+        self._stats_lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'writes': 0, 'invalidations': 0, 'shared_errors': 0}
+        self._shared = None
+        try:
+            if shared_backend == 'redis' and redis_url:
+                self._shared = _RedisChunkTier(redis_url, shared_ttl_seconds, key_prefix)
+            elif shared_backend == 'disk' and disk_path:
+                self._shared = _DiskChunkTier(disk_path, shared_ttl_seconds)
+        except Exception as e:
+            self.logger.error(f"ChunkTextCache: Failed to initialize '{shared_backend}' tier: {e}. Using local tier only.")
+            self._shared = None
+
+    def _count(self, name: str, amount: int = 1):
+        if amount:
+            with self._stats_lock:
+                self.stats[name] += amount
+
+    def _current_epochs(self, scopes: set) -> dict:
+        """Shared invalidation epochs for `scopes`, re-read at most every epoch_refresh_seconds."""
+        now = time.time()
+        stale = [s for s in scopes if s not in self._epochs or now - self._epochs[s][1] > self.epoch_refresh_seconds]
+        if stale and self._shared is not None:
+            try:
+                for scope, epoch in self._shared.get_epochs(stale).items():
+                    self._epochs[scope] = (epoch, now)
+            except Exception as e:
+                self._count('shared_errors')
+                self.logger.warning(f"ChunkTextCache: Failed to read invalidation epochs: {e}")
+        return {s: self._epochs.get(s, (0.0, 0))[0] for s in scopes}
+
+    def get_many(self, blob_names: list) -> list:
+        """Returns cached texts aligned with `blob_names` (None for misses)."""
+        results = [None] * len(blob_names)
+        epochs = self._current_epochs({_scope_of(b) for b in blob_names})
+        shared_lookup = []
+        with self._local_lock:
+            for i, blob_name in enumerate(blob_names):
+                entry = self._local.get(blob_name)
+                if entry is not None and entry[1] >= epochs[_scope_of(blob_name)]:
+                    results[i] = entry[0]
+                else:
+                    shared_lookup.append(i)
+        self._count('local_hits', len(blob_names) - len(shared_lookup))
+
+        if shared_lookup and self._shared is not None:
+            try:
+                texts = self._shared.get_many([blob_names[i] for i in shared_lookup])
+                now = time.time()
+                promoted = {}
+                for i, text in zip(shared_lookup, texts):
+                    if text is not None:
+                        results[i] = text
+                        promoted[blob_names[i]] = (text, now)
+                if promoted:
+                    with self._local_lock:
+                        self._local.update(promoted)
+                self._count('shared_hits', len(promoted))
+            except Exception as e:
+                self._count('shared_errors')
+                self.logger.warning(f"ChunkTextCache: Shared tier lookup failed: {e}")
+
+        self._count('misses', sum(1 for t in results if t is None))
+        return results
+
+    def set_many(self, items: dict):
+        """Stores {blob_name: text} in both tiers."""
+        if not items:
+            return
+        now = time.time()
+        with self._local_lock:
+            for blob_name, text in items.items():
+                try:
+                    self._local[blob_name] = (text, now)
+                except ValueError:
+                    pass # Single text larger than the whole local budget
+        self._count('writes', len(items))
+        if self._shared is None:
+            return
+        try:
+            self._shared.set_many(items)
+        except Exception as e:
+            self._count('shared_errors')
+            self.logger.warning(f"ChunkTextCache: Shared tier write failed: {e}")
+
+    def invalidate_prefix(self, prefix: str) -> int:
+        """Drops every cached chunk whose blob name starts with `prefix` (see chunk_cache_prefix)."""
+        with self._local_lock:
+            local_keys = [k for k in list(self._local.keys()) if k.startswith(prefix)]
+            for key in local_keys:
+                self._local.pop(key, None)
+        removed = len(local_keys)
+        if self._shared is not None:
+            scope = _scope_of(prefix)
+            epoch = time.time()
+            try:
+                removed += self._shared.delete_prefix(prefix)
+                self._shared.bump_epoch(scope, epoch)
+                self._epochs[scope] = (epoch, epoch)
+            except Exception as e:
+                self._count('shared_errors')
+                self.logger.warning(f"ChunkTextCache: Shared tier invalidation failed for '{prefix}': {e}")
+        self._count('invalidations')
+        self.logger.info(f"ChunkTextCache: Invalidated prefix '{prefix}' ({removed} entries removed).")
+        return removed
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        with self._local_lock:
+            stats['local_entries'] = len(self._local)
+            stats['local_bytes'] = int(self._local.currsize)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# --- Per-process instance ---
+_chunk_cache = None
+_chunk_cache_lock = threading.Lock()
+
+
+def get_chunk_cache():
+    """Returns the process-wide ChunkTextCache, or None when disabled in config."""
+    global _chunk_cache
+    app_config = current_app.config
+    if not app_config.get('CHUNK_CACHE_ENABLED', True):
+        return None
+    if _chunk_cache is None:
+        with _chunk_cache_lock:
+            if _chunk_cache is None:
+                _chunk_cache = ChunkTextCache(
+                    max_bytes=app_config.get('CHUNK_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                    ttl_seconds=app_config.get('CHUNK_CACHE_TTL_SECONDS', 3600),
+                    shared_backend=app_config.get('CHUNK_CACHE_SHARED_BACKEND', 'redis'),
+                    redis_url=app_config.get('CHUNK_CACHE_REDIS_URL') or app_config.get('CELERY_BROKER_URL'),
+                    disk_path=app_config.get('CHUNK_CACHE_DISK_PATH'),
+                    shared_ttl_seconds=app_config.get('CHUNK_CACHE_SHARED_TTL_SECONDS', 7 * 24 * 3600),
+                    epoch_refresh_seconds=app_config.get('CHUNK_CACHE_EPOCH_REFRESH_SECONDS', 5),
+                    logger_instance=current_app.logger,
+                )
+    return _chunk_cache
+
+
+def invalidate_chunk_cache(chatbot_id, source_hash: str = None):
+    """Invalidates cached chunk texts for a chatbot (or one source). Never raises; returns entries removed."""
+    try:
+        chunk_cache = get_chunk_cache()
+        if chunk_cache is None:
+            return 0
+        return chunk_cache.invalidate_prefix(chunk_cache_prefix(chatbot_id, source_hash))
+    except Exception as e:
+        current_app.logger.warning(f"ChunkTextCache: Invalidation failed for chatbot {chatbot_id} (source hash {source_hash}): {e}")
+        return 0
@@ -0,0 +1,141 @@
+# app/services/chunk_shards.py
+"""
+Packed per-source chunk storage in GCS.
+
+Instead of one object per chunk (chatbot_{id}/source_{hash}/{i}.txt), a source is
+stored as two objects under the same prefix:
+
+  shard.bin   - every chunk of the source, back to back, each optionally
+                zstd-compressed on its own so it can be read with a range request
+  shard.json  - offset index: {"format", "codec", "generation", "chunks": [[offset, length], ...]}
+
+The index records the GCS generation of shard.bin, and readers pin ranged reads
+to it, so a reader never mixes an old index with a re-written shard. Sources
+without a shard.json are read from the legacy per-chunk objects.
+"""
+import hashlib
+import json
+import logging
+
+from google.api_core.exceptions import NotFound as GoogleNotFound
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+SHARD_FORMAT_VERSION = 1
+SHARD_DATA_BLOB = "shard.bin"
+SHARD_INDEX_BLOB = "shard.json"
+SUPPORTED_CODECS = ('none', 'zstd')
+
+
+def source_hash_for(source_identifier: str) -> str:
+    """Hash used for a source's GCS prefix and vector IDs (see ingestion.save_chunk_to_gcs)."""
+    return hashlib.sha256(source_identifier.encode()).hexdigest()[:16]
+
+
+def shard_blob_names(chatbot_id, source_hash: str) -> tuple[str, str]:
+    """Returns (data blob name, index blob name) for a source."""
+    prefix = f"chatbot_{chatbot_id}/source_{source_hash}/"
+    return prefix + SHARD_DATA_BLOB, prefix + SHARD_INDEX_BLOB
+
+
+def resolve_codec(codec: str) -> str:
+    """Falls back to 'none' when zstd is requested but the zstandard package isn't installed."""
+    if codec == 'zstd' and zstandard is None:
+        logger.warning("Chunk shards: zstd compression requested but 'zstandard' is not installed. Writing uncompressed shards.")
+        return 'none'
+    return codec if codec in SUPPORTED_CODECS else 'none'
+
+
+def encode_chunk(text: str, codec: str, level: int = 3) -> bytes:
+    payload = text.encode('utf-8')
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(payload)
+    return payload
+
+
+def decode_chunk(payload: bytes, codec: str) -> str:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Shard is zstd-compressed but the 'zstandard' package is not installed.")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    return payload.decode('utf-8')
+
+
+def build_shard(chunks: list, codec: str = 'none', level: int = 3) -> tuple[bytes, dict]:
+    """Packs chunk texts into one payload. Returns (data, index) with index["chunks"][i] = [offset, length]."""
+    codec = resolve_codec(codec)
+    parts = []
+    offsets = []
+    position = 0
+    for text in chunks:
+        encoded = encode_chunk(text, codec, level)
+        offsets.append([position, len(encoded)])
+        parts.append(encoded)
+        position += len(encoded)
+    index = {"format": SHARD_FORMAT_VERSION, "codec": codec, "generation": None, "chunks": offsets}
+    return b"".join(parts), index
+
+
+def upload_source_shard(bucket, chatbot_id, source_hash: str, chunks: list, codec: str = 'none', level: int = 3) -> dict:
+    """Writes shard.bin then shard.json for a source (index last, so readers never see an index without data)."""
+    data, index = build_shard(chunks, codec, level)
+    data_blob_name, index_blob_name = shard_blob_names(chatbot_id, source_hash)
+    data_blob = bucket.blob(data_blob_name)
+    data_blob.upload_from_string(data, content_type='application/octet-stream')
+    index["generation"] = data_blob.generation
+    bucket.blob(index_blob_name).upload_from_string(json.dumps(index), content_type='application/json')
+    return index
+
+
+def load_shard_index_text(bucket, chatbot_id, source_hash: str) -> str:
+    """Returns the raw shard.json for a source, or '' when the source uses the per-chunk layout."""
+    _, index_blob_name = shard_blob_names(chatbot_id, source_hash)
+    try:
+        return bucket.blob(index_blob_name).download_as_text(encoding="utf-8")
+    except GoogleNotFound:
+        return ''
+
+
+def plan_range_reads(index: dict, chunk_indices, max_gap_bytes: int = 16384) -> list:
+    """
+    Groups the requested chunks into as few byte ranges as possible.
+
+    Chunks whose byte ranges are at most `max_gap_bytes` apart are read with one
+    request (reading the gap is cheaper than another round trip). Returns a list
+    of (start, end_exclusive, [(chunk_index, offset, length), ...]). Unknown
+    chunk indices are skipped.
+    """
+    offsets = index.get("chunks", [])
+    entries = sorted(
+        ((i, offsets[i][0], offsets[i][1]) for i in set(chunk_indices) if 0 <= i < len(offsets)),
+        key=lambda entry: entry[1]
+    )
+    ranges = []
+    for entry in entries:
+        _, offset, length = entry
+        if ranges and offset - ranges[-1][1] <= max_gap_bytes:
+            start, end, members = ranges[-1]
+            ranges[-1] = (start, max(end, offset + length), members + [entry])
+        else:
+            ranges.append((offset, offset + length, [entry]))
+    return ranges
+
+
+def read_shard_range(bucket, chatbot_id, source_hash: str, index: dict, start: int, end: int) -> bytes:
+    """Downloads bytes [start, end) of a source's shard, pinned to the generation recorded in its index."""
+    data_blob_name, _ = shard_blob_names(chatbot_id, source_hash)
+    blob = bucket.blob(data_blob_name, generation=index.get("generation"))
+    return blob.download_as_bytes(start=start, end=end - 1) # GCS range end is inclusive
+
+
+def split_range(payload: bytes, start: int, members: list, codec: str) -> dict:
+    """Slices a downloaded range back into {chunk_index: text}."""
+    return {
+        chunk_index: decode_chunk(payload[offset - start:offset - start + length], codec)
+        for chunk_index, offset, length in members
+    }
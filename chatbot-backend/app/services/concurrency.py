@@ -0,0 +1,63 @@
+# app/services/concurrency.py
+"""
+Cooperative concurrency helpers for the gevent-patched web and Celery processes.
+
+Under gevent, a request holds a greenlet rather than an OS thread, so one process
+can keep thousands of LLM calls in flight - provided nothing blocks the hub:
+
+- Vertex AI (GenerativeModel, MatchingEngine, Ranking) talks gRPC, whose C core
+  ignores gevent's monkey-patching unless grpc's gevent integration is enabled.
+  run.py and celery_worker.py call grpc.experimental.gevent.init_gevent() through
+  gevent_setup.apply_gevent_patches(), before any channel is created - also when
+  Celery's gevent pool did the patching; without it every gRPC wait froze the
+  whole process.
+- CPU-bound steps (cross-encoder inference, BM25 scoring, local vector search) run
+  through run_cpu_bound(), which hands them to the hub's native thread pool. The
+  calling greenlet yields while they run, and torch/numpy release the GIL, so other
+  requests keep making progress.
+
+Without gevent (tests, Flask's threaded dev server) run_cpu_bound() calls inline.
+"""
+import logging
+import threading
+
+from flask import current_app, has_app_context
+
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:
+    gevent = None
+
+logger = logging.getLogger(__name__)
+
+_threadpool_lock = threading.Lock()
+_threadpool_configured = False
+
+
+def gevent_patched() -> bool:
+    """True when gevent has monkey-patched this process (run.py / celery_worker.py)."""
+    return gevent is not None and gevent.monkey.is_module_patched('socket')
+
+
+def _configure_threadpool():
+    global _threadpool_configured
+    if _threadpool_configured:
+        return
+    with _threadpool_lock:
+        if not _threadpool_configured:
+            max_threads = current_app.config.get('CPU_BOUND_THREADS', 4) if has_app_context() else 4
+            gevent.get_hub().threadpool.maxsize = max(1, max_threads)
+            _threadpool_configured = True
+
+
+def run_cpu_bound(func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) on a native thread when gevent is active (so the hub keeps serving
+    other greenlets) and returns its result; exceptions propagate to the caller. Runs inline otherwise.
+    func runs without a Flask app context, so it must not use current_app or the database.
+    """
+    if not gevent_patched():
+        return func(*args, **kwargs)
+    _configure_threadpool()
+    return gevent.get_hub().threadpool.apply(func, args, kwargs)
@@ -0,0 +1,162 @@
+# app/services/embedding_cache.py
+"""
+Two-tier cache for query embeddings.
+
+Tier 1 is a small in-process TTL/LRU cache, tier 2 is the shared Redis instance
+(the same one Celery uses), so a query embedded by one gunicorn or Celery
+process is a hit for every other process. Vectors are stored as packed
+little-endian float16 (default) or float32 to keep Redis memory low.
+"""
+import hashlib
+import logging
+import re
+import struct
+import threading
+import unicodedata
+
+import redis
+from cachetools import TTLCache
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# dtype name -> (header byte, struct format char)
+_DTYPES = {
+    'float16': (b'h', 'e'),
+    'float32': (b'f', 'f'),
+}
+_HEADER_TO_FORMAT = {header: fmt for header, fmt in _DTYPES.values()}
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_query_text(text: str) -> str:
+    """Normalizes query text for cache keying (unicode form, whitespace and case)."""
+    return _WHITESPACE_RE.sub(' ', unicodedata.normalize('NFKC', text)).strip().casefold()
+
+
+def encode_vector(values, dtype: str = 'float16') -> bytes:
+    header, fmt = _DTYPES.get(dtype, _DTYPES['float16'])
+    return header + struct.pack(f'<{len(values)}{fmt}', *values)
+
+
+def decode_vector(payload: bytes):
+    if not payload:
+        return None
+    fmt = _HEADER_TO_FORMAT.get(payload[:1])
+    if fmt is None:
+        return None
+    body = payload[1:]
+    count = len(body) // struct.calcsize(fmt)
+    return list(struct.unpack(f'<{count}{fmt}', body))
+
+
+class EmbeddingCache:
+    def __init__(self, redis_url: str = None, local_maxsize: int = 2048, ttl_seconds: int = 7 * 24 * 3600,
+                 dtype: str = 'float16', key_prefix: str = 'embcache:v1', logger_instance=None):
+        self.logger = logger_instance or logger
+        self.ttl_seconds = ttl_seconds
+        self.dtype = dtype if dtype in _DTYPES else 'float16'
+        self.key_prefix = key_prefix
+        self._local = TTLCache(maxsize=local_maxsize, ttl=ttl_seconds)
+        self._local_lock = threading.Lock() # cachetools caches are not thread-safe
+        self._stats_lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'writes': 0, 'redis_errors': 0}
+        self._redis = None
+        if redis_url:
+            try:
+                # Binary payloads, so no decode_responses here (unlike sse_utils)
+                self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+            except Exception as e:
+                self.logger.error(f"EmbeddingCache: Failed to create Redis pool for {redis_url}: {e}. Using local tier only.")
+                self._redis = None
+
+    def make_key(self, text: str, model_name: str, task_type: str, output_dimensionality=None) -> str:
+        digest = hashlib.sha256(normalize_query_text(text).encode('utf-8')).hexdigest()
+        return f"{self.key_prefix}:{model_name}:{task_type}:{output_dimensionality or 'default'}:{digest}"
+
+    def _count(self, name: str, amount: int = 1):
+        if amount:
+            with self._stats_lock:
+                self.stats[name] += amount
+
+    def get_many(self, keys: list) -> list:
+        """Returns cached vectors aligned with `keys` (None for misses)."""
+        results = [None] * len(keys)
+        redis_lookup = []
+        with self._local_lock:
+            for i, key in enumerate(keys):
+                values = self._local.get(key)
+                if values is not None:
+                    results[i] = values
+                else:
+                    redis_lookup.append(i)
+        self._count('local_hits', len(keys) - len(redis_lookup))
+
+        if redis_lookup and self._redis is not None:
+            try:
+                payloads = self._redis.mget([keys[i] for i in redis_lookup])
+                promoted = {}
+                for i, payload in zip(redis_lookup, payloads):
+                    values = decode_vector(payload)
+                    if values is not None:
+                        results[i] = values
+                        promoted[keys[i]] = values
+                if promoted:
+                    with self._local_lock:
+                        self._local.update(promoted)
+                self._count('redis_hits', len(promoted))
+            except Exception as e:
+                self._count('redis_errors')
+                self.logger.warning(f"EmbeddingCache: Redis lookup failed: {e}")
+
+        self._count('misses', sum(1 for v in results if v is None))
+        return results
+
+    def set_many(self, items: dict):
+        """Stores {key: vector} in both tiers."""
+        if not items:
+            return
+        with self._local_lock:
+            self._local.update(items)
+        self._count('writes', len(items))
+        if self._redis is None:
+            return
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for key, values in items.items():
+                pipe.set(key, encode_vector(values, self.dtype), ex=self.ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            self._count('redis_errors')
+            self.logger.warning(f"EmbeddingCache: Redis write failed: {e}")
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['local_hits'] + stats['redis_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# --- Per-process instance ---
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Returns the process-wide EmbeddingCache, or None when disabled in config."""
+    global _embedding_cache
+    app_config = current_app.config
+    if not app_config.get('EMBEDDING_CACHE_ENABLED', True):
+        return None
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache(
+                    redis_url=app_config.get('EMBEDDING_CACHE_REDIS_URL') or app_config.get('CELERY_BROKER_URL'),
+                    local_maxsize=app_config.get('EMBEDDING_CACHE_LOCAL_MAXSIZE', 2048),
+                    ttl_seconds=app_config.get('EMBEDDING_CACHE_TTL_SECONDS', 7 * 24 * 3600),
+                    dtype=app_config.get('EMBEDDING_CACHE_DTYPE', 'float16'),
+                    logger_instance=current_app.logger,
+                )
+    return _embedding_cache
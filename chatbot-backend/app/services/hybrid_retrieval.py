@@ -0,0 +1,117 @@
+# app/services/hybrid_retrieval.py
+"""
+Batched hybrid (vector + BM25) retrieval for the advanced RAG retrieval rounds.
+
+Each round used to handle its query variations one at a time: embed, vector
+search, score the whole BM25 corpus with BM25Okapi.get_scores (a Python loop
+over every document per query token), build rank dicts, sort, fuse. Now a round
+embeds all variations in one batch and runs one multi-query vector search
+(process_advanced_query), and this module does the lexical side for all of
+them at once:
+
+- SparseBM25 turns a built BM25Okapi index into a sparse term x document
+  matrix of per-term BM25 contributions. Scoring every variation is then a
+  single sparse (variations x terms) @ (terms x documents) product, with the
+  same scores get_scores returns.
+- fuse_hybrid_ranks applies reciprocal rank fusion per variation with NumPy.
+  Only the BM25 top-n documents (np.partition) can enter a variation's top n
+  on BM25 alone, and the vector candidates get their exact BM25 rank, so the
+  selected chunks match the per-variation loop.
+
+scipy is needed for SparseBM25; without it callers fall back to get_scores.
+"""
+import logging
+
+import numpy as np
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+logger = logging.getLogger(__name__)
+
+
+class SparseBM25:
+    def __init__(self, vocabulary: dict, term_doc_matrix, corpus_ids: list):
+        self.vocabulary = vocabulary # term -> row
+        self.term_doc_matrix = term_doc_matrix # CSR (terms x documents)
+        self.corpus_ids = corpus_ids
+
+    @classmethod
+    def from_bm25(cls, bm25, corpus_ids: list):
+        """Builds the matrix from a rank_bm25 BM25Okapi index (doc_freqs, idf, doc_len, avgdl, k1, b)."""
+        if sparse is None:
+            raise ImportError("scipy is required for SparseBM25")
+        vocabulary = {}
+        rows, cols, values = [], [], []
+        doc_len = np.asarray(bm25.doc_len, dtype=np.float64)
+        length_norm = bm25.k1 * (1 - bm25.b + bm25.b * doc_len / bm25.avgdl)
+        for doc_index, frequencies in enumerate(bm25.doc_freqs):
+            for term, frequency in frequencies.items():
+                idf = bm25.idf.get(term)
+                if not idf:
+                    continue
+                row = vocabulary.setdefault(term, len(vocabulary))
+                rows.append(row)
+                cols.append(doc_index)
+                values.append(idf * frequency * (bm25.k1 + 1) / (frequency + length_norm[doc_index]))
+        matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(vocabulary), len(bm25.doc_freqs)), dtype=np.float64)
+        return cls(vocabulary, matrix, list(corpus_ids))
+
+    def score_batch(self, tokenized_queries: list) -> np.ndarray:
+        """BM25 scores of every document for each query: array of shape (queries, documents)."""
+        rows, cols, values = [], [], []
+        for query_index, tokens in enumerate(tokenized_queries):
+            for token in tokens: # Repeated tokens count again, as in get_scores
+                term_row = self.vocabulary.get(token)
+                if term_row is not None:
+                    rows.append(query_index)
+                    cols.append(term_row)
+                    values.append(1.0)
+        query_matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(tokenized_queries), len(self.vocabulary)), dtype=np.float64)
+        return np.asarray((query_matrix @ self.term_doc_matrix).todense())
+
+
+def _bm25_ranks(scores: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """1-based rank of each position among positive scores (ties by corpus order, like a stable sort); 0 if its score isn't positive."""
+    order = np.argsort(-scores, kind='stable') # One O(n log n) sort, O(n) memory
+    ranks = np.empty(scores.shape[0], dtype=np.int64)
+    ranks[order] = np.arange(1, scores.shape[0] + 1)
+    return np.where(scores[positions] > 0, ranks[positions], 0)
+
+
+def fuse_hybrid_ranks(vector_id_lists: list, bm25_scores: np.ndarray | None, corpus_ids: list, top_n: int, rrf_k: int = 60) -> list:
+    """
+    Reciprocal rank fusion of each variation's vector results (ranked ID lists) with its BM25 scores
+    (row of bm25_scores, aligned with corpus_ids; None when there is no BM25 index). Returns the top_n IDs per variation.
+    """
+    position_by_id = {chunk_id: position for position, chunk_id in enumerate(corpus_ids)} if bm25_scores is not None else {}
+    fused = []
+    for variation_index, vector_ids in enumerate(vector_id_lists):
+        vector_ids = list(vector_ids or [])
+        candidate_ids = list(vector_ids)
+        rrf_scores = 1.0 / (rrf_k + np.arange(1, len(vector_ids) + 1, dtype=np.float64))
+        if bm25_scores is not None and bm25_scores.shape[1]:
+            scores = bm25_scores[variation_index]
+            # Documents outside the BM25 top_n can only reach the fused top_n through a vector rank.
+            # Everything tied with the top_n-th score is kept, since ties are broken by corpus order.
+            k = min(top_n, scores.shape[0])
+            if k:
+                kth_score = np.partition(scores, scores.shape[0] - k)[scores.shape[0] - k]
+                top_positions = np.flatnonzero((scores >= kth_score) & (scores > 0))
+            else:
+                top_positions = np.array([], dtype=np.int64)
+            vector_positions = {position_by_id[chunk_id] for chunk_id in vector_ids if chunk_id in position_by_id}
+            extra_positions = [int(p) for p in top_positions if int(p) not in vector_positions]
+            candidate_ids.extend(corpus_ids[p] for p in extra_positions)
+            rrf_scores = np.concatenate([rrf_scores, np.zeros(len(extra_positions))])
+            candidate_positions = np.array([position_by_id.get(chunk_id, -1) for chunk_id in candidate_ids], dtype=np.int64)
+            in_corpus = candidate_positions >= 0
+            if in_corpus.any():
+                ranks = _bm25_ranks(scores, candidate_positions[in_corpus])
+                bonus = np.where(ranks > 0, 1.0 / (rrf_k + np.maximum(ranks, 1)), 0.0)
+                rrf_scores[in_corpus] += bonus
+        order = np.argsort(-rrf_scores, kind='stable')[:top_n]
+        fused.append([candidate_ids[i] for i in order])
+    return fused
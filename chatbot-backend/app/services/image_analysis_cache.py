@@ -0,0 +1,228 @@
+# app/services/image_analysis_cache.py
+"""
+Content-addressed cache for image text extraction.
+
+Every image query (/query_with_image, MCP process_image, the image branch of the
+pipeline) sends the image to Gemini to extract its text before retrieval. Results
+are cached by SHA-256 of the image bytes plus the extraction model and prompt
+version, so a resubmitted screenshot skips the multimodal call entirely; bumping
+the prompt version (or changing the model) starts fresh.
+
+Tier 1 is an in-process LRU bounded by the size of the cached results. Tier 2 is
+optional: Redis (shared by every process) or a local directory (shared by the
+processes on one host). The directory is bounded too: once it grows past
+IMAGE_ANALYSIS_CACHE_DISK_MAX_BYTES, the least recently used files (hits refresh
+a file's mtime) are deleted until it is back under 90% of the limit. Only
+completed extractions are cached - including ones stopped by safety filters,
+with their safety metadata - never API errors.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import redis
+from cachetools import TTLCache
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+def image_analysis_key(image_data: bytes, model_name: str, prompt_version: str) -> str:
+    """Cache key for an image's extraction result under a given model and prompt version."""
+    digest = hashlib.sha256(image_data).hexdigest()
+    return hashlib.sha256(f"{digest}\x1f{model_name}\x1f{prompt_version}".encode('utf-8')).hexdigest()
+
+
+class _RedisImageTier:
+    def __init__(self, redis_url: str, ttl_seconds: int, key_prefix: str):
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+
+    def get(self, key: str) -> str | None:
+        payload = self._redis.get(f"{self.key_prefix}:{key}")
+        return payload.decode('utf-8') if payload is not None else None
+
+    def set(self, key: str, payload: str):
+        self._redis.set(f"{self.key_prefix}:{key}", payload.encode('utf-8'), ex=self.ttl_seconds)
+
+
+class _DiskImageTier:
+    def __init__(self, root: str, ttl_seconds: int, max_bytes: int = 256 * 1024 * 1024, logger_instance=None):
+        self.root = os.path.abspath(root)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.logger = logger_instance or logger
+        os.makedirs(self.root, exist_ok=True)
+        self._prune_lock = threading.Lock()
+        # Bytes on disk as of the last scan plus this process's writes since; other processes' writes
+        # are picked up by the next scan, so the directory can briefly exceed max_bytes
+        self._approx_bytes = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json") # Keys are hex digests
+
+    def _scan(self) -> list:
+        """Returns [(mtime, size, path)] for every cached file."""
+        files = []
+        for path in glob.glob(os.path.join(self.root, '*', '*.json')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # Removed by another process meanwhile
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                payload = f.read()
+            os.utime(path) # Marks the entry as recently used for pruning
+            return payload
+        except OSError:
+            return None
+
+    def set(self, key: str, payload: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, path) # Atomic, so readers never see partial files
+        self._approx_bytes += os.path.getsize(path)
+        if self._approx_bytes > self.max_bytes:
+            self._prune()
+
+    def _prune(self):
+        """Deletes expired files, then the least recently used ones, until the directory is under 90% of max_bytes."""
+        if not self._prune_lock.acquire(blocking=False):
+            return # Another thread is already pruning
+        try:
+            start_time = time.time()
+            files = sorted(self._scan()) # Oldest mtime first
+            total_bytes = sum(size for _, size, _ in files)
+            target_bytes = int(self.max_bytes * 0.9)
+            removed = 0
+            for mtime, size, path in files:
+                if total_bytes <= target_bytes and start_time - mtime <= self.ttl_seconds:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass # Already removed by another process
+                total_bytes -= size
+                removed += 1
+            self._approx_bytes = total_bytes
+            self.logger.info(f"ImageAnalysisCache: Pruned {removed} disk entries in {time.time() - start_time:.4f} seconds ({total_bytes} bytes left, limit {self.max_bytes}).")
+        finally:
+            self._prune_lock.release()
+
+
+class ImageAnalysisCache:
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024, ttl_seconds: int = 24 * 3600, shared_backend: str = None,
+                 redis_url: str = None, disk_path: str = None, shared_ttl_seconds: int = 30 * 24 * 3600,
+                 disk_max_bytes: int = 256 * 1024 * 1024, key_prefix: str = 'imgcache:v1', logger_instance=None):
+        self.logger = logger_instance or logger
+        # Values are result dicts; size is the memory footprint of their JSON form
+        self._local = TTLCache(maxsize=max_bytes, ttl=ttl_seconds, getsizeof=lambda entry: sys.getsizeof(json.dumps(entry)))
+        self._local_lock = threading.Lock() # cachetools caches are not thread-safe
+        self._stats_lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'writes': 0, 'shared_errors': 0}
+        self._shared = None
+        try:
+            if shared_backend == 'redis' and redis_url:
+                self._shared = _RedisImageTier(redis_url, shared_ttl_seconds, key_prefix)
+            elif shared_backend == 'disk' and disk_path:
+                self._shared = _DiskImageTier(disk_path, shared_ttl_seconds, disk_max_bytes, self.logger)
+        except Exception as e:
+            self.logger.error(f"ImageAnalysisCache: Failed to initialize '{shared_backend}' tier: {e}. Using local tier only.")
+            self._shared = None
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get(self, key: str) -> dict | None:
+        """Returns the cached extraction result ({'text', 'warnings', 'safety_ratings'}) or None."""
+        with self._local_lock:
+            entry = self._local.get(key)
+        if entry is not None:
+            self._count('local_hits')
+            return entry
+        if self._shared is not None:
+            try:
+                payload = self._shared.get(key)
+                if payload is not None:
+                    entry = json.loads(payload)
+                    self._store_local(key, entry)
+                    self._count('shared_hits')
+                    return entry
+            except Exception as e:
+                self._count('shared_errors')
+                self.logger.warning(f"ImageAnalysisCache: Shared tier lookup failed: {e}")
+        self._count('misses')
+        return None
+
+    def _store_local(self, key: str, entry: dict):
+        with self._local_lock:
+            try:
+                self._local[key] = entry
+            except ValueError:
+                pass # Single result larger than the whole local budget
+
+    def set(self, key: str, entry: dict):
+        """Stores an extraction result in both tiers. Failures are logged and ignored."""
+        self._store_local(key, entry)
+        self._count('writes')
+        if self._shared is None:
+            return
+        try:
+            self._shared.set(key, json.dumps(entry))
+        except Exception as e:
+            self._count('shared_errors')
+            self.logger.warning(f"ImageAnalysisCache: Shared tier write failed: {e}")
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        with self._local_lock:
+            stats['local_entries'] = len(self._local)
+            stats['local_bytes'] = int(self._local.currsize)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# --- Per-process instance ---
+_image_analysis_cache = None
+_image_analysis_cache_lock = threading.Lock()
+
+
+def get_image_analysis_cache():
+    """Returns the process-wide ImageAnalysisCache, or None when disabled in config."""
+    global _image_analysis_cache
+    app_config = current_app.config
+    if not app_config.get('IMAGE_ANALYSIS_CACHE_ENABLED', True):
+        return None
+    if _image_analysis_cache is None:
+        with _image_analysis_cache_lock:
+            if _image_analysis_cache is None:
+                _image_analysis_cache = ImageAnalysisCache(
+                    max_bytes=app_config.get('IMAGE_ANALYSIS_CACHE_MAX_BYTES', 8 * 1024 * 1024),
+                    ttl_seconds=app_config.get('IMAGE_ANALYSIS_CACHE_TTL_SECONDS', 24 * 3600),
+                    shared_backend=app_config.get('IMAGE_ANALYSIS_CACHE_SHARED_BACKEND', 'none'),
+                    redis_url=app_config.get('IMAGE_ANALYSIS_CACHE_REDIS_URL') or app_config.get('CELERY_BROKER_URL'),
+                    disk_path=app_config.get('IMAGE_ANALYSIS_CACHE_DISK_PATH'),
+                    shared_ttl_seconds=app_config.get('IMAGE_ANALYSIS_CACHE_SHARED_TTL_SECONDS', 30 * 24 * 3600),
+                    disk_max_bytes=app_config.get('IMAGE_ANALYSIS_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024),
+                    logger_instance=current_app.logger,
+                )
+    return _image_analysis_cache
@@ -10,26 +10,16 @@ import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 from datetime import datetime
-from pdfminer.high_level import extract_text as extract_text_from_pdf
-from docx import Document
+# pdfminer, python-docx and the LangChain splitter are imported where they are used:
+# the web process imports this module for run_ingestion_task and never parses files
 import chardet
 from celery.utils.log import get_task_logger
 import random # Added for jitter calculation
 
-# --- ADD LANGCHAIN SPLITTER IMPORT ---
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-# ------------------------------------
-
-# GCP imports
 # GCP imports
-import vertexai # Use Vertex AI SDK
-from google.cloud import storage
-# from vertexai.language_models import TextEmbeddingModel # Replaced with google.genai
-from google import genai # Added for new embedding model
-from google.genai.types import EmbedContentConfig # Added for new embedding model config
-from google.cloud import aiplatform # Keep for ME client
+# vertexai, google.cloud.storage/aiplatform and google.genai are imported in initialize_gcp_clients
+# and the embedding step, like the parsers above: the web process never initializes these clients
 from google.api_core.exceptions import GoogleAPICallError, ServiceUnavailable, ResourceExhausted, InternalServerError, DeadlineExceeded # Added more specific exceptions
-from google.genai import errors as google_genai_errors # Added for specific GenAI errors
 from requests.exceptions import Timeout, ConnectionError, HTTPError, RequestException # Added requests exceptions
 
 # Flask/App specific imports
@@ -39,6 +29,9 @@ from celery import current_app as celery_current_app # Use celery's current_app
 from app import db  # Import db session
 from celery_worker import celery_app # Import celery_app instance from its definition file
 from app.models import Chatbot, VectorIdMapping # Import models
+from app.services.chunk_cache import invalidate_chunk_cache
+from app.services.vector_backends import persist_chatbot_vectors
+from app.services.chunk_shards import source_hash_for, shard_blob_names, upload_source_shard
 
 # --- Import shared SSE utility ---
 # SSE push is now handled within Chatbot model methods, so this might be removable if not used elsewhere
@@ -99,6 +92,9 @@ INGESTION_RETRYABLE_EXCEPTIONS = (
 # No longer needs 'app' passed explicitly, uses current_app
 def initialize_gcp_clients():
     """Initializes Storage, Vertex AI Embedding Model, and Matching Engine Index clients."""
+    import vertexai
+    from google import genai
+    from google.cloud import aiplatform, storage
     logger = current_app.logger
     logger.info("Attempting to initialize GCP clients (Storage, Google GenAI Client, ME Index)...") # Updated log
     project_id = current_app.config.get('PROJECT_ID', PROJECT_ID)
@@ -239,6 +235,62 @@ def save_chunk_to_gcs(bucket, client_id, chatbot_id, source_identifier, chunk_in
     return None, None
 
 
+# --- Helper: Save all chunks of one source to GCS ---
+def save_source_chunks_to_gcs(bucket, client_id, chatbot_id, source_identifier, chunks: list, task_instance=None):
+    """
+    Saves the chunks of one source according to CHUNK_STORAGE_FORMAT:
+    'shard' packs them into one shard object plus an offset index (see chunk_shards),
+    'object' writes one GCS object per chunk (legacy layout).
+    Vector IDs are identical in both layouts.
+
+    Returns: (chunks_data list of {"id", "text", "source", "chunk_index"}, number of failed chunks)
+    Raises retryable GCS errors so the Celery task can retry.
+    """
+    logger = current_app.logger
+    log_source_id = (source_identifier[:75] + '...') if len(source_identifier) > 78 else source_identifier
+
+    if current_app.config.get('CHUNK_STORAGE_FORMAT', 'shard') != 'shard':
+        chunks_data = []
+        chunk_errors = 0
+        for i, chunk in enumerate(chunks):
+            # --- Start Inner Try-Except for chunk saving ---
+            try:
+                blob_name, vector_id = save_chunk_to_gcs(bucket, client_id, chatbot_id, source_identifier, i, chunk, task_instance=task_instance) # Pass chatbot_id
+                if blob_name and vector_id: chunks_data.append({"id": vector_id, "text": chunk, "source": source_identifier, "chunk_index": i})
+                else:
+                    logger.warning(f"Chatbot {chatbot_id}: Failed to save chunk {i} for {source_identifier} (save_chunk_to_gcs returned None).")
+                    chunk_errors += 1
+            except Exception as chunk_save_e:
+                logger.error(f"Chatbot {chatbot_id}: Error saving chunk {i} for {source_identifier}: {chunk_save_e}", exc_info=True)
+                chunk_errors += 1 # Continue to the next chunk within the same source
+            # --- End Inner Try-Except ---
+        return chunks_data, chunk_errors
+
+    hashed_source = source_hash_for(source_identifier)
+    try:
+        index = upload_source_shard(
+            bucket, chatbot_id, hashed_source, chunks,
+            codec=current_app.config.get('CHUNK_SHARD_COMPRESSION', 'none'),
+            level=current_app.config.get('CHUNK_SHARD_COMPRESSION_LEVEL', 3)
+        )
+        logger.info(f"Saved shard for '{log_source_id}': gs://{bucket.name}/{shard_blob_names(chatbot_id, hashed_source)[0]} ({len(chunks)} chunks, codec: {index['codec']})")
+    except GoogleAPICallError as gcs_err:
+        if isinstance(gcs_err, INGESTION_RETRYABLE_EXCEPTIONS):
+            logger.warning(f"Chatbot {chatbot_id}: Retryable GCS error saving shard for '{log_source_id}': {gcs_err}. Propagating for Celery retry.")
+            raise gcs_err # Propagate up
+        logger.error(f"Chatbot {chatbot_id}: Non-retryable GCS error saving shard for '{log_source_id}': {gcs_err}", exc_info=True)
+        return [], len(chunks)
+    except Exception as e:
+        logger.error(f"Chatbot {chatbot_id}: Failed to save shard for '{log_source_id}': {e}", exc_info=True)
+        return [], len(chunks)
+
+    chunks_data = [
+        {"id": f"chatbot_{chatbot_id}_source_{hashed_source}_chunk_{i}", "text": chunk, "source": source_identifier, "chunk_index": i}
+        for i, chunk in enumerate(chunks)
+    ]
+    return chunks_data, 0
+
+
 # --- Embeddings Generation (STREAM UPSERT VERSION) ---
 # Modified to use google-genai SDK and include retry logic via the bound task instance ('self')
 # Updated signature to accept genai_client instead of embedding_model
@@ -288,6 +340,7 @@ def generate_and_trigger_batch_update(task_instance, chatbot_id, client_id, gena
 
             try:
                 # --- Generate embedding for ONE chunk using GenAI Client ---
+                from google.genai.types import EmbedContentConfig
                 task_type_for_embedding = "RETRIEVAL_DOCUMENT" # Use DOCUMENT type for ingestion
 
                 api_response = genai_client.models.embed_content(
@@ -372,6 +425,8 @@ def generate_and_trigger_batch_update(task_instance, chatbot_id, client_id, gena
                         db.session.bulk_save_objects(all_mappings_to_save)
                         db.session.commit()
                         logger.info(f"Chatbot {chatbot_id}: Saved {len(all_mappings_to_save)} vector ID mappings to DB.")
+                        # Keep the embeddings (instead of discarding them after the upsert) for local search and re-indexing
+                        persist_chatbot_vectors(chatbot_id, [c["id"] for c in processed_chunks], [c["embedding"] for c in processed_chunks], bucket)
                     except Exception as mapping_db_error:
                         db.session.rollback() # Rollback DB changes if mapping save fails
                         logger.error(f"Chatbot {chatbot_id}: Failed to save vector ID mappings to DB: {mapping_db_error}", exc_info=True)
@@ -432,6 +487,7 @@ def process_uploaded_files(chatbot_id, client_id, uploaded_file_paths, storage_c
     file_errors = 0
     processed_files_count = 0 # Corrected indentation
 
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     # --- Instantiate the text splitter here ---
     # Uses parameters defined in constants
     # length_function=len counts characters, which is simpler and avoids extra tokenizer dependency/cost
@@ -450,8 +506,12 @@ def process_uploaded_files(chatbot_id, client_id, uploaded_file_paths, storage_c
          text = ""
          try:
              ext = os.path.splitext(filename)[1].lower()
-             if ext == '.pdf': text = extract_text_from_pdf(file_path)
-             elif ext == '.docx': doc = Document(file_path); text = '\n'.join([p.text for p in doc.paragraphs if p.text])
+             if ext == '.pdf':
+                 from pdfminer.high_level import extract_text as extract_text_from_pdf
+                 text = extract_text_from_pdf(file_path)
+             elif ext == '.docx':
+                 from docx import Document
+                 doc = Document(file_path); text = '\n'.join([p.text for p in doc.paragraphs if p.text])
              elif ext == '.txt':
                  with open(file_path, 'rb') as f: raw = f.read(); enc = chardet.detect(raw)['encoding'] or 'utf-8'; text = raw.decode(enc, errors='ignore')
              else: logger.warning(f"Skipping unsupported file: {filename}"); continue
@@ -464,21 +524,11 @@ def process_uploaded_files(chatbot_id, client_id, uploaded_file_paths, storage_c
              # --------------------------------------------
 
              logger.info(f"Chatbot {chatbot_id}: Split '{filename}' into {len(chunks)} chunks.")
-             for i, chunk in enumerate(chunks):
-                 source_id = f"file://{filename}" # Use original filename as source ID
-                 # Pass task_instance for potential GCS retry
-                 # --- Start Inner Try-Except for chunk saving ---
-                 try:
-                     blob_name, vector_id = save_chunk_to_gcs(bucket, client_id, chatbot_id, source_id, i, chunk, task_instance=task_instance) # Pass chatbot_id
-                     if blob_name and vector_id: all_chunks_data.append({"id": vector_id, "text": chunk, "source": source_id, "chunk_index": i})
-                     else:
-                         logger.warning(f"Chatbot {chatbot_id}: Failed to save chunk {i} for {source_id} (save_chunk_to_gcs returned None).")
-                         file_errors += 1
-                 except Exception as chunk_save_e:
-                     logger.error(f"Chatbot {chatbot_id}: Error saving chunk {i} for {source_id}: {chunk_save_e}", exc_info=True)
-                     file_errors += 1 # Increment file_errors for chunk-specific issues
-                     # Continue to the next chunk within the same file
-                 # --- End Inner Try-Except ---
+             source_id = f"file://{filename}" # Use original filename as source ID
+             # Pass task_instance for potential GCS retry
+             source_chunks_data, chunk_errors = save_source_chunks_to_gcs(bucket, client_id, chatbot_id, source_id, chunks, task_instance=task_instance)
+             all_chunks_data.extend(source_chunks_data)
+             file_errors += chunk_errors # Count chunk-specific issues as file errors
          except Exception as e: logger.error(f"Chatbot {chatbot_id}: FAILED processing file '{filename}': {e}", exc_info=True); file_errors += 1
 
     logger.info(f"Chatbot {chatbot_id}: File parsing finished. Processed: {processed_files_count}, Chunks generated: {len(all_chunks_data)}, Errors: {file_errors}.")
@@ -507,6 +557,7 @@ def process_web_source(chatbot_id, client_id, urls_to_process: list, source_type
     session = requests.Session()
     session.headers.update({'User-Agent': USER_AGENT})
 
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     # --- Instantiate the text splitter here ---
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=RECURSIVE_CHUNK_SIZE,
@@ -586,31 +637,10 @@ def process_web_source(chatbot_id, client_id, urls_to_process: list, source_type
             logger.info(f"Chatbot {chatbot_id}: Split '{url}' into {len(chunks)} chunks.")
 
             # Save chunks to GCS
-            file_errors = 0 # Track errors for this specific URL
-            for chunk_index, chunk in enumerate(chunks):
-                source_id = url # Use URL as source ID
-                # Pass task_instance for potential GCS retry
-                # --- Start Inner Try-Except for chunk saving ---
-                try:
-                    blob_name, vector_id = save_chunk_to_gcs(
-                        bucket, client_id, chatbot_id, source_id, chunk_index, chunk, task_instance=task_instance # Pass chatbot_id
-                    )
-
-                    if blob_name and vector_id: # Check if save was successful
-                        all_chunks_data.append({
-                            'id': vector_id,
-                            'text': chunk,
-                            'source': source_id, # Store URL as source
-                            'chunk_index': chunk_index
-                        })
-                    else:
-                        logger.warning(f"Chatbot {chatbot_id}: Failed to save chunk {chunk_index} for {source_id} (save_chunk_to_gcs returned None).")
-                        file_errors += 1 # Increment error count if save failed
-                except Exception as chunk_save_e:
-                    logger.error(f"Chatbot {chatbot_id}: Error saving chunk {chunk_index} for {source_id}: {chunk_save_e}", exc_info=True)
-                    file_errors += 1 # Increment file_errors for chunk-specific issues
-                    # Continue to the next chunk within the same URL
-                # --- End Inner Try-Except ---
+            source_id = url # Use URL as source ID
+            # Pass task_instance for potential GCS retry
+            source_chunks_data, file_errors = save_source_chunks_to_gcs(bucket, client_id, chatbot_id, source_id, chunks, task_instance=task_instance) # Track errors for this specific URL
+            all_chunks_data.extend(source_chunks_data)
 
             processed_count += 1
             logger.info(f"Chatbot {chatbot_id}: Successfully processed {url}")
@@ -918,6 +948,9 @@ def run_ingestion_task(self, chatbot_id, client_id, source_details):
             else:
                  logger.info(f"Task {self.request.id}: STEP 6: No processed files to cleanup.")
 
+            # Re-ingested sources overwrite their chunk blobs, so cached texts for this chatbot are stale
+            invalidate_chunk_cache(chatbot_id)
+
             # Update final status using model method
             chatbot.complete_index_operation(success=True, total_chunks=total_chunks_processed)
             # Note: complete_index_operation commits and pushes SSE
@@ -1016,6 +1049,7 @@ def run_ingestion_task(self, chatbot_id, client_id, source_details):
                     db.session.rollback() # Rollback if status update fails
             # --- Final Failure (Non-retryable or Max Retries Exceeded) ---
             logger.error(f"Task {self.request.id}: FINAL FAILURE for Chatbot {chatbot_id} after {self.request.retries} retries: {e}", exc_info=True)
+            invalidate_chunk_cache(chatbot_id) # Some chunk blobs may already have been overwritten
             # Update final status using model method
             if chatbot:
                 try:
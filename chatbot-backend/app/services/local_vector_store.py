@@ -0,0 +1,421 @@
+# app/services/local_vector_store.py
+"""
+On-disk per-chatbot embedding matrices, written at ingestion and searched in-process.
+
+Layout (one directory per chatbot and embedding model):
+
+  {root}/chatbot_{id}/{model}/manifest.json    - {"format", "dtype", "dim", "count", "tombstones",
+                                                   "model", "rows_version", "updated_at"}
+                              vectors.bin      - (count, dim) unit-normalized float16 or int8, row-major
+                              scales.bin       - (count,) float32 per-row scales (int8 only)
+                              ids.txt          - one vector ID per line, row-aligned with vectors.bin
+                              tombstones.txt   - one deleted row index per line
+
+The data files are append-only: new rows are appended and the manifest (written
+last, atomically) says how many rows are valid, so a crashed append is simply
+truncated away by the next one. Deletes append tombstones; compact() rewrites the
+directory without them. Re-adding an existing vector ID tombstones the old row.
+
+Vectors are normalized before storing, so a dot product is the cosine similarity
+and distances are reported as 1 - cosine (lower is closer, like the Matching
+Engine distances used by retrieve_chunks_multi_query). vectors.bin is opened with
+numpy memory mapping, so only the pages touched by a search are read.
+
+The same files are mirrored to GCS under chatbot_{id}/vectors/{model}/ with
+backup_to_gcs / restore_from_gcs, so the store survives worker restarts and can
+be shared by hosts that didn't run the ingestion.
+"""
+import contextlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; the in-process lock still applies
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+SUPPORTED_DTYPES = ('float16', 'int8')
+STORE_FILES = ('vectors.bin', 'scales.bin', 'ids.txt', 'tombstones.txt')
+MANIFEST_FILE = 'manifest.json'
+_SEARCH_BLOCK_ROWS = 16384 # Rows converted to float32 at a time during brute-force search
+_MODEL_SLUG_RE = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+def model_slug(model_name: str) -> str:
+    return _MODEL_SLUG_RE.sub('_', model_name)
+
+
+def gcs_backup_prefix(chatbot_id, model_name: str = None) -> str:
+    """GCS prefix of a chatbot's vector backups (all models when model_name is None)."""
+    prefix = f"chatbot_{chatbot_id}/vectors/"
+    return prefix + f"{model_slug(model_name)}/" if model_name else prefix
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def quantize_rows(vectors: np.ndarray, dtype: str):
+    """Returns (stored matrix, per-row scales or None) for unit-normalized float32 rows."""
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+    return vectors.astype(np.float16), None
+
+
+class LocalVectorSet:
+    """A loaded (memory-mapped) matrix for one chatbot/model."""
+
+    def __init__(self, ids: list, matrix, scales=None, live_mask=None, version: str = None, rows_version: str = None):
+        self.ids = ids
+        self.matrix = matrix
+        self.scales = scales
+        self.live_mask = live_mask # bool (count,), None when nothing is tombstoned
+        self.version = version # Changes on every write (appends, deletes, compaction)
+        self.rows_version = rows_version # Changes only when rows are added or rewritten
+        self.count = len(ids)
+        self.dim = matrix.shape[1] if matrix is not None and matrix.ndim == 2 else 0
+
+    @property
+    def live_count(self) -> int:
+        return self.count if self.live_mask is None else int(self.live_mask.sum())
+
+    def row_block(self, start: int, end: int) -> np.ndarray:
+        block = np.asarray(self.matrix[start:end], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[start:end, None]
+        return block
+
+    def combined_mask(self, row_mask: np.ndarray = None):
+        if row_mask is None:
+            return self.live_mask
+        return row_mask if self.live_mask is None else (row_mask & self.live_mask)
+
+    def search(self, queries: np.ndarray, k: int, row_mask: np.ndarray = None) -> list:
+        """
+        Brute-force top-k for unit-normalized float32 queries (q, dim). Tombstoned rows are skipped;
+        `row_mask` (bool, count) also excludes rows where False. Returns per-query [(vector_id, distance), ...].
+        """
+        if self.count == 0 or k <= 0:
+            return [[] for _ in range(len(queries))]
+        scores = np.empty((len(queries), self.count), dtype=np.float32)
+        for start in range(0, self.count, _SEARCH_BLOCK_ROWS):
+            end = min(start + _SEARCH_BLOCK_ROWS, self.count)
+            scores[:, start:end] = queries @ self.row_block(start, end).T
+        mask = self.combined_mask(row_mask)
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for q_index, candidates in enumerate(top):
+            ordered = candidates[np.argsort(-scores[q_index, candidates])]
+            results.append([
+                (self.ids[row], float(1.0 - scores[q_index, row]))
+                for row in ordered if np.isfinite(scores[q_index, row])
+            ])
+        return results
+
+
+class LocalVectorStore:
+    def __init__(self, root: str, dtype: str = 'float16', logger_instance=None):
+        self.root = os.path.abspath(root)
+        self.dtype = dtype if dtype in SUPPORTED_DTYPES else 'float16'
+        self.logger = logger_instance or logger
+        self._write_lock = threading.Lock()
+        self._loaded = {} # directory -> LocalVectorSet
+        self._loaded_lock = threading.Lock()
+
+    def directory(self, chatbot_id, model_name: str) -> str:
+        return os.path.join(self.root, f"chatbot_{chatbot_id}", model_slug(model_name))
+
+    def list_stores(self) -> list:
+        """Returns [(chatbot_id, model directory name), ...] for every store on disk."""
+        stores = []
+        if not os.path.isdir(self.root):
+            return stores
+        for chatbot_dir in os.listdir(self.root):
+            if not chatbot_dir.startswith('chatbot_') or not chatbot_dir[8:].isdigit():
+                continue
+            for model_dir in os.listdir(os.path.join(self.root, chatbot_dir)):
+                if os.path.exists(os.path.join(self.root, chatbot_dir, model_dir, MANIFEST_FILE)):
+                    stores.append((int(chatbot_dir[8:]), model_dir))
+        return stores
+
+    def read_manifest(self, chatbot_id, model_name: str) -> dict | None:
+        return self._read_manifest_at(self.directory(chatbot_id, model_name))
+
+    @staticmethod
+    def _read_manifest_at(directory: str) -> dict | None:
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_manifest_at(directory: str, manifest: dict):
+        manifest["updated_at"] = time.time()
+        temp_path = os.path.join(directory, f"{MANIFEST_FILE}.tmp-{os.getpid()}-{threading.get_ident()}")
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, os.path.join(directory, MANIFEST_FILE))
+
+    @contextlib.contextmanager
+    def _locked(self, chatbot_id, model_name: str):
+        """Serializes writers of one store across threads and (where fcntl exists) processes."""
+        directory = self.directory(chatbot_id, model_name)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        with self._write_lock:
+            with open(f"{directory}.lock", 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield directory
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # --- Reading ---
+    @staticmethod
+    def _read_lines(path: str, limit: int) -> list:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return [line.rstrip('\n') for _, line in zip(range(limit), f)]
+        except FileNotFoundError:
+            return []
+
+    def _read_tombstones(self, directory: str, count: int) -> set:
+        try:
+            with open(os.path.join(directory, 'tombstones.txt'), 'r') as f:
+                return {int(line) for line in f if line.strip().isdigit() and int(line) < count}
+        except FileNotFoundError:
+            return set()
+
+    def load(self, chatbot_id, model_name: str) -> LocalVectorSet | None:
+        """Returns the memory-mapped vectors of a chatbot/model (cached until the manifest changes), or None."""
+        directory = self.directory(chatbot_id, model_name)
+        manifest = self._read_manifest_at(directory)
+        if not manifest:
+            return None
+        version = str(manifest.get("updated_at"))
+        with self._loaded_lock:
+            cached = self._loaded.get(directory)
+            if cached is not None and cached.version == version:
+                return cached
+        count, dim, dtype = manifest.get("count", 0), manifest.get("dim", 0), manifest.get("dtype", 'float16')
+        try:
+            ids = self._read_lines(os.path.join(directory, 'ids.txt'), count)
+            if len(ids) != count:
+                raise ValueError(f"ids.txt has {len(ids)} rows, manifest says {count}")
+            matrix = np.memmap(os.path.join(directory, 'vectors.bin'), dtype=dtype, mode='r', shape=(count, dim)) if count else np.zeros((0, dim), dtype=dtype)
+            scales = np.fromfile(os.path.join(directory, 'scales.bin'), dtype=np.float32, count=count) if dtype == 'int8' and count else None
+            tombstones = self._read_tombstones(directory, count)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"LocalVectorStore: Failed to load vectors for chatbot {chatbot_id}: {e}")
+            return None
+        live_mask = None
+        if tombstones:
+            live_mask = np.ones(count, dtype=bool)
+            live_mask[list(tombstones)] = False
+        vector_set = LocalVectorSet(ids, matrix, scales, live_mask, version, str(manifest.get("rows_version")))
+        with self._loaded_lock:
+            self._loaded[directory] = vector_set
+        return vector_set
+
+    def read_vectors(self, chatbot_id, model_name: str):
+        """Returns (live vector IDs, float32 unit-normalized matrix) for offline re-indexing, or ([], None)."""
+        vector_set = self.load(chatbot_id, model_name)
+        if vector_set is None or vector_set.live_count == 0:
+            return [], None
+        matrix = vector_set.row_block(0, vector_set.count)
+        if vector_set.live_mask is None:
+            return list(vector_set.ids), matrix
+        rows = np.flatnonzero(vector_set.live_mask)
+        return [vector_set.ids[row] for row in rows], matrix[rows]
+
+    # --- Writing ---
+    def _write_directory(self, directory: str, model_name: str, dtype: str, ids: list, stored: np.ndarray, scales, rows_version: str):
+        """Writes a complete store to a staging directory and swaps it in."""
+        staging = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        np.ascontiguousarray(stored).tofile(os.path.join(staging, 'vectors.bin'))
+        if scales is not None:
+            np.asarray(scales, dtype=np.float32).tofile(os.path.join(staging, 'scales.bin'))
+        with open(os.path.join(staging, 'ids.txt'), 'w', encoding='utf-8') as f:
+            f.writelines(f"{vector_id}\n" for vector_id in ids)
+        manifest = {
+            "format": STORE_FORMAT_VERSION, "dtype": dtype, "dim": int(stored.shape[1]) if stored.ndim == 2 else 0,
+            "count": len(ids), "tombstones": 0, "model": model_name, "rows_version": rows_version,
+        }
+        self._write_manifest_at(staging, manifest)
+        previous = f"{directory}.old-{os.getpid()}-{threading.get_ident()}"
+        if os.path.isdir(directory):
+            os.replace(directory, previous)
+        os.replace(staging, directory)
+        shutil.rmtree(previous, ignore_errors=True)
+        return manifest
+
+    def write(self, chatbot_id, model_name: str, ids: list, vectors) -> dict:
+        """Replaces the stored vectors of a chatbot/model."""
+        matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        stored, scales = quantize_rows(matrix, self.dtype)
+        with self._locked(chatbot_id, model_name) as directory:
+            manifest = self._write_directory(directory, model_name, self.dtype, list(ids), stored, scales, f"{time.time()}")
+        self.logger.info(f"LocalVectorStore: Wrote {len(ids)} vectors ({self.dtype}) for chatbot {chatbot_id}, model '{model_name}'.")
+        return manifest
+
+    def append(self, chatbot_id, model_name: str, ids: list, vectors) -> dict:
+        """
+        Appends vectors for a chatbot/model, creating the store if needed. IDs that are
+        already stored have their old rows tombstoned. Raises ValueError on a dimension mismatch.
+        """
+        if not ids:
+            return self.read_manifest(chatbot_id, model_name) or {}
+        matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        with self._locked(chatbot_id, model_name) as directory:
+            manifest = self._read_manifest_at(directory)
+            if manifest is None:
+                stored, scales = quantize_rows(matrix, self.dtype)
+                return self._write_directory(directory, model_name, self.dtype, list(ids), stored, scales, f"{time.time()}")
+            if manifest["dim"] != matrix.shape[1]:
+                raise ValueError(f"Vector dimension {matrix.shape[1]} does not match stored dimension {manifest['dim']} for chatbot {chatbot_id}.")
+
+            dtype, count = manifest["dtype"], manifest["count"]
+            stored, scales = quantize_rows(matrix, dtype)
+            existing_ids = self._read_lines(os.path.join(directory, 'ids.txt'), count)
+            tombstones = self._read_tombstones(directory, count)
+            new_ids = set(ids)
+            replaced = [row for row, vector_id in enumerate(existing_ids) if vector_id in new_ids and row not in tombstones]
+
+            # Drop anything past the last committed row (left behind by an interrupted append)
+            with open(os.path.join(directory, 'vectors.bin'), 'ab') as f:
+                f.truncate(count * manifest["dim"] * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(stored).tobytes())
+            if scales is not None:
+                with open(os.path.join(directory, 'scales.bin'), 'ab') as f:
+                    f.truncate(count * 4)
+                    f.write(scales.tobytes())
+            with open(os.path.join(directory, 'ids.txt'), 'w', encoding='utf-8') as f:
+                f.writelines(f"{vector_id}\n" for vector_id in existing_ids + list(ids))
+            if replaced:
+                with open(os.path.join(directory, 'tombstones.txt'), 'a') as f:
+                    f.writelines(f"{row}\n" for row in replaced)
+
+            manifest.update(count=count + len(ids), tombstones=len(tombstones) + len(replaced), rows_version=f"{time.time()}")
+            self._write_manifest_at(directory, manifest)
+        self.logger.info(f"LocalVectorStore: Appended {len(ids)} vectors for chatbot {chatbot_id} ({len(replaced)} replaced, {manifest['count']} rows).")
+        return manifest
+
+    def delete(self, chatbot_id, model_name: str, vector_ids: list = None, id_prefix: str = None) -> int:
+        """Tombstones the given vector IDs and/or every ID starting with id_prefix. Returns rows tombstoned."""
+        wanted = set(vector_ids or [])
+        with self._locked(chatbot_id, model_name) as directory:
+            manifest = self._read_manifest_at(directory)
+            if manifest is None:
+                return 0
+            count = manifest["count"]
+            existing_ids = self._read_lines(os.path.join(directory, 'ids.txt'), count)
+            tombstones = self._read_tombstones(directory, count)
+            rows = [
+                row for row, vector_id in enumerate(existing_ids)
+                if row not in tombstones and (vector_id in wanted or (id_prefix and vector_id.startswith(id_prefix)))
+            ]
+            if not rows:
+                return 0
+            with open(os.path.join(directory, 'tombstones.txt'), 'a') as f:
+                f.writelines(f"{row}\n" for row in rows)
+            manifest["tombstones"] = len(tombstones) + len(rows)
+            self._write_manifest_at(directory, manifest)
+        self.logger.info(f"LocalVectorStore: Tombstoned {len(rows)} vectors for chatbot {chatbot_id} ({manifest['tombstones']}/{count} rows dead).")
+        return len(rows)
+
+    def delete_chatbot(self, chatbot_id):
+        """Removes every store of a chatbot."""
+        with self._write_lock:
+            shutil.rmtree(os.path.join(self.root, f"chatbot_{chatbot_id}"), ignore_errors=True)
+        with self._loaded_lock:
+            prefix = os.path.join(self.root, f"chatbot_{chatbot_id}") + os.sep
+            self._loaded = {k: v for k, v in self._loaded.items() if not k.startswith(prefix)}
+
+    @staticmethod
+    def tombstone_ratio(manifest: dict | None) -> float:
+        if not manifest or not manifest.get("count"):
+            return 0.0
+        return manifest.get("tombstones", 0) / manifest["count"]
+
+    def compact(self, chatbot_id, model_name: str) -> dict | None:
+        """Rewrites a store without its tombstoned rows (stored values are copied, not re-quantized)."""
+        with self._locked(chatbot_id, model_name) as directory:
+            manifest = self._read_manifest_at(directory)
+            if manifest is None or not manifest.get("tombstones"):
+                return manifest
+            count, dim, dtype = manifest["count"], manifest["dim"], manifest["dtype"]
+            existing_ids = self._read_lines(os.path.join(directory, 'ids.txt'), count)
+            tombstones = self._read_tombstones(directory, count)
+            live_rows = np.array([row for row in range(count) if row not in tombstones], dtype=np.int64)
+            matrix = np.fromfile(os.path.join(directory, 'vectors.bin'), dtype=dtype, count=count * dim).reshape(count, dim)
+            scales = np.fromfile(os.path.join(directory, 'scales.bin'), dtype=np.float32, count=count) if dtype == 'int8' else None
+            compacted = self._write_directory(
+                directory, model_name, dtype, [existing_ids[row] for row in live_rows],
+                matrix[live_rows], scales[live_rows] if scales is not None else None, f"{time.time()}"
+            )
+        self.logger.info(f"LocalVectorStore: Compacted chatbot {chatbot_id} store from {count} to {compacted['count']} rows.")
+        return compacted
+
+    # --- GCS mirror ---
+    def backup_to_gcs(self, bucket, chatbot_id, model_name: str) -> bool:
+        """Uploads a store to GCS (manifest last). Returns False if there is nothing to upload."""
+        with self._locked(chatbot_id, model_name) as directory:
+            manifest = self._read_manifest_at(directory)
+            if manifest is None:
+                return False
+            prefix = gcs_backup_prefix(chatbot_id, model_name)
+            for file_name in STORE_FILES:
+                path = os.path.join(directory, file_name)
+                if os.path.exists(path):
+                    bucket.blob(prefix + file_name).upload_from_filename(path, content_type='application/octet-stream')
+            bucket.blob(prefix + MANIFEST_FILE).upload_from_string(json.dumps(manifest), content_type='application/json')
+        return True
+
+    def restore_from_gcs(self, bucket, chatbot_id, model_name: str) -> bool:
+        """Downloads a store from GCS when the backup is newer than the local copy. Returns True if restored."""
+        prefix = gcs_backup_prefix(chatbot_id, model_name)
+        manifest_blob = bucket.blob(prefix + MANIFEST_FILE)
+        if not manifest_blob.exists():
+            return False
+        remote_manifest = json.loads(manifest_blob.download_as_text(encoding='utf-8'))
+        local_manifest = self.read_manifest(chatbot_id, model_name)
+        if local_manifest and local_manifest.get("updated_at", 0) >= remote_manifest.get("updated_at", 0):
+            return False
+        with self._locked(chatbot_id, model_name) as directory:
+            staging = f"{directory}.restore-{os.getpid()}-{threading.get_ident()}"
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            for file_name in STORE_FILES:
+                blob = bucket.blob(prefix + file_name)
+                if blob.exists():
+                    blob.download_to_filename(os.path.join(staging, file_name))
+            with open(os.path.join(staging, MANIFEST_FILE), 'w') as f:
+                json.dump(remote_manifest, f) # Keep the remote updated_at so the next sync compares equal
+            previous = f"{directory}.old-{os.getpid()}-{threading.get_ident()}"
+            if os.path.isdir(directory):
+                os.replace(directory, previous)
+            os.replace(staging, directory)
+            shutil.rmtree(previous, ignore_errors=True)
+        self.logger.info(f"LocalVectorStore: Restored chatbot {chatbot_id} store ({remote_manifest.get('count')} rows) from GCS.")
+        return True
@@ -0,0 +1,157 @@
+# app/services/prompt_budget.py
+"""
+Token-budgeted context assembly for construct_prompt.
+
+Retrieved chunks used to be pasted in rerank order until MAX_CONTEXT_CHARS was
+reached. Ingestion splits documents with RECURSIVE_CHUNK_OVERLAP characters of
+overlap, so neighbouring chunks of the same source repeated that text in the prompt.
+assemble_context() instead:
+
+- Groups chunks by source (from the chatbot_{id}_source_{hash}_chunk_{index} vector
+  ID) and merges runs of consecutive chunk indices into one section, dropping the
+  overlap each chunk shares with the one before it.
+- Ranks each section by its best-ranked chunk and fills MAX_CONTEXT_TOKENS in that
+  order. A section that doesn't fit falls back to its best chunk alone, and smaller
+  sections further down can still use the remaining budget.
+
+Tokens are counted locally with tiktoken (an approximation of Gemini's tokenizer,
+which is good enough for budgeting). If tiktoken or its encoding file is unavailable,
+counts fall back to a characters/4 estimate.
+"""
+import logging
+import math
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def _estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / 4)
+
+
+def get_token_counter(encoding_name: str = "cl100k_base"):
+    """Returns a text -> token count function for the encoding (loaded once per process)."""
+    with _encoders_lock:
+        if encoding_name not in _encoders:
+            encoder = None
+            if tiktoken is not None:
+                try:
+                    encoder = tiktoken.get_encoding(encoding_name)
+                except Exception as e: # Unknown encoding, or the encoding file couldn't be downloaded
+                    logger.warning(f"prompt_budget: Could not load tiktoken encoding '{encoding_name}' ({e}); estimating tokens from length.")
+            _encoders[encoding_name] = encoder
+        encoder = _encoders[encoding_name]
+    if encoder is None:
+        return _estimate_tokens
+    return lambda text: len(encoder.encode(text, disallowed_special=()))
+
+
+def parse_chunk_position(vector_id: str) -> tuple[str, int] | None:
+    """Returns (source_hash, chunk_index) for chatbot_{id}_source_{hash}_chunk_{index}, or None."""
+    parts = vector_id.split('_') if vector_id else []
+    if len(parts) < 6 or parts[0] != 'chatbot' or parts[2] != 'source' or parts[4] != 'chunk':
+        return None
+    try:
+        return parts[3], int(parts[5])
+    except ValueError:
+        return None
+
+
+def strip_overlap(previous: str, following: str, max_overlap: int = 200, min_overlap: int = 8) -> tuple[str, int]:
+    """
+    Removes the longest prefix of `following` (at most max_overlap chars) that repeats the end of
+    `previous`. Returns (remaining text, number of characters removed).
+    """
+    head = previous.rstrip()
+    tail = following.lstrip()
+    for size in range(min(len(head), len(tail), max_overlap), min_overlap - 1, -1):
+        if head.endswith(tail[:size]):
+            return tail[size:].lstrip(), len(following) - len(tail[size:].lstrip())
+    return following, 0
+
+
+def _merge_run(texts: list, max_overlap: int) -> tuple[str, int]:
+    merged = texts[0]
+    removed_total = 0
+    for text in texts[1:]:
+        remainder, removed = strip_overlap(merged, text, max_overlap)
+        removed_total += removed
+        if not remainder:
+            continue
+        # Overlap-free continuation of the same passage reads as one block; otherwise keep a paragraph break
+        merged = f"{merged.rstrip()} {remainder}" if removed else f"{merged.rstrip()}\n\n{remainder}"
+    return merged, removed_total
+
+
+def assemble_context(texts: list, vector_ids: list = None, max_tokens: int = 2200, count_tokens=None,
+                     max_overlap: int = 200, separator: str = "\n\n") -> tuple[list, dict]:
+    """
+    Builds "--- Context Section N ---" sections from texts in relevance order (best first).
+    vector_ids, when given, must align with texts and enables merging of adjacent chunks.
+    Returns (sections, stats); stats includes "context_tokens", the tokens the sections use.
+    """
+    count_tokens = count_tokens or _estimate_tokens
+    vector_ids = vector_ids if vector_ids and len(vector_ids) == len(texts) else [None] * len(texts)
+
+    # Each unit is one section candidate: (best rank, [member texts in document order])
+    runs_by_source = {}
+    units = []
+    seen_texts = set()
+    for rank, (text, vector_id) in enumerate(zip(texts, vector_ids)):
+        if not text or text in seen_texts:
+            continue
+        seen_texts.add(text)
+        position = parse_chunk_position(vector_id)
+        if position is None:
+            units.append((rank, [(rank, text)]))
+        else:
+            runs_by_source.setdefault(position[0], []).append((position[1], rank, text))
+    for chunks in runs_by_source.values():
+        chunks.sort()
+        run = [chunks[0]]
+        for chunk in chunks[1:]:
+            if chunk[0] != run[-1][0] + 1:
+                units.append((min(r for _, r, _ in run), [(r, t) for _, r, t in run]))
+                run = []
+            run.append(chunk)
+        units.append((min(r for _, r, _ in run), [(r, t) for _, r, t in run]))
+    units.sort(key=lambda unit: unit[0])
+
+    sections = []
+    tokens_used = 0
+    included_chunks = 0
+    overlap_chars_removed = 0
+    separator_tokens = count_tokens(separator)
+    for best_rank, members in units:
+        candidates = []
+        if len(members) > 1:
+            merged, removed = _merge_run([text for _, text in members], max_overlap)
+            candidates.append((merged, len(members), removed))
+        candidates.append((next(text for rank, text in members if rank == best_rank), 1, 0))
+        for text, chunk_count, removed in candidates:
+            section = f"--- Context Section {len(sections) + 1} ---\n{text}"
+            section_tokens = count_tokens(section) + (separator_tokens if sections else 0)
+            if tokens_used + section_tokens <= max_tokens:
+                sections.append(section)
+                tokens_used += section_tokens
+                included_chunks += chunk_count
+                overlap_chars_removed += removed
+                break
+
+    stats = {
+        "context_tokens": tokens_used,
+        "context_token_budget": max_tokens,
+        "sections": len(sections),
+        "chunks_included": included_chunks,
+        "chunks_total": len(texts),
+        "overlap_chars_removed": overlap_chars_removed,
+    }
+    return sections, stats
@@ -0,0 +1,134 @@
+# app/services/rag_router.py
+"""
+Per-query routing between the standard and advanced RAG pipelines.
+
+Chatbots with advanced_rag_enabled used to send every query through
+process_advanced_query (intent recognition, decomposition, query variations,
+hybrid retrieval and cross-encoder reranking - 6 to 15 LLM calls), even for
+"what are your opening hours?". With ADAPTIVE_RAG_ROUTING_ENABLED, such queries
+first go through cheap checks and only escalate when the standard pipeline is
+likely to fall short:
+
+- Query signals (no I/O): long queries, queries with several clauses or
+  questions, and short follow-ups that lean on the chat history ("what about
+  the second one?") - the standard pipeline retrieves on the raw query only.
+- Retrieval signals: the standard pipeline's first step (one embedding, one
+  vector search) runs as a probe. A weak best match, or a flat distance
+  distribution where no chunk stands out, escalates. Otherwise the probe's
+  embedding and neighbors are reused by the standard pipeline, so a query that
+  stays standard pays nothing extra.
+
+Distances are the vector backend's (cosine distance: smaller is closer).
+"""
+import re
+
+# References back to earlier turns. Only words that cannot stand on their own count, so
+# self-contained questions ("Is there parking?", "Do you have more sizes?") stay standard:
+# - personal pronouns, except expletive "it" ("is it possible to ...")
+# - demonstratives with no noun after them ("how much is that?", not "this product's price")
+# - "one(s)" after an ordinal or determiner ("the second one", not "return one item")
+_ANAPHORIC_PRONOUNS = frozenset({'it', 'its', 'they', 'them', 'their', 'theirs', 'he', 'she', 'him', 'her', 'his', 'former', 'latter'})
+_DEMONSTRATIVES = frozenset({'this', 'that', 'these', 'those'})
+# Words after a demonstrative that show it stands alone rather than determining a noun
+_NON_NOUN_FOLLOWERS = frozenset({
+    'is', 'are', 'was', 'were', 'be', 'does', 'do', 'did', 'can', 'will', 'would', 'cost', 'costs', 'come', 'comes',
+    'work', 'works', 'mean', 'include', 'includes', 'in', 'on', 'for', 'with', 'to', 'at', 'from', 'also', 'too',
+    'still', 'available', 'one', 'ones',
+})
+_ONE_DETERMINERS = frozenset({
+    'first', 'second', 'third', 'fourth', 'last', 'other', 'same', 'this', 'that', 'which', 'another', 'previous',
+    'cheaper', 'cheapest', 'bigger', 'biggest', 'smaller', 'smallest', 'better', 'best',
+})
+_EXPLETIVE_IT_PATTERN = re.compile(r"\bit(?:'s|\s+is)?\s+(?:possible|ok(?:ay)?|necessary|required|true|safe|free)\b", re.IGNORECASE)
+_FOLLOW_UP_PREFIXES = ('and ', 'what about', 'how about', 'also ', 'but ', 'so ')
+# Clause boundaries: question/semicolon breaks, comparisons, and conjunctions that start a new question
+# ("... and do you deliver?") - a plain "and" between nouns ("black and white printers") is not one
+_CLAUSE_SPLIT_PATTERN = re.compile(
+    r"[?;]|\b(?:versus|vs\.?|compared? (?:to|with))\b"
+    r"|\b(?:and|or|also|then|but)\s+(?=(?:what|how|why|when|where|who|which|do|does|did|is|are|can|could|will|would|should)\b)",
+    re.IGNORECASE,
+)
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+DEFAULT_THRESHOLDS = {
+    'long_query_words': 25, # Queries longer than this escalate
+    'max_clauses': 1, # More clauses/questions than this escalate
+    'follow_up_max_words': 8, # Short queries with anaphora are treated as history-dependent
+    'max_best_distance': 0.45, # Best match farther than this is weak
+    'confident_distance': 0.30, # Best match closer than this is trusted even if scores are flat
+    'min_distance_spread': 0.02, # Top-k distances closer together than this are "flat"
+}
+
+
+def _refers_back(words: list, lowered: str) -> bool:
+    """True if the query leans on an earlier turn for its subject (see _ANAPHORIC_PRONOUNS)."""
+    expletive_its = len(_EXPLETIVE_IT_PATTERN.findall(lowered))
+    for i, word in enumerate(words):
+        following = words[i + 1] if i + 1 < len(words) else None
+        if word in _ANAPHORIC_PRONOUNS:
+            if word == 'it' and expletive_its:
+                expletive_its -= 1
+                continue
+            return True
+        if word in _DEMONSTRATIVES and (following is None or following in _NON_NOUN_FOLLOWERS):
+            return True
+        if word in ('one', 'ones') and i > 0 and words[i - 1] in _ONE_DETERMINERS:
+            return True
+    return False
+
+
+def query_signals(query: str, chat_history: list = None) -> dict:
+    """Features of the query text itself; computed without any I/O."""
+    text = (query or '').strip()
+    words = _WORD_PATTERN.findall(text.lower())
+    clauses = [part for part in _CLAUSE_SPLIT_PATTERN.split(text) if part and _WORD_PATTERN.search(part)]
+    has_history = bool(chat_history)
+    lowered = text.lower()
+    history_dependent = has_history and (_refers_back(words, lowered) or lowered.startswith(_FOLLOW_UP_PREFIXES))
+    return {
+        'words': len(words),
+        'clauses': max(1, len(clauses)),
+        'question_marks': text.count('?'),
+        'history_dependent': history_dependent,
+    }
+
+
+def retrieval_signals(neighbors: list | None) -> dict:
+    """Features of one query's [(vector_id, distance), ...] neighbor list (None if the search failed)."""
+    if not neighbors:
+        return {'neighbors': 0, 'best_distance': None, 'distance_spread': None, 'failed': neighbors is None}
+    distances = sorted(distance for _, distance in neighbors)
+    return {
+        'neighbors': len(distances),
+        'best_distance': round(distances[0], 4),
+        'distance_spread': round(distances[-1] - distances[0], 4),
+        'failed': False,
+    }
+
+
+def escalation_reasons_for_query(signals: dict, thresholds: dict = None) -> list:
+    """Reasons (possibly none) to use the advanced pipeline, from query signals alone."""
+    thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    reasons = []
+    if signals['words'] > thresholds['long_query_words']:
+        reasons.append('long_query')
+    if signals['clauses'] > thresholds['max_clauses'] or signals['question_marks'] > 1:
+        reasons.append('multi_part_query')
+    if signals['history_dependent'] and signals['words'] <= thresholds['follow_up_max_words']:
+        reasons.append('history_dependent')
+    return reasons
+
+
+def escalation_reasons_for_retrieval(signals: dict, thresholds: dict = None) -> list:
+    """Reasons (possibly none) to use the advanced pipeline, from the probe retrieval."""
+    thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    if signals['failed']:
+        return [] # The advanced pipeline searches the same backend; let the standard path report the failure
+    if not signals['neighbors']:
+        return ['no_matches']
+    best = signals['best_distance']
+    if best > thresholds['max_best_distance']:
+        return ['weak_best_match']
+    if signals['neighbors'] > 1 and best > thresholds['confident_distance'] and signals['distance_spread'] < thresholds['min_distance_spread']:
+        return ['flat_scores']
+    return []
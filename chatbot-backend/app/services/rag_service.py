@@ -1,52 +1,59 @@
 # app/services/rag_service.py
 
+import copy
 import hashlib
 import os
 import traceback
 import json
 import time
 # import re # Removed as generate_rephrased_queries is removed
-import functools
 import uuid
 import logging
 from collections import defaultdict
 import concurrent.futures
+import threading
+from typing import TYPE_CHECKING
 from google.api_core import exceptions as api_core_exceptions
-from google.cloud import storage
-from google.cloud import aiplatform
-from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
 from google.api_core.exceptions import GoogleAPICallError, NotFound as GoogleNotFound, ResourceExhausted
 from flask import current_app
-import vertexai
 # from google.cloud import translate_v2 as translate # Removed as detection/translation is skipped here
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import select
 
 # Vertex AI SDK imports
-# from vertexai.language_models import TextEmbeddingModel # Replaced with google.genai
-from google import genai # Added for new embedding model
-from google.genai.types import EmbedContentConfig # Added for new embedding model
-from vertexai.generative_models import (
-    GenerativeModel,
-    Part,
-    GenerationConfig,
-    FinishReason,
-    HarmCategory,
-    HarmBlockThreshold
-)
+if TYPE_CHECKING:
+    from vertexai.generative_models import GenerationConfig
+# vertexai, google.cloud.aiplatform/storage and google.genai are imported where they are first
+# used (client initialization, generation): together they are most of the app's import time
 
 # Application-specific imports
 from app import db
 from app.models import VectorIdMapping, Chatbot, ChatMessage, DetailedFeedback, UsageLog, User
-from app.services import advanced_rag_service
-from app.services.ranking_service import RankingService
+from app.services.embedding_cache import get_embedding_cache
+from app.services.chunk_cache import get_chunk_cache, invalidate_chunk_cache
+from app.services.chunk_shards import shard_blob_names, load_shard_index_text, plan_range_reads, read_shard_range, split_range
+from app.services.answer_cache import get_answer_cache, chatbot_answer_fingerprint, answer_cache_applies
+from app.services.stage_scheduler import StageScheduler, StageFailedError
+from app.services.chatbot_config_cache import get_chatbot_config
+from app.services.usage_logger import build_usage_record, log_usage_record
+from app.services.prompt_budget import assemble_context, get_token_counter
+from app.services.chat_history import format_history, SUMMARY_ROLE
+from app.services.image_analysis_cache import get_image_analysis_cache, image_analysis_key
+from app.services.single_flight import get_single_flight, coalescing_key
+from app.services.rag_router import query_signals, retrieval_signals, escalation_reasons_for_query, escalation_reasons_for_retrieval
+from app.services.vector_backends import MatchingEngineBackend, get_local_vector_backend, remove_source_vectors, remove_chatbot_vectors
+# Prompt for extracting text from user images; bump the version whenever the prompt changes (it keys the image cache)
+IMAGE_EXTRACTION_PROMPT = "Extract all text visible in this image in the exact same language as it is in the image  . If no text is present, briefly describe the image's main subject and context.again in the same language as in the image "
+IMAGE_EXTRACTION_PROMPT_VERSION = "v1"
 # Safety settings for generative models
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-}
+def _safety_settings() -> dict:
+    from vertexai.generative_models import HarmCategory, HarmBlockThreshold
+    return {
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    }
 
 # --- Custom Exceptions for Deletion ---
 class SourceNotFoundError(Exception):
@@ -70,6 +77,7 @@ class RagService:
         self.embedding_model = None # This will no longer store a model instance, genai_client will be used directly
         self.genai_client = None # Added for the new SDK
         self.generation_model = None
+        self.generation_model_name = None
         # self.rephrase_model = None # Removed, not needed
         self.index_endpoint = None
         self.index_object = None
@@ -79,6 +87,10 @@ class RagService:
         self.initialization_error = None
         self.index_resource_name = None
         self.deployed_index_id = None
+        self._io_executor = None # Shared GCS I/O pool, created on first use
+        self._io_executor_lock = threading.Lock()
+        self._local_coverage = {} # chatbot_id -> (manifest revision, checked at, store holds every mapped vector)
+        self._single_input_embedding_models = set() # Models seen rejecting batched embed_content requests
 
     def _ensure_clients_initialized(self):
         """Ensure all clients are initialized before proceeding."""
@@ -99,6 +111,11 @@ class RagService:
         self.logger.info("RAG Service: Attempting client initialization...")
         start_time = time.time()
         try:
+            import vertexai
+            from google import genai
+            from google.cloud import aiplatform, storage
+            from vertexai.generative_models import GenerativeModel
+            from app.services.ranking_service import RankingService # Pulls in google.cloud.discoveryengine_v1
             app_config = current_app.config
             project_id = app_config.get('PROJECT_ID')
             region = app_config.get('REGION')
@@ -160,6 +177,7 @@ class RagService:
             # --- Generation Model ---
             self.logger.info(f"RAG Service: Initializing Generation Model '{generation_model_name}'...")
             self.generation_model = GenerativeModel(model_name=generation_model_name)
+            self.generation_model_name = generation_model_name
             self.logger.info(f"RAG Service: Generation Model '{generation_model_name}' OK.")
 
             # --- Rephrase Model Initialization Removed ---
@@ -222,9 +240,93 @@ class RagService:
             self.clients_initialized = False
             raise e
 
+    def _plan_embedding_batches(self, indexed_texts: list, max_items: int, max_tokens: int) -> list:
+        """Splits (index, text) pairs into sub-batches honouring the per-request item and token limits."""
+        batches = []
+        current_batch = []
+        current_tokens = 0
+        for index, text in indexed_texts:
+            est_tokens = max(1, len(text) // 4) # Rough estimate, same heuristic as elsewhere
+            if current_batch and (len(current_batch) >= max_items or current_tokens + est_tokens > max_tokens):
+                batches.append(current_batch)
+                current_batch = []
+                current_tokens = 0
+            current_batch.append((index, text))
+            current_tokens += est_tokens
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    def _embedding_accepts_batches(self, model_name: str) -> bool:
+        """False for models configured (EMBEDDING_SINGLE_INPUT_MODELS) or seen to take one input per request."""
+        configured = current_app.config.get('EMBEDDING_SINGLE_INPUT_MODELS', ['gemini-embedding-001'])
+        return model_name not in configured and model_name not in self._single_input_embedding_models
+
+    def _embed_batches(self, batches: list, model_name: str, task_type: str, output_dimensionality: int = None) -> dict:
+        """Embeds sub-batches, concurrently (up to EMBEDDING_MAX_CONCURRENCY) when there are several. Returns {input_index: values or None}."""
+        if not batches:
+            return {}
+        if len(batches) == 1:
+            return self._embed_sub_batch(batches[0], model_name, task_type, output_dimensionality)
+        results = {}
+        max_workers = min(len(batches), current_app.config.get('EMBEDDING_MAX_CONCURRENCY', 4))
+        app = current_app._get_current_object()
+
+        def _embed_in_app_context(batch):
+            with app.app_context():
+                return self._embed_sub_batch(batch, model_name, task_type, output_dimensionality)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_embed_in_app_context, batch) for batch in batches]
+            for future in concurrent.futures.as_completed(futures):
+                results.update(future.result())
+        return results
+
+    def _embed_sub_batch(self, batch: list, model_name: str, task_type: str, output_dimensionality: int = None) -> dict:
+        """
+        Embeds one sub-batch with a single embed_content call.
+        Returns {input_index: values or None}. If the batched call is rejected
+        (e.g. a model that only accepts one input per request) it falls back to
+        concurrent per-item calls so a single bad item doesn't fail the whole batch;
+        a rejected request (HTTP 400) also marks the model as single-input for later calls.
+        """
+        from google.genai.types import EmbedContentConfig
+        results = {}
+        try:
+            api_response = self.genai_client.models.embed_content(
+                model=model_name,
+                contents=[text for _, text in batch],
+                config=EmbedContentConfig(task_type=task_type, output_dimensionality=output_dimensionality)
+            )
+            embeddings = api_response.embeddings if api_response else None
+            if embeddings and len(embeddings) == len(batch):
+                for (index, text), embedding in zip(batch, embeddings):
+                    values = embedding.values if embedding else None
+                    if not values:
+                        self.logger.warning(f"Received no/empty embedding values for query index {index}: '{text[:50]}...'")
+                    results[index] = values or None
+                return results
+            self.logger.error(f"Unexpected response structure from batched embed_content ({len(batch)} inputs, got {len(embeddings) if embeddings else 0}). Response: {api_response}")
+        except Exception as batch_error:
+            if len(batch) == 1:
+                index, text = batch[0]
+                self.logger.error(f"Failed to generate embedding for query index {index}: '{text[:50]}...'. Error: {batch_error}", exc_info=True)
+                return {index: None}
+            if getattr(batch_error, 'code', None) == 400 and model_name not in self._single_input_embedding_models:
+                self._single_input_embedding_models.add(model_name)
+                self.logger.warning(f"Embedding model '{model_name}' rejected a batch of {len(batch)} inputs ({batch_error}); sending one input per request from now on.")
+            else:
+                self.logger.warning(f"Batched embed_content failed for {len(batch)} inputs ({batch_error}). Retrying item by item.")
+
+        if len(batch) == 1:
+            return {batch[0][0]: None}
+        return self._embed_batches([[item] for item in batch], model_name, task_type, output_dimensionality)
+
     def generate_multiple_embeddings(self, queries: list):
-        """Generates embeddings for a list of query texts."""
-        # ... (keep this method exactly as is - it correctly handles batch_size=1) ...
+        """
+        Generates embeddings for a list of query texts using batched embed_content calls.
+        Returns (embeddings, error) where embeddings is aligned with `queries`:
+        entries for empty or failed queries are None.
+        """
         if not self._ensure_clients_initialized():
             return None, "Clients not initialized."
 
@@ -239,55 +341,59 @@ class RagService:
 
         try:
             start_time = time.time()
-            successful_embeddings = []
+            app_config = current_app.config
             num_requested = len(queries)
-            num_generated = 0
-
-            self.logger.info(f"Generating embeddings individually for {num_requested} queries...")
+            embeddings = [None] * num_requested
+            current_embedding_model_name = app_config.get('EMBEDDING_MODEL_NAME')
+            task_type_for_embedding = "RETRIEVAL_QUERY" # Default for queries
+            output_dimensionality = app_config.get('EMBEDDING_OUTPUT_DIMENSIONALITY')
 
+            indexed_queries = []
             for index, query in enumerate(queries):
                 if not query or not query.strip():
                     self.logger.warning(f"Skipping empty query at index {index}.")
                     continue
-
-                try:
-                    single_query_list = [query]
-                    # Use the genai_client and configured model name
-                    current_embedding_model_name = current_app.config.get('EMBEDDING_MODEL_NAME')
-                    task_type_for_embedding = "RETRIEVAL_QUERY" # Default for queries
-
-                    api_response = self.genai_client.models.embed_content(
-                        model=current_embedding_model_name,
-                        contents=single_query_list,
-                        config=EmbedContentConfig(
-                            task_type=task_type_for_embedding,
-                            # output_dimensionality=3072, # Optional: default for text-embedding-large-exp-03-07
-                            # auto_truncate=False # Optional: default is True (silent truncation)
-                        )
-                    )
-
-                    if api_response and api_response.embeddings:
-                        embedding_values = api_response.embeddings[0].values
-                        if embedding_values:
-                            successful_embeddings.append(embedding_values)
-                            num_generated += 1
-                            self.logger.debug(f"Successfully generated embedding for query index {index}.")
-                        else:
-                            self.logger.warning(f"Received no/empty embedding values for query index {index}: '{query[:50]}...'")
+                indexed_queries.append((index, query))
+
+            # --- Embedding cache lookup (local LRU + shared Redis) ---
+            embedding_cache = get_embedding_cache()
+            cache_keys = {}
+            if embedding_cache and indexed_queries:
+                cache_keys = {index: embedding_cache.make_key(query, current_embedding_model_name, task_type_for_embedding, output_dimensionality) for index, query in indexed_queries}
+                cached_values = embedding_cache.get_many([cache_keys[index] for index, _ in indexed_queries])
+                uncached_queries = []
+                for (index, query), values in zip(indexed_queries, cached_values):
+                    if values is not None:
+                        embeddings[index] = values
                     else:
-                        self.logger.error(f"Unexpected response structure from embed_content for query index {index}: '{query[:50]}...'. Response: {api_response}")
+                        uncached_queries.append((index, query))
+                self.logger.info(f" -> Embedding cache: {len(indexed_queries) - len(uncached_queries)} hit(s), {len(uncached_queries)} miss(es). Stats: {embedding_cache.get_stats()}")
+                indexed_queries = uncached_queries
+
+            accepts_batches = self._embedding_accepts_batches(current_embedding_model_name)
+            batches = self._plan_embedding_batches(
+                indexed_queries,
+                max_items=max(1, app_config.get('EMBEDDING_MAX_BATCH_SIZE', 250)) if accepts_batches else 1,
+                max_tokens=max(1, app_config.get('EMBEDDING_MAX_BATCH_TOKENS', 20000))
+            )
+            self.logger.info(f"Generating embeddings for {len(indexed_queries)} queries in {len(batches)} {'batched' if accepts_batches else 'single-input'} request(s)...")
+
+            results = self._embed_batches(batches, current_embedding_model_name, task_type_for_embedding, output_dimensionality)
 
-                except Exception as single_emb_error:
-                    self.logger.error(f"Failed to generate embedding for query index {index}: '{query[:50]}...'. Error: {single_emb_error}", exc_info=True)
+            for index, values in results.items():
+                embeddings[index] = values
+            if embedding_cache:
+                embedding_cache.set_many({cache_keys[index]: values for index, values in results.items() if values is not None})
+            num_generated = sum(1 for e in embeddings if e is not None)
 
             duration = time.time() - start_time
-            self.logger.info(f" -> Generated {num_generated} embeddings out of {num_requested} requested queries individually in {duration:.3f}s.")
+            self.logger.info(f" -> Generated {num_generated} embeddings out of {num_requested} requested queries in {duration:.3f}s.")
 
-            if not successful_embeddings:
+            if num_generated == 0:
                 self.logger.error("Failed to generate any embeddings for the provided queries.")
                 return [], "Failed to generate any embeddings."
 
-            return successful_embeddings, None
+            return embeddings, None
 
         except GoogleAPICallError as e:
             self.logger.error(f" -> Error generating embeddings: {e}", exc_info=True)
@@ -298,18 +404,10 @@ class RagService:
 
     # --- generate_rephrased_queries METHOD REMOVED ---
 
-    def generate_response(self, prompt: str, image_data: bytes = None, image_mime_type: str = None, generation_config: GenerationConfig = None):
-        """Generates a response using the LLM, potentially including image context."""
-        # ... (keep this method exactly as is) ...
-        if not self._ensure_clients_initialized():
-            return None, "Clients not initialized.", None
-
+    def _build_generation_request(self, prompt: str, image_data: bytes = None, image_mime_type: str = None):
+        """Returns (content_parts, generation_config) for the main generation call."""
+        from vertexai.generative_models import GenerationConfig, Part
         app_config = current_app.config
-        self.logger.info(f"RAG Step 5: Generate Response (Image provided: {image_data is not None})")
-        if not self.generation_model:
-            self.logger.error("Generation model not initialized.")
-            return None, "Generation model not initialized.", None
-
         generation_config = GenerationConfig(
             temperature=app_config.get('GENERATION_TEMPERATURE', 0.3),
             max_output_tokens=app_config.get('GENERATION_MAX_TOKENS', 512),
@@ -321,13 +419,79 @@ class RagService:
             self.logger.info(f" -> Including image ({image_mime_type}, {len(image_data)} bytes) in generation request.")
             image_part = Part.from_data(data=image_data, mime_type=image_mime_type)
             content_parts.append(image_part)
+        return content_parts, generation_config
+
+    def _finalize_generation(self, response_text: str, finish_reason, safety_ratings: list, token_counts: dict, duration: float):
+        """Maps the finish reason of a (streamed or non-streamed) generation to (text, error, metadata)."""
+        from vertexai.generative_models import FinishReason
+        finish_reason_str = finish_reason.name if finish_reason else "UNKNOWN"
+        self.logger.info(f" -> LLM generation finished. Reason: {finish_reason_str} (Time: {duration:.3f}s)")
+
+        response_metadata = {
+            "finish_reason": finish_reason_str,
+            "token_counts": token_counts,
+            "safety_ratings": safety_ratings
+        }
+
+        if finish_reason != FinishReason.STOP:
+            self.logger.warning(f"LLM generation finished with non-STOP reason: {finish_reason_str}. Ratings: {safety_ratings}")
+            error_message = f"Response generation issue: {finish_reason_str}."
+            if finish_reason == FinishReason.SAFETY:
+                blocked_categories = [r['category'] for r in safety_ratings if r.get('probability') in ['HIGH', 'MEDIUM']]
+                error_message = f"Response blocked due to safety concerns ({', '.join(blocked_categories)})." if blocked_categories else "Response blocked due to safety concerns."
+                return None, error_message, response_metadata
+            elif finish_reason == FinishReason.MAX_TOKENS:
+                error_message = "Response may be incomplete as the maximum length was reached."
+                return response_text.strip() + "...", error_message, response_metadata
+            elif finish_reason == FinishReason.RECITATION:
+                 error_message = "Response generation stopped to avoid potential recitation of copyrighted material."
+                 return None, error_message, response_metadata
+            else:
+                return None, error_message, response_metadata
+
+        if not response_text and finish_reason == FinishReason.STOP:
+            self.logger.warning("LLM generation finished with STOP but returned empty text.")
+            return None, "The AI generated an empty response.", response_metadata
+
+        return response_text.strip(), None, response_metadata
+
+    @staticmethod
+    def _usage_token_counts(response) -> dict:
+        if hasattr(response, 'usage_metadata') and response.usage_metadata:
+            return {
+                'prompt_tokens': response.usage_metadata.prompt_token_count,
+                'candidates_token_count': response.usage_metadata.candidates_token_count,
+                'total_tokens': response.usage_metadata.total_token_count
+            }
+        return {}
+
+    @staticmethod
+    def _safety_ratings_list(candidate) -> list:
+        if candidate.safety_ratings:
+            return [
+                {"category": rating.category.name, "probability": rating.probability.name}
+                for rating in candidate.safety_ratings
+            ]
+        return []
+
+    def generate_response(self, prompt: str, image_data: bytes = None, image_mime_type: str = None, generation_config: 'GenerationConfig' = None):
+        """Generates a response using the LLM, potentially including image context."""
+        if not self._ensure_clients_initialized():
+            return None, "Clients not initialized.", None
+
+        self.logger.info(f"RAG Step 5: Generate Response (Image provided: {image_data is not None})")
+        if not self.generation_model:
+            self.logger.error("Generation model not initialized.")
+            return None, "Generation model not initialized.", None
+
+        content_parts, generation_config = self._build_generation_request(prompt, image_data, image_mime_type)
 
         try:
             start_time = time.time()
             response = self.generation_model.generate_content(
                 contents=content_parts,
                 generation_config=generation_config,
-                safety_settings=SAFETY_SETTINGS,
+                safety_settings=_safety_settings(),
                 stream=False
             )
             duration = time.time() - start_time
@@ -342,49 +506,10 @@ class RagService:
                 if candidate.content and candidate.content.parts:
                     response_text = candidate.content.parts[0].text
                 finish_reason = candidate.finish_reason
-                if candidate.safety_ratings:
-                    safety_ratings = [
-                        {"category": rating.category.name, "probability": rating.probability.name}
-                        for rating in candidate.safety_ratings
-                    ]
-
-                if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                    token_counts = {
-                        'prompt_tokens': response.usage_metadata.prompt_token_count,
-                        'candidates_token_count': response.usage_metadata.candidates_token_count,
-                        'total_tokens': response.usage_metadata.total_token_count
-                    }
-
-            finish_reason_str = finish_reason.name if finish_reason else "UNKNOWN"
-            self.logger.info(f" -> LLM generation finished. Reason: {finish_reason_str} (Time: {duration:.3f}s)")
+                safety_ratings = self._safety_ratings_list(candidate)
+                token_counts = self._usage_token_counts(response)
 
-            response_metadata = {
-                "finish_reason": finish_reason_str,
-                "token_counts": token_counts,
-                "safety_ratings": safety_ratings
-            }
-
-            if finish_reason != FinishReason.STOP:
-                self.logger.warning(f"LLM generation finished with non-STOP reason: {finish_reason_str}. Ratings: {safety_ratings}")
-                error_message = f"Response generation issue: {finish_reason_str}."
-                if finish_reason == FinishReason.SAFETY:
-                    blocked_categories = [r['category'] for r in safety_ratings if r.get('probability') in ['HIGH', 'MEDIUM']]
-                    error_message = f"Response blocked due to safety concerns ({', '.join(blocked_categories)})." if blocked_categories else "Response blocked due to safety concerns."
-                    return None, error_message, response_metadata
-                elif finish_reason == FinishReason.MAX_TOKENS:
-                    error_message = "Response may be incomplete as the maximum length was reached."
-                    return response_text.strip() + "...", error_message, response_metadata
-                elif finish_reason == FinishReason.RECITATION:
-                     error_message = "Response generation stopped to avoid potential recitation of copyrighted material."
-                     return None, error_message, response_metadata
-                else:
-                    return None, error_message, response_metadata
-
-            if not response_text and finish_reason == FinishReason.STOP:
-                self.logger.warning("LLM generation finished with STOP but returned empty text.")
-                return None, "The AI generated an empty response.", response_metadata
-
-            return response_text.strip(), None, response_metadata
+            return self._finalize_generation(response_text, finish_reason, safety_ratings, token_counts, duration)
 
         except GoogleAPICallError as e:
             self.logger.error(f" -> Google API Error during generation: {e}", exc_info=True)
@@ -393,9 +518,65 @@ class RagService:
             self.logger.error(f" -> Unexpected error during LLM response generation: {e}", exc_info=True)
             return None, f"Unexpected error generating response: {e}", None
 
-    # --- GCS Caching Helper ---
-    # ... (keep this method exactly as is) ...
-    @functools.lru_cache(maxsize=1024)
+    def generate_response_stream(self, prompt: str, image_data: bytes = None, image_mime_type: str = None):
+        """
+        Streaming counterpart of generate_response using generate_content(stream=True).
+        Yields ('delta', text) for each fragment, then exactly one
+        ('complete', (text, error, metadata)) with the same semantics as generate_response.
+        """
+        if not self._ensure_clients_initialized():
+            yield 'complete', (None, "Clients not initialized.", None)
+            return
+
+        self.logger.info(f"RAG Step 5: Generate Response [stream] (Image provided: {image_data is not None})")
+        if not self.generation_model:
+            self.logger.error("Generation model not initialized.")
+            yield 'complete', (None, "Generation model not initialized.", None)
+            return
+
+        content_parts, generation_config = self._build_generation_request(prompt, image_data, image_mime_type)
+
+        start_time = time.time()
+        text_parts = []
+        finish_reason = None
+        token_counts = {}
+        safety_ratings = []
+        try:
+            response_stream = self.generation_model.generate_content(
+                contents=content_parts,
+                generation_config=generation_config,
+                safety_settings=_safety_settings(),
+                stream=True
+            )
+            first_token_logged = False
+            for chunk in response_stream:
+                if chunk.candidates:
+                    candidate = chunk.candidates[0]
+                    if candidate.content and candidate.content.parts:
+                        delta = candidate.content.parts[0].text
+                        if delta:
+                            if not first_token_logged:
+                                self.logger.info(f" -> PERF: Time to first token: {time.time() - start_time:.3f}s")
+                                first_token_logged = True
+                            text_parts.append(delta)
+                            yield 'delta', delta
+                    # Finish reason and ratings arrive on the last chunk(s)
+                    if candidate.finish_reason:
+                        finish_reason = candidate.finish_reason
+                    safety_ratings = self._safety_ratings_list(candidate) or safety_ratings
+                token_counts = self._usage_token_counts(chunk) or token_counts
+        except GoogleAPICallError as e:
+            self.logger.error(f" -> Google API Error during streamed generation: {e}", exc_info=True)
+            yield 'complete', (None, f"LLM API Error: {e}", None)
+            return
+        except Exception as e:
+            self.logger.error(f" -> Unexpected error during streamed LLM response generation: {e}", exc_info=True)
+            yield 'complete', (None, f"Unexpected error generating response: {e}", None)
+            return
+
+        yield 'complete', self._finalize_generation("".join(text_parts), finish_reason, safety_ratings, token_counts, time.time() - start_time)
+
+    # --- GCS Download Helper (cached by ChunkTextCache in fetch_chunk_texts_by_id) ---
     def _download_chunk_from_gcs(self, blob_name: str):
         if not self._ensure_clients_initialized(): return None
         if not self.bucket: return None
@@ -410,29 +591,38 @@ class RagService:
             self.logger.error(f" -> GCS download error for '{blob_name}': {e}", exc_info=True)
             return None
 
+    # --- _parse_chunk_vector_id / _chunk_blob_name ---
+    def _parse_chunk_vector_id(self, vector_id: str, chatbot_id: int) -> tuple[str, str] | None:
+        """Returns (source_hash, chunk_index) for a vector ID (chatbot_{id}_source_{hash}_chunk_{index}), or None if invalid."""
+        parts = vector_id.split('_')
+        # Need at least 6 parts: 'chatbot', id, 'source', hash, 'chunk', index
+        if len(parts) < 6 or parts[0] != 'chatbot' or parts[2] != 'source' or parts[4] != 'chunk':
+             self.logger.warning(f" -> Invalid vector ID format, cannot parse GCS path: {vector_id}")
+             return None
+
+        extracted_chatbot_id_str = parts[1]
+        # Security check: Compare extracted chatbot_id with the one passed to the function
+        if extracted_chatbot_id_str != str(chatbot_id):
+            self.logger.error(f" -> SECURITY MISMATCH! Vector ID chatbot '{extracted_chatbot_id_str}' != Query chatbot '{chatbot_id}'. Vector ID: {vector_id}. Skipping!")
+            return None
+        return parts[3], parts[5]
+
+    def _chunk_blob_name(self, vector_id: str, chatbot_id: int) -> str | None:
+        """Maps a vector ID to its per-chunk GCS blob name (also the chunk cache key), or None if invalid."""
+        parsed = self._parse_chunk_vector_id(vector_id, chatbot_id)
+        if parsed is None:
+            return None
+        hash_part, chunk_index_part = parsed
+        return f"chatbot_{chatbot_id}/source_{hash_part}/{chunk_index_part}.txt"
+
     # --- _fetch_single_chunk_text ---
-    # ... (keep this method exactly as is) ...
     # Updated to use chatbot_id and new vector ID/GCS path format
     def _fetch_single_chunk_text(self, vector_id: str, chatbot_id: int) -> tuple[bool, str | None]:
         self.logger.debug(f" -> Submitting fetch task for Vector ID: {vector_id}")
         try:
-            # Expected format: chatbot_{chatbot_id}_source_{hash}_chunk_{index}
-            parts = vector_id.split('_')
-            # Need at least 6 parts: 'chatbot', id, 'source', hash, 'chunk', index
-            if len(parts) < 6 or parts[0] != 'chatbot' or parts[2] != 'source' or parts[4] != 'chunk':
-                 self.logger.warning(f" -> Invalid vector ID format, cannot parse GCS path: {vector_id}")
-                 return False, None
-
-            extracted_chatbot_id_str = parts[1]
-            # Security check: Compare extracted chatbot_id with the one passed to the function
-            if extracted_chatbot_id_str != str(chatbot_id):
-                self.logger.error(f" -> SECURITY MISMATCH! Vector ID chatbot '{extracted_chatbot_id_str}' != Query chatbot '{chatbot_id}'. Vector ID: {vector_id}. Skipping!")
+            blob_name = self._chunk_blob_name(vector_id, chatbot_id)
+            if blob_name is None:
                 return False, None
-
-            hash_part = parts[3]
-            chunk_index_part = parts[5]
-            # Construct GCS path using the new format
-            blob_name = f"chatbot_{extracted_chatbot_id_str}/source_{hash_part}/{chunk_index_part}.txt"
             chunk_text = self._download_chunk_from_gcs(blob_name)
             if chunk_text is not None:
                 return True, chunk_text
@@ -442,131 +632,317 @@ class RagService:
             self.logger.error(f" -> Unexpected error processing vector ID '{vector_id}' before GCS download: {e}", exc_info=True)
             return False, None
 
-    # --- fetch_chunk_texts ---
-    # ... (keep this method exactly as is) ...
-    # Updated to accept chatbot_id instead of client_id
-    def fetch_chunk_texts(self, vector_ids: list, chatbot_id: int):
-        if not self._ensure_clients_initialized(): return [], "Clients not initialized."
+    # --- _fetch_shard_range ---
+    def _fetch_shard_range(self, chatbot_id: int, source_hash: str, index: dict, start: int, end: int, members: list) -> dict:
+        """Reads one coalesced byte range of a source shard. Returns {chunk_index: text} ({} on failure)."""
+        try:
+            payload = read_shard_range(self.bucket, chatbot_id, source_hash, index, start, end)
+            return split_range(payload, start, members, index.get("codec", "none"))
+        except Exception as e:
+            self.logger.error(f" -> Shard range read failed for source {source_hash} bytes {start}-{end}: {e}", exc_info=True)
+            return {}
+
+    # --- Shared GCS I/O pool ---
+    def _get_io_executor(self):
+        """Long-lived thread pool for GCS reads, shared by all requests in this process (bounded by GCS_IO_MAX_WORKERS)."""
+        if self._io_executor is None:
+            with self._io_executor_lock:
+                if self._io_executor is None:
+                    max_workers = current_app.config.get('GCS_IO_MAX_WORKERS', 32)
+                    self._io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gcs-io')
+                    self.logger.info(f"RAG Service: Created shared GCS I/O pool ({max_workers} workers).")
+        return self._io_executor
+
+    def _run_io_tasks(self, tasks: list, max_in_flight: int):
+        """
+        Runs [(key, func, args), ...] on the shared I/O pool, keeping at most `max_in_flight`
+        of them queued or running so one large request can't starve the others.
+        Yields (key, result, exception) as tasks complete.
+        """
+        executor = self._get_io_executor()
+        task_iter = iter(tasks)
+        pending = {}
+        while True:
+            while len(pending) < max_in_flight:
+                task = next(task_iter, None)
+                if task is None:
+                    break
+                key, func, args = task
+                pending[executor.submit(func, *args)] = key
+            if not pending:
+                return
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    yield key, future.result(), None
+                except Exception as e:
+                    yield key, None, e
 
-        self.logger.info(f"RAG Step 3: Fetch Chunk Texts ({len(vector_ids)} IDs for Chatbot {chatbot_id})") # Log chatbot_id
-        if not vector_ids: return [], None
-        if not self.bucket: return [], "GCS bucket not initialized."
+    # --- _load_shard_indexes ---
+    def _load_shard_indexes(self, chatbot_id: int, source_hashes: list, chunk_cache, max_in_flight: int) -> dict:
+        """
+        Returns {source_hash: index dict or None}; None means the source uses per-chunk objects.
+        Raw shard.json texts ('' for per-chunk sources) are cached in the chunk cache next to the
+        chunks, so prefix invalidation on ingestion/deletion covers them too.
+        """
+        index_texts = {}
+        index_keys = {h: shard_blob_names(chatbot_id, h)[1] for h in source_hashes}
+        if chunk_cache:
+            cached = chunk_cache.get_many([index_keys[h] for h in source_hashes])
+            index_texts = {h: text for h, text in zip(source_hashes, cached) if text is not None}
+
+        missing = [h for h in source_hashes if h not in index_texts]
+        loaded = {}
+        tasks = [(h, load_shard_index_text, (self.bucket, chatbot_id, h)) for h in missing]
+        for source_hash, text, error in self._run_io_tasks(tasks, max_in_flight):
+            if error is not None:
+                # Not cached, so the next request tries again; this one falls back to per-chunk objects
+                self.logger.warning(f" -> Failed to load shard index for source {source_hash}: {error}")
+                index_texts[source_hash] = ''
+            else:
+                loaded[source_hash] = text
+        index_texts.update(loaded)
+        if chunk_cache and loaded:
+            chunk_cache.set_many({index_keys[h]: text for h, text in loaded.items()})
+
+        indexes = {}
+        for source_hash, text in index_texts.items():
+            try:
+                indexes[source_hash] = json.loads(text) if text else None
+            except ValueError:
+                self.logger.warning(f" -> Corrupt shard index for source {source_hash}; using per-chunk objects.")
+                indexes[source_hash] = None
+        return indexes
+
+    # --- fetch_chunk_texts_by_id ---
+    def fetch_chunk_texts_by_id(self, vector_ids: list, chatbot_id: int):
+        """
+        Fetches chunk texts for `vector_ids`.
+
+        Returns: (dict of vector_id -> text in the order of first appearance in vector_ids, error message or None).
+        Duplicate IDs are fetched once; IDs that could not be fetched (or have empty text) are left out.
+        Cache misses are grouped per source: packed sources are read with coalesced range requests,
+        per-chunk sources with one GET per chunk, all on the shared I/O pool.
+        """
+        if not self._ensure_clients_initialized(): return {}, "Clients not initialized."
+
+        unique_ids = list(dict.fromkeys(vector_ids))
+        self.logger.info(f"RAG Step 3: Fetch Chunk Texts ({len(unique_ids)} unique IDs for Chatbot {chatbot_id})") # Log chatbot_id
+        if not unique_ids: return {}, None
+        if not self.bucket: return {}, "GCS bucket not initialized."
 
-        retrieved_texts = []
-        fetch_errors = 0
         start_time = time.time()
+        texts_by_id = {}
+        parsed_ids = {vid: self._parse_chunk_vector_id(vid, chatbot_id) for vid in unique_ids}
+        valid_ids = [vid for vid in unique_ids if parsed_ids[vid]]
+        blob_names = {vid: self._chunk_blob_name(vid, chatbot_id) for vid in valid_ids}
+
+        # Serve what we can from the chunk text cache; only misses go to GCS
+        chunk_cache = get_chunk_cache()
+        if chunk_cache and valid_ids:
+            cached_texts = chunk_cache.get_many([blob_names[vid] for vid in valid_ids])
+            texts_by_id.update({vid: text for vid, text in zip(valid_ids, cached_texts) if text is not None})
+        cache_hits = len(texts_by_id)
+        ids_to_download = [vid for vid in valid_ids if vid not in texts_by_id]
+
+        downloaded = {}
+        range_reads = 0
+        object_reads = 0
+        if ids_to_download:
+            app_config = current_app.config
+            max_gap_bytes = app_config.get('CHUNK_SHARD_COALESCE_GAP_BYTES', 16384)
+            max_in_flight = app_config.get('GCS_FETCH_MAX_IN_FLIGHT', 16)
+            ids_by_source = defaultdict(list)
+            for vid in ids_to_download:
+                ids_by_source[parsed_ids[vid][0]].append(vid)
+            shard_indexes = self._load_shard_indexes(chatbot_id, list(ids_by_source), chunk_cache, max_in_flight)
+
+            tasks = []
+            for source_hash, source_ids in ids_by_source.items():
+                index = shard_indexes.get(source_hash)
+                if index is None:
+                    # Per-chunk layout: one GET per chunk
+                    object_reads += len(source_ids)
+                    tasks.extend((('object', vid), self._fetch_single_chunk_text, (vid, chatbot_id)) for vid in source_ids)
+                    continue
+                ids_by_chunk_index = {int(parsed_ids[vid][1]): vid for vid in source_ids if parsed_ids[vid][1].isdigit()}
+                for start, end, members in plan_range_reads(index, ids_by_chunk_index, max_gap_bytes):
+                    range_reads += 1
+                    tasks.append((('shard', ids_by_chunk_index), self._fetch_shard_range, (chatbot_id, source_hash, index, start, end, members)))
+
+            for (kind, target), result, error in self._run_io_tasks(tasks, max_in_flight):
+                if error is not None:
+                    self.logger.error(f" -> Exception retrieving chunk text result ({kind}): {error}", exc_info=error)
+                elif kind == 'object':
+                    success, text = result
+                    if success and text is not None:
+                        downloaded[target] = text
+                else:
+                    for chunk_index, text in result.items():
+                        downloaded[target[chunk_index]] = text
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            # Pass chatbot_id to _fetch_single_chunk_text
-            future_to_vector_id = {executor.submit(self._fetch_single_chunk_text, vid, chatbot_id): vid for vid in vector_ids}
-            for future in concurrent.futures.as_completed(future_to_vector_id):
-                vector_id = future_to_vector_id[future]
-                try:
-                    success, text = future.result()
-                    if success and text:
-                        retrieved_texts.append(text)
-                    elif not success:
-                        fetch_errors += 1
-                except Exception as exc:
-                    self.logger.error(f" -> Exception retrieving result for vector ID '{vector_id}': {exc}", exc_info=True)
-                    fetch_errors += 1
+        if chunk_cache and downloaded:
+            chunk_cache.set_many({blob_names[vid]: text for vid, text in downloaded.items()})
+        texts_by_id.update(downloaded)
+
+        ordered_texts = {vid: texts_by_id[vid] for vid in unique_ids if texts_by_id.get(vid)}
+        fetch_errors = sum(1 for vid in unique_ids if vid not in texts_by_id)
 
         duration = time.time() - start_time
-        self.logger.info(f" -> Fetched text for {len(retrieved_texts)} chunks concurrently. Errors: {fetch_errors} (Time: {duration:.3f}s).")
+        self.logger.info(f" -> Fetched text for {len(ordered_texts)} chunks ({cache_hits} from cache, {len(downloaded)} from GCS via {range_reads} shard range reads and {object_reads} object reads). Errors: {fetch_errors} (Time: {duration:.3f}s).")
+        if chunk_cache:
+            self.logger.info(f"PERF: Chunk text cache stats: {chunk_cache.get_stats()}")
 
         error_msg = None
         if fetch_errors > 0:
-             error_msg = f"Failed to fetch text content for {fetch_errors} out of {len(vector_ids)} relevant document sections."
-             if not retrieved_texts: # All failed
-                  error_msg = f"Failed to fetch text content for any of the {len(vector_ids)} relevant document sections."
+             error_msg = f"Failed to fetch text content for {fetch_errors} out of {len(unique_ids)} relevant document sections."
+             if not ordered_texts: # All failed
+                  error_msg = f"Failed to fetch text content for any of the {len(unique_ids)} relevant document sections."
+
+        return ordered_texts, error_msg
+
+    # --- fetch_chunk_texts ---
+    def fetch_chunk_texts(self, vector_ids: list, chatbot_id: int):
+        """
+        List form of fetch_chunk_texts_by_id: texts in the order of the (deduplicated) vector_ids,
+        with missing chunks left out. Use fetch_chunk_texts_by_id when texts must be matched to IDs.
+        """
+        texts_by_id, error_msg = self.fetch_chunk_texts_by_id(vector_ids, chatbot_id)
+        return list(texts_by_id.values()), error_msg
 
-        return retrieved_texts, error_msg
+    # --- select_vector_backend ---
+    def select_vector_backend(self, chatbot_id: int, query_dim: int = None):
+        """
+        Picks the vector search backend for a chatbot from VECTOR_BACKEND:
+        'matching_engine' (default), 'local' (always the in-process store), or 'auto'
+        (the local store when it holds every vector of the chatbot - see _local_store_is_complete -,
+        at most LOCAL_VECTOR_MAX_CHUNKS of them and the query dimension; Matching Engine otherwise).
+        Local stores are refreshed from their GCS backup at most every LOCAL_VECTOR_SYNC_INTERVAL_SECONDS.
+        Returns the backend, or None if none is usable.
+        """
+        app_config = current_app.config
+        mode = app_config.get('VECTOR_BACKEND', 'matching_engine')
+        if mode in ('local', 'auto'):
+            local_backend = get_local_vector_backend()
+            if app_config.get('LOCAL_VECTOR_GCS_BACKUP', True):
+                local_backend.maybe_sync(self.bucket, chatbot_id, app_config.get('LOCAL_VECTOR_SYNC_INTERVAL_SECONDS', 60))
+            if mode == 'local':
+                return local_backend
+            manifest = local_backend.store.read_manifest(chatbot_id, local_backend.model_name)
+            live_count = (manifest or {}).get("count", 0) - (manifest or {}).get("tombstones", 0)
+            if (manifest and 0 < live_count <= app_config.get('LOCAL_VECTOR_MAX_CHUNKS', 50000)
+                    and (query_dim is None or manifest.get("dim") == query_dim)
+                    and self._local_store_is_complete(chatbot_id, manifest, live_count)):
+                return local_backend
+        if not self.index_endpoint or not self.deployed_index_id:
+            return None
+        return MatchingEngineBackend(
+            self.index_endpoint, self.deployed_index_id, self._run_io_tasks,
+            max_queries_per_request=app_config.get('MATCHING_ENGINE_MAX_QUERIES_PER_REQUEST', 64),
+            logger_instance=self.logger,
+        )
+
+    def _local_store_is_complete(self, chatbot_id: int, manifest: dict, live_count: int) -> bool:
+        """
+        True when the local store has as many live vectors as the chatbot has mapped vector IDs. Stores only
+        receive vectors from ingestions since they were enabled (and a failed persist doesn't stop ingestion),
+        so a partial store must not replace Matching Engine. The check is cached per manifest revision for
+        LOCAL_VECTOR_SYNC_INTERVAL_SECONDS, so new mappings are noticed within that interval.
+        """
+        revision = (manifest.get("rows_version"), manifest.get("count"), manifest.get("tombstones"))
+        cached = self._local_coverage.get(chatbot_id)
+        if cached and cached[0] == revision and time.time() - cached[1] < current_app.config.get('LOCAL_VECTOR_SYNC_INTERVAL_SECONDS', 60):
+            return cached[2]
+        try:
+            mapped_count = db.session.query(db.func.count(db.distinct(VectorIdMapping.vector_id))) \
+                .filter(VectorIdMapping.chatbot_id == chatbot_id).scalar() or 0
+        except SQLAlchemyError as e:
+            self.logger.warning(f"Could not count vector mappings for chatbot {chatbot_id}; using Matching Engine: {e}")
+            return False
+        complete = live_count == mapped_count
+        if not complete:
+            self.logger.info(f"Local vector store for chatbot {chatbot_id} has {live_count} of {mapped_count} vectors; using Matching Engine.")
+        self._local_coverage[chatbot_id] = (revision, time.time(), complete)
+        return complete
+
+    # --- find_neighbors_per_query ---
+    def find_neighbors_per_query(self, query_embeddings: list, chatbot_id: int, num_neighbors: int = None):
+        """
+        Runs vector search for all embeddings on the chatbot's backend (see select_vector_backend).
+        Matching Engine uses as few find_neighbors requests as possible; the local backend searches in-process.
+
+        Returns: (per-query neighbor lists aligned with query_embeddings, each a list of (vector_id, distance)
+                  or None if that query's request failed, number of failed requests)
+        """
+        num_neighbors = num_neighbors or current_app.config.get('RAG_TOP_K', 5)
+        if not query_embeddings:
+            return [], 0
+        backend = self.select_vector_backend(chatbot_id, len(query_embeddings[0]))
+        if backend is None:
+            self.logger.error("ME client/deployed ID not initialized.")
+            return [None] * len(query_embeddings), 1
+        self.logger.debug(f" -> Vector backend for chatbot {chatbot_id}: {backend.name}")
+        return backend.find_neighbors(query_embeddings, chatbot_id, num_neighbors)
+
+    # --- fuse_neighbor_lists ---
+    @staticmethod
+    def fuse_neighbor_lists(per_query_neighbors: list, strategy: str = 'min_distance', rrf_k: int = 60) -> list:
+        """
+        Fuses per-query [(vector_id, distance), ...] lists into one ranked list of unique IDs.
+        'min_distance' ranks each ID by its smallest distance across queries (the original behavior);
+        'rrf' ranks by reciprocal rank fusion, sum(1 / (rrf_k + rank)), which rewards IDs found by several queries.
+        """
+        if strategy == 'rrf':
+            rrf_scores = defaultdict(float)
+            for neighbors in per_query_neighbors:
+                for rank, (chunk_id, _) in enumerate(neighbors or [], start=1):
+                    rrf_scores[chunk_id] += 1.0 / (rrf_k + rank)
+            return sorted(rrf_scores, key=rrf_scores.get, reverse=True)
+
+        min_distances = defaultdict(lambda: float('inf'))
+        for neighbors in per_query_neighbors:
+            for chunk_id, distance in neighbors or []:
+                min_distances[chunk_id] = min(min_distances[chunk_id], distance)
+        return sorted(min_distances, key=min_distances.get)
 
     # --- retrieve_chunks_multi_query ---
-    # ... (keep this method exactly as is) ...
-    def retrieve_chunks_multi_query(self, query_embeddings: list, chatbot_id: int, client_id: str): # Added chatbot_id
+    def retrieve_chunks_multi_query(self, query_embeddings: list, chatbot_id: int, client_id: str, per_query_neighbors: list = None): # Added chatbot_id
+        """per_query_neighbors (aligned with query_embeddings) skips the vector search when it has already run, e.g. as the routing probe."""
         if not self._ensure_clients_initialized(): return [], "Clients not initialized."
 
         app_config = current_app.config
         rag_top_k = app_config.get('RAG_TOP_K', 5)
+        fusion_strategy = app_config.get('RETRIEVAL_FUSION_STRATEGY', 'min_distance')
         # Updated log message to show chatbot_id
-        self.logger.info(f"RAG Step 2: Retrieve Chunks (Multi-Query: {len(query_embeddings)}, Chatbot: {chatbot_id}, K per query: {rag_top_k})")
-        if not self.index_endpoint or not self.deployed_index_id:
-            self.logger.error("ME client/deployed ID not initialized.")
-            return [], "ME client/deployed ID not initialized."
+        self.logger.info(f"RAG Step 2: Retrieve Chunks (Multi-Query: {len(query_embeddings)}, Chatbot: {chatbot_id}, K per query: {rag_top_k}, Fusion: {fusion_strategy})")
         if not query_embeddings:
             return [], None
         # Keep client_id check if needed elsewhere, but primary filter is chatbot_id
         if not chatbot_id:
              return [], "Chatbot ID missing."
 
-        all_neighbors_with_distances = []
-        total_api_time = 0
-        retrieval_errors = 0
-        futures = []
-
-        # Filter by chatbot_id namespace
-        chatbot_filter = [Namespace(name="chatbot_id", allow_tokens=[str(chatbot_id)])]
-        self.logger.debug(f" -> Using Filter: namespace='chatbot_id', allow_tokens=['{chatbot_id}']")
-
-        def _find_neighbors_task(embedding, query_index):
-            self.logger.debug(f" -> Submitting query with embedding #{query_index+1}...")
-            start_time = time.time()
-            try:
-                response = self.index_endpoint.find_neighbors(
-                    deployed_index_id=self.deployed_index_id,
-                    queries=[embedding],
-                    num_neighbors=rag_top_k,
-                    filter=chatbot_filter # Use the new filter
-                )
-                duration = time.time() - start_time
-                if response and isinstance(response, list) and len(response) > 0 and isinstance(response[0], list):
-                    neighbors = response[0]
-                    self.logger.debug(f" -> Query #{query_index+1} retrieved {len(neighbors)} neighbors (Time: {duration:.3f}s).")
-                    return neighbors, duration, True, query_index
-                else:
-                    self.logger.debug(f" -> Query #{query_index+1} found no neighbors (Time: {duration:.3f}s). Response: {response}")
-                    return [], duration, True, query_index
-            except (GoogleAPICallError, Exception) as e:
-                duration = time.time() - start_time
-                self.logger.error(f" -> Error retrieving chunks for query #{query_index+1}: {e}", exc_info=True)
-                return [], duration, False, query_index
-
-        max_workers = min(len(query_embeddings), 10)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            for i, embedding in enumerate(query_embeddings):
-                futures.append(executor.submit(_find_neighbors_task, embedding, i))
-
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    neighbors, duration, success, query_idx = future.result()
-                    total_api_time += duration
-                    if success:
-                        for neighbor in neighbors:
-                            if hasattr(neighbor, 'id') and hasattr(neighbor, 'distance'):
-                                all_neighbors_with_distances.append((neighbor.id, neighbor.distance))
-                            else:
-                                self.logger.warning(f" -> Neighbor object missing id or distance: {neighbor}")
-                    else:
-                        retrieval_errors += 1
-                except Exception as exc:
-                    self.logger.error(f" -> Error processing result from concurrent task: {exc}", exc_info=True)
-                    retrieval_errors += 1
+        # generate_multiple_embeddings keeps failed entries as None to stay aligned with its input
+        query_embeddings = [e for e in query_embeddings if e is not None]
+        if not query_embeddings:
+            return [], "No valid query embeddings provided."
 
-        self.logger.info(f" -> Total neighbors found across all queries: {len(all_neighbors_with_distances)} (Errors: {retrieval_errors}, Total API time (summed): {total_api_time:.3f}s).")
+        start_time = time.time()
+        if per_query_neighbors is not None:
+            failed_requests = sum(1 for n in per_query_neighbors if n is None)
+        else:
+            per_query_neighbors, failed_requests = self.find_neighbors_per_query(query_embeddings, chatbot_id, rag_top_k)
+        total_neighbors = sum(len(n) for n in per_query_neighbors if n)
+        self.logger.info(f" -> Total neighbors found across all queries: {total_neighbors} (Failed requests: {failed_requests}, Time: {time.time() - start_time:.3f}s).")
 
-        if retrieval_errors == len(query_embeddings) and query_embeddings:
+        if all(n is None for n in per_query_neighbors):
             return [], "Failed to retrieve chunks for all query variations."
 
-        if not all_neighbors_with_distances:
+        if not total_neighbors:
             self.logger.warning(" -> No neighbors found across any query variations.")
             return [], None
 
-        min_distances = defaultdict(lambda: float('inf'))
-        for chunk_id, distance in all_neighbors_with_distances:
-            min_distances[chunk_id] = min(min_distances[chunk_id], distance)
-
-        sorted_unique_chunk_ids = sorted(min_distances, key=min_distances.get)
+        sorted_unique_chunk_ids = self.fuse_neighbor_lists(per_query_neighbors, fusion_strategy, app_config.get('RRF_K', 60))
 
         m_fused_chunks = app_config.get('M_FUSED_CHUNKS', 10)
         final_chunk_ids = sorted_unique_chunk_ids[:m_fused_chunks]
@@ -577,8 +953,12 @@ class RagService:
         return final_chunk_ids, None
 
     # --- construct_prompt METHOD MODIFIED ---
-    def construct_prompt(self, retrieved_texts: list, query: str, client_id: str, base_prompt: str = None, chat_history: list = None, knowledge_adherence_level: str = 'strict', is_image_only: bool = False, query_language: str = 'en'):
-        """Constructs the final prompt for the LLM."""
+    def construct_prompt(self, retrieved_texts: list, query: str, client_id: str, base_prompt: str = None, chat_history: list = None, knowledge_adherence_level: str = 'strict', is_image_only: bool = False, query_language: str = 'en', retrieved_ids: list = None, prompt_stats: dict = None):
+        """
+        Constructs the final prompt for the LLM.
+        retrieved_ids (aligned with retrieved_texts) lets adjacent chunks of a source be merged. If prompt_stats
+        is given, it is filled with the prompt's token counts.
+        """
         # Removed query_language parameter as it's no longer used here for the prompt instruction
         if not self._ensure_clients_initialized(): return ""
 
@@ -588,22 +968,23 @@ class RagService:
 
         history_str = ""
         if chat_history:
-            temp_history = ""
-            total_len = 0
             max_history_chars = app_config.get('MAX_HISTORY_CHARS', 1500)
-            for msg in reversed(chat_history):
-                role = "User" if msg.get('role') == 'user' else "Chatbot"
-                content = msg.get('content', '')
-                entry = f"{role}: {content}\n"
-                entry_len = len(entry)
+            # A leading summary entry stands in for everything older, so it is always kept and only the verbatim turns share what's left of the cap
+            summary_turns = chat_history[:1] if chat_history[0].get('role') == SUMMARY_ROLE else []
+            recent_turns = chat_history[len(summary_turns):]
+            kept_turns = []
+            total_len = len(format_history(summary_turns)) + 1 if summary_turns else 0
+            for msg in reversed(recent_turns): # Newest first, so the oldest turns are the ones cut
+                entry_len = len(format_history([msg])) + 1 # Plus the newline
                 if total_len + entry_len > max_history_chars:
-                    remaining_space = max_history_chars - total_len
-                    if remaining_space > len(role) + 5:
-                         temp_history = f"{role}: {content[:remaining_space-len(role)-3]}...\n" + temp_history
+                    content = msg.get('content', '')
+                    kept_chars = len(content) - (total_len + entry_len - max_history_chars) - 3 # Room left for "..."
+                    if kept_chars > 2:
+                        kept_turns.append({**msg, 'content': f"{content[:kept_chars]}..."})
                     break
-                temp_history = entry + temp_history
+                kept_turns.append(msg)
                 total_len += entry_len
-            history_str = temp_history.strip()
+            history_str = format_history(summary_turns + kept_turns[::-1]).strip()
             if history_str:
                  self.logger.debug(f" -> Included {len(history_str)} chars of history (limit: {max_history_chars}).")
                  history_str = f"this is just a histroy dont use this as a query ,dont detect the query language from this and reponsed in this language  , this is just a histroy of the chat conversion to help u with context\n\"\"\"\n{history_str}\n\"\"\"\n\n"
@@ -669,7 +1050,22 @@ Knowledge Adherence Level: {knowledge_adherence_level}
         prompt_parts = [system_instructions, f"Previous Conversation History:\n---\n{history_str}\n---\n\n"]
 
         context_str = ""
-        if not is_image_only:
+        context_stats = {}
+        count_tokens = get_token_counter(app_config.get('PROMPT_TOKENIZER_ENCODING', 'cl100k_base'))
+        if not is_image_only and app_config.get('PROMPT_TOKEN_BUDGET_ENABLED', True):
+            context_str_parts, context_stats = assemble_context(
+                retrieved_texts or [],
+                retrieved_ids,
+                max_tokens=app_config.get('MAX_CONTEXT_TOKENS', 2200),
+                count_tokens=count_tokens,
+                max_overlap=app_config.get('PROMPT_OVERLAP_MAX_CHARS', 200),
+            )
+            self.logger.info(f" -> Context: {context_stats['sections']} sections from {context_stats['chunks_included']}/{context_stats['chunks_total']} chunks, {context_stats['context_tokens']}/{context_stats['context_token_budget']} tokens ({context_stats['overlap_chars_removed']} overlap chars removed).")
+            if context_str_parts:
+                 context_str = "\n\n".join(context_str_parts)
+            else:
+                 context_str = "No relevant context sections could be included within the size limit." if retrieved_texts else "No relevant context sections were found."
+        elif not is_image_only:
             max_context_chars = app_config.get('MAX_CONTEXT_CHARS', 8000) # Default to 8000 chars if not set
             context_str_parts = []
             current_chars = 0
@@ -702,22 +1098,212 @@ Knowledge Adherence Level: {knowledge_adherence_level}
         prompt_parts.append(f"\"\"\"\nUser Query:\n{query}\n\"\"\"") # The LLM will see the query in its original language here
 
         final_prompt = "\n".join(prompt_parts).strip()
+        prompt_tokens = count_tokens(final_prompt)
+        self.logger.info(f" -> Final prompt: {prompt_tokens} tokens ({len(final_prompt)} chars).")
+        if prompt_stats is not None:
+            prompt_stats.update(context_stats)
+            prompt_stats["prompt_tokens"] = prompt_tokens
         self.logger.debug(f" -> Final Constructed Prompt (first 200 chars):\n{final_prompt[:200]}...")
         return final_prompt
 
+    # --- extract_image_text ---
+    def extract_image_text(self, image_data: bytes, image_mime_type: str, request_id: str = None) -> tuple[str, list]:
+        """
+        Extracts the text (or a short description) from an image with the generation model.
+        Returns (extracted_text, warnings). Results are cached by image content (see image_analysis_cache).
+        """
+        step_start_time = time.time()
+        image_cache = get_image_analysis_cache()
+        cache_key = image_analysis_key(image_data, self.generation_model_name, IMAGE_EXTRACTION_PROMPT_VERSION) if image_cache else None
+        if image_cache:
+            cached = image_cache.get(cache_key)
+            if cached is not None:
+                self.logger.info(f"[ReqID: {request_id}] -> Image extraction cache hit ({len(cached['text'])} chars).")
+                return cached['text'], list(cached['warnings'])
+
+        extracted_image_text = ""
+        warnings = []
+        safety_ratings = []
+        cacheable = True # API errors are transient and never cached
+        from vertexai.generative_models import FinishReason, GenerationConfig, HarmBlockThreshold, Part
+        try:
+            image_part = Part.from_data(data=image_data, mime_type=image_mime_type)
+            extraction_gen_config = GenerationConfig(max_output_tokens=500, temperature=0.1)
+            extraction_response = self.generation_model.generate_content(
+                [IMAGE_EXTRACTION_PROMPT, image_part],
+                generation_config=extraction_gen_config,
+                safety_settings=_safety_settings()
+            )
+            safety_blocked = False
+            if hasattr(extraction_response, 'prompt_feedback') and extraction_response.prompt_feedback and extraction_response.prompt_feedback.safety_ratings:
+                safety_blocked = any(
+                    rating.probability in [HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE, HarmBlockThreshold.BLOCK_ONLY_HIGH]
+                    for rating in extraction_response.prompt_feedback.safety_ratings
+                )
+            if safety_blocked:
+                self.logger.warning(f"[ReqID: {request_id}] Image extraction prompt blocked due to safety (Time: {time.time() - step_start_time:.3f}s)")
+                warnings.append("Image processing prompt blocked due to safety concerns.")
+            elif extraction_response.candidates:
+                img_candidate = extraction_response.candidates[0]
+                img_finish_reason = img_candidate.finish_reason
+                img_finish_reason_str = img_finish_reason.name if img_finish_reason else "UNKNOWN"
+                if img_finish_reason != FinishReason.STOP:
+                    self.logger.warning(f"[ReqID: {request_id}] Image extraction finished with reason: {img_finish_reason_str} (Time: {time.time() - step_start_time:.3f}s)")
+                    if img_finish_reason == FinishReason.SAFETY:
+                        safety_ratings.extend({"category": r.category.name, "probability": r.probability.name} for r in img_candidate.safety_ratings or [])
+                        self.logger.warning(f"[ReqID: {request_id}] -> Safety Ratings: {safety_ratings}")
+                        warnings.append("Image processing stopped due to safety settings.")
+                if img_finish_reason != FinishReason.SAFETY: # Check again, as it might be STOP but still have content
+                    if img_candidate.content and img_candidate.content.parts:
+                        extracted_image_text = img_candidate.content.parts[0].text.strip()
+                        if extracted_image_text: self.logger.info(f"[ReqID: {request_id}] -> Extracted text/desc: '{extracted_image_text[:100]}...'")
+                        else: self.logger.info(f"[ReqID: {request_id}] -> Image processed, but no text extracted (Reason: {img_finish_reason_str}).")
+                    else: self.logger.warning(f"[ReqID: {request_id}] -> Could not extract text/desc (Reason: {img_finish_reason_str}, missing content parts).")
+            else:
+                self.logger.warning(f"[ReqID: {request_id}] -> Image extraction returned no candidates and prompt was not blocked.")
+                cacheable = False
+        except GoogleAPICallError as e:
+            self.logger.error(f"[ReqID: {request_id}] -> API Error during image extraction: {e}", exc_info=True)
+            warnings.append(f"API error processing image: {e}")
+            cacheable = False
+        except Exception as e:
+            self.logger.error(f"[ReqID: {request_id}] -> General Error during image extraction: {e}", exc_info=True)
+            warnings.append(f"Failed to process image: {e}")
+            cacheable = False
+        if image_cache and cacheable:
+            image_cache.set(cache_key, {"text": extracted_image_text, "warnings": warnings, "safety_ratings": safety_ratings})
+        return extracted_image_text, warnings
+
+    def route_query(self, query: str, chat_history: list, chatbot_id: int, query_embedding: list = None, request_id: str = None) -> tuple[dict, dict]:
+        """
+        Decides whether a query on an advanced-RAG chatbot needs the advanced pipeline (see rag_router.py).
+        Returns (decision, probe): decision = {"route", "reasons", "query_signals", "retrieval_signals", "latency_ms"}
+        for metadata["routing"]; probe = {"embedding", "neighbors"} from the probe retrieval, which the standard
+        pipeline reuses (empty when no probe ran or it failed).
+        """
+        start_time = time.time()
+        app_config = current_app.config
+        thresholds = {
+            'long_query_words': app_config.get('ADAPTIVE_RAG_LONG_QUERY_WORDS', 25),
+            'max_best_distance': app_config.get('ADAPTIVE_RAG_MAX_BEST_DISTANCE', 0.45),
+            'confident_distance': app_config.get('ADAPTIVE_RAG_CONFIDENT_DISTANCE', 0.30),
+            'min_distance_spread': app_config.get('ADAPTIVE_RAG_MIN_DISTANCE_SPREAD', 0.02),
+        }
+        decision = {"route": "standard", "reasons": [], "query_signals": query_signals(query, chat_history), "retrieval_signals": None}
+        probe = {}
+        decision["reasons"] = escalation_reasons_for_query(decision["query_signals"], thresholds)
+        if not decision["reasons"]: # Query signals alone are enough to escalate, so only probe when they pass
+            if query_embedding is None:
+                embeddings, emb_err = self.generate_multiple_embeddings([query])
+                query_embedding = embeddings[0] if not emb_err and embeddings else None
+            if query_embedding is not None:
+                per_query_neighbors, _ = self.find_neighbors_per_query([query_embedding], chatbot_id)
+                neighbors = per_query_neighbors[0] if per_query_neighbors else None
+                decision["retrieval_signals"] = retrieval_signals(neighbors)
+                decision["reasons"] = escalation_reasons_for_retrieval(decision["retrieval_signals"], thresholds)
+                if neighbors is not None:
+                    probe = {"embedding": query_embedding, "neighbors": neighbors}
+        if decision["reasons"]:
+            decision["route"] = "advanced"
+        decision["latency_ms"] = int((time.time() - start_time) * 1000)
+        self.logger.info(f"[ReqID: {request_id}] PERF: Adaptive RAG routing chose {decision['route']} in {decision['latency_ms']}ms (Reasons: {decision['reasons'] or 'none'}).")
+        return decision, probe
+
     # --- execute_pipeline METHOD MODIFIED ---
-    def execute_pipeline(self, query: str, chatbot_id: int, client_id: str, chat_history: list = None, query_language: str = None, image_data: bytes = None, image_mime_type: str = None, force_advanced_rag: bool = None):
+    def execute_pipeline(self, query: str, chatbot_id: int, client_id: str, chat_history: list = None, query_language: str = None, image_data: bytes = None, image_mime_type: str = None, force_advanced_rag: bool = None, history_loader=None, history_fingerprint=None):
         """
         Executes the full RAG pipeline.
         Returns a dictionary: {"answer": str, "sources": list, "metadata": dict, "error": str|None, "warnings": str|None}
+        Concurrent identical text queries share one pipeline run (see single_flight.py).
+        `history_loader` (a callable returning the chat history) may be passed instead of `chat_history`, so the
+        history is loaded while the query is embedded and retrieved (see _pipeline_events). `history_fingerprint`
+        (a callable returning a cheap identity of that history, '' when it is empty - see
+        chat_history.session_history_fingerprint) lets coalescing key on the history without loading it.
         """
+        def _run():
+            final_result = None
+            for event_type, payload in self._pipeline_events(query, chatbot_id, client_id, chat_history, query_language, image_data, image_mime_type, force_advanced_rag, history_loader=history_loader, stream_generation=False):
+                if event_type == 'result':
+                    final_result = payload
+            return final_result
+
+        single_flight = get_single_flight() if (query and not image_data) else None
+        chatbot = get_chatbot_config(chatbot_id) if single_flight else None
+        if chatbot is None:
+            return _run()
+        session_fingerprint = None
+        if chat_history is None and history_loader:
+            session_fingerprint = self._history_fingerprint(history_fingerprint)
+            if session_fingerprint is None:
+                # No cheap identity for the history; the key has to compare its contents
+                chat_history = self._load_deferred_history(history_loader)
+                history_loader = None
+            elif not session_fingerprint:
+                chat_history, history_loader = [], None # The session has no messages yet
+        advanced_mode = force_advanced_rag if force_advanced_rag is not None else chatbot.advanced_rag_enabled
+        key = coalescing_key(chatbot.id, chatbot_answer_fingerprint(chatbot, advanced_mode), query, chat_history, query_language,
+                             history_fingerprint=session_fingerprint)
+        start_time = time.time()
+        result, shared = single_flight.do(key, _run)
+        if not shared or not isinstance(result, dict):
+            return result
+
+        # A follower gets its own copy and message ID, and its own usage record (no LLM spend of its own)
+        request_id = str(uuid.uuid4())
+        follower_result = copy.deepcopy(result)
+        follower_result["response_message_id"] = str(uuid.uuid4())
+        follower_result.setdefault("metadata", {})["coalesced"] = True
+        self.logger.info(f"[ReqID: {request_id}] PERF: Served by a concurrent identical request's pipeline run in {time.time() - start_time:.4f} seconds.")
+        self._log_usage(request_id, chatbot_id, client_id, query, follower_result.get("answer"), follower_result.get("sources", []), time.time() - start_time, follower_result.get("error"), 500 if follower_result.get("error") else 200, {"coalesced": True})
+        return follower_result
+
+    def stream_pipeline(self, query: str, chatbot_id: int, client_id: str, chat_history: list = None, query_language: str = None, image_data: bytes = None, image_mime_type: str = None, force_advanced_rag: bool = None, history_loader=None):
+        """
+        Streaming variant of execute_pipeline. Returns a generator of (event_type, payload) tuples:
+          ('retrieval', {"sources": list, "response_message_id": str})  once context is ready,
+          ('delta', str)                                                  for each generated text fragment,
+          ('result', dict)                                                last; same dict execute_pipeline returns.
+        Advanced RAG and answer-cache hits are not token-streamed; their answer arrives as a single delta.
+        """
+        return self._pipeline_events(query, chatbot_id, client_id, chat_history, query_language, image_data, image_mime_type, force_advanced_rag, history_loader=history_loader, stream_generation=True)
+
+    def _history_fingerprint(self, history_fingerprint) -> str | None:
+        """Runs a `history_fingerprint` callable; None when there is none or it fails."""
+        if history_fingerprint is None:
+            return None
+        try:
+            return history_fingerprint()
+        except Exception as e:
+            self.logger.warning(f"Chat history fingerprint failed, loading the history for the coalescing key instead: {e}")
+            return None
+
+    def _load_deferred_history(self, history_loader, request_id: str = None) -> list:
+        """Runs a `history_loader` passed to the pipeline. A failing loader means no history, as in the routes."""
+        start_time = time.time()
+        try:
+            chat_history = history_loader() or []
+        except Exception as e:
+            self.logger.error(f"[ReqID: {request_id}] Deferred chat history load failed, continuing without history: {e}", exc_info=True)
+            chat_history = []
+        self.logger.info(f"[ReqID: {request_id}] PERF: Deferred Chat History Load took {time.time() - start_time:.4f} seconds ({len(chat_history)} turns).")
+        return chat_history
+
+    def _pipeline_events(self, query: str, chatbot_id: int, client_id: str, chat_history: list = None, query_language: str = None, image_data: bytes = None, image_mime_type: str = None, force_advanced_rag: bool = None, history_loader=None, stream_generation: bool = False):
+        """
+        Generator implementing the pipeline for execute_pipeline/stream_pipeline (see stream_pipeline for events).
+        With a `history_loader` and no `chat_history`, the history starts loading on the shared I/O pool as soon as
+        the request is validated and is joined only where it is read: after the answer cache's query embedding,
+        before adaptive routing / advanced RAG, and before the standard path builds its prompt (after retrieval).
+        """
+        if chat_history is not None:
+            history_loader = None
         request_id = str(uuid.uuid4())
         response_message_id = str(uuid.uuid4()) # Generate ID for the assistant's response
         self.logger.info(f"[ReqID: {request_id}] --- Starting RAG Pipeline ---")
         self.logger.info(f"[ReqID: {request_id}] Chatbot ID: {chatbot_id}, Client ID: {client_id}")
         self.logger.info(f"[ReqID: {request_id}] Original Text Query: '{query[:100] if query else 'N/A'}{'...' if query and len(query) > 100 else ''}'")
         self.logger.info(f"[ReqID: {request_id}] Image Provided: {'Yes (' + image_mime_type + ')' if image_data else 'No'}")
-        self.logger.info(f"[ReqID: {request_id}] History Turns: {len(chat_history) if chat_history else 0}")
+        self.logger.info(f"[ReqID: {request_id}] History Turns: {'deferred' if history_loader else len(chat_history or [])}")
         self.logger.info(f"[ReqID: {request_id}] Requested Language Parameter: {query_language or 'Not Provided'}")
         self.logger.info(f"[ReqID: {request_id}] Force Advanced RAG Parameter: {force_advanced_rag}")
 
@@ -733,30 +1319,58 @@ Knowledge Adherence Level: {knowledge_adherence_level}
             final_result["error"] = f"Service initialization failed: {self.initialization_error}"
             self.logger.info(f"[ReqID: {request_id}] PERF: Client Initialization Check took {time.time() - step_start_time:.4f} seconds (Failed).")
             self._log_usage(request_id, chatbot_id, client_id, query, None, [], time.time() - pipeline_overall_start_time, final_result["error"], 503, {})
-            return final_result
+            yield 'result', final_result
+            return
         self.logger.info(f"[ReqID: {request_id}] PERF: Client Initialization Check took {time.time() - step_start_time:.4f} seconds.")
 
         if not query and not image_data:
              self.logger.warning(f"[ReqID: {request_id}] Pipeline Aborted: Both query text and image data are missing.")
              final_result["error"] = "Please provide a text question or upload an image."
              self._log_usage(request_id, chatbot_id, client_id, "[No Query]", None, [], time.time() - pipeline_overall_start_time, final_result["error"], 400, {})
-             return final_result
+             yield 'result', final_result
+             return
         if not chatbot_id or not client_id:
              self.logger.error(f"[ReqID: {request_id}] Pipeline Aborted: Missing chatbot_id ({chatbot_id}) or client_id ({client_id}).")
              final_result["error"] = "Missing required chatbot identification."
              self._log_usage(request_id, chatbot_id, client_id, query, None, [], time.time() - pipeline_overall_start_time, final_result["error"], 400, {})
-             return final_result
+             yield 'result', final_result
+             return
+
+        # --- Deferred Chat History (runs alongside everything up to the first step that reads it) ---
+        history_future = None
+        history_timing = {}
+        if history_loader:
+            app = current_app._get_current_object()
+
+            def _load_history_in_background():
+                history_timing["start"] = time.time()
+                try:
+                    with app.app_context():
+                        return self._load_deferred_history(history_loader, request_id)
+                finally:
+                    history_timing["end"] = time.time()
+            history_future = self._get_io_executor().submit(_load_history_in_background)
+
+        def _join_history():
+            nonlocal chat_history, history_future
+            if history_future is not None:
+                join_start = time.time()
+                chat_history = history_future.result() # _load_deferred_history doesn't raise
+                history_future = None
+                self.logger.info(f"[ReqID: {request_id}] PERF: Waited {time.time() - join_start:.4f} seconds for the deferred chat history.")
+            return chat_history
 
         # --- Get Chatbot Configuration ---
         step_start_time = time.time()
         try:
-            chatbot = db.session.get(Chatbot, chatbot_id)
+            chatbot = get_chatbot_config(chatbot_id) # Cached snapshot (also used by require_api_key)
             if not chatbot:
                 self.logger.error(f"[ReqID: {request_id}] Pipeline Error: Chatbot with ID {chatbot_id} not found.")
                 final_result["error"] = "Chatbot configuration not found."
                 self.logger.info(f"[ReqID: {request_id}] PERF: Chatbot Config Fetch took {time.time() - step_start_time:.4f} seconds (Failed).")
                 self._log_usage(request_id, chatbot_id, client_id, query, None, [], time.time() - pipeline_overall_start_time, final_result["error"], 404, {})
-                return final_result
+                yield 'result', final_result
+                return
             base_prompt_override = chatbot.base_prompt
             knowledge_adherence = chatbot.knowledge_adherence_level or 'strict'
             image_analysis_enabled = chatbot.image_analysis_enabled
@@ -767,7 +1381,8 @@ Knowledge Adherence Level: {knowledge_adherence_level}
              final_result["error"] = "Database error retrieving chatbot configuration."
              self.logger.info(f"[ReqID: {request_id}] PERF: Chatbot Config Fetch took {time.time() - step_start_time:.4f} seconds (DB Error).")
              self._log_usage(request_id, chatbot_id, client_id, query, None, [], time.time() - pipeline_overall_start_time, final_result["error"], 500, {})
-             return final_result
+             yield 'result', final_result
+             return
 
         # --- Determine RAG Mode (Standard or Advanced) ---
         use_advanced_processing = False
@@ -777,6 +1392,56 @@ Knowledge Adherence Level: {knowledge_adherence_level}
         else:
             use_advanced_processing = chatbot.advanced_rag_enabled
             self.logger.info(f"[ReqID: {request_id}] RAG mode determined by chatbot setting: {'Advanced' if use_advanced_processing else 'Standard'}")
+        # Advanced chatbots route each text query; the answer cache and single-flight key stay on the configured mode
+        adaptive_routing = (force_advanced_rag is None and use_advanced_processing and bool(query) and not image_data
+                            and current_app.config.get('ADAPTIVE_RAG_ROUTING_ENABLED', True))
+        routing_decision = None
+        routing_probe = {}
+
+        # --- Semantic Answer Cache (opt-in per chatbot, standalone text-only queries) ---
+        # A history still loading is checked once the query is embedded, so the two overlap
+        answer_cache = get_answer_cache() if (chatbot.answer_cache_enabled and answer_cache_applies(query, None if history_future else chat_history, image_data)) else None
+        answer_cache_fingerprint = None
+        answer_cache_embedding = None
+        if answer_cache:
+            step_start_time = time.time()
+            answer_cache_fingerprint = chatbot_answer_fingerprint(chatbot, use_advanced_processing, query_language)
+            cache_embeddings, cache_emb_err = self.generate_multiple_embeddings([query])
+            if not answer_cache_applies(query, _join_history(), image_data):
+                self.logger.info(f"[ReqID: {request_id}] Answer cache skipped: the query continues a conversation.")
+                answer_cache = None # Neither served from nor stored in the cache
+            elif not cache_emb_err and cache_embeddings and cache_embeddings[0] is not None:
+                answer_cache_embedding = cache_embeddings[0]
+                cached_entry = answer_cache.lookup(chatbot_id, answer_cache_fingerprint, query, answer_cache_embedding)
+                self.logger.info(f"[ReqID: {request_id}] PERF: Answer Cache Lookup took {time.time() - step_start_time:.4f} seconds ({'HIT' if cached_entry else 'MISS'}).")
+                if cached_entry:
+                    cache_metadata = {
+                        "answer_cache": {
+                            "hit": True,
+                            "similarity": cached_entry.get("similarity"),
+                            "cached_query": cached_entry.get("query"),
+                            # Token counts of the original generation, i.e. the LLM spend this hit saved
+                            "saved_token_counts": (cached_entry.get("metadata") or {}).get("token_counts", {}),
+                        }
+                    }
+                    final_result["answer"] = cached_entry.get("answer")
+                    final_result["sources"] = cached_entry.get("sources", [])
+                    final_result["retrieved_raw_texts"] = []
+                    final_result["metadata"] = cache_metadata
+                    final_result["response_message_id"] = response_message_id
+                    self._log_usage(request_id, chatbot_id, client_id, query, final_result["answer"], final_result["sources"], time.time() - pipeline_overall_start_time, None, 200, cache_metadata)
+                    yield 'retrieval', {"sources": final_result["sources"], "response_message_id": response_message_id}
+                    yield 'delta', final_result["answer"]
+                    yield 'result', final_result
+                    return
+            else:
+                self.logger.warning(f"[ReqID: {request_id}] Answer cache lookup skipped: could not embed query ({cache_emb_err}).")
+
+        if use_advanced_processing:
+            _join_history() # Routing signals and advanced RAG's first step (query rephrasing) read the history
+        if adaptive_routing:
+            routing_decision, routing_probe = self.route_query(query, chat_history, chatbot_id, answer_cache_embedding, request_id)
+            use_advanced_processing = routing_decision["route"] == "advanced"
 
         if use_advanced_processing:
             try:
@@ -812,13 +1477,23 @@ Knowledge Adherence Level: {knowledge_adherence_level}
                 final_result["sources"] = adv_sources
                 final_result["response_message_id"] = response_message_id 
                 final_result["metadata"] = adv_metadata or {}
-                final_result["retrieved_raw_texts"] = adv_metadata.get("retrieved_raw_texts", []) # Add this line
+                final_result["retrieved_raw_texts"] = final_result["metadata"].get("retrieved_raw_texts", []) # Add this line
+                if routing_decision:
+                    final_result["metadata"]["routing"] = routing_decision
                 
                 if adv_status_code != 200 and adv_error_message:
                     final_result["error"] = adv_error_message
+                elif answer_cache and answer_cache_embedding is not None and adv_response_text:
+                    answer_cache.store(chatbot_id, answer_cache_fingerprint, query, answer_cache_embedding, adv_response_text, adv_sources,
+                                       {k: v for k, v in (adv_metadata or {}).items() if k != "retrieved_raw_texts"})
+                    final_result["metadata"]["answer_cache"] = {"hit": False}
                 
-                self._log_usage(request_id, chatbot_id, client_id, query, adv_response_text, adv_sources, time.time() - pipeline_overall_start_time, final_result.get("error"), adv_status_code, adv_metadata or {})
-                return final_result
+                self._log_usage(request_id, chatbot_id, client_id, query, adv_response_text, adv_sources, time.time() - pipeline_overall_start_time, final_result.get("error"), adv_status_code, final_result["metadata"])
+                if not final_result.get("error"):
+                    yield 'retrieval', {"sources": adv_sources, "response_message_id": response_message_id}
+                    yield 'delta', adv_response_text
+                yield 'result', final_result
+                return
 
             except Exception as adv_e:
                 self.logger.error(f"[ReqID: {request_id}] Unhandled exception during advanced RAG processing call: {adv_e}", exc_info=True)
@@ -831,92 +1506,40 @@ Knowledge Adherence Level: {knowledge_adherence_level}
                 final_result["metadata"] = {"internal_error_type": str(type(adv_e).__name__)}
 
                 self._log_usage(request_id, chatbot_id, client_id, query, final_result["answer"], [], time.time() - pipeline_overall_start_time, final_result["error"], 500, final_result["metadata"])
-                return final_result
+                yield 'result', final_result
+                return
         # --- End Advanced RAG Routing ---
 
         # --- Standard RAG Pipeline (if not routed to Advanced) ---
         self.logger.info(f"[ReqID: {request_id}] Proceeding with Standard RAG Pipeline for chatbot {chatbot_id}.")
+        # Steps 1-7b run as a dependency graph so independent stages overlap:
+        #   [image_text ->] embed -> retrieve -> fetch -> rerank
+        #                            retrieve -> source_map (runs alongside fetch/rerank)
+        # A deferred chat history keeps loading alongside the graph and is joined before the prompt is built.
+        # Image extraction only gates embedding when there is no text query to embed.
+        # Per-stage timings are returned in metadata["stage_timings"].
+        run_image_extraction = bool(image_data and image_analysis_enabled)
+        if image_data and not image_analysis_enabled:
+             self.logger.warning(f"[ReqID: {request_id}] Image provided but image analysis is disabled for this chatbot. Ignoring image.")
+
         # --- 1. Image Text Extraction (if image provided and enabled) ---
-        extracted_image_text = ""
-        if image_data and image_analysis_enabled:
+        def _stage_image_text(_deps):
             step_start_time = time.time()
             self.logger.info(f"[ReqID: {request_id}] RAG Step 1: Extracting text/description from image...")
-            try:
-                image_part = Part.from_data(data=image_data, mime_type=image_mime_type)
-                extraction_prompt = "Extract all text visible in this image in the exact same language as it is in the image  . If no text is present, briefly describe the image's main subject and context.again in the same language as in the image "
-                extraction_gen_config = GenerationConfig(max_output_tokens=500, temperature=0.1)
-                extraction_response = self.generation_model.generate_content(
-                    [extraction_prompt, image_part],
-                    generation_config=extraction_gen_config,
-                    safety_settings=SAFETY_SETTINGS
-                )
-                safety_blocked = False
-                if hasattr(extraction_response, 'prompt_feedback') and extraction_response.prompt_feedback and extraction_response.prompt_feedback.safety_ratings:
-                    safety_blocked = any(
-                        rating.probability in [HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE, HarmBlockThreshold.BLOCK_ONLY_HIGH]
-                        for rating in extraction_response.prompt_feedback.safety_ratings
-                    )
-                if safety_blocked:
-                    self.logger.warning(f"[ReqID: {request_id}] Image extraction prompt blocked due to safety (Time: {time.time() - step_start_time:.3f}s)")
-                    error_accumulator.append("Image processing prompt blocked due to safety concerns.")
-                elif extraction_response.candidates:
-                    img_candidate = extraction_response.candidates[0]
-                    img_finish_reason = img_candidate.finish_reason
-                    img_finish_reason_str = img_finish_reason.name if img_finish_reason else "UNKNOWN"
-                    if img_finish_reason != FinishReason.STOP:
-                        self.logger.warning(f"[ReqID: {request_id}] Image extraction finished with reason: {img_finish_reason_str} (Time: {time.time() - step_start_time:.3f}s)")
-                        if img_finish_reason == FinishReason.SAFETY:
-                            safety_ratings = [{"category": r.category.name, "probability": r.probability.name} for r in img_candidate.safety_ratings] if img_candidate.safety_ratings else []
-                            self.logger.warning(f"[ReqID: {request_id}] -> Safety Ratings: {safety_ratings}")
-                            error_accumulator.append("Image processing stopped due to safety settings.")
-                    if img_finish_reason != FinishReason.SAFETY: # Check again, as it might be STOP but still have content
-                        if img_candidate.content and img_candidate.content.parts:
-                            extracted_image_text = img_candidate.content.parts[0].text.strip()
-                            if extracted_image_text: self.logger.info(f"[ReqID: {request_id}] -> Extracted text/desc: '{extracted_image_text[:100]}...'")
-                            else: self.logger.info(f"[ReqID: {request_id}] -> Image processed, but no text extracted (Reason: {img_finish_reason_str}).")
-                        else: self.logger.warning(f"[ReqID: {request_id}] -> Could not extract text/desc (Reason: {img_finish_reason_str}, missing content parts).")
-                else: self.logger.warning(f"[ReqID: {request_id}] -> Image extraction returned no candidates and prompt was not blocked.")
-            except GoogleAPICallError as e:
-                self.logger.error(f"[ReqID: {request_id}] -> API Error during image extraction: {e}", exc_info=True)
-                error_accumulator.append(f"API error processing image: {e}")
-            except Exception as e:
-                self.logger.error(f"[ReqID: {request_id}] -> General Error during image extraction: {e}", exc_info=True)
-                error_accumulator.append(f"Failed to process image: {e}")
+            extracted_image_text, image_warnings = self.extract_image_text(image_data, image_mime_type, request_id)
+            error_accumulator.extend(image_warnings)
             self.logger.info(f"[ReqID: {request_id}] PERF: Image Text Extraction took {time.time() - step_start_time:.4f} seconds.")
-        elif image_data and not image_analysis_enabled:
-             self.logger.warning(f"[ReqID: {request_id}] Image provided but image analysis is disabled for this chatbot. Ignoring image.")
-
-        # --- 2. Determine RAG Query ---
-        rag_query = extracted_image_text if extracted_image_text and not query else query # Prioritize user text query if both exist
-        if not rag_query and extracted_image_text: # If only image text was available
-            rag_query = extracted_image_text
-            
-        is_image_only_query = bool(image_data and not query and extracted_image_text) # True if query is based *solely* on image extraction
-
-        if not rag_query: # Final check if we still don't have a query
-             self.logger.error(f"[ReqID: {request_id}] No effective query available for RAG after considering image and text inputs.")
-             self.logger.error(f"[ReqID: {request_id}] No effective query available for RAG after considering image and text inputs.")
-             final_result["error"] = "; ".join(error_accumulator) or "Could not determine a query from the provided input."
-             self._log_usage(request_id, chatbot_id, client_id, "[No Effective Query]", None, [], time.time() - pipeline_overall_start_time, final_result["error"], 400, {})
-             return final_result
-        
-        if extracted_image_text and query: self.logger.info(f"[ReqID: {request_id}] -> Using user text query ('{query[:50]}...') for RAG, extracted image text ('{extracted_image_text[:50]}...') might be used in prompt.")
-        elif extracted_image_text: self.logger.info(f"[ReqID: {request_id}] -> Using extracted image text ('{rag_query[:50]}...') as the query for RAG.")
-        else: self.logger.info(f"[ReqID: {request_id}] -> Using user-provided text query ('{rag_query[:50]}...') for RAG.")
-
-        # --- 3. Language Detection & Translation (SKIPPED) ---
-        self.logger.info(f"[ReqID: {request_id}] RAG Step 3: Skipping Language Detection & Translation.")
-        query_for_embedding = rag_query 
-
-        # --- 4. Generate Rephrased Queries (SKIPPED) ---
-        self.logger.info(f"[ReqID: {request_id}] RAG Step 4a: Skipping Query Rephrasing.")
-        all_queries_for_embedding = [query_for_embedding] 
-        all_queries_for_embedding = [q for q in all_queries_for_embedding if q and q.strip()]
-
-
-        # --- 5. Generate Embeddings ---
-        query_embeddings = []
-        if all_queries_for_embedding:
+            return extracted_image_text
+
+        # --- 2-5. Determine RAG Query & Generate Embeddings ---
+        # Language detection/translation (step 3) and query rephrasing (step 4a) are skipped in the standard path.
+        def _stage_embed(deps):
+            rag_query_local = query or deps.get('image_text') or ""
+            if routing_probe:
+                return rag_query_local, [routing_probe["embedding"]] # Embedded by the routing probe
+            all_queries_for_embedding = [q for q in [rag_query_local] if q and q.strip()]
+            if not all_queries_for_embedding:
+                return rag_query_local, [] # Handled after the graph (no effective query)
             step_start_time = time.time()
             self.logger.info(f"[ReqID: {request_id}] RAG Step 4b: Generate Embeddings for {len(all_queries_for_embedding)} queries")
             embeddings, emb_err = self.generate_multiple_embeddings(all_queries_for_embedding)
@@ -924,100 +1547,135 @@ Knowledge Adherence Level: {knowledge_adherence_level}
             if emb_err:
                 self.logger.error(f"[ReqID: {request_id}] Pipeline Step Failed: Embedding Generation - {emb_err}")
                 error_accumulator.append(f"Embedding generation failed: {emb_err}")
-            elif embeddings:
-                query_embeddings = embeddings
-            else:
-                 self.logger.error(f"[ReqID: {request_id}] Embedding generation returned no results and no error.")
-                 error_accumulator.append("Embedding generation failed unexpectedly.")
-        else:
-             self.logger.warning(f"[ReqID: {request_id}] No valid queries available for embedding generation.")
-             error_accumulator.append("No query available for embedding.")
+                return rag_query_local, []
+            if not embeddings:
+                self.logger.error(f"[ReqID: {request_id}] Embedding generation returned no results and no error.")
+                error_accumulator.append("Embedding generation failed unexpectedly.")
+                return rag_query_local, []
+            return rag_query_local, [e for e in embeddings if e is not None]
 
         # --- 6. Retrieve Relevant Chunks ---
-        retrieved_chunk_ids = []
-        retrieved_texts = []
-        sources = []
-        if query_embeddings:
+        def _stage_retrieve(deps):
+            _, query_embeddings = deps['embed']
+            if not query_embeddings:
+                self.logger.warning(f"[ReqID: {request_id}] Skipping retrieval and fetch due to missing embeddings.")
+                return []
             step_start_time = time.time()
             self.logger.info(f"[ReqID: {request_id}] RAG Step 5: Retrieve Chunks")
-            chunk_ids, ret_err = self.retrieve_chunks_multi_query(query_embeddings, chatbot_id, client_id)
+            probe_neighbors = [routing_probe["neighbors"]] if routing_probe else None
+            chunk_ids, ret_err = self.retrieve_chunks_multi_query(query_embeddings, chatbot_id, client_id, per_query_neighbors=probe_neighbors)
             self.logger.info(f"[ReqID: {request_id}] PERF: Chunk Retrieval (Vector Search) took {time.time() - step_start_time:.4f} seconds.")
             if ret_err:
                 self.logger.error(f"[ReqID: {request_id}] Pipeline Step Warning: Retrieval Failed - {ret_err}")
                 error_accumulator.append(f"Chunk retrieval failed: {ret_err}")
-            elif chunk_ids:
-                retrieved_chunk_ids = chunk_ids
-                # --- 7. Fetch Chunk Texts ---
-                step_start_time_fetch = time.time()
-                self.logger.info(f"[ReqID: {request_id}] RAG Step 6: Fetch Chunk Texts ({len(retrieved_chunk_ids)} IDs)")
-                texts, fetch_err = self.fetch_chunk_texts(retrieved_chunk_ids, chatbot_id)
-                self.logger.info(f"[ReqID: {request_id}] PERF: Fetch Chunk Texts (GCS) took {time.time() - step_start_time_fetch:.4f} seconds.")
-                if fetch_err:
-                    self.logger.warning(f"[ReqID: {request_id}] Pipeline Step Warning: Fetch Failed - {fetch_err}. Proceeding with partial/no context.")
-                    error_accumulator.append(f"Chunk text fetching failed: {fetch_err}")
-                    if texts: retrieved_texts = texts
-                elif texts:
-                    # Combine chunk IDs and their text content for reranking
-                    docs_for_reranking = []
-                    for i, text in enumerate(texts):
-                        # Assuming the document ID is stored in the 'id' field of the document object
-                        # and the text content is in 'page_content'.
-                        # You might need to adjust this based on your actual data structure.
-                        doc_id = retrieved_chunk_ids[i]
-                        docs_for_reranking.append({
-                            'id': doc_id,
-                            'page_content': text,
-                            'metadata': {'title': f"Document {doc_id}"} # Add a placeholder title if not available
-                        })
-
-                    # --- 7a. Rerank Chunks ---
-                    step_start_time_rerank = time.time()
-                    self.logger.info(f"[ReqID: {request_id}] RAG Step 6a: Reranking {len(docs_for_reranking)} chunks.")
-                    
-                    # Use the new ranking_service
-                    reranked_docs = self.ranking_service.rank_documents(rag_query, docs_for_reranking)
-                    
-                    self.logger.info(f"[ReqID: {request_id}] PERF: Reranking took {time.time() - step_start_time_rerank:.4f} seconds.")
-
-                    if reranked_docs:
-                        self.logger.info(f"[ReqID: {request_id}] -> Reranking successful. Using new order for context.")
-                        # The new order of texts and IDs for the prompt and source mapping
-                        retrieved_texts = [doc['page_content'] for doc in reranked_docs]
-                        retrieved_chunk_ids = [doc['id'] for doc in reranked_docs] # Update chunk IDs to match new order
-                    else:
-                        self.logger.warning("[ReqID: {request_id}] -> Reranking returned no documents or an error occurred. Using original order.")
-                        error_accumulator.append("Reranking failed or returned no results.")
-                        retrieved_texts = texts # Fallback to original order
-
-                    # --- 7b. Map Vector IDs to Source Info ---
-                    step_start_time_map = time.time()
-                    try:
-                         mappings = VectorIdMapping.query.filter(VectorIdMapping.vector_id.in_(retrieved_chunk_ids)).all()
-                         source_map = {m.vector_id: m.source_identifier for m in mappings if hasattr(m, 'source_identifier') and m.source_identifier}
-                         
-                         processed_sources = set()
-                         # Iterate through the (potentially reranked) chunk IDs to preserve order
-                         for chunk_id in retrieved_chunk_ids:
-                             identifier = source_map.get(chunk_id)
-                             if identifier:
-                                 source_type = 'unknown'
-                                 if identifier.startswith('file://'): source_type = 'file'
-                                 elif identifier.startswith('http://') or identifier.startswith('https://'): source_type = 'web'
-                                 source_key = (source_type, identifier)
-                                 if source_key not in processed_sources:
-                                     sources.append({'type': source_type, 'identifier': identifier})
-                                     processed_sources.add(source_key)
-                         
-                         self.logger.info(f"[ReqID: {request_id}] -> Mapped {len(sources)} unique sources from {len(retrieved_chunk_ids)} vector IDs.")
-                    except SQLAlchemyError as db_map_err:
-                         self.logger.error(f"[ReqID: {request_id}] -> Database error mapping vector IDs to sources: {db_map_err}", exc_info=True)
-                         error_accumulator.append("Failed to map retrieved chunks to sources.")
-                    self.logger.info(f"[ReqID: {request_id}] PERF: Map Vector IDs to Sources took {time.time() - step_start_time_map:.4f} seconds.")
-            else:
-                 self.logger.info("[ReqID: {request_id}] -> No relevant chunks found after retrieval.")
-        else:
-             self.logger.warning("[ReqID: {request_id}] Skipping retrieval and fetch due to missing embeddings.")
+                return []
+            if not chunk_ids:
+                self.logger.info(f"[ReqID: {request_id}] -> No relevant chunks found after retrieval.")
+            return chunk_ids or []
+
+        # --- 7. Fetch Chunk Texts ---
+        def _stage_fetch(deps):
+            chunk_ids = deps['retrieve']
+            if not chunk_ids:
+                return {}
+            step_start_time = time.time()
+            self.logger.info(f"[ReqID: {request_id}] RAG Step 6: Fetch Chunk Texts ({len(chunk_ids)} IDs)")
+            texts_by_id, fetch_err = self.fetch_chunk_texts_by_id(chunk_ids, chatbot_id)
+            self.logger.info(f"[ReqID: {request_id}] PERF: Fetch Chunk Texts (GCS) took {time.time() - step_start_time:.4f} seconds.")
+            if fetch_err:
+                self.logger.warning(f"[ReqID: {request_id}] Pipeline Step Warning: Fetch Failed - {fetch_err}. Proceeding with partial/no context.")
+                error_accumulator.append(f"Chunk text fetching failed: {fetch_err}")
+            return texts_by_id
+
+        # --- 7a. Rerank Chunks ---
+        def _stage_rerank(deps):
+            texts_by_id = deps['fetch']
+            if not texts_by_id:
+                return [], []
+            # Texts are keyed by vector ID, so partial fetches still pair each text with its own chunk
+            docs_for_reranking = [{
+                'id': doc_id,
+                'page_content': text,
+                'metadata': {'title': f"Document {doc_id}"} # Add a placeholder title if not available
+            } for doc_id, text in texts_by_id.items()]
+            step_start_time = time.time()
+            self.logger.info(f"[ReqID: {request_id}] RAG Step 6a: Reranking {len(docs_for_reranking)} chunks.")
+            reranked_docs = self.ranking_service.rank_documents(deps['embed'][0], docs_for_reranking)
+            self.logger.info(f"[ReqID: {request_id}] PERF: Reranking took {time.time() - step_start_time:.4f} seconds.")
+            if reranked_docs:
+                self.logger.info(f"[ReqID: {request_id}] -> Reranking successful. Using new order for context.")
+                return [doc['page_content'] for doc in reranked_docs], [doc['id'] for doc in reranked_docs]
+            self.logger.warning(f"[ReqID: {request_id}] -> Reranking returned no documents or an error occurred. Using original order.")
+            error_accumulator.append("Reranking failed or returned no results.")
+            return list(texts_by_id.values()), list(texts_by_id.keys())
+
+        # --- 7b. Map Vector IDs to Source Info (only needs the retrieved IDs, so it overlaps fetch/rerank) ---
+        def _stage_source_map(deps):
+            chunk_ids = deps['retrieve']
+            if not chunk_ids:
+                return {}
+            step_start_time = time.time()
+            try:
+                mappings = VectorIdMapping.query.filter(VectorIdMapping.vector_id.in_(chunk_ids)).all()
+                return {m.vector_id: m.source_identifier for m in mappings if hasattr(m, 'source_identifier') and m.source_identifier}
+            except SQLAlchemyError as db_map_err:
+                self.logger.error(f"[ReqID: {request_id}] -> Database error mapping vector IDs to sources: {db_map_err}", exc_info=True)
+                error_accumulator.append("Failed to map retrieved chunks to sources.")
+                return {}
+            finally:
+                self.logger.info(f"[ReqID: {request_id}] PERF: Map Vector IDs to Sources took {time.time() - step_start_time:.4f} seconds.")
+
+        scheduler = StageScheduler(logger_instance=self.logger, log_prefix=f"[ReqID: {request_id}] ")
+        if run_image_extraction:
+            scheduler.add('image_text', _stage_image_text)
+        scheduler.add('embed', _stage_embed, deps=('image_text',) if run_image_extraction and not query else ())
+        scheduler.add('retrieve', _stage_retrieve, deps=('embed',))
+        scheduler.add('fetch', _stage_fetch, deps=('retrieve',))
+        scheduler.add('source_map', _stage_source_map, deps=('retrieve',))
+        scheduler.add('rerank', _stage_rerank, deps=('fetch', 'embed'))
+        scheduler.run()
+        for stage_name, stage_err in scheduler.errors.items():
+            if not isinstance(stage_err, StageFailedError):
+                error_accumulator.append(f"Pipeline stage '{stage_name}' failed: {stage_err}")
+
+        extracted_image_text = scheduler.get('image_text') or ""
+        rag_query, _ = scheduler.get('embed', (query or extracted_image_text, []))
+        retrieved_texts, retrieved_chunk_ids = scheduler.get('rerank', ([], []))
+        source_map = scheduler.get('source_map', {})
+        if history_future is not None:
+            _join_history()
+            scheduler.record_timing('history', history_timing["start"], history_timing["end"])
+        stage_timings = scheduler.timings
+
+        is_image_only_query = bool(image_data and not query and extracted_image_text) # True if query is based *solely* on image extraction
 
+        if not rag_query: # Final check if we still don't have a query
+             self.logger.error(f"[ReqID: {request_id}] No effective query available for RAG after considering image and text inputs.")
+             final_result["error"] = "; ".join(error_accumulator) or "Could not determine a query from the provided input."
+             final_result["metadata"] = {"stage_timings": stage_timings}
+             self._log_usage(request_id, chatbot_id, client_id, "[No Effective Query]", None, [], time.time() - pipeline_overall_start_time, final_result["error"], 400, {})
+             yield 'result', final_result
+             return
+
+        if extracted_image_text and query: self.logger.info(f"[ReqID: {request_id}] -> Using user text query ('{query[:50]}...') for RAG, extracted image text ('{extracted_image_text[:50]}...') might be used in prompt.")
+        elif extracted_image_text: self.logger.info(f"[ReqID: {request_id}] -> Using extracted image text ('{rag_query[:50]}...') as the query for RAG.")
+        else: self.logger.info(f"[ReqID: {request_id}] -> Using user-provided text query ('{rag_query[:50]}...') for RAG.")
+
+        sources = []
+        processed_sources = set()
+        # Iterate through the (potentially reranked) chunk IDs to preserve order
+        for chunk_id in retrieved_chunk_ids:
+            identifier = source_map.get(chunk_id)
+            if identifier:
+                source_type = 'unknown'
+                if identifier.startswith('file://'): source_type = 'file'
+                elif identifier.startswith('http://') or identifier.startswith('https://'): source_type = 'web'
+                source_key = (source_type, identifier)
+                if source_key not in processed_sources:
+                    sources.append({'type': source_type, 'identifier': identifier})
+                    processed_sources.add(source_key)
+        if retrieved_chunk_ids:
+            self.logger.info(f"[ReqID: {request_id}] -> Mapped {len(sources)} unique sources from {len(retrieved_chunk_ids)} vector IDs.")
         # --- 8. Construct Final Prompt ---
         step_start_time = time.time()
         # Use original query for the "User Query:" part of the prompt, and rag_query for context building if different
@@ -1029,6 +1687,7 @@ Knowledge Adherence Level: {knowledge_adherence_level}
         self.logger.info(f"[ReqID: {request_id}] DEBUG: base_prompt_override before construct_prompt: {base_prompt_override}")
         self.logger.info(f"[ReqID: {request_id}] RAG Step 7: Construct Prompt")
         
+        prompt_stats = {}
         final_prompt = self.construct_prompt(
             retrieved_texts=retrieved_texts,
             query=prompt_user_query, # This is what the LLM sees as "User Query:"
@@ -1037,9 +1696,12 @@ Knowledge Adherence Level: {knowledge_adherence_level}
             chat_history=chat_history,
             knowledge_adherence_level=knowledge_adherence,
             is_image_only=is_image_only_query, # This flag indicates if context should be skipped
-            query_language=query_language
+            query_language=query_language,
+            retrieved_ids=retrieved_chunk_ids,
+            prompt_stats=prompt_stats
         )
         self.logger.info(f"[ReqID: {request_id}] PERF: Prompt Construction took {time.time() - step_start_time:.4f} seconds.")
+        scheduler.record_timing('prompt', step_start_time)
 
         # --- 9. Generate Response ---
         step_start_time = time.time()
@@ -1068,17 +1730,48 @@ Knowledge Adherence Level: {knowledge_adherence_level}
             else:
                 self.logger.info(f"[ReqID: {request_id}] RAG found context or query was text-based. NOT resupplying original image to LLM.")
         
-        response_text, gen_err, generation_metadata = self.generate_response(
-            prompt=final_prompt,
-            image_data=image_for_generation,
-            image_mime_type=mime_for_generation
-        )
+        yield 'retrieval', {"sources": sources, "response_message_id": response_message_id}
+        if stream_generation:
+            response_text, gen_err, generation_metadata = None, "Streaming generation did not complete.", None
+            generation_stream = self.generate_response_stream(
+                prompt=final_prompt,
+                image_data=image_for_generation,
+                image_mime_type=mime_for_generation
+            )
+            streamed_parts = []
+            stream_interrupted = True
+            try:
+                for gen_event, gen_payload in generation_stream:
+                    if gen_event == 'delta':
+                        streamed_parts.append(gen_payload)
+                        yield 'delta', gen_payload
+                    else:
+                        response_text, gen_err, generation_metadata = gen_payload
+                stream_interrupted = False
+            finally:
+                if stream_interrupted:
+                    # The client disconnected (GeneratorExit) or the stream raised mid-answer. Stop the LLM stream and
+                    # still log the request: the tokens generated so far were spent and partly delivered.
+                    generation_stream.close()
+                    self.logger.warning(f"[ReqID: {request_id}] Stream closed after {len(streamed_parts)} fragments; logging the partial answer.")
+                    scheduler.record_timing('generate', step_start_time)
+                    self._log_usage(request_id, chatbot_id, client_id, query, "".join(streamed_parts), sources, time.time() - pipeline_overall_start_time,
+                                    "Stream closed before the answer completed.", 200, {"stage_timings": stage_timings, "prompt": prompt_stats, "stream_interrupted": True})
+        else:
+            response_text, gen_err, generation_metadata = self.generate_response(
+                prompt=final_prompt,
+                image_data=image_for_generation,
+                image_mime_type=mime_for_generation
+            )
         self.logger.info(f"[ReqID: {request_id}] PERF: LLM Response Generation took {time.time() - step_start_time:.4f} seconds.")
+        scheduler.record_timing('generate', step_start_time)
         if gen_err:
             self.logger.error(f"[ReqID: {request_id}] Pipeline Step Failed: Generation - {gen_err}")
             final_result["error"] = "; ".join(error_accumulator + [f"Failed to generate response: {gen_err}"])
+            final_result["metadata"] = {"stage_timings": stage_timings}
             self._log_usage(request_id, chatbot_id, client_id, query, None, sources, time.time() - pipeline_overall_start_time, final_result["error"], 500, generation_metadata or {})
-            return final_result
+            yield 'result', final_result
+            return
         final_answer = response_text
 
         # --- 10. Final Translation (SKIPPED) ---
@@ -1091,18 +1784,28 @@ Knowledge Adherence Level: {knowledge_adherence_level}
         final_result["sources"] = sources
         final_result["retrieved_raw_texts"] = retrieved_texts
         final_result["metadata"] = generation_metadata or {}
+        final_result["metadata"]["stage_timings"] = stage_timings
+        final_result["metadata"]["prompt"] = prompt_stats
+        if routing_decision:
+            final_result["metadata"]["routing"] = routing_decision
         final_result["response_message_id"] = response_message_id 
         if error_accumulator:
              final_result["warnings"] = "; ".join(error_accumulator)
              self.logger.warning(f"[ReqID: {request_id}] Pipeline completed with warnings: {final_result['warnings']}")
-        self._log_usage(request_id, chatbot_id, client_id, query, final_answer, sources, pipeline_duration, final_result.get("warnings"), 200, generation_metadata or {})
-        return final_result
+        elif answer_cache and answer_cache_embedding is not None and final_answer:
+             # Only clean answers are cached so transient retrieval failures aren't replayed
+             answer_cache.store(chatbot_id, answer_cache_fingerprint, query, answer_cache_embedding, final_answer, sources, generation_metadata or {})
+             final_result["metadata"]["answer_cache"] = {"hit": False}
+        self._log_usage(request_id, chatbot_id, client_id, query, final_answer, sources, pipeline_duration, final_result.get("warnings"), 200, final_result["metadata"])
+        yield 'result', final_result
+        return
 
     def multimodal_query(self, query: str, chatbot_id: int, client_id: str, chat_history: list = None, query_language: str = None, image_data: bytes = None, image_mime_type: str = None, force_advanced_rag: bool = None):
         """
         Handles a multimodal query by first generating a descriptive query from the image,
         and then using that query to execute the full RAG pipeline.
         """
+        from vertexai.generative_models import GenerationConfig
         # Step 1: Generate a descriptive query from the image and optional text.
         image_analysis_prompt = "Analyze the provided image and generate a very short  , descriptive query less 3 consice sentence  based on its content. If text is also provided, use it to refine the focus of the query. this is critical you need to respond in the exact same language as the content of the image ,no matter if its a text or other diagram or anything  "
         if query:
@@ -1146,21 +1849,27 @@ Knowledge Adherence Level: {knowledge_adherence_level}
         return response_data.get("answer"), response_data.get("error"), response_data.get("metadata")
 
     def _log_usage(self, request_id: str, chatbot_id: int, client_id: str, query: str | None, response: str | None, sources: list, duration: float, error: str | None, status_code: int, metadata: dict):
-         """Logs usage details to the database."""
+         """Queues usage details for the database (see usage_logger.py)."""
          self.logger.debug(f"[ReqID: {request_id}] Logging usage to database...")
          try:
-             user = User.query.filter_by(client_id=client_id).first()
-             if not user:
-                 self.logger.error(f"[ReqID: {request_id}] Could not find user with client_id {client_id} to log usage.")
-                 return
-             user_id = user.id
+             # The chatbot snapshot already carries the owner, which saves a User lookup per query
+             chatbot = get_chatbot_config(chatbot_id) if chatbot_id else None
+             if chatbot is not None and chatbot.client_id == client_id:
+                 user_id = chatbot.user_id
+             else:
+                 user = User.query.filter_by(client_id=client_id).first()
+                 if not user:
+                     self.logger.error(f"[ReqID: {request_id}] Could not find user with client_id {client_id} to log usage.")
+                     return
+                 user_id = user.id
              truncated_query = (query[:4997] + '...') if query and len(query) > 5000 else query
              truncated_response = (response[:9997] + '...') if response and len(response) > 10000 else response
-             log_entry = UsageLog(
-                 user_id=user_id,
-                 chatbot_id=chatbot_id,
-                 action_type='query',
-                 action_details=json.dumps({
+             # Written by the background usage-log flusher, so the response doesn't wait on this commit
+             log_usage_record(build_usage_record(
+                 user_id,
+                 chatbot_id,
+                 'query',
+                 {
                      'query': truncated_query,
                      'response': truncated_response,
                      'sources': sources,
@@ -1169,12 +1878,11 @@ Knowledge Adherence Level: {knowledge_adherence_level}
                      'error': error,
                      'metadata': metadata,
                      'request_id': request_id
-                 }),
+                 },
                  resource_usage=1,
-             )
-             db.session.add(log_entry)
-             db.session.commit()
-             self.logger.debug(f"[ReqID: {request_id}] Usage logged successfully.")
+                 counts_as_query=status_code < 400, # Failed requests don't count against the plan
+             ))
+             self.logger.debug(f"[ReqID: {request_id}] Usage record queued.")
          except SQLAlchemyError as e:
              db.session.rollback()
              self.logger.error(f"[ReqID: {request_id}] Database error logging usage: {e}", exc_info=True)
@@ -1255,6 +1963,9 @@ Knowledge Adherence Level: {knowledge_adherence_level}
                 return False, f"Database error during cleanup: {e}"
 
             db.session.commit()
+            source_hash = hashlib.sha256(source_identifier.encode()).hexdigest()[:16]
+            invalidate_chunk_cache(chatbot_id, source_hash)
+            remove_source_vectors(chatbot_id, source_hash, self.bucket)
             self.logger.info(f"Successfully deleted all data for source '{source_identifier}' from chatbot {chatbot_id}.")
             return True, f"Source data for '{source_identifier}' deleted successfully."
 
@@ -1340,6 +2051,8 @@ Knowledge Adherence Level: {knowledge_adherence_level}
                 return False, f"Database error during cleanup: {e}"
 
             db.session.commit()
+            invalidate_chunk_cache(chatbot_id)
+            remove_chatbot_vectors(chatbot_id, self.bucket)
             self.logger.info(f"Successfully deleted all associated data for chatbot {chatbot_id}.")
             return True, "All chatbot data deleted successfully."
 
@@ -0,0 +1,233 @@
+# app/services/reranker.py
+"""
+Cross-encoder scoring for advanced RAG reranking.
+
+_rerank_chunks used to call CrossEncoder.predict once per request under a lock,
+so concurrent advanced queries queued up behind each other's inference, each
+paying a full forward pass for a handful of pairs. Two pieces replace that:
+
+- Scorers load CROSS_ENCODER_MODEL_NAME for CPU inference, either with
+  sentence-transformers/torch ('torch') or as an ONNX export run by
+  onnxruntime ('onnx'), optionally int8-quantized, with RERANKER_THREADS intra-op
+  threads. The ONNX export and its quantized copy are written once to
+  RERANKER_ONNX_CACHE_DIR and reused by every process. If onnxruntime/optimum
+  are not installed, the torch scorer is used.
+- MicroBatchReranker collects (query, passage) pairs from concurrent requests
+  for up to RERANKER_MAX_WAIT_MS (or RERANKER_MAX_BATCH_PAIRS pairs), scores them
+  in one call on a single worker, and hands each caller its own scores. Inference
+  runs through run_cpu_bound, so under gevent the hub keeps serving requests.
+
+Scores are the same as CrossEncoder.predict's for single-label models (sigmoid
+of the logit), so reranking order does not depend on the backend.
+"""
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+from app.services.concurrency import run_cpu_bound
+
+logger = logging.getLogger(__name__)
+
+
+class TorchCrossEncoderScorer:
+    backend = 'torch'
+
+    def __init__(self, model_name: str, max_length: int, quantize: bool = False, threads: int = 0, batch_size: int = 32):
+        import torch
+        from sentence_transformers import CrossEncoder
+        if threads:
+            torch.set_num_threads(threads)
+        self.batch_size = batch_size
+        self.quantized = quantize
+        self.model = CrossEncoder(model_name, max_length=max_length, device='cpu')
+        if quantize:
+            # Dynamic int8 quantization of the Linear layers (weights int8, activations quantized on the fly)
+            self.model.model = torch.quantization.quantize_dynamic(self.model.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def predict(self, pairs: list) -> list:
+        return [float(score) for score in self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)]
+
+
+def export_onnx_cross_encoder(model_name: str, cache_dir: str, quantize: bool) -> tuple[str, str]:
+    """
+    Exports model_name to ONNX under cache_dir (and an int8 copy when quantize is set) unless already there.
+    Returns (model directory with the tokenizer files, path of the .onnx file to load).
+    """
+    model_dir = os.path.join(os.path.abspath(cache_dir), re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+    onnx_path = os.path.join(model_dir, 'model.onnx')
+    if not os.path.exists(onnx_path):
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        from transformers import AutoTokenizer
+        export_start = time.time()
+        tmp_dir = f"{model_dir}.{os.getpid()}.tmp"
+        ORTModelForSequenceClassification.from_pretrained(model_name, export=True).save_pretrained(tmp_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+        try:
+            os.replace(tmp_dir, model_dir) # Atomic; another process may have finished first
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.info(f"PERF: Exported cross-encoder '{model_name}' to ONNX in {time.time() - export_start:.2f}s.")
+    if not quantize:
+        return model_dir, onnx_path
+    quantized_path = os.path.join(model_dir, 'model_int8.onnx')
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, quantized_path)
+        logger.info(f"Quantized cross-encoder '{model_name}' to int8: {quantized_path}")
+    return model_dir, quantized_path
+
+
+class OnnxCrossEncoderScorer:
+    backend = 'onnx'
+
+    def __init__(self, model_name: str, max_length: int, cache_dir: str, quantize: bool = False, threads: int = 0, batch_size: int = 32):
+        import numpy as np
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        self._np = np
+        self.batch_size = batch_size
+        self.quantized = quantize
+        model_dir, model_path = export_onnx_cross_encoder(model_name, cache_dir, quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = min(max_length, self.tokenizer.model_max_length or max_length)
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def predict(self, pairs: list) -> list:
+        np = self._np
+        scores = [0.0] * len(pairs)
+        # Batching similar lengths together keeps padding (wasted compute) low
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            encoded = self.tokenizer(
+                [pairs[i][0] for i in indices], [pairs[i][1] for i in indices],
+                padding=True, truncation=True, max_length=self.max_length, return_tensors='np',
+            )
+            feeds = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+            logits = self.session.run(None, feeds)[0]
+            if logits.shape[1] == 1:
+                batch_scores = 1.0 / (1.0 + np.exp(-logits[:, 0]))
+            else:
+                exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+                batch_scores = (exp_logits / exp_logits.sum(axis=1, keepdims=True))[:, -1]
+            for i, score in zip(indices, batch_scores):
+                scores[i] = float(score)
+        return scores
+
+
+def load_cross_encoder_scorer(model_name: str, max_length: int, backend: str = 'torch', quantize: bool = False, threads: int = 0,
+                              cache_dir: str = None, batch_size: int = 32):
+    """Loads a scorer for the configured backend, falling back to torch if the ONNX runtime is unavailable."""
+    if backend == 'onnx':
+        try:
+            return OnnxCrossEncoderScorer(model_name, max_length, cache_dir or 'reranker_onnx', quantize=quantize, threads=threads, batch_size=batch_size)
+        except ImportError as e:
+            logger.warning(f"Reranker: ONNX backend unavailable ({e}); using sentence-transformers.")
+        except Exception as e:
+            logger.error(f"Reranker: Failed to load ONNX cross-encoder '{model_name}': {e}. Using sentence-transformers.", exc_info=True)
+    return TorchCrossEncoderScorer(model_name, max_length, quantize=quantize, threads=threads, batch_size=batch_size)
+
+
+class _PendingScores:
+    __slots__ = ('pairs', 'scores', 'error', 'done')
+
+    def __init__(self, pairs: list):
+        self.pairs = pairs
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatchReranker:
+    def __init__(self, scorer, max_batch_pairs: int = 128, max_wait_ms: float = 5.0, logger_instance=None):
+        self.scorer = scorer
+        self.max_batch_pairs = max(1, max_batch_pairs)
+        self.max_wait_seconds = max(0.0, max_wait_ms) / 1000.0
+        self.logger = logger_instance or logger
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'pairs': 0, 'batches': 0, 'errors': 0}
+
+    def score(self, pairs: list) -> list:
+        """Scores (query, passage) pairs, sharing an inference call with concurrent callers. Raises the scorer's errors."""
+        if not pairs:
+            return []
+        pending = _PendingScores(list(pairs))
+        self._ensure_worker()
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.scores
+
+    def _ensure_worker(self):
+        # Started on first use so it belongs to the serving process (not a pre-fork parent)
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='reranker-batcher', daemon=True)
+                self._worker.start()
+
+    def _collect_batch(self) -> list:
+        batch = [self._queue.get()]
+        pair_count = len(batch[0].pairs)
+        deadline = time.monotonic() + self.max_wait_seconds
+        while pair_count < self.max_batch_pairs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            pair_count += len(pending.pairs)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            all_pairs = [pair for pending in batch for pair in pending.pairs]
+            start_time = time.time()
+            try:
+                scores = run_cpu_bound(self.scorer.predict, all_pairs)
+                offset = 0
+                for pending in batch:
+                    pending.scores = scores[offset:offset + len(pending.pairs)]
+                    offset += len(pending.pairs)
+            except Exception as e:
+                self.logger.error(f"Reranker: Batch of {len(all_pairs)} pairs failed: {e}", exc_info=True)
+                for pending in batch:
+                    pending.error = e
+                with self._stats_lock:
+                    self.stats['errors'] += 1
+            finally:
+                with self._stats_lock:
+                    self.stats['requests'] += len(batch)
+                    self.stats['pairs'] += len(all_pairs)
+                    self.stats['batches'] += 1
+                for pending in batch:
+                    pending.done.set()
+            self.logger.debug(f"PERF: Reranker scored {len(all_pairs)} pairs from {len(batch)} request(s) in {time.time() - start_time:.3f}s.")
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['avg_requests_per_batch'] = round(stats['requests'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['backend'] = getattr(self.scorer, 'backend', None)
+        stats['quantized'] = getattr(self.scorer, 'quantized', False)
+        return stats
@@ -0,0 +1,185 @@
+# app/services/single_flight.py
+"""
+Single-flight coalescing of identical concurrent pipeline runs.
+
+Bursts of the same question (e.g. a widget's suggested first message on a busy
+page) used to run the whole RAG pipeline once per request. Requests are keyed by
+(chatbot, answer fingerprint - index version, prompt, adherence, RAG mode -,
+normalized query, history fingerprint, language); while one request (the leader)
+runs the pipeline for a key, identical requests wait for its result instead.
+
+- Within a process, followers (threads or greenlets) wait on the leader's event,
+  for at most SINGLE_FLIGHT_WAIT_SECONDS; a follower whose leader is stuck (e.g.
+  on a stalled LLM call) then runs the pipeline itself.
+- Across processes (SINGLE_FLIGHT_REDIS_ENABLED), the leader also takes a short
+  Redis lock. A process that finds the lock held subscribes to the key's channel
+  and receives the leader's result when it is published. If no result arrives
+  within SINGLE_FLIGHT_WAIT_SECONDS, it runs the pipeline itself.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import redis
+from flask import current_app
+
+from app.services.embedding_cache import normalize_query_text
+
+logger = logging.getLogger(__name__)
+
+
+def coalescing_key(chatbot_id, answer_fingerprint: str, query: str, chat_history: list = None, query_language: str = None,
+                   history_fingerprint: str = None) -> str:
+    """
+    Identifies pipeline runs that must produce the same answer. `history_fingerprint` identifies a stored session's
+    history without loading it (see chat_history.session_history_fingerprint); '' (no messages) keys like no history.
+    """
+    history_fingerprint = history_fingerprint or hashlib.sha256(json.dumps(chat_history or [], sort_keys=True).encode('utf-8')).hexdigest()
+    parts = [str(chatbot_id), answer_fingerprint, normalize_query_text(query), history_fingerprint, query_language or '']
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self, redis_url: str = None, wait_seconds: float = 30.0, lock_ttl_seconds: int = 60,
+                 result_ttl_seconds: int = 10, key_prefix: str = 'singleflight:v1', logger_instance=None):
+        self.logger = logger_instance or logger
+        self.wait_seconds = wait_seconds
+        self.lock_ttl_seconds = lock_ttl_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.key_prefix = key_prefix
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            try:
+                self._redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+            except Exception as e:
+                self.logger.warning(f"SingleFlight: Redis unavailable ({e}); coalescing within this process only.")
+
+    def do(self, key: str, func) -> tuple:
+        """
+        Runs func() once per key among concurrent callers. Returns (result, shared) where shared is True
+        for callers that received another caller's result. The leader's exception is raised in every caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+
+        if not is_leader:
+            if call.done.wait(self.wait_seconds):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            self.logger.warning(f"SingleFlight: No result from the leading request within {self.wait_seconds}s; running the pipeline here.")
+            return func(), False
+
+        shared = False
+        try:
+            if self._redis is not None:
+                call.result, shared = self._do_across_processes(key, func)
+            else:
+                call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            if call.followers:
+                self.logger.info(f"SingleFlight: Shared one pipeline run with {call.followers} concurrent identical request(s).")
+        return call.result, shared
+
+    def _do_across_processes(self, key: str, func) -> tuple:
+        lock_key = f"{self.key_prefix}:lock:{key}"
+        result_key = f"{self.key_prefix}:result:{key}"
+        channel = f"{self.key_prefix}:done:{key}"
+        try:
+            acquired = self._redis.set(lock_key, "1", nx=True, ex=self.lock_ttl_seconds)
+        except Exception as e:
+            self.logger.warning(f"SingleFlight: Redis lock failed ({e}); running without cross-process coalescing.")
+            return func(), False
+
+        if acquired:
+            try:
+                result = func()
+                try:
+                    payload = json.dumps(result, default=str)
+                    pipe = self._redis.pipeline(transaction=False)
+                    pipe.set(result_key, payload, ex=self.result_ttl_seconds)
+                    pipe.publish(channel, payload)
+                    pipe.execute()
+                except Exception as e:
+                    self.logger.warning(f"SingleFlight: Failed to publish result: {e}")
+                return result, False
+            finally:
+                try:
+                    self._redis.delete(lock_key)
+                except Exception:
+                    pass
+
+        result = self._wait_for_result(result_key, channel)
+        if result is not None:
+            return result, True
+        self.logger.warning(f"SingleFlight: No result from the leading process within {self.wait_seconds}s; running the pipeline here.")
+        return func(), False
+
+    def _wait_for_result(self, result_key: str, channel: str):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(channel)
+            payload = self._redis.get(result_key) # Published before we subscribed
+            deadline = time.time() + self.wait_seconds
+            while payload is None and time.time() < deadline:
+                message = pubsub.get_message(timeout=min(1.0, max(0.0, deadline - time.time())))
+                if message and message.get('type') == 'message':
+                    payload = message['data']
+            return json.loads(payload) if payload is not None else None
+        except Exception as e:
+            self.logger.warning(f"SingleFlight: Waiting for the leading process failed: {e}")
+            return None
+        finally:
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Returns the process-wide SingleFlight, or None when disabled in config."""
+    global _single_flight
+    app_config = current_app.config
+    if not app_config.get('SINGLE_FLIGHT_ENABLED', True):
+        return None
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                redis_url = None
+                if app_config.get('SINGLE_FLIGHT_REDIS_ENABLED', False):
+                    redis_url = app_config.get('SINGLE_FLIGHT_REDIS_URL') or app_config.get('CELERY_BROKER_URL')
+                _single_flight = SingleFlight(
+                    redis_url=redis_url,
+                    wait_seconds=app_config.get('SINGLE_FLIGHT_WAIT_SECONDS', 30.0),
+                    logger_instance=current_app.logger,
+                )
+    return _single_flight
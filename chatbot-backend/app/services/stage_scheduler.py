@@ -0,0 +1,99 @@
+# app/services/stage_scheduler.py
+"""
+Small dependency-graph executor for request pipelines.
+
+Stages are plain callables that receive a dict with the results of the stages
+they depend on. Each stage starts as soon as its dependencies have finished,
+so independent stages overlap and wall-clock time approaches the critical path.
+Stages run in worker threads (greenlets under gevent) inside a pushed Flask
+app context, so they can use current_app and the database.
+"""
+import concurrent.futures
+import logging
+import time
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+
+class StageFailedError(Exception):
+    """Recorded in StageScheduler.errors for stages skipped because a dependency failed."""
+    pass
+
+
+class StageScheduler:
+    def __init__(self, max_workers: int = 6, logger_instance=None, log_prefix: str = ""):
+        self.max_workers = max_workers
+        self.logger = logger_instance or logger
+        self.log_prefix = log_prefix
+        self._stages = {} # name -> (func, deps), insertion ordered
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+        self.started_at = None
+
+    def add(self, name: str, func, deps=()):
+        """Registers a stage. `func(dep_results: dict)` runs once all `deps` have succeeded."""
+        unknown = [d for d in deps if d not in self._stages]
+        if unknown:
+            raise ValueError(f"Stage '{name}' depends on unknown stage(s): {unknown}")
+        self._stages[name] = (func, tuple(deps))
+        return self
+
+    def record_timing(self, name: str, start: float, end: float = None):
+        """Records a timing (time.time() values) for work done outside the graph, e.g. sequential steps after run()."""
+        end = end if end is not None else time.time()
+        self.timings[name] = {
+            "start_ms": int((start - (self.started_at or start)) * 1000),
+            "duration_ms": int((end - start) * 1000),
+        }
+
+    def _run_stage(self, app, name, func, dep_results):
+        start = time.time()
+        try:
+            if app is not None:
+                with app.app_context():
+                    return func(dep_results)
+            return func(dep_results)
+        finally:
+            self.record_timing(name, start)
+
+    def run(self) -> dict:
+        """Runs all stages and returns {name: result}. Failed/skipped stages are recorded in self.errors."""
+        app = current_app._get_current_object() if has_app_context() else None
+        self.started_at = time.time()
+        pending = dict(self._stages)
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    func, deps = pending[name]
+                    if any(d in self.errors for d in deps):
+                        self.errors[name] = StageFailedError(f"Skipped: dependency failed ({[d for d in deps if d in self.errors]})")
+                        del pending[name]
+                    elif all(d in self.results for d in deps):
+                        dep_results = {d: self.results[d] for d in deps}
+                        running[executor.submit(self._run_stage, app, name, func, dep_results)] = name
+                        del pending[name]
+
+                if not running:
+                    break # Remaining stages can never become ready (only reachable via failed deps)
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        self.logger.error(f"{self.log_prefix}Pipeline stage '{name}' failed: {e}", exc_info=True)
+                        self.errors[name] = e
+
+        total_ms = int((time.time() - self.started_at) * 1000)
+        summed_ms = sum(t["duration_ms"] for t in self.timings.values())
+        self.logger.info(f"{self.log_prefix}PERF: Stage graph finished in {total_ms}ms (sum of stages {summed_ms}ms): {self.timings}")
+        return self.results
+
+    def get(self, name: str, default=None):
+        return self.results.get(name, default)
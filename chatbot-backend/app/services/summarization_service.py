@@ -8,9 +8,8 @@ import os
 import time # For timing
 from flask import current_app
 from google.api_core import exceptions as google_exceptions
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, HarmCategory, HarmBlockThreshold, FinishReason # Added Vertex AI imports
-from google.cloud import aiplatform # Though not directly used in init, good practice if extending later
+# vertexai / google.cloud.aiplatform are imported when the service is first created: they are the
+# slowest imports in the app and only the summarize/translate endpoints use them
 
 from app.models import Chatbot, db # Assuming db is initialized in app
 
@@ -20,12 +19,15 @@ REGION = os.environ.get('REGION', "us-central1") # Use the same default as RAG
 GEMINI_MODEL_NAME = 'gemini-2.5-flash' # Model for summarization/translation tasks
 
 # --- Safety Settings (Mirrors rag_service) ---
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-}
+def _safety_settings() -> dict:
+    from vertexai.generative_models import HarmCategory, HarmBlockThreshold
+    return {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    }
+
 class SummarizationService:
     def __init__(self, logger):
         # Store the passed logger instance
@@ -37,6 +39,9 @@ class SummarizationService:
         try:
             self.logger.info(f"Summarization Service: Initializing Vertex AI SDK (Project: {PROJECT_ID}, Region: {REGION})...")
             start_time = time.time()
+            import vertexai
+            from vertexai.generative_models import GenerativeModel
+            from google.cloud import aiplatform
             # Check if already initialized (optional, but can prevent warnings if called multiple times)
             try:
                 aiplatform.Client() # Check if a client context exists
@@ -215,11 +220,11 @@ class SummarizationService:
         api_call_start_time = time.time()
         try:
             self.logger.debug(f"Sending prompt for {purpose} to Vertex AI Gemini ({GEMINI_MODEL_NAME}): {prompt[:100]}...") # Log truncated prompt
-            # Use the SAFETY_SETTINGS defined at the module level
+            from vertexai.generative_models import FinishReason
             response = self.gemini_model.generate_content(
                 contents=prompt, # Vertex AI uses 'contents' parameter
                 generation_config={"temperature": 0.3, "max_output_tokens": 8192}, 
-                safety_settings=SAFETY_SETTINGS,
+                safety_settings=_safety_settings(),
                 # stream=False # Default is False
             )
             self.logger.info(f"PERF: Vertex AI Gemini API call for {purpose} took {time.time() - api_call_start_time:.4f} seconds.")
@@ -0,0 +1,237 @@
+# app/services/usage_logger.py
+"""
+Write-behind usage logging.
+
+RagService._log_usage used to insert and commit a UsageLog row before the query
+response was returned. Records are now handed to a per-process UsageLogWriter:
+
+- submit() puts the record on a bounded in-memory queue. When the queue is full,
+  it waits up to USAGE_LOG_ENQUEUE_TIMEOUT_SECONDS (back-pressure) and then
+  spills the record to a local JSON-lines file instead of dropping it.
+- A background flusher bulk-inserts queued records every
+  USAGE_LOG_FLUSH_INTERVAL_SECONDS (or as soon as USAGE_LOG_BATCH_SIZE are
+  waiting). In the same transaction it increments Subscription.current_period_queries
+  and total_queries with atomic UPDATE ... SET x = x + n statements.
+- A batch that fails to commit is spilled to disk. Spill files are claimed
+  (renamed) and replayed by whichever process flushes next, and the queue is
+  drained at interpreter exit.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.models import UsageLog, Subscription
+
+logger = logging.getLogger(__name__)
+
+
+def build_usage_record(user_id, chatbot_id, action_type: str, details: dict, resource_usage: float = 1, counts_as_query: bool = False) -> dict:
+    """A JSON-serializable usage record (also the spill-file line format)."""
+    return {
+        "user_id": user_id,
+        "chatbot_id": chatbot_id,
+        "action_type": action_type,
+        "action_details": json.dumps(details),
+        "resource_usage": resource_usage,
+        "timestamp": datetime.utcnow().isoformat(), # Event time, not insert time
+        "counts_as_query": counts_as_query, # Increments the owner's Subscription query counters
+    }
+
+
+class UsageLogWriter:
+    def __init__(self, app, max_queue: int = 10000, batch_size: int = 200, flush_interval_seconds: float = 1.0,
+                 enqueue_timeout_seconds: float = 0.05, spill_dir: str = None, logger_instance=None):
+        self.app = app
+        self.logger = logger_instance or logger
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.enqueue_timeout_seconds = enqueue_timeout_seconds
+        self.spill_dir = spill_dir
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._flush_lock = threading.Lock() # One batch at a time per process (flusher thread vs. atexit)
+        self._thread = None
+        self._last_replay = 0.0
+        self._stats = Counter()
+
+    # --- Producer side ---
+    def submit(self, record: dict) -> bool:
+        """Queues a record for the flusher. Never raises; returns False if the record had to be spilled."""
+        try:
+            self._queue.put(record, timeout=self.enqueue_timeout_seconds)
+            self._stats["queued"] += 1
+            return True
+        except queue.Full:
+            self._stats["spilled_full_queue"] += 1
+            self.logger.warning("UsageLogWriter: Queue full; spilling usage record to disk.")
+            self._spill([record])
+            return False
+
+    def write_now(self, records: list):
+        """Writes records synchronously (used when async logging is disabled)."""
+        with self._flush_lock:
+            self._write_batch(records, remove_session=False) # Caller's session; don't discard it
+
+    # --- Flusher ---
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="usage-log-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch(self.flush_interval_seconds)
+            try:
+                with self._flush_lock:
+                    written = self._write_batch(batch) if batch else True
+                    # Replay spills only while the database is accepting writes, and not on every tick
+                    if written and time.time() - self._last_replay >= 30:
+                        self._last_replay = time.time()
+                        self._replay_spills()
+            except Exception as e: # The flusher must survive anything
+                self.logger.error(f"UsageLogWriter: Flusher error: {e}", exc_info=True)
+
+    def _next_batch(self, wait_seconds: float) -> list:
+        """Blocks up to wait_seconds for the first record, then takes whatever else is queued (up to batch_size)."""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=wait_seconds))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """Writes everything queued right now (called at exit)."""
+        with self._flush_lock:
+            while True:
+                batch = self._next_batch(0)
+                if not batch:
+                    return
+                self._write_batch(batch)
+
+    def _write_batch(self, records: list, remove_session: bool = True) -> bool:
+        with self.app.app_context():
+            try:
+                db.session.bulk_insert_mappings(UsageLog, [{
+                    "user_id": r["user_id"],
+                    "chatbot_id": r["chatbot_id"],
+                    "action_type": r["action_type"],
+                    "action_details": r["action_details"],
+                    "resource_usage": r["resource_usage"],
+                    "timestamp": datetime.fromisoformat(r["timestamp"]),
+                } for r in records])
+                query_counts = Counter(r["user_id"] for r in records if r.get("counts_as_query"))
+                for user_id, count in query_counts.items():
+                    Subscription.query.filter_by(user_id=user_id).update({
+                        Subscription.current_period_queries: db.func.coalesce(Subscription.current_period_queries, 0) + count,
+                        Subscription.total_queries: db.func.coalesce(Subscription.total_queries, 0) + count,
+                    }, synchronize_session=False)
+                db.session.commit()
+                self._stats["written"] += len(records)
+                self.logger.debug(f"UsageLogWriter: Wrote {len(records)} usage records.")
+                return True
+            except Exception as e:
+                db.session.rollback()
+                self.logger.error(f"UsageLogWriter: Failed to write {len(records)} usage records; spilling to disk: {e}", exc_info=True)
+                self._spill(records)
+                return False
+            finally:
+                if remove_session:
+                    db.session.remove()
+
+    # --- Spill files ---
+    def _spill_path(self) -> str:
+        return os.path.join(self.spill_dir, f"usage-{os.getpid()}.jsonl")
+
+    def _spill(self, records: list):
+        if not self.spill_dir:
+            self._stats["dropped"] += len(records)
+            self.logger.error(f"UsageLogWriter: No spill directory configured; dropped {len(records)} usage records.")
+            return
+        try:
+            with self._spill_lock:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                with open(self._spill_path(), 'a', encoding='utf-8') as f:
+                    f.writelines(json.dumps(r) + "\n" for r in records)
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._stats["spilled"] += len(records)
+        except OSError as e:
+            self._stats["dropped"] += len(records)
+            self.logger.error(f"UsageLogWriter: Failed to spill {len(records)} usage records: {e}")
+
+    def _replay_spills(self):
+        """Claims spill files (any process's) by renaming them, then writes them back in batches."""
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return
+        for path in glob.glob(os.path.join(self.spill_dir, "usage-*.jsonl")):
+            claimed = f"{path}.replay-{os.getpid()}-{time.time():.0f}"
+            try:
+                with self._spill_lock:
+                    os.rename(path, claimed) # Atomic; another process that got there first wins
+            except OSError:
+                continue
+            with open(claimed, 'r', encoding='utf-8') as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            os.remove(claimed) # Failed batches are re-spilled by _write_batch
+            for start in range(0, len(records), self.batch_size):
+                self._write_batch(records[start:start + self.batch_size])
+            self.logger.info(f"UsageLogWriter: Replayed {len(records)} spilled usage records.")
+
+    def get_stats(self) -> dict:
+        return {"queue_depth": self._queue.qsize(), **self._stats}
+
+
+_usage_log_writer = None
+_usage_log_writer_lock = threading.Lock()
+
+
+def get_usage_log_writer() -> UsageLogWriter:
+    """Returns the process-wide UsageLogWriter (its flusher starts on first use when async logging is enabled)."""
+    global _usage_log_writer
+    if _usage_log_writer is None:
+        with _usage_log_writer_lock:
+            if _usage_log_writer is None:
+                app_config = current_app.config
+                writer = UsageLogWriter(
+                    current_app._get_current_object(),
+                    max_queue=app_config.get('USAGE_LOG_QUEUE_MAX', 10000),
+                    batch_size=app_config.get('USAGE_LOG_BATCH_SIZE', 200),
+                    flush_interval_seconds=app_config.get('USAGE_LOG_FLUSH_INTERVAL_SECONDS', 1.0),
+                    enqueue_timeout_seconds=app_config.get('USAGE_LOG_ENQUEUE_TIMEOUT_SECONDS', 0.05),
+                    spill_dir=app_config.get('USAGE_LOG_SPILL_DIR'),
+                    logger_instance=current_app.logger,
+                )
+                if app_config.get('USAGE_LOG_ASYNC', True):
+                    writer.start()
+                _usage_log_writer = writer
+    return _usage_log_writer
+
+
+def log_usage_record(record: dict):
+    """Queues a usage record (or writes it immediately when USAGE_LOG_ASYNC is off). Never raises."""
+    try:
+        writer = get_usage_log_writer()
+        if current_app.config.get('USAGE_LOG_ASYNC', True):
+            writer.submit(record)
+        else:
+            writer.write_now([record])
+    except Exception as e:
+        logger.error(f"Usage logging failed: {e}", exc_info=True)
@@ -0,0 +1,424 @@
+# app/services/vector_backends.py
+"""
+Vector search backends used by RagService.find_neighbors_per_query.
+
+Every backend implements find_neighbors(query_embeddings, chatbot_id, num_neighbors)
+and returns (per-query lists of (vector_id, distance) aligned with query_embeddings,
+or None for a query whose request failed; number of failed requests). Distances are
+"lower is closer" in both backends.
+
+- MatchingEngineBackend: the deployed Vertex AI index, filtered by the chatbot_id namespace.
+- LocalVectorBackend: in-process search over the LocalVectorStore matrices. Small
+  chatbots use exact NumPy brute force; chatbots with at least LOCAL_VECTOR_HNSW_MIN_CHUNKS
+  vectors use an HNSW graph (optional 'hnswlib' package), persisted next to the vectors.
+  The graph is loaded or built in the background on first use (the build runs through
+  run_cpu_bound, one per chatbot at a time); queries use brute force until it is ready.
+
+The maintenance hooks at the bottom (ingestion, source removal, compaction) hold a
+per-chatbot Redis lock while they restore, modify and back up a store.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import redis
+from flask import current_app
+
+from app.services.concurrency import run_cpu_bound
+from app.services.local_vector_store import LocalVectorStore, gcs_backup_prefix
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+HNSW_INDEX_BLOB = "hnsw.bin"
+HNSW_META_BLOB = "hnsw.json"
+
+
+class VectorSearchBackend:
+    name = "base"
+
+    def find_neighbors(self, query_embeddings: list, chatbot_id: int, num_neighbors: int):
+        raise NotImplementedError
+
+
+class MatchingEngineBackend(VectorSearchBackend):
+    name = "matching_engine"
+
+    def __init__(self, index_endpoint, deployed_index_id: str, run_io_tasks, max_queries_per_request: int = 64, logger_instance=None):
+        self.index_endpoint = index_endpoint
+        self.deployed_index_id = deployed_index_id
+        self.run_io_tasks = run_io_tasks # RagService._run_io_tasks
+        self.max_queries_per_request = max(1, max_queries_per_request)
+        self.logger = logger_instance or logger
+
+    def find_neighbors(self, query_embeddings: list, chatbot_id: int, num_neighbors: int):
+        """
+        Runs vector search for all embeddings with as few find_neighbors requests as possible
+        (split only at max_queries_per_request; multiple requests run concurrently).
+        """
+        from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace # Heavy SDK; loaded on first search
+        # Filter by chatbot_id namespace
+        chatbot_filter = [Namespace(name="chatbot_id", allow_tokens=[str(chatbot_id)])]
+        self.logger.debug(f" -> Using Filter: namespace='chatbot_id', allow_tokens=['{chatbot_id}']")
+        max_queries_per_request = self.max_queries_per_request
+
+        def _find_neighbors_request(start, batch):
+            request_start = time.time()
+            response = self.index_endpoint.find_neighbors(
+                deployed_index_id=self.deployed_index_id,
+                queries=batch,
+                num_neighbors=num_neighbors,
+                filter=chatbot_filter # Use the new filter
+            )
+            self.logger.debug(f" -> find_neighbors for queries {start + 1}-{start + len(batch)} took {time.time() - request_start:.3f}s.")
+            return response
+
+        per_query_neighbors = [None] * len(query_embeddings)
+        batches = [(start, query_embeddings[start:start + max_queries_per_request]) for start in range(0, len(query_embeddings), max_queries_per_request)]
+        failed_requests = 0
+        if len(batches) == 1:
+            # Common case: one RPC, no pool hop
+            try:
+                results = [(0, _find_neighbors_request(*batches[0]), None)]
+            except Exception as e:
+                results = [(0, None, e)]
+        else:
+            tasks = [(start, _find_neighbors_request, (start, batch)) for start, batch in batches]
+            results = self.run_io_tasks(tasks, max_in_flight=len(tasks))
+
+        for start, response, error in results:
+            batch_size = min(max_queries_per_request, len(query_embeddings) - start)
+            if error is not None:
+                self.logger.error(f" -> Error retrieving chunks for queries {start + 1}-{start + batch_size}: {error}", exc_info=error)
+                failed_requests += 1
+                continue
+            response = response if isinstance(response, list) else []
+            for offset in range(batch_size):
+                neighbors = response[offset] if offset < len(response) and isinstance(response[offset], list) else []
+                per_query = []
+                for neighbor in neighbors:
+                    if hasattr(neighbor, 'id') and hasattr(neighbor, 'distance'):
+                        per_query.append((neighbor.id, neighbor.distance))
+                    else:
+                        self.logger.warning(f" -> Neighbor object missing id or distance: {neighbor}")
+                per_query_neighbors[start + offset] = per_query
+        return per_query_neighbors, failed_requests
+
+
+class LocalVectorBackend(VectorSearchBackend):
+    name = "local"
+
+    def __init__(self, store: LocalVectorStore, model_name: str, hnsw_min_chunks: int = 20000,
+                 hnsw_m: int = 16, hnsw_ef_construction: int = 200, hnsw_ef_search: int = 64, logger_instance=None):
+        self.store = store
+        self.model_name = model_name
+        self.hnsw_min_chunks = hnsw_min_chunks
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+        self.logger = logger_instance or logger
+        self._masks = {} # (chatbot_id, rows_version) -> bool row mask or None
+        self._graphs = {} # (chatbot_id, rows_version) -> hnswlib.Index
+        self._graphs_lock = threading.Lock() # Guards the bookkeeping dicts only, never held during a build
+        self._building = {} # chatbot_id -> rows_version of the graph being loaded/built
+        self._failed_graphs = set() # (chatbot_id, rows_version) whose build failed; not retried
+        self._last_sync = {} # chatbot_id -> time of the last GCS manifest check
+
+    def maybe_sync(self, bucket, chatbot_id: int, interval_seconds: float):
+        """Pulls a newer GCS backup of the chatbot's store, checking at most once per interval. Never raises."""
+        now = time.time()
+        if bucket is None or now - self._last_sync.get(chatbot_id, 0) < interval_seconds:
+            return
+        self._last_sync[chatbot_id] = now
+        try:
+            self.store.restore_from_gcs(bucket, chatbot_id, self.model_name)
+        except Exception as e:
+            self.logger.warning(f"LocalVectorBackend: GCS sync failed for chatbot {chatbot_id}: {e}")
+
+    def _namespace_mask(self, chatbot_id: int, vector_set):
+        """Rows whose ID belongs to the chatbot's namespace; None when all of them do (the normal case)."""
+        key = (chatbot_id, vector_set.rows_version)
+        if key not in self._masks:
+            prefix = f"chatbot_{chatbot_id}_"
+            mask = np.fromiter((vector_id.startswith(prefix) for vector_id in vector_set.ids), dtype=bool, count=vector_set.count)
+            if not mask.all():
+                self.logger.warning(f"LocalVectorBackend: {int((~mask).sum())} vectors outside namespace chatbot_id={chatbot_id} are excluded.")
+            self._masks = {k: v for k, v in self._masks.items() if k[0] != chatbot_id}
+            self._masks[key] = None if mask.all() else mask
+        return self._masks[key]
+
+    def _get_graph(self, chatbot_id: int, vector_set):
+        """
+        Returns the HNSW graph for a vector set if it is ready. Otherwise starts loading or building it in the
+        background (at most one per chatbot) and returns None, so the caller falls back to brute force.
+        Graphs are keyed by rows_version, so deletes (tombstones) don't force a rebuild; they are filtered at query time.
+        """
+        key = (chatbot_id, vector_set.rows_version)
+        with self._graphs_lock:
+            graph = self._graphs.get(key)
+            if graph is not None or key in self._failed_graphs or chatbot_id in self._building:
+                return graph
+            self._building[chatbot_id] = vector_set.rows_version
+        threading.Thread(target=self._prepare_graph, args=(chatbot_id, vector_set), name=f"hnsw-build-{chatbot_id}", daemon=True).start()
+        return None
+
+    def _prepare_graph(self, chatbot_id: int, vector_set):
+        key = (chatbot_id, vector_set.rows_version)
+        try:
+            graph = run_cpu_bound(self._load_or_build_graph, chatbot_id, vector_set) # Native thread; the hub keeps serving
+            with self._graphs_lock:
+                self._graphs = {k: v for k, v in self._graphs.items() if k[0] != chatbot_id}
+                self._graphs[key] = graph
+        except Exception as e:
+            self.logger.error(f"LocalVectorBackend: HNSW graph build failed for chatbot {chatbot_id}; using brute force: {e}", exc_info=True)
+            with self._graphs_lock:
+                self._failed_graphs.add(key)
+        finally:
+            with self._graphs_lock:
+                self._building.pop(chatbot_id, None)
+
+    def _load_or_build_graph(self, chatbot_id: int, vector_set):
+        """Loads the persisted graph for the vector set, or builds and persists a new one. CPU-bound; no app context."""
+        directory = self.store.directory(chatbot_id, self.model_name)
+        index_path = os.path.join(directory, HNSW_INDEX_BLOB)
+        meta_path = os.path.join(directory, HNSW_META_BLOB)
+        graph = hnswlib.Index(space='cosine', dim=vector_set.dim)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get("rows_version") != vector_set.rows_version:
+                raise ValueError("stale graph")
+            graph.load_index(index_path, max_elements=vector_set.count)
+        except (OSError, ValueError, RuntimeError):
+            build_start = time.time()
+            graph.init_index(max_elements=vector_set.count, ef_construction=self.hnsw_ef_construction, M=self.hnsw_m)
+            for start in range(0, vector_set.count, 16384):
+                end = min(start + 16384, vector_set.count)
+                graph.add_items(vector_set.row_block(start, end), np.arange(start, end))
+            try:
+                graph.save_index(index_path)
+                with open(meta_path, 'w') as f:
+                    json.dump({"rows_version": vector_set.rows_version, "count": vector_set.count}, f)
+            except OSError as e:
+                self.logger.warning(f"LocalVectorBackend: Could not persist HNSW graph for chatbot {chatbot_id}: {e}")
+            self.logger.info(f"PERF: LocalVectorBackend built HNSW graph for chatbot {chatbot_id} ({vector_set.count} vectors) in {time.time() - build_start:.3f}s.")
+        graph.set_ef(max(self.hnsw_ef_search, 1))
+        return graph
+
+    def _search_graph(self, graph, vector_set, queries: np.ndarray, k: int, row_mask) -> list:
+        row_mask = vector_set.combined_mask(row_mask)
+        # Over-fetch by the number of excluded rows so the post-filter still leaves k results
+        fetch_k = min(vector_set.count, k if row_mask is None else k + int((~row_mask).sum()))
+        labels, distances = graph.knn_query(queries, k=fetch_k)
+        results = []
+        for query_labels, query_distances in zip(labels, distances):
+            neighbors = [
+                (vector_set.ids[row], float(distance))
+                for row, distance in zip(query_labels, query_distances)
+                if row_mask is None or row_mask[row]
+            ]
+            results.append(neighbors[:k])
+        return results
+
+    def find_neighbors(self, query_embeddings: list, chatbot_id: int, num_neighbors: int):
+        vector_set = self.store.load(chatbot_id, self.model_name)
+        if vector_set is None or vector_set.live_count == 0:
+            self.logger.warning(f"LocalVectorBackend: No local vectors for chatbot {chatbot_id} (model '{self.model_name}').")
+            return [[] for _ in query_embeddings], 0
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != vector_set.dim:
+            self.logger.error(f"LocalVectorBackend: Query dimension {queries.shape[-1]} does not match stored dimension {vector_set.dim} for chatbot {chatbot_id}.")
+            return [None] * len(query_embeddings), 1
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1.0, norms)
+
+        search_start = time.time()
+        row_mask = self._namespace_mask(chatbot_id, vector_set)
+        graph = self._get_graph(chatbot_id, vector_set) if hnswlib is not None and vector_set.count >= self.hnsw_min_chunks else None
+        use_graph = graph is not None
+        if use_graph:
+            results = run_cpu_bound(self._search_graph, graph, vector_set, queries, num_neighbors, row_mask)
+        else:
+            results = run_cpu_bound(vector_set.search, queries, num_neighbors, row_mask)
+        self.logger.debug(f" -> Local {'HNSW' if use_graph else 'brute-force'} search over {vector_set.count} vectors took {(time.time() - search_start) * 1000:.2f}ms.")
+        return results, 0
+
+
+# --- Process-wide store ---
+_local_vector_store = None
+_local_vector_store_lock = threading.Lock()
+
+
+def get_local_vector_store() -> LocalVectorStore:
+    """Returns the process-wide LocalVectorStore rooted at LOCAL_VECTOR_STORE_PATH."""
+    global _local_vector_store
+    if _local_vector_store is None:
+        with _local_vector_store_lock:
+            if _local_vector_store is None:
+                app_config = current_app.config
+                _local_vector_store = LocalVectorStore(
+                    root=app_config.get('LOCAL_VECTOR_STORE_PATH'),
+                    dtype=app_config.get('LOCAL_VECTOR_DTYPE', 'float16'),
+                    logger_instance=current_app.logger,
+                )
+    return _local_vector_store
+
+
+_local_vector_backend = None
+
+
+def get_local_vector_backend() -> LocalVectorBackend:
+    """Returns the process-wide LocalVectorBackend (it caches namespace masks and HNSW graphs)."""
+    global _local_vector_backend
+    if _local_vector_backend is None:
+        store = get_local_vector_store()
+        with _local_vector_store_lock:
+            if _local_vector_backend is None:
+                app_config = current_app.config
+                _local_vector_backend = LocalVectorBackend(
+                    store,
+                    model_name=app_config.get('EMBEDDING_MODEL_NAME'),
+                    hnsw_min_chunks=app_config.get('LOCAL_VECTOR_HNSW_MIN_CHUNKS', 20000),
+                    hnsw_m=app_config.get('LOCAL_VECTOR_HNSW_M', 16),
+                    hnsw_ef_construction=app_config.get('LOCAL_VECTOR_HNSW_EF_CONSTRUCTION', 200),
+                    hnsw_ef_search=app_config.get('LOCAL_VECTOR_HNSW_EF_SEARCH', 64),
+                    logger_instance=current_app.logger,
+                )
+    return _local_vector_backend
+
+
+# --- Cross-worker lock for store maintenance ---
+_store_lock_redis = None
+_store_lock_redis_lock = threading.Lock()
+
+
+def _get_store_lock_redis():
+    """Returns the Redis client used for per-chatbot store locks, or None when no Redis URL is configured."""
+    global _store_lock_redis
+    if _store_lock_redis is None:
+        app_config = current_app.config
+        redis_url = app_config.get('LOCAL_VECTOR_LOCK_REDIS_URL') or app_config.get('CELERY_BROKER_URL')
+        if not redis_url:
+            return None
+        with _store_lock_redis_lock:
+            if _store_lock_redis is None:
+                _store_lock_redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+    return _store_lock_redis
+
+
+@contextlib.contextmanager
+def _chatbot_store_lock(chatbot_id):
+    """
+    Holds a Redis lock for one chatbot around restore -> modify -> backup, so two workers (on any host)
+    can't each start from the same GCS copy and have the last upload drop the other's rows.
+    Raises TimeoutError when the lock can't be acquired within LOCAL_VECTOR_LOCK_WAIT_SECONDS.
+    """
+    client = _get_store_lock_redis()
+    if client is None:
+        yield # No shared Redis configured: a single host, where the store's own file lock suffices
+        return
+    app_config = current_app.config
+    lock = client.lock(
+        f"localvectors:v1:{chatbot_id}:lock",
+        timeout=app_config.get('LOCAL_VECTOR_LOCK_TIMEOUT_SECONDS', 600),
+        blocking_timeout=app_config.get('LOCAL_VECTOR_LOCK_WAIT_SECONDS', 300),
+    )
+    if not lock.acquire():
+        raise TimeoutError(f"Timed out waiting for the local vector store lock of chatbot {chatbot_id}")
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError as e:
+            current_app.logger.warning(f"Local vector store: Lock for chatbot {chatbot_id} expired before release ({e}).")
+
+
+# --- Store maintenance hooks (ingestion / deletion); never raise ---
+def persist_chatbot_vectors(chatbot_id, vector_ids: list, vectors: list, bucket=None) -> bool:
+    """Appends freshly computed document embeddings to the chatbot's local store and mirrors it to GCS."""
+    app_config = current_app.config
+    if not app_config.get('LOCAL_VECTOR_PERSIST_ENABLED', True) or not vector_ids:
+        return False
+    model_name = app_config.get('EMBEDDING_MODEL_NAME')
+    backup = bucket is not None and app_config.get('LOCAL_VECTOR_GCS_BACKUP', True)
+    try:
+        store = get_local_vector_store()
+        with _chatbot_store_lock(chatbot_id):
+            if backup:
+                # Another worker may have written newer rows; start from them so the backup isn't rolled back
+                store.restore_from_gcs(bucket, chatbot_id, model_name)
+            store.append(chatbot_id, model_name, vector_ids, vectors)
+            if backup:
+                store.backup_to_gcs(bucket, chatbot_id, model_name)
+        return True
+    except Exception as e:
+        current_app.logger.error(f"Local vector store: Failed to persist {len(vector_ids)} vectors for chatbot {chatbot_id}: {e}", exc_info=True)
+        return False
+
+
+def compact_chatbot_vectors(chatbot_id, bucket=None, force: bool = False) -> bool:
+    """Compacts the chatbot's store when its tombstone ratio exceeds LOCAL_VECTOR_COMPACT_TOMBSTONE_RATIO (or force)."""
+    app_config = current_app.config
+    model_name = app_config.get('EMBEDDING_MODEL_NAME')
+    try:
+        with _chatbot_store_lock(chatbot_id):
+            return _compact_locked(get_local_vector_store(), chatbot_id, model_name, bucket, force)
+    except Exception as e:
+        current_app.logger.error(f"Local vector store: Failed to compact store for chatbot {chatbot_id}: {e}", exc_info=True)
+        return False
+
+
+def _compact_locked(store, chatbot_id, model_name: str, bucket, force: bool) -> bool:
+    """compact_chatbot_vectors for a caller already holding the chatbot's store lock."""
+    app_config = current_app.config
+    backup = bucket is not None and app_config.get('LOCAL_VECTOR_GCS_BACKUP', True)
+    if backup:
+        store.restore_from_gcs(bucket, chatbot_id, model_name) # Compact the latest rows, not a stale local copy
+    ratio = store.tombstone_ratio(store.read_manifest(chatbot_id, model_name))
+    if not ratio or (not force and ratio < app_config.get('LOCAL_VECTOR_COMPACT_TOMBSTONE_RATIO', 0.2)):
+        return False
+    store.compact(chatbot_id, model_name)
+    if backup:
+        store.backup_to_gcs(bucket, chatbot_id, model_name)
+    return True
+
+
+def remove_source_vectors(chatbot_id, source_hash: str, bucket=None) -> int:
+    """Tombstones every vector of one source (chatbot_{id}_source_{hash}_chunk_*). Returns rows tombstoned."""
+    app_config = current_app.config
+    model_name = app_config.get('EMBEDDING_MODEL_NAME')
+    backup = bucket is not None and app_config.get('LOCAL_VECTOR_GCS_BACKUP', True)
+    try:
+        store = get_local_vector_store()
+        with _chatbot_store_lock(chatbot_id):
+            if backup:
+                store.restore_from_gcs(bucket, chatbot_id, model_name)
+            removed = store.delete(chatbot_id, model_name, id_prefix=f"chatbot_{chatbot_id}_source_{source_hash}_")
+            if removed and not _compact_locked(store, chatbot_id, model_name, bucket, force=False) and backup:
+                store.backup_to_gcs(bucket, chatbot_id, model_name)
+        return removed
+    except Exception as e:
+        current_app.logger.error(f"Local vector store: Failed to remove source {source_hash} for chatbot {chatbot_id}: {e}", exc_info=True)
+        return 0
+
+
+def remove_chatbot_vectors(chatbot_id, bucket=None) -> bool:
+    """Deletes the chatbot's local stores and their GCS backups."""
+    try:
+        get_local_vector_store().delete_chatbot(chatbot_id)
+        if bucket is not None:
+            for blob in bucket.list_blobs(prefix=gcs_backup_prefix(chatbot_id)):
+                blob.delete()
+        return True
+    except Exception as e:
+        current_app.logger.error(f"Local vector store: Failed to remove stores for chatbot {chatbot_id}: {e}", exc_info=True)
+        return False
@@ -1,5 +1,6 @@
 # app/sse_utils.py
 import json
+import threading
 import redis
 from flask import current_app
 from config import Config # Import Config to get Redis URL
@@ -10,18 +11,32 @@ SSE_CHANNEL = "chatbot-status-updates" # Define a channel name
 # -----------------------------------
 
 # --- Redis Connection ---
-# Create a connection pool for efficiency
+# Connected on first use rather than at import, so importing this module (routes,
+# ingestion, models) never blocks process startup on a network round trip.
 # decode_responses=True handles decoding from bytes to strings
-try:
-    redis_pool = redis.ConnectionPool.from_url(REDIS_URL, decode_responses=True)
-    redis_client = redis.Redis(connection_pool=redis_pool)
-    # Test connection
-    redis_client.ping()
-    print(f"SSE Utils: Connected to Redis at {REDIS_URL}")
-except Exception as e:
-    print(f"ERROR: SSE Utils: Failed to connect to Redis at {REDIS_URL} - {e}")
-    # Fallback or handle error appropriately - maybe disable SSE?
-    redis_client = None
+_redis_client = None
+_redis_client_lock = threading.Lock()
+_redis_client_failed = False
+
+
+def get_redis_client():
+    """Returns the shared Redis client for SSE pub/sub, or None if Redis is unreachable."""
+    global _redis_client, _redis_client_failed
+    if _redis_client is None and not _redis_client_failed:
+        with _redis_client_lock:
+            if _redis_client is None and not _redis_client_failed:
+                try:
+                    redis_pool = redis.ConnectionPool.from_url(REDIS_URL, decode_responses=True)
+                    client = redis.Redis(connection_pool=redis_pool)
+                    # Test connection
+                    client.ping()
+                    print(f"SSE Utils: Connected to Redis at {REDIS_URL}")
+                    _redis_client = client
+                except Exception as e:
+                    print(f"ERROR: SSE Utils: Failed to connect to Redis at {REDIS_URL} - {e}")
+                    # Fallback or handle error appropriately - maybe disable SSE?
+                    _redis_client_failed = True
+    return _redis_client
 # ------------------------
 
 
@@ -29,6 +44,7 @@ def push_status_update(chatbot_id, status, client_id):
     """Publishes a status update message to the Redis Pub/Sub channel."""
     logger = current_app.logger if current_app else None # Get logger if in app context
 
+    redis_client = get_redis_client()
     if not redis_client:
         if logger:
             logger.error(f"SSE Push: Cannot publish status for chatbot {chatbot_id}, Redis client not available.")
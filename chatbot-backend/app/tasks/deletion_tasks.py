@@ -11,6 +11,9 @@ from app import db, create_app
 from app.models import Chatbot, VectorIdMapping, ChatMessage, DetailedFeedback, UsageLog
 from app.services.rag_service import RagService, VertexAIDeletionError # Import only needed exceptions
 from app.api.routes import get_rag_service
+from app.services.chunk_cache import invalidate_chunk_cache
+from app.services.chunk_shards import shard_blob_names
+from app.services.vector_backends import remove_source_vectors, remove_chatbot_vectors
 from google.cloud.exceptions import NotFound as GoogleNotFound
 
 flask_app = create_app()
@@ -166,6 +169,10 @@ def delete_source_data_task(self, chatbot_id: int, source_identifier: str):
             else:
                 logger.error(f"Task {self.request.id}: CRITICAL - Cannot delete GCS files for GCS hash ID '{gcs_hash_identifier}'. Bucket initialization failed or rag_service is None.")
 
+            # Drop cached chunk texts for this source in every worker (GCS objects are gone or going)
+            invalidate_chunk_cache(chatbot_id, hashlib.sha256(gcs_hash_identifier.encode()).hexdigest()[:16])
+            remove_source_vectors(chatbot_id, hashlib.sha256(gcs_hash_identifier.encode()).hexdigest()[:16], rag_service.bucket if gcs_init_success else None)
+
             # 2. Delete from Vector Store
             if vector_ids_to_delete:
                 try:
@@ -184,6 +191,7 @@ def delete_source_data_task(self, chatbot_id: int, source_identifier: str):
             try:
                 chatbot = db.session.get(Chatbot, chatbot_id)
                 if chatbot:
+                    chatbot.bump_index_version() # Content changed; invalidates cached answers
                     logger.info(f"Task {self.request.id}: Updating source_details for chatbot {chatbot_id} to remove '{source_identifier}'.")
                     current_source_details_str = chatbot.source_details
                     if current_source_details_str:
@@ -303,6 +311,9 @@ def delete_chatbot_data_task(self, chatbot_id: int, user_id: int):
                 gcs_path = _construct_gcs_path_from_vector_id(mapping.vector_id, chatbot_id)
                 if gcs_path:
                     gcs_paths_to_delete.add(gcs_path)
+                    # Packed sources keep their chunks in shard objects next to (or instead of) per-chunk objects
+                    source_hash = mapping.vector_id.split('_')[3]
+                    gcs_paths_to_delete.update(shard_blob_names(chatbot_id, source_hash))
                 # else: # Already logged in helper function
                 #    logger.warning(f"Task {self.request.id}: Could not construct GCS path for vector ID {mapping.vector_id}")
 
@@ -358,6 +369,9 @@ def delete_chatbot_data_task(self, chatbot_id: int, user_id: int):
                 # Decide if this should be a hard failure/retry
                 # raise self.retry(exc=Exception("RAG service bucket not initialized for GCS deletion."), countdown=60)
 
+            invalidate_chunk_cache(chatbot_id) # Drop cached chunk texts for this chatbot in every worker
+            remove_chatbot_vectors(chatbot_id, rag_service.bucket if gcs_init_success else None) # Local embedding store and its GCS backup
+
             # --- 2. Delete from Vector Store ---
             # (Keep this section as is)
             if vector_ids_to_delete:
@@ -1,11 +1,12 @@
+import time
+_import_started = time.perf_counter() # Import-time budget: measured from here until the task modules are imported
+
 # --- GEVENT PATCHING ---
 # Do this BEFORE any other imports that might use network/ssl
-try:
-    import gevent.monkey
-    gevent.monkey.patch_all()
-    # print("Gevent monkey patching applied.") # Made silent
-except ImportError:
-    pass # print("Gevent not installed, skipping monkey patching.") # Made silent
+# Patching is skipped if already done (run.py, or Celery's -P gevent pool), but grpc's gevent
+# integration still runs once per process either way
+from gevent_setup import apply_gevent_patches
+apply_gevent_patches() # Silent; run.py reports problems for the web process
 # -----------------------
 
 import os
@@ -50,6 +51,18 @@ celery_app.conf.broker_connection_retry_on_startup = True
 #     enable_utc=True,
 # )
 
+# --- Startup Import Budget ---
+from celery.signals import import_modules
+
+@import_modules.connect
+def _report_import_time(sender=None, **kwargs):
+    # Sent once the worker has imported every module in `include`
+    import_seconds = time.perf_counter() - _import_started
+    print(f"PERF: celery_worker.py imports (including task modules) took {import_seconds:.2f}s (budget {Config.STARTUP_IMPORT_BUDGET_SECONDS:.1f}s).")
+    if import_seconds > Config.STARTUP_IMPORT_BUDGET_SECONDS:
+        print(f"WARNING: Worker startup exceeded its import budget by {import_seconds - Config.STARTUP_IMPORT_BUDGET_SECONDS:.2f}s; check for eager imports of heavy modules.")
+# --------------------------
+
 # --- Celery Beat Schedule ---
 from celery.schedules import crontab
 
@@ -59,6 +72,10 @@ celery_app.conf.beat_schedule = {
         'schedule': crontab(minute=0, hour=3),  # Run daily at 3:00 AM UTC
         #'args': (), # No arguments needed for this task
     },
+    'compact-local-vector-stores-daily': {
+        'task': 'cleanup_tasks.compact_local_vector_stores',
+        'schedule': crontab(minute=30, hour=3),
+    },
 }
 celery_app.conf.timezone = 'UTC' # Ensure timezone is set for schedule clarity
 # --------------------------
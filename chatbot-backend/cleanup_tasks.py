@@ -71,6 +71,23 @@ def cleanup_old_chat_messages():
             db.session.rollback() # Rollback any potential partial commits if the outer loop fails
             logger.error(f"Critical error during chat message cleanup task: {e}", exc_info=True)
 
+@celery_app.task(name='cleanup_tasks.compact_local_vector_stores')
+def compact_local_vector_stores():
+    """
+    Compacts local embedding stores whose share of deleted (tombstoned) rows exceeds
+    LOCAL_VECTOR_COMPACT_TOMBSTONE_RATIO, and refreshes their GCS backups.
+    """
+    from app.api.routes import get_rag_service
+    from app.services.vector_backends import get_local_vector_store, compact_chatbot_vectors
+
+    app = create_app()
+    with app.app_context():
+        rag_service = get_rag_service()
+        bucket = rag_service.bucket if rag_service and rag_service._ensure_clients_initialized() else None
+        chatbot_ids = sorted({chatbot_id for chatbot_id, _ in get_local_vector_store().list_stores()})
+        compacted = sum(1 for chatbot_id in chatbot_ids if compact_chatbot_vectors(chatbot_id, bucket))
+        logger.info(f"Local vector store compaction finished. Checked {len(chatbot_ids)} chatbots, compacted {compacted}.")
+
 if __name__ == '__main__':
     # This allows running the cleanup manually via `python cleanup_tasks.py`
     # Ensure your Flask app environment (e.g., DATABASE_URL) is configured
@@ -48,11 +48,127 @@ class Config:
     GENERATION_MODEL_NAME = os.environ.get('GENERATION_MODEL_NAME', "gemini-2.5-flash")
     #REPHRASE_MODEL_NAME = os.environ.get('REPHRASE_MODEL_NAME', "gemini-2.5-flash")
     
+    # Per-request limits for batched embed_content calls; larger inputs are split into concurrent sub-batches.
+    # Models that only accept a single input per request get concurrent per-item calls: those listed here from
+    # the start, others once they reject a batch.
+    EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get('EMBEDDING_MAX_BATCH_SIZE', 250))
+    EMBEDDING_SINGLE_INPUT_MODELS = [m.strip() for m in os.environ.get('EMBEDDING_SINGLE_INPUT_MODELS', 'gemini-embedding-001').split(',') if m.strip()]
+    EMBEDDING_MAX_BATCH_TOKENS = int(os.environ.get('EMBEDDING_MAX_BATCH_TOKENS', 20000))
+    EMBEDDING_MAX_CONCURRENCY = int(os.environ.get('EMBEDDING_MAX_CONCURRENCY', 4))
+    # Leave unset to use the model's default size (must match the dimensionality of the deployed index)
+    EMBEDDING_OUTPUT_DIMENSIONALITY = int(os.environ['EMBEDDING_OUTPUT_DIMENSIONALITY']) if os.environ.get('EMBEDDING_OUTPUT_DIMENSIONALITY') else None
+
+    # --- Query Embedding Cache (in-process LRU + shared Redis) ---
+    EMBEDDING_CACHE_ENABLED = os.environ.get('EMBEDDING_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    EMBEDDING_CACHE_REDIS_URL = os.environ.get('EMBEDDING_CACHE_REDIS_URL') # Defaults to CELERY_BROKER_URL
+    EMBEDDING_CACHE_LOCAL_MAXSIZE = int(os.environ.get('EMBEDDING_CACHE_LOCAL_MAXSIZE', 2048))
+    EMBEDDING_CACHE_TTL_SECONDS = int(os.environ.get('EMBEDDING_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+    EMBEDDING_CACHE_DTYPE = os.environ.get('EMBEDDING_CACHE_DTYPE', 'float16') # 'float16' or 'float32'
+
+    # --- Chunk Text Cache (byte-bounded in-process tier + optional shared tier) ---
+    CHUNK_CACHE_ENABLED = os.environ.get('CHUNK_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    CHUNK_CACHE_MAX_BYTES = int(os.environ.get('CHUNK_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    CHUNK_CACHE_TTL_SECONDS = int(os.environ.get('CHUNK_CACHE_TTL_SECONDS', 3600))
+    CHUNK_CACHE_SHARED_BACKEND = os.environ.get('CHUNK_CACHE_SHARED_BACKEND', 'redis').lower() # 'redis', 'disk' or 'none'
+    CHUNK_CACHE_REDIS_URL = os.environ.get('CHUNK_CACHE_REDIS_URL') # Defaults to CELERY_BROKER_URL
+    CHUNK_CACHE_DISK_PATH = os.environ.get('CHUNK_CACHE_DISK_PATH', os.path.join(basedir, 'instance', 'chunk_cache'))
+    CHUNK_CACHE_SHARED_TTL_SECONDS = int(os.environ.get('CHUNK_CACHE_SHARED_TTL_SECONDS', 7 * 24 * 3600))
+    CHUNK_CACHE_EPOCH_REFRESH_SECONDS = float(os.environ.get('CHUNK_CACHE_EPOCH_REFRESH_SECONDS', 5))
+
+    # --- Chunk Storage Layout (see app/services/chunk_shards.py) ---
+    CHUNK_STORAGE_FORMAT = os.environ.get('CHUNK_STORAGE_FORMAT', 'shard').lower() # 'shard' (one packed object per source) or 'object' (one object per chunk)
+    CHUNK_SHARD_COMPRESSION = os.environ.get('CHUNK_SHARD_COMPRESSION', 'none').lower() # 'none' or 'zstd' (needs the zstandard package)
+    CHUNK_SHARD_COMPRESSION_LEVEL = int(os.environ.get('CHUNK_SHARD_COMPRESSION_LEVEL', 3))
+    CHUNK_SHARD_COALESCE_GAP_BYTES = int(os.environ.get('CHUNK_SHARD_COALESCE_GAP_BYTES', 16384)) # Merge range reads closer than this
+    GCS_IO_MAX_WORKERS = int(os.environ.get('GCS_IO_MAX_WORKERS', 32)) # Shared chunk-fetch pool per process
+    GCS_FETCH_MAX_IN_FLIGHT = int(os.environ.get('GCS_FETCH_MAX_IN_FLIGHT', 16)) # Per request, so one large fetch can't starve the pool
+
 # --- RAG & Generation Configuration ---
     GENERATION_MAX_TOKENS = int(os.environ.get('GENERATION_MAX_TOKENS', 2048)) # Increased default from 512
     GENERATION_TEMPERATURE = float(os.environ.get('GENERATION_TEMPERATURE', 0.3))
     RAG_TOP_K = int(os.environ.get('RAG_TOP_K', 10)) # Number of chunks to retrieve
-    MAX_CONTEXT_CHARS = int(os.environ.get('MAX_CONTEXT_CHARS', 9000)) # Max chars for context in prompt
+    # How per-query neighbor lists are merged in retrieve_chunks_multi_query: 'min_distance' or 'rrf'
+    RETRIEVAL_FUSION_STRATEGY = os.environ.get('RETRIEVAL_FUSION_STRATEGY', 'min_distance').lower()
+    RRF_K = int(os.environ.get('RRF_K', 60))
+    MATCHING_ENGINE_MAX_QUERIES_PER_REQUEST = int(os.environ.get('MATCHING_ENGINE_MAX_QUERIES_PER_REQUEST', 64)) # Larger query sets are split into concurrent requests
+    # --- Vector Search Backend (see app/services/vector_backends.py) ---
+    VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'matching_engine').lower() # 'matching_engine', 'local' or 'auto'
+    LOCAL_VECTOR_STORE_PATH = os.environ.get('LOCAL_VECTOR_STORE_PATH', os.path.join(basedir, 'instance', 'vector_store'))
+    LOCAL_VECTOR_DTYPE = os.environ.get('LOCAL_VECTOR_DTYPE', 'float16').lower() # 'float16' or 'int8'
+    LOCAL_VECTOR_MAX_CHUNKS = int(os.environ.get('LOCAL_VECTOR_MAX_CHUNKS', 50000)) # 'auto' serves chatbots up to this size locally, once their store holds all of their vectors
+    LOCAL_VECTOR_HNSW_MIN_CHUNKS = int(os.environ.get('LOCAL_VECTOR_HNSW_MIN_CHUNKS', 20000)) # Below this, exact brute force (HNSW needs hnswlib)
+    LOCAL_VECTOR_HNSW_M = int(os.environ.get('LOCAL_VECTOR_HNSW_M', 16))
+    LOCAL_VECTOR_HNSW_EF_CONSTRUCTION = int(os.environ.get('LOCAL_VECTOR_HNSW_EF_CONSTRUCTION', 200))
+    LOCAL_VECTOR_HNSW_EF_SEARCH = int(os.environ.get('LOCAL_VECTOR_HNSW_EF_SEARCH', 64))
+    LOCAL_VECTOR_PERSIST_ENABLED = os.environ.get('LOCAL_VECTOR_PERSIST_ENABLED', 'True').lower() in ('true', '1', 'yes') # Keep document embeddings at ingestion
+    LOCAL_VECTOR_GCS_BACKUP = os.environ.get('LOCAL_VECTOR_GCS_BACKUP', 'True').lower() in ('true', '1', 'yes') # Mirror stores to chatbot_{id}/vectors/ in BUCKET_NAME
+    LOCAL_VECTOR_SYNC_INTERVAL_SECONDS = float(os.environ.get('LOCAL_VECTOR_SYNC_INTERVAL_SECONDS', 60)) # How often query hosts check for a newer backup
+    LOCAL_VECTOR_COMPACT_TOMBSTONE_RATIO = float(os.environ.get('LOCAL_VECTOR_COMPACT_TOMBSTONE_RATIO', 0.2)) # Compact once this share of rows is deleted
+    LOCAL_VECTOR_LOCK_REDIS_URL = os.environ.get('LOCAL_VECTOR_LOCK_REDIS_URL') # Per-chatbot lock around restore/modify/backup; defaults to CELERY_BROKER_URL
+    LOCAL_VECTOR_LOCK_TIMEOUT_SECONDS = int(os.environ.get('LOCAL_VECTOR_LOCK_TIMEOUT_SECONDS', 600)) # Lock expiry if a worker dies holding it
+    LOCAL_VECTOR_LOCK_WAIT_SECONDS = float(os.environ.get('LOCAL_VECTOR_LOCK_WAIT_SECONDS', 300))
+    MAX_CONTEXT_CHARS = int(os.environ.get('MAX_CONTEXT_CHARS', 9000)) # Max chars for context in prompt (used when the token budget is disabled)
+    # --- Cooperative Concurrency (gevent) ---
+    CPU_BOUND_THREADS = int(os.environ.get('CPU_BOUND_THREADS', 4)) # Native threads for cross-encoder, BM25 and local vector search
+    # --- Startup Import Budget (run.py / celery_worker.py; enforced by tests/test_startup_imports.py) ---
+    STARTUP_IMPORT_BUDGET_SECONDS = float(os.environ.get('STARTUP_IMPORT_BUDGET_SECONDS', 8.0)) # Warn when an entry point's imports exceed this
+    # --- Single-Flight Query Coalescing ---
+    SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    SINGLE_FLIGHT_REDIS_ENABLED = os.environ.get('SINGLE_FLIGHT_REDIS_ENABLED', 'False').lower() in ('true', '1', 'yes') # Also coalesce across processes
+    SINGLE_FLIGHT_REDIS_URL = os.environ.get('SINGLE_FLIGHT_REDIS_URL') # Defaults to CELERY_BROKER_URL
+    SINGLE_FLIGHT_WAIT_SECONDS = float(os.environ.get('SINGLE_FLIGHT_WAIT_SECONDS', 30)) # Max wait for another request's result before running the pipeline independently
+    # --- Image Analysis Cache (extracted text keyed by image content hash) ---
+    IMAGE_ANALYSIS_CACHE_ENABLED = os.environ.get('IMAGE_ANALYSIS_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    IMAGE_ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_ANALYSIS_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+    IMAGE_ANALYSIS_CACHE_TTL_SECONDS = int(os.environ.get('IMAGE_ANALYSIS_CACHE_TTL_SECONDS', 24 * 3600))
+    IMAGE_ANALYSIS_CACHE_SHARED_BACKEND = os.environ.get('IMAGE_ANALYSIS_CACHE_SHARED_BACKEND', 'none').lower() # 'redis', 'disk' or 'none'
+    IMAGE_ANALYSIS_CACHE_REDIS_URL = os.environ.get('IMAGE_ANALYSIS_CACHE_REDIS_URL') # Defaults to CELERY_BROKER_URL
+    IMAGE_ANALYSIS_CACHE_DISK_PATH = os.environ.get('IMAGE_ANALYSIS_CACHE_DISK_PATH', os.path.join(basedir, 'instance', 'image_analysis_cache'))
+    IMAGE_ANALYSIS_CACHE_SHARED_TTL_SECONDS = int(os.environ.get('IMAGE_ANALYSIS_CACHE_SHARED_TTL_SECONDS', 30 * 24 * 3600))
+    IMAGE_ANALYSIS_CACHE_DISK_MAX_BYTES = int(os.environ.get('IMAGE_ANALYSIS_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024)) # LRU-pruned past this size
+    # --- Chat History Compaction ---
+    CHAT_HISTORY_COMPACTION_ENABLED = os.environ.get('CHAT_HISTORY_COMPACTION_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    CHAT_HISTORY_RECENT_MAX_MESSAGES = int(os.environ.get('CHAT_HISTORY_RECENT_MAX_MESSAGES', 6)) # Most recent messages sent verbatim
+    CHAT_HISTORY_RECENT_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_RECENT_TOKEN_BUDGET', 600)) # Token cap for the verbatim messages
+    CHAT_HISTORY_SUMMARY_MODEL_NAME = os.environ.get('CHAT_HISTORY_SUMMARY_MODEL_NAME', "gemini-2.5-flash")
+    CHAT_HISTORY_SUMMARY_MAX_WORDS = int(os.environ.get('CHAT_HISTORY_SUMMARY_MAX_WORDS', 150))
+    CHAT_HISTORY_SUMMARY_BATCH_MESSAGES = int(os.environ.get('CHAT_HISTORY_SUMMARY_BATCH_MESSAGES', 40)) # Older messages folded per summarization call
+    CHAT_HISTORY_SUMMARY_TTL_SECONDS = int(os.environ.get('CHAT_HISTORY_SUMMARY_TTL_SECONDS', 7 * 24 * 3600))
+    CHAT_HISTORY_SUMMARY_REDIS_URL = os.environ.get('CHAT_HISTORY_SUMMARY_REDIS_URL') # Defaults to CELERY_BROKER_URL
+    # --- Prompt Token Budget ---
+    PROMPT_TOKEN_BUDGET_ENABLED = os.environ.get('PROMPT_TOKEN_BUDGET_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    MAX_CONTEXT_TOKENS = int(os.environ.get('MAX_CONTEXT_TOKENS', 2200)) # Token budget for context sections in the prompt
+    PROMPT_TOKENIZER_ENCODING = os.environ.get('PROMPT_TOKENIZER_ENCODING', 'cl100k_base') # tiktoken encoding used to count prompt tokens
+    PROMPT_OVERLAP_MAX_CHARS = int(os.environ.get('PROMPT_OVERLAP_MAX_CHARS', 200)) # Longest overlap stripped between adjacent chunks (ingestion overlaps 80 chars)
+    # --- Advanced RAG Configuration ---
+    QUERY_REPHRASING_MODEL_NAME = os.environ.get('QUERY_REPHRASING_MODEL_NAME', "gemini-2.5-flash")
+    FINAL_RESPONSE_MODEL_NAME = os.environ.get('FINAL_RESPONSE_MODEL_NAME', "gemini-2.5-flash")
+    CROSS_ENCODER_MODEL_NAME = os.environ.get('CROSS_ENCODER_MODEL_NAME', 'cross-encoder/ms-marco-MiniLM-L6-v2')
+    CROSS_ENCODER_MAX_LENGTH = int(os.environ.get('CROSS_ENCODER_MAX_LENGTH', 1000))
+    # Cross-encoder inference (see app/services/reranker.py)
+    RERANKER_BACKEND = os.environ.get('RERANKER_BACKEND', 'torch') # 'torch' (sentence-transformers) or 'onnx' (onnxruntime; needs optimum[onnxruntime])
+    RERANKER_QUANTIZE = os.environ.get('RERANKER_QUANTIZE', 'False').lower() in ('true', '1', 'yes') # Dynamic int8 quantization
+    RERANKER_THREADS = int(os.environ.get('RERANKER_THREADS', 0)) # Intra-op threads for inference; 0 = library default
+    RERANKER_ONNX_CACHE_DIR = os.environ.get('RERANKER_ONNX_CACHE_DIR', os.path.join(basedir, 'instance', 'reranker_onnx')) # ONNX exports, shared by processes
+    RERANKER_INFERENCE_BATCH_SIZE = int(os.environ.get('RERANKER_INFERENCE_BATCH_SIZE', 32)) # Pairs per forward pass
+    RERANKER_BATCHING_ENABLED = os.environ.get('RERANKER_BATCHING_ENABLED', 'True').lower() in ('true', '1', 'yes') # Micro-batch pairs across concurrent requests
+    RERANKER_MAX_BATCH_PAIRS = int(os.environ.get('RERANKER_MAX_BATCH_PAIRS', 128)) # Stop collecting once a batch has this many pairs
+    RERANKER_MAX_WAIT_MS = float(os.environ.get('RERANKER_MAX_WAIT_MS', 5)) # How long the first request in a batch waits for others
+    # Load and warm the advanced RAG models (incl. the CrossEncoder) once per process at boot
+    ADVANCED_RAG_WARMUP_ON_BOOT = os.environ.get('ADVANCED_RAG_WARMUP_ON_BOOT', 'True').lower() in ('true', '1', 'yes')
+    ADVANCED_RAG_LLM_CONCURRENCY = int(os.environ.get('ADVANCED_RAG_LLM_CONCURRENCY', 4)) # Max concurrent LLM calls per advanced query (intent/decomposition, variations)
+    # --- Adaptive RAG Routing (advanced_rag_enabled chatbots escalate per query; see app/services/rag_router.py) ---
+    ADAPTIVE_RAG_ROUTING_ENABLED = os.environ.get('ADAPTIVE_RAG_ROUTING_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    ADAPTIVE_RAG_LONG_QUERY_WORDS = int(os.environ.get('ADAPTIVE_RAG_LONG_QUERY_WORDS', 25)) # Longer queries always escalate
+    ADAPTIVE_RAG_MAX_BEST_DISTANCE = float(os.environ.get('ADAPTIVE_RAG_MAX_BEST_DISTANCE', 0.45)) # Escalate when the closest chunk is farther than this
+    ADAPTIVE_RAG_CONFIDENT_DISTANCE = float(os.environ.get('ADAPTIVE_RAG_CONFIDENT_DISTANCE', 0.30)) # Closest chunk within this is trusted even if scores are flat
+    ADAPTIVE_RAG_MIN_DISTANCE_SPREAD = float(os.environ.get('ADAPTIVE_RAG_MIN_DISTANCE_SPREAD', 0.02)) # Top-k distance spread below this counts as flat
+    # --- Semantic Answer Cache (per-chatbot opt-in via Chatbot.answer_cache_enabled) ---
+    ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes') # Global kill switch
+    ANSWER_CACHE_REDIS_URL = os.environ.get('ANSWER_CACHE_REDIS_URL') # Defaults to CELERY_BROKER_URL
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('ANSWER_CACHE_SIMILARITY_THRESHOLD', 0.95)) # Cosine similarity
+    ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('ANSWER_CACHE_TTL_SECONDS', 24 * 3600))
+    ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 200)) # Per chatbot
     # --- Google Generative AI Configuration ---
     GOOGLE_GEMINI_API_KEY = os.environ.get('GOOGLE_GEMINI_API_KEY')
     # When using the google-generativeai SDK with Vertex AI, this environment variable
@@ -80,6 +196,27 @@ class Config:
     DEFAULT_RATE_LIMIT_PER_DAY = os.environ.get('DEFAULT_RATE_LIMIT_PER_DAY', '1000')
     DEFAULT_RATE_LIMIT = "200 per day" # Default rate limit for limiter decorators
 
+    # --- Chatbot Config Snapshot Cache (see app/services/chatbot_config_cache.py) ---
+    CHATBOT_CONFIG_CACHE_ENABLED = os.environ.get('CHATBOT_CONFIG_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+    CHATBOT_CONFIG_CACHE_TTL_SECONDS = int(os.environ.get('CHATBOT_CONFIG_CACHE_TTL_SECONDS', 300)) # Upper bound on staleness if an invalidation is missed
+    CHATBOT_CONFIG_CACHE_MAX_ENTRIES = int(os.environ.get('CHATBOT_CONFIG_CACHE_MAX_ENTRIES', 5000))
+    CHATBOT_CONFIG_CACHE_REDIS_URL = os.environ.get('CHATBOT_CONFIG_CACHE_REDIS_URL') # Pub/sub for invalidations; defaults to CELERY_BROKER_URL
+
+    # --- Usage Logging (write-behind; see app/services/usage_logger.py) ---
+    USAGE_LOG_ASYNC = os.environ.get('USAGE_LOG_ASYNC', 'True').lower() in ('true', '1', 'yes') # False writes each record before responding
+    USAGE_LOG_QUEUE_MAX = int(os.environ.get('USAGE_LOG_QUEUE_MAX', 10000))
+    USAGE_LOG_BATCH_SIZE = int(os.environ.get('USAGE_LOG_BATCH_SIZE', 200))
+    USAGE_LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get('USAGE_LOG_FLUSH_INTERVAL_SECONDS', 1.0))
+    USAGE_LOG_ENQUEUE_TIMEOUT_SECONDS = float(os.environ.get('USAGE_LOG_ENQUEUE_TIMEOUT_SECONDS', 0.05)) # Back-pressure before spilling
+    USAGE_LOG_SPILL_DIR = os.environ.get('USAGE_LOG_SPILL_DIR', os.path.join(basedir, 'instance', 'usage_log_spill'))
+
+    # --- Widget API Key Verification (see app/services/api_key_cache.py) ---
+    API_KEY_CACHE_TTL_SECONDS = int(os.environ.get('API_KEY_CACHE_TTL_SECONDS', 300)) # 0 disables caching of valid keys
+    API_KEY_NEGATIVE_CACHE_TTL_SECONDS = int(os.environ.get('API_KEY_NEGATIVE_CACHE_TTL_SECONDS', 30)) # 0 disables caching of rejected keys
+    API_KEY_CACHE_MAX_ENTRIES = int(os.environ.get('API_KEY_CACHE_MAX_ENTRIES', 10000))
+    API_KEY_HASH_SCHEME = os.environ.get('API_KEY_HASH_SCHEME', 'pbkdf2').lower() # 'pbkdf2' or 'hmac' (needs API_KEY_HMAC_SECRET)
+    API_KEY_HMAC_SECRET = os.environ.get('API_KEY_HMAC_SECRET')
+
     # --- File Upload Configuration ---
     MAX_IMAGE_SIZE_BYTES = int(os.environ.get('MAX_IMAGE_SIZE_BYTES', 10 * 1024 * 1024)) # Default 10MB
     MAX_IMAGE_SIZE_MB = MAX_IMAGE_SIZE_BYTES / (1024 * 1024)
@@ -0,0 +1,33 @@
+# gevent_setup.py
+"""
+Gevent monkey patching plus gRPC's gevent integration, shared by run.py and
+celery_worker.py. Both import it first, before anything opens a socket or a
+gRPC channel.
+
+The two steps are tracked separately: a worker started with `-P gevent` has
+already been patched by Celery before celery_worker.py is imported, and gRPC
+still has to be made gevent-aware there (see app/services/concurrency.py).
+"""
+_grpc_gevent_initialized = False
+
+
+def apply_gevent_patches() -> tuple[bool, str | None]:
+    """
+    Monkey-patches the stdlib unless that has been done already, and runs grpc's init_gevent() once per process.
+    Returns (gevent available, gRPC integration error or None).
+    """
+    global _grpc_gevent_initialized
+    try:
+        import gevent.monkey
+    except ImportError:
+        return False, None
+    if not gevent.monkey.is_module_patched('socket'):
+        gevent.monkey.patch_all()
+    if not _grpc_gevent_initialized:
+        try:
+            import grpc.experimental.gevent as grpc_gevent
+            grpc_gevent.init_gevent() # Before any gRPC channel exists, so Vertex AI calls yield to other greenlets
+            _grpc_gevent_initialized = True
+        except Exception as e:
+            return True, str(e)
+    return True, None
@@ -0,0 +1,110 @@
+"""
+Script to convert sources stored as one GCS object per chunk
+(chatbot_{id}/source_{hash}/{i}.txt) into packed shards (shard.bin + shard.json).
+
+Vector IDs don't change, so the vector index and VectorIdMapping rows are untouched.
+Sources that already have a shard are skipped unless --force is given.
+
+Usage:
+    python migrate_chunk_shards.py [--chatbot-id ID] [--dry-run] [--delete-legacy] [--force]
+"""
+import argparse
+import concurrent.futures
+import sys
+from collections import defaultdict
+
+from google.api_core.exceptions import NotFound as GoogleNotFound
+
+from app import create_app
+from app.api.routes import get_rag_service
+from app.models import VectorIdMapping
+from app.services.chunk_cache import invalidate_chunk_cache
+from app.services.chunk_shards import shard_blob_names, upload_source_shard
+
+
+def _download_legacy_chunks(bucket, chatbot_id, source_hash, chunk_indices):
+    """Returns {chunk_index: text}; raises if any chunk object is missing."""
+    def download(chunk_index):
+        blob = bucket.blob(f"chatbot_{chatbot_id}/source_{source_hash}/{chunk_index}.txt")
+        return chunk_index, blob.download_as_text(encoding="utf-8")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        return dict(executor.map(download, chunk_indices))
+
+
+def migrate_chunk_shards(chatbot_id=None, dry_run=False, delete_legacy=False, force=False):
+    """Migrate per-chunk sources to shards. Returns True if every source migrated (or was skipped)."""
+    app = create_app()
+    with app.app_context():
+        rag_service = get_rag_service()
+        if not rag_service or not rag_service._ensure_clients_initialized() or not rag_service.bucket:
+            print("Error: GCS bucket could not be initialized.")
+            return False
+        bucket = rag_service.bucket
+        codec = app.config.get('CHUNK_SHARD_COMPRESSION', 'none')
+        level = app.config.get('CHUNK_SHARD_COMPRESSION_LEVEL', 3)
+
+        query = VectorIdMapping.query
+        if chatbot_id is not None:
+            query = query.filter_by(chatbot_id=chatbot_id)
+
+        # (chatbot_id, source_hash) -> chunk indices, parsed from chatbot_{id}_source_{hash}_chunk_{i}
+        sources = defaultdict(set)
+        for mapping in query.all():
+            parts = mapping.vector_id.split('_')
+            if len(parts) == 6 and parts[0] == 'chatbot' and parts[2] == 'source' and parts[4] == 'chunk' and parts[5].isdigit():
+                sources[(mapping.chatbot_id, parts[3])].add(int(parts[5]))
+            else:
+                print(f"Skipping vector ID with unexpected format: {mapping.vector_id}")
+
+        print(f"Found {len(sources)} sources to check.")
+        migrated = skipped = failed = 0
+        for (source_chatbot_id, source_hash), chunk_indices in sorted(sources.items()):
+            label = f"chatbot {source_chatbot_id} source {source_hash}"
+            _, index_blob_name = shard_blob_names(source_chatbot_id, source_hash)
+            if not force and bucket.blob(index_blob_name).exists():
+                skipped += 1
+                continue
+
+            expected = list(range(max(chunk_indices) + 1))
+            if sorted(chunk_indices) != expected:
+                print(f"  {label}: chunk indices are not contiguous ({len(chunk_indices)} of {len(expected)}); skipping.")
+                failed += 1
+                continue
+
+            try:
+                texts = _download_legacy_chunks(bucket, source_chatbot_id, source_hash, expected)
+            except GoogleNotFound as e:
+                print(f"  {label}: missing chunk object ({e}); skipping.")
+                failed += 1
+                continue
+
+            if dry_run:
+                print(f"  {label}: would pack {len(texts)} chunks.")
+                migrated += 1
+                continue
+
+            index = upload_source_shard(bucket, source_chatbot_id, source_hash, [texts[i] for i in expected], codec=codec, level=level)
+            invalidate_chunk_cache(source_chatbot_id, source_hash)
+            print(f"  {label}: packed {len(texts)} chunks (codec: {index['codec']}).")
+            migrated += 1
+
+            if delete_legacy:
+                for i in expected:
+                    try:
+                        bucket.blob(f"chatbot_{source_chatbot_id}/source_{source_hash}/{i}.txt").delete()
+                    except GoogleNotFound:
+                        pass
+
+        print(f"Done. Migrated: {migrated}, already packed: {skipped}, failed: {failed}{' (dry run)' if dry_run else ''}.")
+        return failed == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack per-chunk GCS objects into per-source shards.")
+    parser.add_argument('--chatbot-id', type=int, default=None, help="Only migrate this chatbot.")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would be migrated without writing.")
+    parser.add_argument('--delete-legacy', action='store_true', help="Delete the per-chunk objects after packing.")
+    parser.add_argument('--force', action='store_true', help="Re-pack sources that already have a shard.")
+    args = parser.parse_args()
+    sys.exit(0 if migrate_chunk_shards(args.chatbot_id, args.dry_run, args.delete_legacy, args.force) else 1)
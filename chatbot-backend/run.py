@@ -1,10 +1,15 @@
+import time
+_import_started = time.perf_counter() # Import-time budget: measured from here until the app is created
+
 # --- GEVENT PATCHING ---
 # Apply patch *before* importing Flask, app factory, or anything using networking/ssl.
-try:
-    import gevent.monkey
-    gevent.monkey.patch_all()
+from gevent_setup import apply_gevent_patches
+gevent_available, grpc_err = apply_gevent_patches()
+if gevent_available:
     print("Gevent monkey patching applied in run.py.") # Confirmation log
-except ImportError:
+    if grpc_err:
+        print(f"WARNING: grpc gevent integration unavailable ({grpc_err}); Vertex AI calls will block the event loop.")
+else:
     print("Gevent not installed in run.py, skipping monkey patching.")
 # -----------------------
 
@@ -18,6 +23,12 @@ from celery import Task # Keep Task import if needed elsewhere, otherwise remove
 
 app = create_app()
 
+_import_seconds = time.perf_counter() - _import_started
+_import_budget = app.config.get('STARTUP_IMPORT_BUDGET_SECONDS', 8.0)
+print(f"PERF: run.py imports and app creation took {_import_seconds:.2f}s (budget {_import_budget:.1f}s).")
+if _import_seconds > _import_budget:
+    print(f"WARNING: Startup exceeded its import budget by {_import_seconds - _import_budget:.2f}s; check for eager imports of heavy modules.")
+
 # --- Removed Celery Context Task Setup ---
 # Context will be handled manually within each task function
 # -----------------------------------------
@@ -28,6 +39,10 @@ if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
         print("Attempting to eagerly initialize services...")
         try:
             get_rag_service() # Call the function to trigger initialization
+            if app.config.get('ADVANCED_RAG_WARMUP_ON_BOOT', True):
+                from app.services.advanced_rag_service import warm_up_advanced_rag
+                if not warm_up_advanced_rag():
+                    print("WARNING: Advanced RAG warm-up failed; models will be loaded on first advanced query.")
             print("Services initialized.")
         except Exception as e:
             print(f"ERROR: Service initialization failed during startup: {e}")
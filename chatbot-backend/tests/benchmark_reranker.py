@@ -0,0 +1,128 @@
+# chatbot-backend/tests/benchmark_reranker.py
+"""
+CPU benchmark for cross-encoder reranking under concurrent advanced queries.
+
+Compares the per-request path (each request calls predict on a shared model under
+a lock, as _rerank_chunks did) with MicroBatchReranker, for the torch or ONNX
+backend, optionally int8-quantized. Reports throughput and latency percentiles.
+
+    python tests/benchmark_reranker.py --concurrency 8 --requests 64
+    python tests/benchmark_reranker.py --backend onnx --quantize --threads 4
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.reranker import load_cross_encoder_scorer, MicroBatchReranker
+
+OUTPUT_FILE = "reranker_benchmark_results.json"
+
+WORDS = ("office clerk letter copy desk window partition screen wall court law chambers employer "
+         "ginger nut cake apple refused prefer dinner lodging wages building street trespasser").split()
+
+
+def make_requests(count: int, pairs_per_request: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        query = " ".join(rng.choices(WORDS, k=rng.randint(5, 15)))
+        passages = [" ".join(rng.choices(WORDS, k=rng.randint(60, 180))) for _ in range(pairs_per_request)]
+        requests.append([(query, passage) for passage in passages])
+    return requests
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run(label: str, score_request, requests: list, concurrency: int) -> dict:
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def one(pairs):
+        start = time.perf_counter()
+        score_request(pairs)
+        with latencies_lock:
+            latencies.append(time.perf_counter() - start)
+
+    score_request(requests[0]) # Warm up
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, requests))
+    wall = time.perf_counter() - wall_start
+    result = {
+        "mode": label,
+        "requests": len(requests),
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(requests) / wall, 2),
+        "pairs_per_second": round(sum(len(r) for r in requests) / wall, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+    }
+    print(json.dumps(result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.environ.get('CROSS_ENCODER_MODEL_NAME', 'cross-encoder/ms-marco-MiniLM-L6-v2'))
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--backend", choices=("torch", "onnx"), default="torch")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--onnx-cache-dir", default=os.path.join(project_root, 'instance', 'reranker_onnx'))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--pairs-per-request", type=int, default=20)
+    parser.add_argument("--max-batch-pairs", type=int, default=128)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    requests = make_requests(args.requests, args.pairs_per_request)
+    results = []
+
+    # Baseline: the per-request path with the unquantized torch model
+    baseline = load_cross_encoder_scorer(args.model, args.max_length, backend="torch", threads=args.threads)
+    baseline_lock = threading.Lock()
+
+    def per_request(pairs):
+        with baseline_lock:
+            return baseline.predict(pairs)
+
+    results.append(run("per_request/torch", per_request, requests, args.concurrency))
+
+    scorer = load_cross_encoder_scorer(args.model, args.max_length, backend=args.backend, quantize=args.quantize,
+                                       threads=args.threads, cache_dir=args.onnx_cache_dir)
+    label = f"{scorer.backend}{'-int8' if scorer.quantized else ''}"
+    candidate_lock = threading.Lock()
+
+    def per_request_candidate(pairs):
+        with candidate_lock:
+            return scorer.predict(pairs)
+
+    if label != "torch":
+        results.append(run(f"per_request/{label}", per_request_candidate, requests, args.concurrency))
+    reranker = MicroBatchReranker(scorer, max_batch_pairs=args.max_batch_pairs, max_wait_ms=args.max_wait_ms)
+    results.append(run(f"micro_batched/{label}", reranker.score, requests, args.concurrency))
+    print(json.dumps({"batching": reranker.get_stats()}))
+
+    with open(OUTPUT_FILE, 'w') as f:
+        json.dump({"args": vars(args), "results": results}, f, indent=2)
+    print(f"Results written to {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# chatbot-backend/tests/test_answer_cache.py
+
+import unittest
+import os
+import sys
+from types import SimpleNamespace
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.answer_cache import answer_cache_applies, chatbot_answer_fingerprint
+
+
+class TestAnswerCacheScope(unittest.TestCase):
+
+    def test_follow_ups_with_history_are_not_cached(self):
+        history = [
+            {"role": "user", "content": "Which plans do you offer?"},
+            {"role": "assistant", "content": "Basic, Pro and Enterprise."},
+        ]
+        self.assertTrue(answer_cache_applies("What about the second one?", []))
+        self.assertFalse(answer_cache_applies("What about the second one?", history))
+        self.assertFalse(answer_cache_applies("What is in this picture?", [], image_data=b"\x89PNG"))
+        self.assertFalse(answer_cache_applies("", []))
+
+    def test_fingerprint_depends_on_language(self):
+        chatbot = SimpleNamespace(index_version=3, last_index_update=None, base_prompt="Be brief.", knowledge_adherence_level="strict")
+        self.assertNotEqual(chatbot_answer_fingerprint(chatbot, False, 'en'), chatbot_answer_fingerprint(chatbot, False, 'he'))
+        self.assertEqual(chatbot_answer_fingerprint(chatbot, False, 'EN'), chatbot_answer_fingerprint(chatbot, False, 'en'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# chatbot-backend/tests/test_api_key_cache.py
+
+import unittest
+import os
+import sys
+from unittest import mock
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from werkzeug.security import generate_password_hash
+
+from app.services import api_key_cache
+from app.services.api_key_cache import ApiKeyCache
+
+
+class TestApiKeyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.stored_hash = generate_password_hash("good-key")
+        self.cache = ApiKeyCache(ttl_seconds=60, negative_ttl_seconds=60)
+
+    def test_valid_and_invalid_results_are_cached(self):
+        with mock.patch.object(api_key_cache, 'check_password_hash', wraps=api_key_cache.check_password_hash) as check:
+            self.assertTrue(self.cache.verify(1, self.stored_hash, "good-key"))
+            self.assertTrue(self.cache.verify(1, self.stored_hash, "good-key"))
+            self.assertFalse(self.cache.verify(1, self.stored_hash, "bad-key"))
+            self.assertFalse(self.cache.verify(1, self.stored_hash, "bad-key"))
+            self.assertEqual(check.call_count, 2)
+
+    def test_new_stored_hash_does_not_reuse_old_result(self):
+        self.assertTrue(self.cache.verify(1, self.stored_hash, "good-key"))
+        self.assertFalse(self.cache.verify(1, generate_password_hash("new-key"), "good-key"))
+
+    def test_invalidate_drops_chatbot_entries(self):
+        self.cache.verify(1, self.stored_hash, "good-key")
+        self.cache.invalidate(1)
+        with mock.patch.object(api_key_cache, 'check_password_hash', return_value=True) as check:
+            self.cache.verify(1, self.stored_hash, "good-key")
+            check.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
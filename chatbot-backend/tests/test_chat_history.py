@@ -0,0 +1,126 @@
+# chatbot-backend/tests/test_chat_history.py
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from flask import Flask
+
+from app import db
+from app.models import ChatMessage
+from app.services.chat_history import ChatHistoryManager, trim_history, format_history, SUMMARY_ROLE
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class TestChatHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(["word"] * 10)}
+            for i in range(10)
+        ]
+
+    def test_trim_keeps_newest_within_message_limit(self):
+        kept = trim_history(self.messages, 4, 1000, count_words)
+        self.assertEqual(kept, self.messages[-4:])
+
+    def test_trim_respects_token_budget_but_keeps_newest(self):
+        self.assertEqual(trim_history(self.messages, 10, 30, count_words), self.messages[-2:]) # 14 tokens each
+        self.assertEqual(trim_history(self.messages, 10, 1, count_words), self.messages[-1:])
+
+    def test_format_history_labels_summary(self):
+        history = [{"role": SUMMARY_ROLE, "content": "User asked about refunds."}, {"role": "user", "content": "And shipping?"}, {"role": "assistant", "content": "Free over $50."}]
+        self.assertEqual(
+            format_history(history),
+            "Summary of earlier conversation: User asked about refunds.\nUser: And shipping?\nChatbot: Free over $50."
+        )
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TestChatHistoryManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(self.tmp_dir, 'history.db')}"
+        db.init_app(self.app)
+        with self.app.app_context():
+            db.create_all()
+        self.manager = ChatHistoryManager(self.app, redis_url=None, recent_max_messages=4, recent_token_budget=1000)
+        self.manager._redis = _FakeRedis()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _add_turns(self, *contents):
+        with self.app.app_context():
+            for content in contents:
+                db.session.add(ChatMessage(chatbot_id=1, session_id="s1", role="user" if content.endswith("?") else "assistant", content=content))
+            db.session.commit()
+
+    def _load(self):
+        with self.app.app_context():
+            return self.manager.load(1, "s1")
+
+    def test_summary_is_built_in_background_once_turns_age_out_and_then_used(self):
+        self._add_turns("Do you ship abroad?", "Yes, to the EU.", "How long does it take?", "About a week.")
+        with mock.patch.object(self.manager, '_summarize', return_value="User asked about shipping to the EU.") as summarize:
+            history = self._load()
+            self.assertEqual([turn["role"] for turn in history], ["user", "assistant", "user", "assistant"])
+            summarize.assert_not_called() # Everything still fits in the verbatim window
+
+            self._add_turns("What about returns?", "Within 30 days.")
+            history = self._load()
+            self.assertEqual(len(history), 4) # The summary isn't computed on the request path
+            self.assertNotEqual(history[0]["role"], SUMMARY_ROLE)
+
+            key = self.manager._key(1, "s1")
+            deadline = time.monotonic() + 2
+            while key not in self.manager._redis.data and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertIn(key, self.manager._redis.data)
+            summarize.assert_called_once_with("", [
+                {"role": "user", "content": "Do you ship abroad?"},
+                {"role": "assistant", "content": "Yes, to the EU."},
+            ])
+
+            history = self._load()
+            self.assertEqual(history[0], {"role": SUMMARY_ROLE, "content": "User asked about shipping to the EU."})
+            self.assertEqual([turn["content"] for turn in history[1:]], ["How long does it take?", "About a week.", "What about returns?", "Within 30 days."])
+            self.assertEqual(summarize.call_count, 1) # The cached summary already covers the aged-out turns
+
+
+if __name__ == '__main__':
+    unittest.main()
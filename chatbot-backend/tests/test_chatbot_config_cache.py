@@ -0,0 +1,72 @@
+# chatbot-backend/tests/test_chatbot_config_cache.py
+
+import unittest
+import os
+import sys
+import threading
+import time
+from unittest import mock
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services import chatbot_config_cache
+from app.services.chatbot_config_cache import ChatbotConfigCache, ChatbotSnapshot
+
+
+class _FakePubSub:
+    """Delivers the published messages once, then blocks like an idle subscription."""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        for data in self.messages:
+            yield {'type': 'message', 'data': data}
+        threading.Event().wait()
+
+
+class _FakeRedis:
+    def __init__(self, messages):
+        self.messages = messages
+
+    def pubsub(self, ignore_subscribe_messages=True):
+        return _FakePubSub(self.messages)
+
+
+class TestChatbotConfigCache(unittest.TestCase):
+
+    def test_published_int_invalidation_drops_entry_stored_under_str_id(self):
+        published = []
+        cache = ChatbotConfigCache(ttl_seconds=300)
+        loads = []
+
+        def load(model, chatbot_id):
+            loads.append(chatbot_id)
+            return object()
+
+        with mock.patch.object(chatbot_config_cache, 'db') as db, \
+                mock.patch.object(ChatbotSnapshot, 'from_model', side_effect=lambda _: ChatbotSnapshot({'id': 7})):
+            db.session.get.side_effect = load
+            cache.get("7") # routes pass the ID as a string
+            cache.get(7)
+            self.assertEqual(len(loads), 1)
+
+            cache._redis = _FakeRedis(published)
+            published.append(b"7") # What invalidate() publishes from another process
+            cache.start_listener()
+            deadline = time.monotonic() + 2
+            while cache._generations.get(7) is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            cache.get("7")
+            self.assertEqual(len(loads), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
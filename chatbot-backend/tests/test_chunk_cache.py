@@ -0,0 +1,61 @@
+# chatbot-backend/tests/test_chunk_cache.py
+
+import unittest
+import os
+import sys
+import tempfile
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.chunk_cache import ChunkTextCache, chunk_cache_prefix
+
+
+class TestChunkTextCache(unittest.TestCase):
+
+    def test_local_hits_misses_and_stats(self):
+        cache = ChunkTextCache()
+        cache.set_many({"chatbot_1/source_aa/0.txt": "hello"})
+        self.assertEqual(cache.get_many(["chatbot_1/source_aa/0.txt", "chatbot_1/source_aa/1.txt"]), ["hello", None])
+        stats = cache.get_stats()
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_byte_budget_evicts(self):
+        text = "x" * 1000
+        cache = ChunkTextCache(max_bytes=sys.getsizeof(text) * 2)
+        cache.set_many({f"chatbot_1/source_aa/{i}.txt": text for i in range(5)})
+        self.assertLessEqual(cache.get_stats()['local_entries'], 2)
+
+    def test_prefix_invalidation(self):
+        cache = ChunkTextCache()
+        cache.set_many({
+            "chatbot_1/source_aa/0.txt": "a",
+            "chatbot_1/source_bb/0.txt": "b",
+            "chatbot_10/source_aa/0.txt": "c",
+        })
+        cache.invalidate_prefix(chunk_cache_prefix(1, "aa"))
+        self.assertEqual(cache.get_many(["chatbot_1/source_aa/0.txt", "chatbot_1/source_bb/0.txt"]), [None, "b"])
+        cache.invalidate_prefix(chunk_cache_prefix(1))
+        self.assertEqual(cache.get_many(["chatbot_1/source_bb/0.txt", "chatbot_10/source_aa/0.txt"]), [None, "c"])
+
+    def test_disk_tier_shared_between_instances_and_epoch_invalidation(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = ChunkTextCache(shared_backend='disk', disk_path=tmp_dir, epoch_refresh_seconds=0)
+            reader = ChunkTextCache(shared_backend='disk', disk_path=tmp_dir, epoch_refresh_seconds=0)
+            writer.set_many({"chatbot_2/source_aa/0.txt": "shared"})
+            self.assertEqual(reader.get_many(["chatbot_2/source_aa/0.txt"]), ["shared"])
+            self.assertEqual(reader.get_stats()['shared_hits'], 1)
+
+            time.sleep(0.01)
+            writer.invalidate_prefix(chunk_cache_prefix(2, "aa"))
+            # The reader's local copy predates the shared epoch, so it is dropped too
+            self.assertEqual(reader.get_many(["chatbot_2/source_aa/0.txt"]), [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
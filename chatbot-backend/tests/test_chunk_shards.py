@@ -0,0 +1,59 @@
+# chatbot-backend/tests/test_chunk_shards.py
+
+import unittest
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services import chunk_shards
+from app.services.chunk_shards import build_shard, plan_range_reads, split_range
+
+
+class TestChunkShards(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = ["first chunk", "second chunk ü", "third", "fourth chunk"]
+
+    def _read(self, data, index, wanted, max_gap_bytes):
+        texts = {}
+        ranges = plan_range_reads(index, wanted, max_gap_bytes)
+        for start, end, members in ranges:
+            texts.update(split_range(data[start:end], start, members, index["codec"]))
+        return texts, ranges
+
+    def test_round_trip_uncompressed(self):
+        data, index = build_shard(self.chunks, codec='none')
+        texts, _ = self._read(data, index, [0, 1, 2, 3], max_gap_bytes=0)
+        self.assertEqual([texts[i] for i in range(4)], self.chunks)
+
+    @unittest.skipIf(chunk_shards.zstandard is None, "zstandard not installed")
+    def test_round_trip_zstd(self):
+        data, index = build_shard(self.chunks, codec='zstd')
+        self.assertEqual(index["codec"], 'zstd')
+        texts, _ = self._read(data, index, [1, 3], max_gap_bytes=0)
+        self.assertEqual(texts, {1: self.chunks[1], 3: self.chunks[3]})
+
+    def test_adjacent_chunks_are_coalesced(self):
+        data, index = build_shard(self.chunks, codec='none')
+        _, ranges = self._read(data, index, [0, 1], max_gap_bytes=0)
+        self.assertEqual(len(ranges), 1)
+
+    def test_gap_threshold_splits_ranges(self):
+        data, index = build_shard(self.chunks, codec='none')
+        texts, ranges = self._read(data, index, [0, 3], max_gap_bytes=0)
+        self.assertEqual(len(ranges), 2)
+        texts, ranges = self._read(data, index, [0, 3], max_gap_bytes=1024)
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(texts, {0: self.chunks[0], 3: self.chunks[3]})
+
+    def test_unknown_chunk_indices_are_skipped(self):
+        _, index = build_shard(self.chunks, codec='none')
+        self.assertEqual(plan_range_reads(index, [7, -1]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
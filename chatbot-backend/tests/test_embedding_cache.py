@@ -0,0 +1,59 @@
+# chatbot-backend/tests/test_embedding_cache.py
+
+import unittest
+from unittest.mock import MagicMock
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.embedding_cache import EmbeddingCache, encode_vector, decode_vector, normalize_query_text
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def test_normalization_ignores_case_and_whitespace(self):
+        self.assertEqual(normalize_query_text("  What  are your\tHOURS? "), "what are your hours?")
+
+    def test_float16_round_trip(self):
+        values = [0.125, -0.5, 0.3333]
+        decoded = decode_vector(encode_vector(values, 'float16'))
+        self.assertEqual(len(decoded), 3)
+        for original, restored in zip(values, decoded):
+            self.assertAlmostEqual(original, restored, places=3)
+
+    def test_float32_round_trip(self):
+        decoded = decode_vector(encode_vector([1.5, -2.25], 'float32'))
+        self.assertEqual(decoded, [1.5, -2.25])
+
+    def test_key_depends_on_model_task_and_dimensionality(self):
+        cache = EmbeddingCache(redis_url=None)
+        base = cache.make_key("hello", "model-a", "RETRIEVAL_QUERY", None)
+        self.assertEqual(base, cache.make_key("  HELLO ", "model-a", "RETRIEVAL_QUERY", None))
+        self.assertNotEqual(base, cache.make_key("hello", "model-b", "RETRIEVAL_QUERY", None))
+        self.assertNotEqual(base, cache.make_key("hello", "model-a", "RETRIEVAL_DOCUMENT", None))
+        self.assertNotEqual(base, cache.make_key("hello", "model-a", "RETRIEVAL_QUERY", 768))
+
+    def test_local_tier_hits_and_misses(self):
+        cache = EmbeddingCache(redis_url=None)
+        cache.set_many({"k1": [0.1, 0.2]})
+        self.assertEqual(cache.get_many(["k1", "k2"]), [[0.1, 0.2], None])
+        stats = cache.get_stats()
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_redis_tier_hit_is_promoted_locally(self):
+        cache = EmbeddingCache(redis_url=None)
+        cache._redis = MagicMock()
+        cache._redis.mget.return_value = [encode_vector([0.5, 0.25], 'float32')]
+        self.assertEqual(cache.get_many(["k1"]), [[0.5, 0.25]])
+        self.assertEqual(cache.get_many(["k1"]), [[0.5, 0.25]])
+        cache._redis.mget.assert_called_once()
+        self.assertEqual(cache.get_stats()['redis_hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# chatbot-backend/tests/test_hybrid_retrieval.py
+
+import unittest
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from app.services.hybrid_retrieval import SparseBM25, fuse_hybrid_ranks, sparse
+
+CORPUS = [
+    "the office clerk copies the letter",
+    "the clerk prefers ginger nut cake",
+    "a partition screen in the office",
+    "wages for the clerk",
+    "lodging near the court and the law chambers",
+    "the employer refused the clerk",
+]
+CORPUS_IDS = [f"doc_{i}" for i in range(len(CORPUS))]
+QUERIES = ["clerk office", "ginger cake cake", "court law", "unknown words"]
+
+
+def per_variation_fusion(vector_ids: list, scores, top_n: int, rrf_k: int) -> list:
+    """The dict-based fusion the advanced pipeline used per variation."""
+    vector_ranks = {chunk_id: r + 1 for r, chunk_id in enumerate(vector_ids)}
+    scored = [(CORPUS_IDS[idx], scores[idx]) for idx in range(len(scores)) if scores[idx] > 0]
+    bm25_ranks = {chunk_id: r + 1 for r, (chunk_id, _) in enumerate(sorted(scored, key=lambda item: item[1], reverse=True))}
+    rrf_scores = {}
+    for chunk_id in set(vector_ranks) | set(bm25_ranks):
+        rrf_scores[chunk_id] = (1.0 / (rrf_k + vector_ranks[chunk_id]) if chunk_id in vector_ranks else 0.0) + \
+                               (1.0 / (rrf_k + bm25_ranks[chunk_id]) if chunk_id in bm25_ranks else 0.0)
+    return sorted(rrf_scores, key=rrf_scores.get, reverse=True)[:top_n]
+
+
+@unittest.skipIf(sparse is None, "scipy is not installed")
+class TestHybridRetrieval(unittest.TestCase):
+
+    def setUp(self):
+        self.bm25 = BM25Okapi([doc.split(" ") for doc in CORPUS])
+        self.index = SparseBM25.from_bm25(self.bm25, CORPUS_IDS)
+
+    def test_batch_scores_match_get_scores(self):
+        batch_scores = self.index.score_batch([query.split(" ") for query in QUERIES])
+        self.assertEqual(batch_scores.shape, (len(QUERIES), len(CORPUS)))
+        for row, query in zip(batch_scores, QUERIES):
+            np.testing.assert_allclose(row, self.bm25.get_scores(query.split(" ")), rtol=1e-9, atol=1e-12)
+
+    def test_fusion_matches_per_variation_loop(self):
+        batch_scores = self.index.score_batch([query.split(" ") for query in QUERIES])
+        vector_id_lists = [["doc_2", "doc_0"], ["doc_1"], [], ["doc_5", "doc_4", "doc_3"]]
+        fused = fuse_hybrid_ranks(vector_id_lists, batch_scores, CORPUS_IDS, top_n=3, rrf_k=60)
+        for ids, vector_ids, scores in zip(fused, vector_id_lists, batch_scores):
+            expected = per_variation_fusion(vector_ids, scores, top_n=3, rrf_k=60)
+            self.assertEqual(set(ids), set(expected))
+            self.assertEqual(len(ids), len(expected))
+
+    def test_fusion_without_bm25_keeps_vector_order(self):
+        fused = fuse_hybrid_ranks([["doc_3", "doc_1", "doc_0"]], None, [], top_n=2)
+        self.assertEqual(fused, [["doc_3", "doc_1"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# chatbot-backend/tests/test_image_analysis_cache.py
+
+import unittest
+import os
+import sys
+import glob
+import tempfile
+import shutil
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.image_analysis_cache import ImageAnalysisCache, image_analysis_key
+
+
+class TestImageAnalysisCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.entry = {"text": "SALE 50% OFF", "warnings": [], "safety_ratings": []}
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_key_depends_on_content_model_and_prompt_version(self):
+        key = image_analysis_key(b"png-bytes", "gemini-2.5-flash", "v1")
+        self.assertEqual(key, image_analysis_key(b"png-bytes", "gemini-2.5-flash", "v1"))
+        self.assertNotEqual(key, image_analysis_key(b"other-bytes", "gemini-2.5-flash", "v1"))
+        self.assertNotEqual(key, image_analysis_key(b"png-bytes", "gemini-2.5-pro", "v1"))
+        self.assertNotEqual(key, image_analysis_key(b"png-bytes", "gemini-2.5-flash", "v2"))
+
+    def test_disk_tier_is_shared_between_instances(self):
+        key = image_analysis_key(b"png-bytes", "model", "v1")
+        ImageAnalysisCache(shared_backend='disk', disk_path=self.root).set(key, self.entry)
+        other_process = ImageAnalysisCache(shared_backend='disk', disk_path=self.root)
+        self.assertEqual(other_process.get(key), self.entry)
+        self.assertEqual(other_process.get_stats()["shared_hits"], 1)
+        self.assertEqual(other_process.get(key), self.entry)
+        self.assertEqual(other_process.get_stats()["local_hits"], 1)
+
+    def test_local_tier_is_bounded_by_bytes(self):
+        cache = ImageAnalysisCache(max_bytes=400)
+        for i in range(10):
+            cache.set(f"key{i}", {"text": "x" * 100, "warnings": [], "safety_ratings": []})
+        self.assertLessEqual(cache.get_stats()["local_bytes"], 400)
+        self.assertIsNone(cache.get("key0"))
+        self.assertIsNotNone(cache.get("key9"))
+
+    def test_disk_tier_prunes_least_recently_used_files_past_its_limit(self):
+        cache = ImageAnalysisCache(shared_backend='disk', disk_path=self.root, disk_max_bytes=1000)
+        entry = {"text": "x" * 100, "warnings": [], "safety_ratings": []} # ~150 bytes on disk
+        keys = [image_analysis_key(bytes([i]), "model", "v1") for i in range(7)]
+        written_at = time.time() - 1000
+        for i, key in enumerate(keys[:6]):
+            cache.set(key, entry)
+            os.utime(cache._shared._path(key), (written_at + i, written_at + i)) # Oldest first
+        self.assertEqual(len(glob.glob(os.path.join(self.root, "*", "*.json"))), 6) # Still under the limit
+
+        other_process = ImageAnalysisCache(shared_backend='disk', disk_path=self.root)
+        self.assertEqual(other_process.get(keys[0]), entry) # A hit makes the oldest file the most recent
+        cache.set(keys[6], entry)
+
+        remaining = {key for key in keys if os.path.exists(cache._shared._path(key))}
+        self.assertEqual(remaining, set(keys) - {keys[1]})
+        self.assertLessEqual(sum(os.path.getsize(cache._shared._path(key)) for key in remaining), 900)
+
+
+if __name__ == '__main__':
+    unittest.main()
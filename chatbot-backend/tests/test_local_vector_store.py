@@ -0,0 +1,127 @@
+# chatbot-backend/tests/test_local_vector_store.py
+
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+import threading
+import time
+from unittest import mock
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import numpy as np
+
+from app.services import vector_backends
+from app.services.local_vector_store import LocalVectorStore
+from app.services.vector_backends import LocalVectorBackend
+
+
+class TestLocalVectorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(50, 16)).astype(np.float32)
+        self.ids = [f"chatbot_7_source_abc_chunk_{i}" for i in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _exact_top(self, query, k):
+        normalized = self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        return [self.ids[i] for i in np.argsort(-(normalized @ (query / np.linalg.norm(query))))[:k]]
+
+    def test_brute_force_matches_exact_ranking(self):
+        for dtype in ('float16', 'int8'):
+            store = LocalVectorStore(os.path.join(self.root, dtype), dtype=dtype)
+            store.write(7, 'model', self.ids, self.vectors)
+            vector_set = store.load(7, 'model')
+            query = self.vectors[3] + 0.01
+            results = vector_set.search((query / np.linalg.norm(query))[None, :], k=5)
+            self.assertEqual(results[0][0][0], self.ids[3])
+            self.assertEqual([vector_id for vector_id, _ in results[0]][:3], self._exact_top(query, 3))
+            distances = [distance for _, distance in results[0]]
+            self.assertEqual(distances, sorted(distances))
+
+    def test_row_mask_excludes_rows(self):
+        store = LocalVectorStore(self.root)
+        store.write(7, 'model', self.ids, self.vectors)
+        vector_set = store.load(7, 'model')
+        mask = np.ones(len(self.ids), dtype=bool)
+        mask[3] = False
+        query = self.vectors[3] / np.linalg.norm(self.vectors[3])
+        results = vector_set.search(query[None, :], k=len(self.ids), row_mask=mask)
+        self.assertNotIn(self.ids[3], [vector_id for vector_id, _ in results[0]])
+        self.assertEqual(len(results[0]), len(self.ids) - 1)
+
+    def test_append_replaces_existing_ids(self):
+        store = LocalVectorStore(self.root)
+        store.append(7, 'model', self.ids[:30], self.vectors[:30])
+        manifest = store.append(7, 'model', self.ids[20:], self.vectors[20:])
+        self.assertEqual(manifest["count"], 60)
+        self.assertEqual(manifest["tombstones"], 10)
+        ids, matrix = store.read_vectors(7, 'model')
+        self.assertEqual(sorted(ids), sorted(self.ids))
+        self.assertEqual(matrix.shape, (50, 16))
+
+    def test_delete_then_compact(self):
+        store = LocalVectorStore(self.root, dtype='int8')
+        store.append(7, 'model', self.ids, self.vectors)
+        self.assertEqual(store.delete(7, 'model', id_prefix="chatbot_7_source_abc_chunk_1"), 11) # 1 and 10-19
+        query = self.vectors[1] / np.linalg.norm(self.vectors[1])
+        results = store.load(7, 'model').search(query[None, :], k=5)
+        self.assertNotIn(self.ids[1], [vector_id for vector_id, _ in results[0]])
+
+        before, _ = store.read_vectors(7, 'model')
+        manifest = store.compact(7, 'model')
+        self.assertEqual((manifest["count"], manifest["tombstones"]), (39, 0))
+        after, _ = store.read_vectors(7, 'model')
+        self.assertEqual(after, before)
+
+    def test_missing_store_returns_none(self):
+        self.assertIsNone(LocalVectorStore(self.root).load(99, 'model'))
+
+
+class TestLocalVectorBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.vectors = np.random.default_rng(0).normal(size=(50, 16)).astype(np.float32)
+        self.ids = [f"chatbot_7_source_abc_chunk_{i}" for i in range(50)]
+        self.store = LocalVectorStore(self.root)
+        self.store.write(7, 'model', self.ids, self.vectors)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_brute_force_serves_queries_while_graph_builds_in_background(self):
+        backend = LocalVectorBackend(self.store, 'model', hnsw_min_chunks=10)
+        release_build = threading.Event()
+
+        def slow_build(chatbot_id, vector_set):
+            release_build.wait(2)
+            return object()
+
+        with mock.patch.object(vector_backends, 'hnswlib', object()), \
+                mock.patch.object(backend, '_load_or_build_graph', side_effect=slow_build) as build_graph, \
+                mock.patch.object(backend, '_search_graph', return_value=[[("from-graph", 0.0)]]):
+            for _ in range(2): # Neither query waits for the build, and only one build starts
+                results, failed = backend.find_neighbors([self.vectors[3].tolist()], 7, 3)
+                self.assertEqual((results[0][0][0], failed), (self.ids[3], 0))
+
+            release_build.set()
+            deadline = time.monotonic() + 2
+            while not backend._graphs and time.monotonic() < deadline:
+                time.sleep(0.01)
+            results, _ = backend.find_neighbors([self.vectors[3].tolist()], 7, 3)
+            self.assertEqual(results, [[("from-graph", 0.0)]])
+            self.assertEqual(build_graph.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
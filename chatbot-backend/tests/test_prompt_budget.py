@@ -0,0 +1,52 @@
+# chatbot-backend/tests/test_prompt_budget.py
+
+import unittest
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.prompt_budget import assemble_context, strip_overlap, parse_chunk_position
+
+
+class TestPromptBudget(unittest.TestCase):
+
+    def test_strip_overlap_removes_repeated_prefix(self):
+        previous = "The warranty covers parts and labour for two years from the date of purchase."
+        following = "from the date of purchase. Accidental damage is not covered."
+        remainder, removed = strip_overlap(previous, following)
+        self.assertEqual(remainder, "Accidental damage is not covered.")
+        self.assertEqual(removed, len("from the date of purchase. "))
+        self.assertEqual(strip_overlap("no shared text here", "something else entirely"), ("something else entirely", 0))
+
+    def test_parse_chunk_position(self):
+        self.assertEqual(parse_chunk_position("chatbot_7_source_abc_chunk_12"), ("abc", 12))
+        self.assertIsNone(parse_chunk_position("not_a_vector_id"))
+
+    def test_adjacent_chunks_are_merged_in_relevance_order(self):
+        texts = [
+            "Returns are accepted within 30 days. Items must be unused.",
+            "Shipping is free over $50.",
+            "Items must be unused. Refunds go to the original payment method.",
+        ]
+        ids = ["chatbot_1_source_a_chunk_4", "chatbot_1_source_b_chunk_0", "chatbot_1_source_a_chunk_5"]
+        sections, stats = assemble_context(texts, ids, max_tokens=1000)
+        self.assertEqual(len(sections), 2)
+        self.assertEqual(sections[0], "--- Context Section 1 ---\nReturns are accepted within 30 days. Items must be unused. Refunds go to the original payment method.")
+        self.assertTrue(sections[1].endswith("Shipping is free over $50."))
+        self.assertEqual(stats["chunks_included"], 3)
+        self.assertGreater(stats["overlap_chars_removed"], 0)
+
+    def test_budget_skips_sections_that_do_not_fit(self):
+        texts = ["x" * 400, "short answer"]
+        sections, stats = assemble_context(texts, None, max_tokens=50)
+        self.assertEqual(len(sections), 1)
+        self.assertTrue(sections[0].endswith("short answer"))
+        self.assertLessEqual(stats["context_tokens"], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# chatbot-backend/tests/test_rag_router.py
+
+import unittest
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.rag_router import (
+    query_signals, retrieval_signals, escalation_reasons_for_query, escalation_reasons_for_retrieval
+)
+
+
+class TestRagRouter(unittest.TestCase):
+
+    def test_simple_question_stays_standard(self):
+        signals = query_signals("What are your opening hours?")
+        self.assertEqual(escalation_reasons_for_query(signals), [])
+        self.assertEqual(escalation_reasons_for_query(query_signals("Do you sell black and white printers?")), [])
+
+    def test_multi_part_and_long_queries_escalate(self):
+        multi_part = query_signals("What are your opening hours and do you deliver to Haifa?")
+        self.assertIn('multi_part_query', escalation_reasons_for_query(multi_part))
+        long_query = query_signals(" ".join(["word"] * 30))
+        self.assertIn('long_query', escalation_reasons_for_query(long_query))
+
+    def test_follow_up_escalates_only_with_history(self):
+        history = [{"role": "user", "content": "Tell me about the premium plan"}]
+        self.assertIn('history_dependent', escalation_reasons_for_query(query_signals("How much is it?", history)))
+        self.assertEqual(escalation_reasons_for_query(query_signals("How much is it?")), [])
+
+    def test_self_contained_questions_with_history_stay_standard(self):
+        history = [{"role": "user", "content": "Tell me about the premium plan"}]
+        for question in ("Is there parking?", "Can I return one item?", "Do you have more sizes?",
+                         "What is this product's price?", "Is it possible to pay by card?", "Why is shipping delayed?"):
+            self.assertEqual(escalation_reasons_for_query(query_signals(question, history)), [], question)
+
+    def test_references_to_earlier_turns_escalate(self):
+        history = [{"role": "user", "content": "Which plans do you offer?"}]
+        for question in ("What about the second one?", "Is that available in blue?", "How much does that cost?", "Do they ship abroad?"):
+            self.assertIn('history_dependent', escalation_reasons_for_query(query_signals(question, history)), question)
+
+    def test_retrieval_signals(self):
+        confident = retrieval_signals([("a", 0.12), ("b", 0.31), ("c", 0.40)])
+        self.assertEqual(escalation_reasons_for_retrieval(confident), [])
+        weak = retrieval_signals([("a", 0.61), ("b", 0.65)])
+        self.assertEqual(escalation_reasons_for_retrieval(weak), ['weak_best_match'])
+        flat = retrieval_signals([("a", 0.380), ("b", 0.385), ("c", 0.390)])
+        self.assertEqual(escalation_reasons_for_retrieval(flat), ['flat_scores'])
+        self.assertEqual(escalation_reasons_for_retrieval(retrieval_signals([])), ['no_matches'])
+        self.assertEqual(escalation_reasons_for_retrieval(retrieval_signals(None)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
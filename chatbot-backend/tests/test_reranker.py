@@ -0,0 +1,70 @@
+# chatbot-backend/tests/test_reranker.py
+
+import unittest
+import os
+import sys
+import threading
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.reranker import MicroBatchReranker
+
+
+class _LengthScorer:
+    """Scores a pair by its passage length and records each predict call's size."""
+    backend = 'fake'
+    quantized = False
+
+    def __init__(self, delay: float = 0.05, fail: bool = False):
+        self.delay = delay
+        self.fail = fail
+        self.calls = []
+
+    def predict(self, pairs):
+        self.calls.append(len(pairs))
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("inference failed")
+        return [float(len(passage)) for _, passage in pairs]
+
+
+class TestMicroBatchReranker(unittest.TestCase):
+
+    def test_concurrent_requests_share_batches_and_get_their_own_scores(self):
+        scorer = _LengthScorer()
+        reranker = MicroBatchReranker(scorer, max_batch_pairs=100, max_wait_ms=50)
+        results = {}
+
+        def request(i):
+            results[i] = reranker.score([("q", "x" * i), ("q", "y" * (i + 10))])
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            self.assertEqual(results[i], [float(i), float(i + 10)])
+        self.assertEqual(sum(scorer.calls), 16)
+        self.assertLess(len(scorer.calls), 8)
+        self.assertEqual(reranker.get_stats()["requests"], 8)
+
+    def test_batch_size_is_capped(self):
+        scorer = _LengthScorer(delay=0.0)
+        reranker = MicroBatchReranker(scorer, max_batch_pairs=2, max_wait_ms=20)
+        self.assertEqual(reranker.score([("q", "abc")] * 3), [3.0, 3.0, 3.0])
+        self.assertEqual(reranker.score([]), [])
+
+    def test_errors_reach_every_caller(self):
+        reranker = MicroBatchReranker(_LengthScorer(fail=True), max_wait_ms=1)
+        with self.assertRaises(RuntimeError):
+            reranker.score([("q", "passage")])
+        self.assertEqual(reranker.get_stats()["errors"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# chatbot-backend/tests/test_single_flight.py
+
+import unittest
+import os
+import sys
+import threading
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.single_flight import SingleFlight, coalescing_key
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_run(self):
+        single_flight = SingleFlight()
+        calls = []
+        results = []
+
+        def pipeline():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"answer": "42"}
+
+        def worker():
+            results.append(single_flight.do("key", pipeline))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([shared for _, shared in results].count(False), 1)
+        self.assertTrue(all(result == {"answer": "42"} for result, _ in results))
+
+    def test_follower_runs_pipeline_itself_when_leader_hangs(self):
+        single_flight = SingleFlight(wait_seconds=0.1)
+        release_leader = threading.Event()
+        leader_started = threading.Event()
+
+        def stalled_pipeline():
+            leader_started.set()
+            release_leader.wait(5)
+            return "leader"
+
+        leader = threading.Thread(target=single_flight.do, args=("key", stalled_pipeline))
+        leader.start()
+        leader_started.wait(1)
+        start = time.monotonic()
+        self.assertEqual(single_flight.do("key", lambda: "follower"), ("follower", False))
+        self.assertLess(time.monotonic() - start, 2)
+        release_leader.set()
+        leader.join()
+
+    def test_sequential_callers_run_separately(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do("key", lambda: 1), (1, False))
+        self.assertEqual(single_flight.do("key", lambda: 2), (2, False))
+
+    def test_key_normalizes_query_and_includes_history(self):
+        key = coalescing_key(1, "fp", "What are your  hours?")
+        self.assertEqual(key, coalescing_key(1, "fp", "what are your hours?"))
+        self.assertNotEqual(key, coalescing_key(1, "fp", "what are your hours?", [{"role": "user", "content": "hi"}]))
+        self.assertNotEqual(key, coalescing_key(1, "other-index-version", "what are your hours?"))
+
+    def test_key_uses_session_fingerprint_instead_of_history(self):
+        key = coalescing_key(1, "fp", "what are your hours?")
+        self.assertEqual(key, coalescing_key(1, "fp", "what are your hours?", history_fingerprint="")) # Empty session
+        session_key = coalescing_key(1, "fp", "what are your hours?", history_fingerprint="s1:42:3")
+        self.assertNotEqual(key, session_key)
+        self.assertNotEqual(session_key, coalescing_key(1, "fp", "what are your hours?", history_fingerprint="s1:44:4"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# chatbot-backend/tests/test_stage_scheduler.py
+
+import unittest
+import os
+import sys
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from app.services.stage_scheduler import StageScheduler, StageFailedError
+
+
+class TestStageScheduler(unittest.TestCase):
+
+    def test_dependencies_receive_results(self):
+        scheduler = StageScheduler()
+        scheduler.add('a', lambda deps: 2)
+        scheduler.add('b', lambda deps: deps['a'] * 3, deps=('a',))
+        results = scheduler.run()
+        self.assertEqual(results, {'a': 2, 'b': 6})
+        self.assertEqual(set(scheduler.timings), {'a', 'b'})
+
+    def test_independent_stages_overlap(self):
+        scheduler = StageScheduler()
+        scheduler.add('slow_1', lambda deps: time.sleep(0.2))
+        scheduler.add('slow_2', lambda deps: time.sleep(0.2))
+        start = time.time()
+        scheduler.run()
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_failed_stage_skips_dependents(self):
+        def fail(_deps):
+            raise RuntimeError("boom")
+
+        scheduler = StageScheduler()
+        scheduler.add('a', fail)
+        scheduler.add('b', lambda deps: 'never', deps=('a',))
+        scheduler.add('c', lambda deps: 'ok')
+        results = scheduler.run()
+        self.assertEqual(results, {'c': 'ok'})
+        self.assertIsInstance(scheduler.errors['a'], RuntimeError)
+        self.assertIsInstance(scheduler.errors['b'], StageFailedError)
+
+    def test_unknown_dependency_rejected(self):
+        with self.assertRaises(ValueError):
+            StageScheduler().add('b', lambda deps: None, deps=('missing',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# chatbot-backend/tests/test_startup_imports.py
+
+import unittest
+import os
+import sys
+import json
+import subprocess
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from config import Config
+
+# Modules that must only load on first use (Google Cloud SDK clients, advanced RAG, document parsing)
+HEAVY_MODULES = ['vertexai', 'google.cloud.aiplatform', 'google.cloud.storage', 'google.genai',
+                 'google.cloud.discoveryengine_v1', 'google.cloud.texttospeech', 'google.cloud.speech',
+                 'torch', 'sentence_transformers', 'transformers', 'rank_bm25', 'pdfminer', 'docx', 'langchain_text_splitters']
+
+# Each snippet reproduces one entry point's import graph in a fresh interpreter
+WEB_STARTUP = "from app import create_app; create_app()"
+WORKER_STARTUP = "import celery_worker; celery_worker.celery_app.loader.import_default_modules()"
+
+
+def _measure(startup_code: str) -> dict:
+    script = (
+        "import json, sys, time\n"
+        "started = time.perf_counter()\n"
+        f"{startup_code}\n"
+        "elapsed = time.perf_counter() - started\n"
+        f"print(json.dumps({{'elapsed': elapsed, 'heavy': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    result = subprocess.run([sys.executable, '-c', script], cwd=project_root, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise AssertionError(f"Startup failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+class TestStartupImports(unittest.TestCase):
+
+    def _assert_startup(self, startup_code: str):
+        measured = _measure(startup_code)
+        self.assertEqual(measured['heavy'], [], f"Heavy modules imported at startup: {measured['heavy']}")
+        self.assertLess(measured['elapsed'], Config.STARTUP_IMPORT_BUDGET_SECONDS,
+                        f"Startup took {measured['elapsed']:.2f}s, budget is {Config.STARTUP_IMPORT_BUDGET_SECONDS:.1f}s")
+
+    def test_web_startup_is_within_budget(self):
+        self._assert_startup(WEB_STARTUP)
+
+    def test_worker_startup_is_within_budget(self):
+        self._assert_startup(WORKER_STARTUP)
+
+
+if __name__ == '__main__':
+    unittest.main()
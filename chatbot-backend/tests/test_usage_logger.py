@@ -0,0 +1,119 @@
+# chatbot-backend/tests/test_usage_logger.py
+
+import unittest
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(tests_dir, '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from flask import Flask
+
+from app import db
+from app.models import UsageLog, Subscription
+from app.services.usage_logger import UsageLogWriter, build_usage_record
+
+
+class TestUsageLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spill_dir = os.path.join(self.tmp_dir, 'spill')
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(self.tmp_dir, 'usage.db')}"
+        db.init_app(self.app)
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _writer(self, **kwargs):
+        return UsageLogWriter(self.app, spill_dir=self.spill_dir, **kwargs)
+
+    def _usage_rows(self) -> int:
+        with self.app.app_context():
+            try:
+                return UsageLog.query.count()
+            finally:
+                db.session.remove()
+
+    def test_flush_writes_in_batches_of_batch_size(self):
+        writer = self._writer(batch_size=2)
+        for _ in range(5):
+            writer.submit(build_usage_record(1, 1, 'query', {}))
+
+        with mock.patch.object(writer, '_write_batch', wraps=writer._write_batch) as write_batch:
+            writer.flush()
+
+        self.assertEqual([len(call.args[0]) for call in write_batch.call_args_list], [2, 2, 1])
+        self.assertEqual(self._usage_rows(), 5)
+
+    def test_flusher_writes_queued_records_within_the_interval(self):
+        writer = self._writer(flush_interval_seconds=0.05)
+        writer.start()
+        writer.submit(build_usage_record(1, 1, 'query', {}))
+
+        deadline = time.monotonic() + 2
+        while self._usage_rows() < 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self._usage_rows(), 1)
+        self.assertEqual(writer.get_stats()["queue_depth"], 0)
+
+    def test_failed_commit_spills_to_disk_and_replays(self):
+        writer = self._writer()
+        records = [build_usage_record(1, 1, 'query', {"n": n}) for n in range(3)]
+
+        with mock.patch('sqlalchemy.orm.Session.commit', side_effect=RuntimeError("database unavailable")):
+            writer.write_now(records)
+
+        spill_files = glob.glob(os.path.join(self.spill_dir, 'usage-*.jsonl'))
+        self.assertEqual(len(spill_files), 1)
+        with open(spill_files[0], encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 3)
+        self.assertEqual(self._usage_rows(), 0)
+
+        writer._replay_spills()
+
+        self.assertEqual(self._usage_rows(), 3)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_query_records_increment_subscription_counters_in_the_database(self):
+        with self.app.app_context():
+            db.session.add(Subscription(user_id=1, plan_id=1, current_period_queries=5, total_queries=None))
+            db.session.commit()
+            db.session.remove()
+        writer = self._writer()
+
+        writer.write_now([
+            build_usage_record(1, 1, 'query', {}, counts_as_query=True),
+            build_usage_record(1, 1, 'query', {}, counts_as_query=True),
+            build_usage_record(1, 1, 'index', {}), # Not a query
+        ])
+        with self.app.app_context():
+            # A concurrent increment from another process lands between the two batches
+            Subscription.query.filter_by(user_id=1).update({Subscription.current_period_queries: Subscription.current_period_queries + 10})
+            db.session.commit()
+            db.session.remove()
+        writer.write_now([build_usage_record(1, 1, 'query', {}, counts_as_query=True)])
+
+        with self.app.app_context():
+            subscription = Subscription.query.filter_by(user_id=1).one()
+            self.assertEqual(subscription.current_period_queries, 5 + 2 + 10 + 1)
+            self.assertEqual(subscription.total_queries, 3) # NULL counts as 0
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    unittest.main()